@@ -0,0 +1,57 @@
+from datetime import datetime
+import pytest
+
+from structured_log_alerting.columnarcollection import ColumnarCountersCollection
+from structured_log_alerting.metricscollection import CountersCollection
+from structured_log_alerting.parser import Parser
+from structured_log_alerting.synthetic import FIELDNAMES, SyntheticLogGenerator
+
+
+# small enough that the whole suite runs in well under a minute, big
+# enough that per-call overhead doesn't drown out per-line costs.
+BENCHMARK_DURATION_IN_SECONDS = 500
+
+
+@pytest.fixture(scope="session")
+def generator():
+    return SyntheticLogGenerator(requests_per_second=20, section_count=10)
+
+
+@pytest.fixture(scope="session")
+def log_lines(generator):
+    return list(generator.lines(BENCHMARK_DURATION_IN_SECONDS))
+
+
+@pytest.fixture(scope="session")
+def parsed_log_lines(log_lines):
+    parser = Parser(FIELDNAMES, lambda message: None)
+    return [parser.parse_log_line(line) for line in log_lines]
+
+
+@pytest.fixture(scope="session")
+def log_file(tmp_path_factory, generator):
+    path = tmp_path_factory.mktemp("logs") / "synthetic_log.csv"
+    with open(path, "w", newline="") as f:
+        generator.write_csv(f, BENCHMARK_DURATION_IN_SECONDS)
+    return path
+
+
+@pytest.fixture
+def populated_collection(parsed_log_lines):
+    counters_collection = CountersCollection()
+    for metric_name, parsed_log_line in parsed_log_lines:
+        counters_collection.add_or_update_series(metric_name, parsed_log_line)
+    return counters_collection
+
+
+@pytest.fixture
+def populated_columnar_collection(parsed_log_lines):
+    counters_collection = ColumnarCountersCollection()
+    for metric_name, parsed_log_line in parsed_log_lines:
+        counters_collection.add_or_update_series(metric_name, parsed_log_line)
+    return counters_collection
+
+
+@pytest.fixture
+def end_of_log(parsed_log_lines):
+    return max(parsed_log_line["date"] for _, parsed_log_line in parsed_log_lines)
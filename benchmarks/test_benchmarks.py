@@ -0,0 +1,197 @@
+from datetime import timedelta
+import sys
+import tracemalloc
+import pytest
+
+pytest.importorskip("pytest_benchmark")
+
+from structured_log_alerting.__main__ import main
+from structured_log_alerting.alertmanager import AlertManager
+from structured_log_alerting.columnarcollection import ColumnarCountersCollection
+from structured_log_alerting.metricscollection import CountersCollection
+from structured_log_alerting.parser import Parser
+from structured_log_alerting.query import QueryEngine
+from structured_log_alerting.querycache import QueryCache
+from structured_log_alerting.sortedordereddict import SortedOrderedDict
+from structured_log_alerting.synthetic import FIELDNAMES
+from structured_log_alerting.timeseries import CounterSeries
+
+
+def test_parser_throughput(benchmark, log_lines):
+    parser = Parser(FIELDNAMES, lambda message: None)
+
+    def parse_all():
+        for line in log_lines:
+            parser.parse_log_line(line)
+
+    benchmark(parse_all)
+    benchmark.extra_info["lines"] = len(log_lines)
+
+
+def test_sortedordereddict_out_of_order_inserts(benchmark, log_lines):
+    timestamps = [int(line["date"]) for line in log_lines]
+
+    def insert_all():
+        data_points = SortedOrderedDict(100)
+        for timestamp in timestamps:
+            data_points[timestamp] = 1
+
+    benchmark(insert_all)
+
+
+def test_counter_series_add_data_point(benchmark, parsed_log_lines):
+    timestamps = [parsed_log_line["date"] for _, parsed_log_line in parsed_log_lines]
+
+    def add_all():
+        series = CounterSeries("api.200", {}, 100)
+        for timestamp in timestamps:
+            series.add_data_point(timestamp)
+
+    benchmark(add_all)
+
+
+def test_counters_collection_total_count_since(
+    benchmark, populated_collection, end_of_log
+):
+    benchmark(populated_collection.total_count_since, end_of_log, 120)
+
+
+def test_columnar_collection_total_count_since(
+    benchmark, populated_columnar_collection, end_of_log
+):
+    benchmark(populated_columnar_collection.total_count_since, end_of_log, 120)
+
+
+def test_columnar_collection_provide_summary_for_interval(
+    benchmark, populated_columnar_collection, end_of_log
+):
+    alertmanager = AlertManager(populated_columnar_collection, ["404", "500"])
+    benchmark(alertmanager.provide_summary_for_interval, end_of_log)
+
+
+def test_alertmanager_provide_summary_for_interval(
+    benchmark, populated_collection, end_of_log
+):
+    alertmanager = AlertManager(populated_collection, ["404", "500"])
+    benchmark(alertmanager.provide_summary_for_interval, end_of_log)
+
+
+def test_query_cache_sliding_window(benchmark, populated_collection, end_of_log):
+    # what replay does at every boundary: slide a 120s window along by
+    # one 10s block, so all but one block should come from the cache.
+    cache = QueryCache(populated_collection)
+    ends = [end_of_log - timedelta(seconds=10 * i) for i in range(12)][::-1]
+
+    def slide():
+        for end in ends:
+            cache.total_count_since(end, 120)
+
+    benchmark(slide)
+    benchmark.extra_info["hits"] = cache.hits
+    benchmark.extra_info["misses"] = cache.misses
+
+
+@pytest.mark.parametrize("columnar", [False, True], ids=["series", "columnar"])
+def test_query_engine_grouped_sum(
+    benchmark, populated_collection, populated_columnar_collection, end_of_log, columnar
+):
+    engine = QueryEngine(
+        populated_columnar_collection if columnar else populated_collection
+    )
+    benchmark(engine.query, 'sum by (section) ({status!="200"}[120s])', end_of_log)
+
+
+@pytest.mark.parametrize("mode", [[], ["--replay"]], ids=["stream", "replay"])
+def test_main_end_to_end(benchmark, monkeypatch, capsys, tmp_path, log_file, mode):
+    output_file = tmp_path / "output.jsonl"
+    monkeypatch.setattr(
+        sys, "argv", ["main", str(log_file), "--output-file", str(output_file)] + mode
+    )
+
+    benchmark.pedantic(main, rounds=3)
+    capsys.readouterr()
+
+
+def test_counters_collection_memory(benchmark, parsed_log_lines):
+    # pytest-benchmark only compares timings, so the memory numbers ride
+    # along in extra_info where they end up in the saved JSON.
+    def build_collection():
+        counters_collection = CountersCollection()
+        for metric_name, parsed_log_line in parsed_log_lines:
+            counters_collection.add_or_update_series(metric_name, parsed_log_line)
+        return counters_collection
+
+    tracemalloc.start()
+    counters_collection = build_collection()
+    current_bytes, peak_bytes = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    benchmark.pedantic(build_collection, rounds=3)
+    benchmark.extra_info["series"] = len(counters_collection.series)
+    benchmark.extra_info["bytes"] = current_bytes
+    benchmark.extra_info["peak_bytes"] = peak_bytes
+    benchmark.extra_info["bytes_per_series"] = current_bytes / len(
+        counters_collection.series
+    )
+
+
+def measure_bytes(build):
+    tracemalloc.start()
+    built = build()
+    current_bytes, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del built
+
+    return current_bytes
+
+
+def test_counter_series_memory_against_sorted_ordered_dict(benchmark, end_of_log):
+    # full series (max_series_length points each) laid out the way
+    # CounterSeries used to be: an instance __dict__, a labels dict, and
+    # a SortedOrderedDict of datetime -> int.
+    series_count = 2000
+    timestamps = [end_of_log - timedelta(seconds=i) for i in range(100)][::-1]
+    labels = {
+        "remotehost": "10.0.0.1",
+        "section": "api",
+        "endpoint": "/api/user",
+        "http_verb": "GET",
+        "status": "200",
+    }
+
+    class DictBackedSeries:
+        def __init__(self, name):
+            self.name = name
+            self.labels = dict(labels)
+            self.data_points = SortedOrderedDict(100)
+
+    def build_dict_backed():
+        all_series = []
+        for i in range(series_count):
+            series = DictBackedSeries(f"api.{i}")
+            for timestamp in timestamps:
+                series.data_points[timestamp + timedelta(0)] = i + 1000
+            all_series.append(series)
+        return all_series
+
+    def build_compact():
+        counters_collection = CountersCollection()
+        parsed_log_line = dict(labels)
+        for i in range(series_count):
+            for timestamp in timestamps:
+                parsed_log_line["date"] = timestamp
+                counters_collection.add_or_update_series(
+                    f"api.{i}", parsed_log_line, i + 1000
+                )
+        return counters_collection
+
+    dict_backed_bytes = measure_bytes(build_dict_backed)
+    compact_bytes = measure_bytes(build_compact)
+
+    benchmark.pedantic(build_compact, rounds=3)
+    benchmark.extra_info["dict_backed_bytes_per_series"] = (
+        dict_backed_bytes / series_count
+    )
+    benchmark.extra_info["compact_bytes_per_series"] = compact_bytes / series_count
+
+    assert dict_backed_bytes / compact_bytes >= 10
@@ -1,20 +1,721 @@
 import argparse
 import csv
+import os
+import socket
+import sys
+import time
+from contextlib import contextmanager
 from datetime import datetime, timedelta
+from typing import Iterable, Iterator
 
 from structured_log_alerting.alertmanager import AlertManager
+from structured_log_alerting.anomaly import ANOMALY_METHODS, AnomalyDetector
+from structured_log_alerting.columnarcollection import ColumnarCountersCollection
+from structured_log_alerting.federation import (
+    DeltaReceiver,
+    DeltaShipper,
+    parse_delta_address,
+)
+from structured_log_alerting.governor import MemoryGovernor
+from structured_log_alerting.heavyhitters import HeavyHitterDetector
+from structured_log_alerting.httpserver import MetricsServer
 from structured_log_alerting.metricscollection import CountersCollection
+from structured_log_alerting.notify import GROUP_BY, Notifier, WebhookClient
+from structured_log_alerting.output import (
+    BatchedFileSink,
+    JSONLinesSink,
+    OutputSink,
+    RateLimitedLogger,
+    TextSink,
+)
 from structured_log_alerting.parser import Parser
+from structured_log_alerting.paths import PathNormalizer
+from structured_log_alerting.pipeline import OVERFLOW_POLICIES, IngestPipeline
+from structured_log_alerting.profiling import StageProfiler
+from structured_log_alerting.querycache import QueryCache
+from structured_log_alerting.receiver import LogReceiver
+from structured_log_alerting.replay import Replayer
+from structured_log_alerting.selfmetrics import SelfMetrics
+from structured_log_alerting.sharding import LINES, ShardedIngest
+from structured_log_alerting.sources import (
+    MergedLogReader,
+    expand_locations,
+    open_logs,
+)
+from structured_log_alerting.statefile import StateWriter, load_state
+from structured_log_alerting.synthetic import FIELDNAMES
+from structured_log_alerting.windows import TumblingWindows
 
 
 def main():
     # argparse stuff
     parser = argparse.ArgumentParser()
     parser.add_argument(
-        "file_location", help="the location of the csv-formatted log file", type=str
+        "file_location",
+        help="the csv-formatted log file(s) to read: files, directories or globs, merged by timestamp",
+        type=str,
+        nargs="*",
+    )
+    parser.add_argument(
+        "--listen",
+        help="receive log lines over the network instead of reading files: udp://host:port, tcp://host:port or unix:///path (repeatable)",
+        action="append",
+    )
+    parser.add_argument(
+        "--shards",
+        help="with --listen, receive, parse and count lines in this many processes, each with the same ports and its own shared memory matrix",
+        type=int,
+    )
+    parser.add_argument(
+        "--shard-capacity",
+        help="with --shards, how many series each shard has room for",
+        type=int,
+        default=10000,
+    )
+    parser.add_argument(
+        "--central",
+        help="run as a central node: merge and alert on the deltas edges ship to this address, tcp://host:port or unix:///path",
+        type=str,
+    )
+    parser.add_argument(
+        "--edge-to",
+        help="run as an edge: count log lines into per-second deltas and ship them to the central node at this address instead of alerting",
+        type=str,
+    )
+    parser.add_argument(
+        "--edge-id",
+        help="with --edge-to, what this edge is called (defaults to the hostname)",
+        type=str,
+        default=socket.gethostname(),
+    )
+    parser.add_argument(
+        "--ship-interval",
+        help="with --edge-to, how many wall-clock seconds between deltas",
+        type=float,
+        default=1.0,
+    )
+    parser.add_argument(
+        "--tumbling-summaries",
+        help="count summaries up as lines arrive, writing one as each aligned 10 second window closes",
+        action="store_true",
+    )
+    parser.add_argument(
+        "--replay",
+        help="ingest the whole file as fast as possible, only evaluating alerts at window boundaries",
+        action="store_true",
+    )
+    parser.add_argument(
+        "--decompress-in-thread",
+        help="decompress compressed logs on a worker thread, overlapping with parsing",
+        action="store_true",
+    )
+    parser.add_argument(
+        "--output-format",
+        help="how to format summaries and alerts (defaults to text, or jsonl when replaying)",
+        choices=["text", "jsonl"],
+    )
+    parser.add_argument(
+        "--output-file",
+        help="append JSON lines to this file in batches instead of writing to stdout",
+        type=str,
+    )
+    parser.add_argument(
+        "--output-buffer-size",
+        help="how many output lines to buffer before writing (defaults to 1, or 1000 when replaying)",
+        type=int,
+    )
+    parser.add_argument(
+        "--flush-interval",
+        help="the most wall-clock seconds buffered output may wait before being written",
+        type=float,
+    )
+    parser.add_argument(
+        "--evaluation-interval",
+        help="the window size in seconds to evaluate alerts on when replaying",
+        type=int,
+        default=10,
+    )
+    parser.add_argument(
+        "--collection",
+        help="how to store series: one object per series, or a single columnar matrix",
+        choices=["series", "columnar"],
+        default="series",
+    )
+    parser.add_argument(
+        "--retention",
+        help="with --collection columnar, how many seconds of data to keep",
+        type=int,
+        default=300,
+    )
+    parser.add_argument(
+        "--memory-budget",
+        help="keep the collection under about this many megabytes, downsampling, then shortening, then evicting the quietest series",
+        type=float,
+    )
+    parser.add_argument(
+        "--state-file",
+        help="warm start from this state file if it exists, and keep it up to date while running",
+        type=str,
+    )
+    parser.add_argument(
+        "--state-interval",
+        help="with --state-file, how many wall-clock seconds between writes",
+        type=float,
+        default=60.0,
+    )
+    parser.add_argument(
+        "--query-cache-size",
+        help="cache up to this many query results between alert evaluations (0 turns the cache off)",
+        type=int,
+        default=0,
+    )
+    parser.add_argument(
+        "--anomaly-detection",
+        help="also alert on traffic that's unusual for its section, against a moving baseline (ewma) or one that learns a seasonal pattern (holt-winters)",
+        choices=ANOMALY_METHODS,
+    )
+    parser.add_argument(
+        "--anomaly-by",
+        help="with --anomaly-detection, the label to keep a baseline per value of",
+        type=str,
+        default="section",
+    )
+    parser.add_argument(
+        "--anomaly-bucket",
+        help="with --anomaly-detection, how many seconds of requests to count at a time",
+        type=int,
+        default=10,
+    )
+    parser.add_argument(
+        "--anomaly-threshold",
+        help="with --anomaly-detection, how many standard deviations from the baseline is anomalous",
+        type=float,
+        default=4.0,
+    )
+    parser.add_argument(
+        "--anomaly-season",
+        help="with --anomaly-detection holt-winters, how many buckets make up a season",
+        type=int,
+        default=360,
+    )
+    parser.add_argument(
+        "--rate-limit",
+        help="also alert on any single remotehost sending more than this many requests per second, in fixed memory",
+        type=float,
+    )
+    parser.add_argument(
+        "--rate-limit-by",
+        help="with --rate-limit, the label to limit each value of",
+        type=str,
+        default="remotehost",
+    )
+    parser.add_argument(
+        "--rate-limit-window",
+        help="with --rate-limit, roughly how many seconds to average each rate over",
+        type=float,
+        default=60.0,
+    )
+    parser.add_argument(
+        "--rate-limit-candidates",
+        help="with --rate-limit, how many of the busiest values to keep track of",
+        type=int,
+        default=1000,
+    )
+    parser.add_argument(
+        "--webhook",
+        help="also POST alert transitions as JSON to this URL, grouped and in batches",
+        type=str,
+    )
+    parser.add_argument(
+        "--notify-group-by",
+        help="with --webhook, send alerts of the same kind (ex: every anomaly.*) or name together",
+        choices=list(GROUP_BY),
+        default="kind",
+    )
+    parser.add_argument(
+        "--notify-group-interval",
+        help="with --webhook, how many wall-clock seconds to collect alerts before sending them",
+        type=float,
+        default=1.0,
+    )
+    parser.add_argument(
+        "--notify-repeat-interval",
+        help="with --webhook, how many seconds of log time to hold back an alert repeating its last state",
+        type=float,
+        default=3600.0,
+    )
+    parser.add_argument(
+        "--http-port",
+        help="serve /metrics (Prometheus format) and /query over HTTP on this port, and keep serving after the log ends",
+        type=int,
+    )
+    parser.add_argument(
+        "--http-host",
+        help="the address to serve --http-port on",
+        type=str,
+        default="127.0.0.1",
+    )
+    parser.add_argument(
+        "--subpaths",
+        help="keep request subpaths in metric names (ex: api.user.ID.200), with ids, UUIDs and hashes replaced by placeholders",
+        action="store_true",
+    )
+    parser.add_argument(
+        "--route",
+        help="a route template to normalize subpaths with, ex: /api/user/{name} (repeatable, implies --subpaths)",
+        action="append",
+    )
+    parser.add_argument(
+        "--request-cache-size",
+        help="remember how this many distinct request fields parse, least recently used first out (0 turns the cache off)",
+        type=int,
+        default=4096,
+    )
+    parser.add_argument(
+        "--pipeline",
+        help="read, parse and aggregate on separate stages connected by bounded queues",
+        action="store_true",
+    )
+    parser.add_argument(
+        "--queue-size",
+        help="with --pipeline, how many lines each queue between stages holds",
+        type=int,
+        default=100000,
+    )
+    parser.add_argument(
+        "--overflow-policy",
+        help="with --pipeline, what a full queue does: wait, drop the oldest lines, or sample 1 in --sample-rate lines (counting each kept line that many times)",
+        choices=OVERFLOW_POLICIES,
+        default="block",
+    )
+    parser.add_argument(
+        "--sample-rate",
+        help="with --overflow-policy sample, keep 1 in this many lines",
+        type=int,
+        default=10,
+    )
+    parser.add_argument(
+        "--stats",
+        help="record the tool's own throughput, failures and latencies and dump them to stderr",
+        action="store_true",
+    )
+    parser.add_argument(
+        "--stats-interval",
+        help="how often (in wall-clock seconds) to dump stats when --stats is on",
+        type=float,
+        default=10.0,
+    )
+    parser.add_argument(
+        "--profile",
+        help="time each pipeline stage and print a per-stage breakdown to stderr at exit",
+        action="store_true",
+    )
+    parser.add_argument(
+        "--profile-output",
+        help="with --profile, also run under cProfile and write pstats to this file",
+        type=str,
+    )
+    parser.add_argument(
+        "--tracemalloc-output",
+        help="with --profile, also trace allocations and write a tracemalloc snapshot to this file",
+        type=str,
     )
     args = parser.parse_args()
+    try:
+        build_path_normalizer(args)
+        build_anomaly_detector(args)
+        build_heavy_hitter_detector(args, None)
+        if args.webhook is not None:
+            WebhookClient(args.webhook)
+        for address in [args.central, args.edge_to]:
+            if address is not None:
+                parse_delta_address(address)
+    except ValueError as e:
+        parser.error(str(e))
+    if args.memory_budget is not None:
+        if args.collection == "columnar" or args.shards is not None or args.edge_to:
+            parser.error(
+                "--memory-budget is for --collection series, not columnar, --shards or --edge-to"
+            )
+        try:
+            build_memory_governor(args, None)
+        except ValueError as e:
+            parser.error(str(e))
+    if args.output_file and args.output_format == "text":
+        parser.error("--output-file writes JSON lines, not --output-format text")
+    if args.rate_limit is not None and (args.edge_to or args.shards is not None):
+        parser.error("--rate-limit can't be used with --edge-to or --shards")
+    if args.tumbling_summaries and (
+        args.replay or args.edge_to or args.shards is not None
+    ):
+        parser.error(
+            "--tumbling-summaries can't be used with --replay, --edge-to or --shards, which don't write summaries here"
+        )
+    if args.replay and args.pipeline:
+        parser.error(
+            "--replay evaluates as the log's clock crosses each boundary, it can't use --pipeline"
+        )
+    if args.edge_to and (args.central or args.replay):
+        parser.error("--edge-to ships deltas, it can't also --replay or be --central")
+    if args.central:
+        if args.file_location or args.listen:
+            parser.error("a --central node reads deltas, not log files or --listen")
+        if args.replay:
+            parser.error("--replay needs log files, it can't replay --central")
+    elif args.listen:
+        if args.file_location:
+            parser.error("read either log files or --listen, not both")
+        if args.replay:
+            parser.error("--replay needs log files, it can't replay --listen")
+        if args.shards is not None:
+            if args.edge_to:
+                parser.error(
+                    "--shards alerts on what it receives, it can't be an --edge-to"
+                )
+            if args.state_file or args.query_cache_size or args.pipeline:
+                parser.error(
+                    "--shards can't be used with --state-file, --query-cache-size or --pipeline"
+                )
+            try:
+                ShardedIngest(args.listen, args.shards, args.shard_capacity)
+            except ValueError as e:
+                parser.error(str(e))
+    else:
+        if args.shards is not None:
+            parser.error("--shards is for --listen")
+        if not args.file_location:
+            parser.error("the following arguments are required: file_location")
+        try:
+            args.file_location = expand_locations(args.file_location)
+        except ValueError as e:
+            parser.error(str(e))
+    if args.anomaly_detection is not None:
+        labels = series_key_labels(args)
+        if args.anomaly_by not in labels:
+            parser.error(
+                f"--anomaly-by has to be a label series are kept separate by here: {', '.join(labels)}"
+            )
+
+    log = RateLimitedLogger()
+    self_metrics = (
+        SelfMetrics(CountersCollection(), args.stats_interval) if args.stats else None
+    )
+    sink = build_sink(args, build_notifier(args, self_metrics))
+    profiler = StageProfiler() if args.profile else None
+
+    try:
+        if profiler is None:
+            run(args, sink, log, self_metrics, profiler)
+        else:
+            with profiler.profile(args.profile_output, args.tracemalloc_output):
+                run(args, sink, log, self_metrics, profiler)
+    finally:
+        sink.close()
+        log.flush()
+
+    if profiler is not None:
+        profiler.write_breakdown()
 
+
+def run(
+    args: argparse.Namespace,
+    sink: OutputSink,
+    log: RateLimitedLogger,
+    self_metrics: SelfMetrics | None,
+    profiler: StageProfiler | None,
+) -> None:
+    if args.replay:
+        replay(args, sink, log, self_metrics, profiler)
+    elif args.edge_to:
+        edge(args, log, self_metrics, profiler)
+    elif args.shards is not None:
+        sharded(args, sink, self_metrics)
+    else:
+        stream(args, sink, log, self_metrics, profiler)
+
+
+def build_notifier(
+    args: argparse.Namespace, self_metrics: SelfMetrics | None
+) -> Notifier | None:
+    if args.webhook is None:
+        return None
+
+    return Notifier(
+        WebhookClient(args.webhook),
+        group_by=args.notify_group_by,
+        group_interval=args.notify_group_interval,
+        repeat_interval=args.notify_repeat_interval,
+        self_metrics=self_metrics,
+    )
+
+
+def build_sink(args: argparse.Namespace, notifier: Notifier | None) -> OutputSink:
+    if args.output_file:
+        return BatchedFileSink(
+            args.output_file,
+            args.output_buffer_size or 1000,
+            args.flush_interval if args.flush_interval is not None else 5.0,
+            notifier,
+        )
+
+    output_format = args.output_format or ("jsonl" if args.replay else "text")
+    buffer_size = args.output_buffer_size or (1000 if args.replay else 1)
+    sink_class = JSONLinesSink if output_format == "jsonl" else TextSink
+
+    return sink_class(sys.stdout, buffer_size, args.flush_interval, notifier)
+
+
+def build_collection(
+    args: argparse.Namespace, self_metrics: SelfMetrics | None
+) -> CountersCollection:
+    if args.state_file is not None and os.path.exists(args.state_file):
+        started = time.perf_counter()
+        try:
+            collection = load_state(args.state_file, self_metrics)
+        except ValueError as e:
+            sys.exit(f"Couldn't warm start from {args.state_file}: {e}")
+        print(
+            f"Warm started from {args.state_file}: {len(collection.series)} series "
+            f"in {(time.perf_counter() - started) * 1000:.1f}ms",
+            file=sys.stderr,
+        )
+        return collection
+
+    if args.collection == "columnar":
+        return ColumnarCountersCollection(
+            self_metrics=self_metrics, retention_in_seconds=args.retention
+        )
+
+    return CountersCollection(self_metrics=self_metrics)
+
+
+def build_state_writer(
+    args: argparse.Namespace, self_metrics: SelfMetrics | None
+) -> StateWriter | None:
+    if args.state_file is None:
+        return None
+
+    return StateWriter(args.state_file, args.state_interval, self_metrics)
+
+
+def build_memory_governor(
+    args: argparse.Namespace,
+    self_metrics: SelfMetrics | None,
+    collection: CountersCollection | None = None,
+) -> MemoryGovernor | None:
+    if args.memory_budget is None:
+        return None
+    if isinstance(collection, ColumnarCountersCollection):
+        # ex: warm started from a columnar state file
+        sys.exit("--memory-budget can't shrink a columnar collection")
+
+    return MemoryGovernor(
+        int(args.memory_budget * 1024 * 1024), self_metrics=self_metrics
+    )
+
+
+def build_path_normalizer(args: argparse.Namespace) -> PathNormalizer | None:
+    if not args.subpaths and not args.route:
+        return None
+
+    return PathNormalizer(args.route)
+
+
+def series_key_labels(args: argparse.Namespace) -> list[str]:
+    # the labels that are part of metric names (see Parser), so every
+    # line in a series has the same value for them. a series' other
+    # labels (ex: remotehost) are just whatever its first line had.
+    labels = ["section", "status"]
+    if args.subpaths or args.route:
+        labels.append("route")
+    # only a MergedLogReader labels lines with their host; --listen and
+    # --central lines never have one.
+    if not (args.listen or args.central) and len(args.file_location) > 1:
+        labels.append("host")
+
+    return labels
+
+
+def build_anomaly_detector(args: argparse.Namespace) -> AnomalyDetector | None:
+    if args.anomaly_detection is None:
+        return None
+
+    return AnomalyDetector(
+        label=args.anomaly_by,
+        method=args.anomaly_detection,
+        bucket_in_seconds=args.anomaly_bucket,
+        z_threshold=args.anomaly_threshold,
+        season_length=args.anomaly_season,
+    )
+
+
+def build_heavy_hitter_detector(
+    args: argparse.Namespace, self_metrics: SelfMetrics | None
+) -> HeavyHitterDetector | None:
+    if args.rate_limit is None:
+        return None
+
+    return HeavyHitterDetector(
+        args.rate_limit,
+        label=args.rate_limit_by,
+        window_in_seconds=args.rate_limit_window,
+        max_candidates=args.rate_limit_candidates,
+        self_metrics=self_metrics,
+    )
+
+
+def build_query_cache(
+    args: argparse.Namespace,
+    counters_collection: CountersCollection,
+    self_metrics: SelfMetrics | None,
+) -> QueryCache | None:
+    if not args.query_cache_size:
+        return None
+
+    return QueryCache(
+        counters_collection, args.query_cache_size, self_metrics=self_metrics
+    )
+
+
+def build_metrics_server(
+    args: argparse.Namespace,
+    counters_collection: CountersCollection,
+    self_metrics: SelfMetrics | None,
+) -> MetricsServer | None:
+    if args.http_port is None:
+        return None
+
+    metrics_server = MetricsServer(
+        counters_collection, args.http_host, args.http_port, self_metrics=self_metrics
+    )
+    print(f"Serving metrics on {metrics_server.url}", file=sys.stderr)
+
+    return metrics_server.start()
+
+
+def serve_until_interrupted(metrics_server: MetricsServer | None) -> None:
+    if metrics_server is None:
+        return
+
+    print(
+        f"Finished reading the log, still serving on {metrics_server.url} (Ctrl-C to stop)",
+        file=sys.stderr,
+    )
+    try:
+        if metrics_server.thread is not None:
+            metrics_server.thread.join()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        metrics_server.stop()
+
+
+@contextmanager
+def open_input(
+    args: argparse.Namespace, self_metrics: SelfMetrics | None
+) -> Iterator["csv.DictReader | MergedLogReader | LogReceiver | DeltaReceiver"]:
+    if args.central:
+        with DeltaReceiver(args.central, self_metrics=self_metrics) as central:
+            print(f"Receiving deltas on {central.bound_address}", file=sys.stderr)
+            try:
+                yield central
+            except KeyboardInterrupt:
+                pass
+            finally:
+                print(
+                    f"Merged {central.received_deltas} deltas "
+                    f"({central.received_points} points, "
+                    f"{central.duplicate_deltas} duplicates)",
+                    file=sys.stderr,
+                )
+        return
+
+    if not args.listen:
+        with open_logs(
+            args.file_location, decompress_in_thread=args.decompress_in_thread
+        ) as reader:
+            yield reader
+        return
+
+    with LogReceiver(args.listen, self_metrics=self_metrics) as receiver:
+        addresses = ", ".join(map(str, receiver.bound_addresses))
+        print(f"Listening for log lines on {addresses}", file=sys.stderr)
+        try:
+            yield receiver
+        except KeyboardInterrupt:
+            # there's no end of the log to wait for, so Ctrl-C is how
+            # receiving ends and the usual wrap-up happens.
+            pass
+        finally:
+            print(
+                f"Received {receiver.received_lines} lines "
+                f"({receiver.dropped_lines} dropped)",
+                file=sys.stderr,
+            )
+
+
+def parse_lines(
+    lines: Iterable[dict[str, str]],
+    parser: Parser,
+    log: RateLimitedLogger,
+    reader: "csv.DictReader | MergedLogReader | LogReceiver",
+) -> Iterator[tuple[str, dict, int]]:
+    # the same (metric name, parsed line, count) an IngestPipeline
+    # hands out, without the stages.
+    for line in lines:
+        try:
+            metric_name, parsed_log_line = parser.parse_log_line(line)
+        except ValueError:
+            log(f"Problem log line at {reader.line_num}")
+            continue
+        yield metric_name, parsed_log_line, 1
+
+
+def evaluate(
+    alertmanager: AlertManager,
+    sink: OutputSink,
+    current_time: datetime,
+    start_of_current_ten_second_interval: datetime | None,
+    summaries: bool = True,
+) -> datetime:
+    # what happens every time "the present" moves forward: evaluate
+    # alerts, and write a summary if one's due (unless summaries are
+    # written as their windows close instead). returns when the current
+    # ten second interval started.
+    alert = alertmanager.evaluate_elevated_requests(current_time)
+    if alert is not None:
+        sink.write_alert(alert)
+    for alert in alertmanager.evaluate_anomalies(current_time):
+        sink.write_alert(alert)
+    for alert in alertmanager.evaluate_heavy_hitters(current_time):
+        sink.write_alert(alert)
+
+    # all of this timekeeping is clumsy but also feels good
+    # enough. i think my next step would be something like a
+    # pointer or two stored on disk if/when we started treating
+    # this like a proper tsdb that stored other things on disk.
+    # a persistent pointer also starts to feel like yet another
+    # place where we actually have a producer/consumer model
+    # like a queue.
+    if start_of_current_ten_second_interval is None or not summaries:
+        return current_time
+
+    if start_of_current_ten_second_interval + timedelta(seconds=10) <= current_time:
+        # if it's been 10+ seconds since our last summary:
+        summary = alertmanager.provide_summary_for_interval(current_time)
+        sink.write_summary(current_time, summary)
+        return current_time
+
+    return start_of_current_ten_second_interval
+
+
+def stream(
+    args: argparse.Namespace,
+    sink: OutputSink,
+    log: RateLimitedLogger,
+    self_metrics: SelfMetrics | None,
+    profiler: StageProfiler | None,
+) -> None:
     # ideally i'd like to separate the io out of main for a bunch of
     # reasons (readable code, testability) but only opening the file
     # once gets me the perks of an iterable (specifically, the combo
@@ -22,57 +723,331 @@ def main():
     # and i'm not sure how to get that without basically reimplementing
     # this as a class that manually reinvents all of that or using something
     # more formal like asyncio to handle file opening closing.
-    with open(args.file_location) as f:
-        reader = csv.DictReader(f)
-
-        counters_collection = CountersCollection()
-        parser = Parser(reader.fieldnames)
+    with open_input(args, self_metrics) as reader:
+        counters_collection = build_collection(args, self_metrics)
+        parser = Parser(
+            FIELDNAMES if args.central else reader.fieldnames,
+            log,
+            self_metrics,
+            path_normalizer=build_path_normalizer(args),
+            request_cache_size=args.request_cache_size,
+        )
         interesting_counters = ["404", "500"]
-        alertmanager = AlertManager(counters_collection, interesting_counters)
+        alertmanager = AlertManager(
+            counters_collection,
+            interesting_counters,
+            self_metrics=self_metrics,
+            query_cache=build_query_cache(args, counters_collection, self_metrics),
+            anomaly_detector=build_anomaly_detector(args),
+            heavy_hitter_detector=build_heavy_hitter_detector(args, self_metrics),
+        )
+        heavy_hitter_detector = alertmanager.heavy_hitter_detector
+        metrics_server = build_metrics_server(args, counters_collection, self_metrics)
+        state_writer = build_state_writer(args, self_metrics)
+        memory_governor = build_memory_governor(args, self_metrics, counters_collection)
+        summary_windows = (
+            TumblingWindows(interesting_counters, self_metrics=self_metrics)
+            if args.tumbling_summaries
+            else None
+        )
         current_time = datetime.min
-        start_of_current_ten_second_interval = 0
-        ten_seconds_in_timedelta = timedelta(seconds=10)
+        start_of_current_ten_second_interval: datetime | None = None
 
-        for line in reader:
-            try:
-                metric_name, parsed_log_line = parser.parse_log_line(line)
-                counters_collection.add_or_update_series(metric_name, parsed_log_line)
-                log_timestamp = parser.parse_timestamp(line)
-
-                if log_timestamp > current_time:
-                    # our only (and therefore best) proxy of "the present" is
-                    # just whatever latest timestamp we've ever seen. if we
-                    # do see a later timestamp, we can assume "the present"
-                    # has moved forward. but that's the best info we've got.
-                    current_time = log_timestamp
-                    alert_message = alertmanager.check_for_elevated_requests(
-                        current_time
+        lines: Iterable[dict[str, str]] = reader
+        if profiler is not None:
+            profiler.instrument_pipeline(
+                parser, counters_collection, alertmanager, sink
+            )
+            lines = profiler.time_iterator("csv_decode", reader)
+
+        pipeline: IngestPipeline | None = None
+        parsed_lines: Iterable[tuple[str, dict, int]]
+        if args.central:
+            # edges have done the parsing already
+            parsed_lines = reader
+        elif args.pipeline:
+            pipeline = IngestPipeline(
+                lines,
+                parser,
+                args.queue_size,
+                args.overflow_policy,
+                args.sample_rate,
+                self_metrics=self_metrics,
+            )
+            parsed_lines = pipeline
+        else:
+            parsed_lines = parse_lines(lines, parser, log, reader)
+
+        try:
+            for metric_name, parsed_log_line, count in parsed_lines:
+                try:
+                    counters_collection.add_or_update_series(
+                        metric_name, parsed_log_line, count
                     )
-                    if len(alert_message) > 0:
-                        print(alert_message)
-
-                    # all of this timekeeping is clumsy but also feels good
-                    # enough. i think my next step would be something like a
-                    # pointer or two stored on disk if/when we started treating
-                    # this like a proper tsdb that stored other things on disk.
-                    # a persistent pointer also starts to feel like yet another
-                    # place where we actually have a producer/consumer model
-                    # like a queue.
-                    if start_of_current_ten_second_interval == 0:
-                        start_of_current_ten_second_interval = current_time
-
-                    if (
-                        start_of_current_ten_second_interval + ten_seconds_in_timedelta
-                        <= current_time
-                    ):
-                        # if it's been 10+ seconds since our last summary:
-                        summary = alertmanager.provide_summary_for_interval(current_time)
-                        for line in summary:
-                            print(line)
-                        start_of_current_ten_second_interval = current_time
+                    if heavy_hitter_detector is not None:
+                        heavy_hitter_detector.add(parsed_log_line, count)
+                    log_timestamp = parsed_log_line["date"]
 
-            except ValueError as e:
-                print(f"Problem log line at {reader.line_num}")
+                    if log_timestamp > current_time:
+                        # our only (and therefore best) proxy of "the present" is
+                        # just whatever latest timestamp we've ever seen. if we
+                        # do see a later timestamp, we can assume "the present"
+                        # has moved forward. but that's the best info we've got.
+                        current_time = log_timestamp
+                        start_of_current_ten_second_interval = evaluate(
+                            alertmanager,
+                            sink,
+                            current_time,
+                            start_of_current_ten_second_interval,
+                            summaries=summary_windows is None,
+                        )
+
+                    if summary_windows is not None:
+                        window = summary_windows.add(
+                            metric_name, parsed_log_line, count
+                        )
+                        if window is not None:
+                            sink.write_summary(
+                                window.end, alertmanager.summarize_window(window)
+                            )
+
+                except ValueError as e:
+                    log(f"Problem log line at {reader.line_num}")
+
+                if current_time > datetime.min:
+                    if self_metrics is not None:
+                        self_metrics.tick(current_time, counters_collection)
+                    if state_writer is not None:
+                        state_writer.tick(counters_collection)
+                    if memory_governor is not None:
+                        memory_governor.tick(counters_collection)
+                    if metrics_server is not None:
+                        metrics_server.tick(current_time)
+        finally:
+            if pipeline is not None:
+                pipeline.close()
+
+    if state_writer is not None:
+        state_writer.write(counters_collection)
+
+    if self_metrics is not None:
+        self_metrics.dump(
+            current_time if current_time > datetime.min else None,
+            counters_collection,
+        )
+
+    if metrics_server is not None and current_time > datetime.min:
+        metrics_server.publish(current_time)
+    serve_until_interrupted(metrics_server)
+
+
+def sharded(
+    args: argparse.Namespace,
+    sink: OutputSink,
+    self_metrics: SelfMetrics | None,
+) -> None:
+    # the shards do the receiving, parsing and counting, so all that's
+    # left here is to keep evaluating alerts against what they've got.
+    ingest = ShardedIngest(
+        args.listen,
+        args.shards,
+        args.shard_capacity,
+        args.retention,
+        path_normalizer=build_path_normalizer(args),
+        request_cache_size=args.request_cache_size,
+        self_metrics=self_metrics,
+    )
+    counters_collection = ingest.collection
+    alertmanager = AlertManager(
+        counters_collection,
+        ["404", "500"],
+        self_metrics=self_metrics,
+        anomaly_detector=build_anomaly_detector(args),
+    )
+    metrics_server = build_metrics_server(args, counters_collection, self_metrics)
+    if self_metrics is not None:
+        # every tick is a poll rather than a line, so there are few enough
+        # to check the clock on each of them
+        self_metrics.ticks_between_clock_checks = 1
+    if metrics_server is not None:
+        metrics_server.ticks_between_clock_checks = 1
+    current_time = datetime.min
+    start_of_current_ten_second_interval: datetime | None = None
+
+    with ingest:
+        print(
+            f"Listening for log lines on {', '.join(args.listen)} "
+            f"with {args.shards} shards",
+            file=sys.stderr,
+        )
+        try:
+            while True:
+                newest_time = counters_collection.refresh()
+                if newest_time is not None and newest_time > current_time:
+                    current_time = newest_time
+                    start_of_current_ten_second_interval = evaluate(
+                        alertmanager,
+                        sink,
+                        current_time,
+                        start_of_current_ten_second_interval,
+                    )
+
+                if current_time > datetime.min:
+                    if self_metrics is not None:
+                        self_metrics.tick(current_time, counters_collection)
+                    if metrics_server is not None:
+                        metrics_server.tick(current_time)
+                time.sleep(0.05)
+        except KeyboardInterrupt:
+            pass
+
+    print(
+        f"Received {sum(shard.header[LINES] for shard in counters_collection.shards)} "
+        f"lines across {args.shards} shards",
+        file=sys.stderr,
+    )
+    if self_metrics is not None:
+        self_metrics.dump(
+            current_time if current_time > datetime.min else None,
+            counters_collection,
+        )
+
+    if metrics_server is not None and current_time > datetime.min:
+        metrics_server.publish(current_time)
+    serve_until_interrupted(metrics_server)
+
+
+def edge(
+    args: argparse.Namespace,
+    log: RateLimitedLogger,
+    self_metrics: SelfMetrics | None,
+    profiler: StageProfiler | None,
+) -> None:
+    # no alerting here: the central node does that for every edge at once
+    with open_input(args, self_metrics) as reader:
+        parser = Parser(
+            reader.fieldnames,
+            log,
+            self_metrics,
+            path_normalizer=build_path_normalizer(args),
+            request_cache_size=args.request_cache_size,
+        )
+        shipper = DeltaShipper(
+            args.edge_to, args.edge_id, args.ship_interval, self_metrics=self_metrics
+        )
+        # edges don't keep series, but stats dumps want a collection
+        counters_collection = CountersCollection()
+        current_time = datetime.min
+
+        lines: Iterable[dict[str, str]] = reader
+        if profiler is not None:
+            profiler.instrument_method(parser, "parse_log_line", "parse")
+            lines = profiler.time_iterator("csv_decode", reader)
+
+        pipeline: IngestPipeline | None = None
+        parsed_lines: Iterable[tuple[str, dict, int]]
+        if args.pipeline:
+            pipeline = IngestPipeline(
+                lines,
+                parser,
+                args.queue_size,
+                args.overflow_policy,
+                args.sample_rate,
+                self_metrics=self_metrics,
+            )
+            parsed_lines = pipeline
+        else:
+            parsed_lines = parse_lines(lines, parser, log, reader)
+
+        try:
+            for metric_name, parsed_log_line, count in parsed_lines:
+                shipper.add(metric_name, parsed_log_line, count)
+                shipper.tick()
+                current_time = max(current_time, parsed_log_line["date"])
+                if self_metrics is not None:
+                    self_metrics.tick(current_time, counters_collection)
+        finally:
+            if pipeline is not None:
+                pipeline.close()
+            delivered = shipper.close()
+
+    if self_metrics is not None:
+        self_metrics.dump(
+            current_time if current_time > datetime.min else None,
+            counters_collection,
+        )
+
+    print(
+        f"Shipped {shipper.shipped_deltas} deltas ({shipper.shipped_points} points, "
+        f"{shipper.shipped_bytes} bytes, {shipper.retries} retries) to {args.edge_to}",
+        file=sys.stderr,
+    )
+    if not delivered:
+        sys.exit(f"Gave up on deltas {args.edge_to} never acked")
+
+
+def replay(
+    args: argparse.Namespace,
+    sink: OutputSink,
+    log: RateLimitedLogger,
+    self_metrics: SelfMetrics | None,
+    profiler: StageProfiler | None,
+) -> None:
+    # a big read buffer, since the point here is throughput and nobody
+    # is watching the output scroll by.
+    with open_logs(args.file_location, 1 << 20, args.decompress_in_thread) as reader:
+        counters_collection = build_collection(args, self_metrics)
+        replayer = Replayer(
+            Parser(
+                reader.fieldnames,
+                log,
+                self_metrics,
+                path_normalizer=build_path_normalizer(args),
+                request_cache_size=args.request_cache_size,
+            ),
+            counters_collection,
+            AlertManager(
+                counters_collection,
+                ["404", "500"],
+                self_metrics=self_metrics,
+                query_cache=build_query_cache(args, counters_collection, self_metrics),
+                anomaly_detector=build_anomaly_detector(args),
+                heavy_hitter_detector=build_heavy_hitter_detector(args, self_metrics),
+            ),
+            sink,
+            args.evaluation_interval,
+            self_metrics=self_metrics,
+            memory_governor=build_memory_governor(
+                args, self_metrics, counters_collection
+            ),
+            metrics_server=build_metrics_server(
+                args, counters_collection, self_metrics
+            ),
+        )
+
+        lines: Iterable[dict[str, str]] = reader
+        if profiler is not None:
+            profiler.instrument_pipeline(
+                replayer.parser, counters_collection, replayer.alertmanager, sink
+            )
+            lines = profiler.time_iterator("csv_decode", reader)
+
+        stats = replayer.run(lines)
+
+    state_writer = build_state_writer(args, self_metrics)
+    if state_writer is not None:
+        state_writer.write(counters_collection)
+
+    if self_metrics is not None and replayer.next_boundary is not None:
+        self_metrics.dump(replayer.next_boundary, counters_collection)
+
+    print(
+        f"Replayed {stats.lines} lines ({stats.malformed_lines} malformed, "
+        f"{stats.alerts} alert transitions) in {stats.wall_time_in_seconds:.2f}s: "
+        f"{stats.lines_per_second:.0f} lines/sec",
+        file=sys.stderr,
+    )
+    serve_until_interrupted(replayer.metrics_server)
 
 
 if __name__ == "__main__":
@@ -1,6 +1,26 @@
 from datetime import datetime
+from typing import NamedTuple
 
+from structured_log_alerting.anomaly import AnomalyDetector
+from structured_log_alerting.heavyhitters import HeavyHitterDetector
 from structured_log_alerting.metricscollection import CountersCollection
+from structured_log_alerting.querycache import QueryCache
+from structured_log_alerting.selfmetrics import SelfMetrics, instrumented
+from structured_log_alerting.windows import WindowSummary
+
+
+class Alert(NamedTuple):
+    """
+    A single alert state transition, so callers that want something
+    more machine-readable than a sentence (ex: replay output) don't
+    have to parse it back out of the printed message.
+    """
+
+    name: str
+    state: str
+    timestamp: datetime
+    value: float
+    message: str
 
 
 class AlertManager:
@@ -22,6 +42,22 @@ class AlertManager:
     elevated_request_threshold : int, optional
             At what number of requests (averaged) should AM start alerting.
             Defaults to 10.
+    self_metrics : SelfMetrics or None, optional
+            Where to record evaluation latency. Defaults to None, which
+            skips recording it.
+    query_cache : QueryCache or None, optional
+            If given, run every count query through this cache (which
+            must be for the same collection) rather than straight
+            against counters_collection. Defaults to None.
+    anomaly_detector : AnomalyDetector or None, optional
+            If given, #evaluate_anomalies alerts on traffic that's
+            unusual for its section (or whatever it groups by), on top
+            of the fixed elevated_request_threshold. Defaults to None.
+    heavy_hitter_detector : HeavyHitterDetector or None, optional
+            If given, #evaluate_heavy_hitters alerts on any single client
+            (or whatever it's keyed by) sending too many requests a
+            second. Whoever ingests lines has to HeavyHitterDetector#add
+            them to it. Defaults to None.
 
     Notes
     -----
@@ -40,6 +76,9 @@ class AlertManager:
     else and I don't know how to do that. So we're leaving this as a
     much simpler version where we just pass in the CountersCollection
     and the AlertManager instance simply handles the entire thing.
+    (Ingest itself can now be split into stages connected by queues,
+    see pipeline.IngestPipeline, but evaluation still happens on the
+    last of them, alongside aggregation.)
     """
 
     def __init__(
@@ -48,8 +87,18 @@ class AlertManager:
         interesting_counter_names: list[str] | None = None,
         rolling_alert_window: int = 120,
         elevated_request_threshold: int = 10,
+        self_metrics: SelfMetrics | None = None,
+        query_cache: QueryCache | None = None,
+        anomaly_detector: AnomalyDetector | None = None,
+        heavy_hitter_detector: HeavyHitterDetector | None = None,
     ) -> None:
         self.counters_collection = counters_collection
+        self.self_metrics = self_metrics
+        self.anomaly_detector = anomaly_detector
+        self.heavy_hitter_detector = heavy_hitter_detector
+        self.queries: CountersCollection | QueryCache = (
+            query_cache if query_cache is not None else counters_collection
+        )
         self.rolling_alert_window = rolling_alert_window
         self.elevated_request_threshold = elevated_request_threshold
 
@@ -105,19 +154,27 @@ class AlertManager:
         """
         metric_names_to_check: list[str] = []
         metric_type: str = "metric"
+        counts: dict[str, int] = {}
 
         if len(metric_names) > 0:
             metric_names_to_check = metric_names
+            for metric in metric_names_to_check:
+                counts[metric] = self.queries.total_count_since(
+                    current_time, since_interval_in_seconds, metric
+                )
         else:
+            # sections are a label on every series, so we can total them
+            # all up in one grouped pass instead of a scan per section.
             metric_names_to_check = self.counters_collection.sections
             metric_type = "section"
+            counts = self.queries.total_counts_by_label(
+                current_time, since_interval_in_seconds, "section"
+            )
 
         most_requested_metric: str = ""
         most_requested_counter: int = 0
         for metric in metric_names_to_check:
-            temp_count: int = self.counters_collection.total_count_since(
-                current_time, since_interval_in_seconds, metric
-            )
+            temp_count: int = counts.get(metric, 0)
             if temp_count > most_requested_counter:
                 most_requested_metric = metric
                 most_requested_counter = temp_count
@@ -176,7 +233,7 @@ class AlertManager:
 
             # summarize interesting metrics
             for metric in metric_names_to_check:
-                count = self.counters_collection.total_count_since(
+                count = self.queries.total_count_since(
                     current_time, since_interval_in_seconds, metric
                 )
                 if count > 0:
@@ -224,20 +281,22 @@ class AlertManager:
                 The average rps over the given interval for the given metrics.
         """
         total_count: int = 0
-        metric_names_to_check: list[str] = []
 
         if len(metric_names) > 0:
-            metric_names_to_check = metric_names
+            for metric in metric_names:
+                total_count += self.queries.total_count_since(
+                    current_time, since_interval_in_seconds, metric
+                )
         else:
-            metric_names_to_check = self.counters_collection.sections
-
-        for metric in metric_names_to_check:
-            total_count += self.counters_collection.total_count_since(
-                current_time, since_interval_in_seconds, metric
+            # every series is in exactly one section, so the total across
+            # all sections is just the total of everything.
+            total_count = self.queries.total_count_since(
+                current_time, since_interval_in_seconds
             )
 
         return total_count / since_interval_in_seconds
 
+    @instrumented("alertmanager.provide_summary_for_interval")
     def provide_summary_for_interval(
         self,
         current_time: datetime = datetime.now(),
@@ -294,15 +353,49 @@ class AlertManager:
 
         return summary_statements
 
-    def check_for_elevated_requests(
+    @instrumented("alertmanager.summarize_window")
+    def summarize_window(self, window: WindowSummary) -> list[str]:
+        """
+        The same sentences as #provide_summary_for_interval, but read
+        off a window windows.TumblingWindows already counted up as lines
+        came in, rather than queried for, so this doesn't depend on how
+        many sections or series there are.
+
+        Parameters
+        ----------
+        window : WindowSummary
+                The closed window to summarize.
+
+        Returns
+        -------
+        list of str
+                The collection of sentences about the summarized output, to
+                be printed by the main body of the program.
+        """
+        window_in_seconds = int((window.end - window.start).total_seconds()) + 1
+        summary_statements: list[str] = [
+            f"Current time interval: {self.format_timestamp_for_printing(window.end)}",
+            f"The section with the most requests ({window.top_count}) in the last ten seconds was: {window.top_section}",
+        ]
+        for metric in self.interesting_counters:
+            count = window.counter_counts.get(metric, 0)
+            if count > 0:
+                summary_statements.append(
+                    f"There have been {count} counts of a {metric} in the last {window_in_seconds} seconds."
+                )
+
+        return summary_statements
+
+    @instrumented("alertmanager.evaluate_elevated_requests")
+    def evaluate_elevated_requests(
         self,
         current_time: datetime = datetime.now(),
         since_interval_in_seconds: int | None = None,
-    ) -> str:
+    ) -> Alert | None:
         """
         Check across all request counter metrics whether average
         requests has been elevated above the instance's request
-        threshold.
+        threshold, and record the transition if the state changed.
 
         Parameters
         ----------
@@ -316,14 +409,11 @@ class AlertManager:
 
         Returns
         -------
-        str
-                Either an empty string or a sentence of summarized output
-                about the state of elevated requests, to be printed by the
-                main body of the program.
+        Alert or None
+                The alert transition ("firing" or "resolved"), or None if
+                the elevated state didn't change.
         """
-        summary: str = ""
-
-        if since_interval_in_seconds:
+        if not since_interval_in_seconds:
             since_interval_in_seconds = self.rolling_alert_window
 
         current_request_count = self.find_average_request_count_per_second(
@@ -333,10 +423,152 @@ class AlertManager:
         if self.currently_elevated:
             if current_request_count < self.elevated_request_threshold:
                 self.currently_elevated = False
-                summary = f"{self.format_timestamp_for_printing(current_time)}: Traffic is no longer elevated."
+                return Alert(
+                    name="high_traffic",
+                    state="resolved",
+                    timestamp=current_time,
+                    value=current_request_count,
+                    message=f"{self.format_timestamp_for_printing(current_time)}: Traffic is no longer elevated.",
+                )
         else:
             if current_request_count >= self.elevated_request_threshold:
                 self.currently_elevated = True
-                summary = f"{self.format_timestamp_for_printing(current_time)}: High traffic generated an alert - hits = {round(current_request_count, 2)} per second"
+                return Alert(
+                    name="high_traffic",
+                    state="firing",
+                    timestamp=current_time,
+                    value=current_request_count,
+                    message=f"{self.format_timestamp_for_printing(current_time)}: High traffic generated an alert - hits = {round(current_request_count, 2)} per second",
+                )
+
+        return None
+
+    @instrumented("alertmanager.evaluate_anomalies")
+    def evaluate_anomalies(
+        self, current_time: datetime = datetime.now()
+    ) -> list[Alert]:
+        """
+        Feed every bucket that's closed since the last call to
+        self.anomaly_detector, and alert on any group whose traffic went
+        from normal to anomalous or back.
+
+        Parameters
+        ----------
+        current_time : datetime, optional
+                The timestamp we should treat as the present. Defaults to
+                datetime.now()
+
+        Returns
+        -------
+        list of Alert
+                An "anomaly.<group>" transition for every change, or an
+                empty list (always, without an anomaly detector).
+        """
+        if self.anomaly_detector is None:
+            return []
+
+        alerts: list[Alert] = []
+        for anomaly in self.anomaly_detector.evaluate(self.queries, current_time):
+            timestamp = self.format_timestamp_for_printing(anomaly.timestamp)
+            if anomaly.state == "firing":
+                message = (
+                    f"{timestamp}: Anomalous traffic for {anomaly.group} generated an alert"
+                    f" - {anomaly.observed} requests in {self.anomaly_detector.bucket_in_seconds}s,"
+                    f" expected {round(anomaly.expected, 2)} (z = {round(anomaly.z_score, 2)})"
+                )
+            else:
+                message = (
+                    f"{timestamp}: Traffic for {anomaly.group} is no longer anomalous."
+                )
+            alerts.append(
+                Alert(
+                    name=f"anomaly.{anomaly.group}",
+                    state=anomaly.state,
+                    timestamp=anomaly.timestamp,
+                    value=anomaly.observed,
+                    message=message,
+                )
+            )
+
+        return alerts
+
+    @instrumented("alertmanager.evaluate_heavy_hitters")
+    def evaluate_heavy_hitters(
+        self, current_time: datetime = datetime.now()
+    ) -> list[Alert]:
+        """
+        Alert on any key self.heavy_hitter_detector has seen go over its
+        rate threshold, or back under it.
+
+        Parameters
+        ----------
+        current_time : datetime, optional
+                The timestamp we should treat as the present. Defaults to
+                datetime.now()
+
+        Returns
+        -------
+        list of Alert
+                A "rate.<key>" transition for every change, or an empty
+                list (always, without a heavy hitter detector).
+        """
+        detector = self.heavy_hitter_detector
+        if detector is None:
+            return []
+
+        alerts: list[Alert] = []
+        for heavy_hitter in detector.evaluate(current_time):
+            timestamp = self.format_timestamp_for_printing(heavy_hitter.timestamp)
+            if heavy_hitter.state == "firing":
+                message = (
+                    f"{timestamp}: Request rate from {detector.label} {heavy_hitter.key} generated an alert"
+                    f" - about {round(heavy_hitter.rate, 2)} (at most {heavy_hitter.error:.2g} too high)"
+                    f" per second over the last {detector.window_in_seconds:g}s, limit {detector.threshold:g}"
+                )
+            else:
+                message = f"{timestamp}: Request rate from {detector.label} {heavy_hitter.key} is back under the limit."
+            alerts.append(
+                Alert(
+                    name=f"rate.{heavy_hitter.key}",
+                    state=heavy_hitter.state,
+                    timestamp=heavy_hitter.timestamp,
+                    value=heavy_hitter.rate,
+                    message=message,
+                )
+            )
+
+        return alerts
+
+    def check_for_elevated_requests(
+        self,
+        current_time: datetime = datetime.now(),
+        since_interval_in_seconds: int | None = None,
+    ) -> str:
+        """
+        Check across all request counter metrics whether average
+        requests has been elevated above the instance's request
+        threshold.
+
+        Parameters
+        ----------
+        current_time : datetime, optional
+                The timestamp we should treat as the present. Defaults to
+                datetime.now()
+        since_interval_in_seconds : int, optional
+                The interval in seconds (exclusive of the left end, inclusive
+                of the right end) to provide a summary for. If not included,
+                the method will use self.rolling_alert_window instead.
+
+        Returns
+        -------
+        str
+                Either an empty string or a sentence of summarized output
+                about the state of elevated requests, to be printed by the
+                main body of the program.
+        """
+        alert = self.evaluate_elevated_requests(current_time, since_interval_in_seconds)
+
+        if alert is None:
+            return ""
 
-        return summary
+        return alert.message
@@ -0,0 +1,390 @@
+import math
+from array import array
+from datetime import datetime
+from typing import NamedTuple, Protocol
+
+from structured_log_alerting.sortedarraydict import from_seconds, to_seconds
+
+
+# the baselines an AnomalyDetector can keep per group
+EWMA_METHOD = "ewma"
+HOLT_WINTERS_METHOD = "holt-winters"
+ANOMALY_METHODS: list[str] = [EWMA_METHOD, HOLT_WINTERS_METHOD]
+
+
+class Baseline(Protocol):
+    observations: int
+
+    def expected(self) -> float:
+        ...
+
+    def deviation(self) -> float:
+        ...
+
+    def update(self, value: float) -> None:
+        ...
+
+
+class EWMABaseline:
+    """
+    An exponentially weighted moving mean and variance, updated in
+    place one observation at a time. Recent observations count the
+    most: with a smoothing factor of alpha, an observation's weight
+    halves about every 0.69 / alpha observations.
+
+    Attributes
+    ----------
+    alpha : float
+            The smoothing factor, between 0 and 1.
+    mean : float
+            The weighted mean.
+    variance : float
+            The weighted variance around it.
+    observations : int
+            How many observations it's seen.
+    """
+
+    __slots__ = ("alpha", "mean", "variance", "observations")
+
+    def __init__(self, alpha: float) -> None:
+        self.alpha = alpha
+        self.mean: float = 0.0
+        self.variance: float = 0.0
+        self.observations: int = 0
+
+    def expected(self) -> float:
+        return self.mean
+
+    def deviation(self) -> float:
+        return math.sqrt(self.variance)
+
+    def update(self, value: float) -> None:
+        if self.observations == 0:
+            self.mean = value
+        else:
+            # see Finch, "Incremental calculation of weighted mean and
+            # variance" (2009)
+            difference = value - self.mean
+            increment = self.alpha * difference
+            self.mean += increment
+            self.variance = (1 - self.alpha) * (self.variance + difference * increment)
+        self.observations += 1
+
+
+class HoltWintersBaseline:
+    """
+    Additive Holt-Winters (triple exponential smoothing): a level, a
+    trend and one seasonal offset per position in the season, so a
+    forecast can expect more traffic at the busy time of day than the
+    quiet one. How far off its forecasts have been is tracked as an
+    exponentially weighted variance of the errors.
+
+    Attributes
+    ----------
+    season_length : int
+            How many observations make up a season (ex: 144 ten minute
+            buckets for a daily season).
+    alpha : float
+            The smoothing factor for the level (and the error variance).
+    beta : float
+            The smoothing factor for the trend.
+    gamma : float
+            The smoothing factor for the seasonal offsets.
+    level : float
+    trend : float
+    seasonal : array of float
+            The seasonal offsets, indexed by position in the season.
+    error_variance : float
+    observations : int
+            How many observations it's seen.
+    """
+
+    __slots__ = (
+        "season_length",
+        "alpha",
+        "beta",
+        "gamma",
+        "level",
+        "trend",
+        "seasonal",
+        "error_variance",
+        "observations",
+    )
+
+    def __init__(
+        self, season_length: int, alpha: float, beta: float, gamma: float
+    ) -> None:
+        self.season_length = season_length
+        self.alpha = alpha
+        self.beta = beta
+        self.gamma = gamma
+        self.level: float = 0.0
+        self.trend: float = 0.0
+        self.seasonal = array("d", bytes(8 * season_length))
+        self.error_variance: float = 0.0
+        self.observations: int = 0
+
+    def expected(self) -> float:
+        position = self.observations % self.season_length
+        return self.level + self.trend + self.seasonal[position]
+
+    def deviation(self) -> float:
+        return math.sqrt(self.error_variance)
+
+    def update(self, value: float) -> None:
+        position = self.observations % self.season_length
+        if self.observations == 0:
+            self.level = value
+        else:
+            error = value - self.expected()
+            self.error_variance = (1 - self.alpha) * (
+                self.error_variance + self.alpha * error * error
+            )
+
+            previous_level = self.level
+            self.level = self.alpha * (value - self.seasonal[position]) + (
+                1 - self.alpha
+            ) * (self.level + self.trend)
+            self.trend = (
+                self.beta * (self.level - previous_level) + (1 - self.beta) * self.trend
+            )
+            self.seasonal[position] = (
+                self.gamma * (value - self.level)
+                + (1 - self.gamma) * self.seasonal[position]
+            )
+        self.observations += 1
+
+
+class Anomaly(NamedTuple):
+    """
+    A group going into or out of an anomalous state.
+    """
+
+    group: str
+    # "firing" or "resolved"
+    state: str
+    timestamp: datetime
+    observed: int
+    expected: float
+    z_score: float
+
+
+class AnomalyDetector:
+    """
+    Alerts on traffic that's unusual for its group (ex: its section),
+    rather than on a single fixed threshold that's too high for quiet
+    sections and too low for busy ones.
+
+    Every group's requests are counted in fixed buckets (aligned to the
+    UNIX epoch, like Replayer's windows). As each bucket closes, its
+    count is scored against the group's baseline (see EWMABaseline and
+    HoltWintersBaseline) as a z-score: how many standard deviations it
+    is from what the baseline expected. A group is anomalous while the
+    z-score is at least z_threshold either way, so drops in traffic
+    count as well as spikes. The count is then folded into the baseline.
+
+    Baselines are updated in place and are a constant size, so memory
+    grows with the number of groups but never with how long we've been
+    running. Bucket counts come from a single grouped query per bucket
+    (see CountersCollection#total_counts_by_label) rather than a hook on
+    every ingested line.
+
+    Attributes
+    ----------
+    label : str, optional
+            The series label to group by. It should be one that's part
+            of metric names (section, status, and host or route when
+            they're there), since a series' other labels only come from
+            its first line. Defaults to "section".
+    method : str, optional
+            One of ANOMALY_METHODS. Defaults to "ewma".
+    bucket_in_seconds : int, optional
+            How long each bucket is. It should fit in the collection's
+            retention. Defaults to 10.
+    z_threshold : float, optional
+            How many standard deviations from the baseline counts as
+            anomalous. Defaults to 4.
+    alpha : float, optional
+            The smoothing factor for the mean (or level). Defaults to 0.1.
+    beta : float, optional
+            Holt-Winters' trend smoothing factor. Defaults to 0.01.
+    gamma : float, optional
+            Holt-Winters' seasonal smoothing factor. Defaults to 0.1.
+    season_length : int, optional
+            Holt-Winters' season, in buckets. Defaults to 360 (an hour of
+            10 second buckets).
+    warmup_buckets : int, optional
+            How many buckets a group's baseline needs before it's
+            trusted to alert on. Defaults to 30, and is raised to a whole
+            season for Holt-Winters.
+    min_deviation : float, optional
+            The least the standard deviation is taken to be. It's also
+            never taken to be less than the square root of the expected
+            count (the noise in a Poisson count), so perfectly steady
+            traffic doesn't alert on a single extra request. Defaults to
+            1.
+    """
+
+    def __init__(
+        self,
+        label: str = "section",
+        method: str = EWMA_METHOD,
+        bucket_in_seconds: int = 10,
+        z_threshold: float = 4.0,
+        alpha: float = 0.1,
+        beta: float = 0.01,
+        gamma: float = 0.1,
+        season_length: int = 360,
+        warmup_buckets: int = 30,
+        min_deviation: float = 1.0,
+    ) -> None:
+        if method not in ANOMALY_METHODS:
+            raise ValueError(
+                f"Invalid anomaly detection method {method!r}, it should be one of "
+                + ", ".join(ANOMALY_METHODS)
+            )
+        if bucket_in_seconds < 1 or season_length < 1:
+            raise ValueError("bucket_in_seconds and season_length should be at least 1")
+        for name, factor in [("alpha", alpha), ("beta", beta), ("gamma", gamma)]:
+            if not 0 < factor <= 1:
+                raise ValueError(f"{name} should be between 0 and 1, not {factor}")
+
+        self.label = label
+        self.method = method
+        self.bucket_in_seconds = bucket_in_seconds
+        self.z_threshold = z_threshold
+        self.alpha = alpha
+        self.beta = beta
+        self.gamma = gamma
+        self.season_length = season_length
+        self.warmup_buckets = (
+            max(warmup_buckets, season_length)
+            if method == HOLT_WINTERS_METHOD
+            else warmup_buckets
+        )
+        self.min_deviation = min_deviation
+
+        self.baselines: dict[str, Baseline] = {}
+        self.anomalous: set[str] = set()
+        # the end (in seconds since the epoch) of the next bucket to close
+        self.next_bucket_end: int | None = None
+
+    def _new_baseline(self) -> Baseline:
+        if self.method == HOLT_WINTERS_METHOD:
+            return HoltWintersBaseline(
+                self.season_length, self.alpha, self.beta, self.gamma
+            )
+        return EWMABaseline(self.alpha)
+
+    def z_score(self, baseline: Baseline, observed: int) -> float:
+        """
+        Score a count against a baseline.
+
+        Parameters
+        ----------
+        baseline : EWMABaseline or HoltWintersBaseline
+                What the count should look like.
+        observed : int
+                The count.
+
+        Returns
+        -------
+        float
+                How many (floored, see min_deviation) standard deviations
+                the count is above (positive) or below (negative) what the
+                baseline expected.
+        """
+        expected = baseline.expected()
+        deviation = max(
+            baseline.deviation(),
+            math.sqrt(max(expected, 0.0)),
+            self.min_deviation,
+        )
+        return (observed - expected) / deviation
+
+    def observe(self, timestamp: datetime, counts: dict[str, int]) -> list[Anomaly]:
+        """
+        Score one closed bucket's counts and fold them into the
+        baselines.
+
+        Parameters
+        ----------
+        timestamp : datetime
+                The end of the bucket.
+        counts : dict of str: int
+                Every group's count in the bucket. Groups we've seen
+                before that are missing from it counted 0.
+
+        Returns
+        -------
+        list of Anomaly
+                Every group whose anomalous state changed.
+        """
+        transitions: list[Anomaly] = []
+        for group in set(self.baselines) | set(counts):
+            observed = counts.get(group, 0)
+            baseline = self.baselines.get(group)
+            if baseline is None:
+                baseline = self.baselines[group] = self._new_baseline()
+
+            if baseline.observations >= self.warmup_buckets:
+                expected = baseline.expected()
+                z_score = self.z_score(baseline, observed)
+                anomalous = abs(z_score) >= self.z_threshold
+                if anomalous != (group in self.anomalous):
+                    if anomalous:
+                        self.anomalous.add(group)
+                    else:
+                        self.anomalous.discard(group)
+                    transitions.append(
+                        Anomaly(
+                            group=group,
+                            state="firing" if anomalous else "resolved",
+                            timestamp=timestamp,
+                            observed=observed,
+                            expected=expected,
+                            z_score=z_score,
+                        )
+                    )
+
+            baseline.update(observed)
+
+        return sorted(transitions)
+
+    def evaluate(self, queries, current_time: datetime) -> list[Anomaly]:
+        """
+        Close (and #observe) every bucket that ended before the present.
+
+        Parameters
+        ----------
+        queries : CountersCollection or QueryCache
+                Where to count each bucket.
+        current_time : datetime
+                The timestamp we should treat as the present. A bucket is
+                only closed once the present has moved past its end, and
+                anything that shows up for it after that is ignored.
+
+        Returns
+        -------
+        list of Anomaly
+                Every state change, in order.
+        """
+        seconds = to_seconds(current_time)
+        if self.next_bucket_end is None:
+            # the first bucket we see the whole of, ie the first aligned
+            # end at least a bucket after the second before this one
+            self.next_bucket_end = (
+                -(-(seconds + self.bucket_in_seconds - 1) // self.bucket_in_seconds)
+                * self.bucket_in_seconds
+            )
+
+        transitions: list[Anomaly] = []
+        while self.next_bucket_end < seconds:
+            bucket_end = from_seconds(self.next_bucket_end)
+            counts = queries.total_counts_by_label(
+                bucket_end, self.bucket_in_seconds, self.label
+            )
+            transitions.extend(self.observe(bucket_end, counts))
+            self.next_bucket_end += self.bucket_in_seconds
+
+        return transitions
@@ -0,0 +1,614 @@
+import sys
+from array import array
+from copy import copy
+from datetime import datetime
+from typing import Iterable
+
+from structured_log_alerting.metricscollection import (
+    CountersCollection,
+    matches_namespace,
+    series_labels,
+)
+from structured_log_alerting.selfmetrics import SelfMetrics, instrumented
+from structured_log_alerting.sortedarraydict import from_seconds, to_seconds
+from structured_log_alerting.timeseries import Labels
+
+
+# bucket ranges to sum within each row: one list for the one-second
+# ring and one for the pre-aggregated ring. see #window_ranges.
+Window = tuple[list[tuple[int, int]], list[tuple[int, int]]]
+
+
+def copy_column(column: array | memoryview) -> array:
+    """
+    Copy a column of the matrix into a new array, whether it's an array
+    already or a typed memoryview (ex: over a mapped state file, see
+    statefile#load_state).
+    """
+    if isinstance(column, array):
+        return column[:]
+
+    return array(column.format, column.tobytes())
+
+
+def ring_ranges(first: int, length: int, ring_size: int) -> list[tuple[int, int]]:
+    """
+    Split a run of consecutive buckets into [start, end) index ranges
+    within a ring, which takes two ranges when it wraps around the end.
+    """
+    if length <= 0:
+        return []
+
+    start = first % ring_size
+    if start + length <= ring_size:
+        return [(start, start + length)]
+
+    return [(start, ring_size), (0, start + length - ring_size)]
+
+
+class ColumnarSeries:
+    """
+    A lightweight view of a single series stored in a
+    ColumnarCountersCollection, so code that looks series up by name
+    (ex: selfmetrics, tests) works the same against either collection.
+    The data itself lives in the collection's matrix, in row self.row.
+
+    Attributes
+    ----------
+    collection : ColumnarCountersCollection
+            The collection holding this series' data.
+    row : int
+            The series id, which is also its row in the collection's
+            matrix.
+    name : str
+            The short name of the metric.
+    label_pairs : Labels
+            The series' (interned) labels.
+    """
+
+    __slots__ = ("collection", "row", "name", "label_pairs")
+
+    kind = "counter"
+
+    def __init__(
+        self,
+        collection: "ColumnarCountersCollection",
+        row: int,
+        name: str,
+        label_pairs: Labels,
+    ) -> None:
+        self.collection = collection
+        self.row = row
+        self.name = name
+        self.label_pairs = label_pairs
+
+    @property
+    def labels(self) -> dict[str, str]:
+        return dict(self.label_pairs)
+
+    @property
+    def total(self) -> int:
+        """
+        See CounterSeries#total.
+        """
+        return self.collection.totals[self.row]
+
+    def total_count_since(
+        self, current_time: datetime, since_number_of_seconds: int = 10
+    ) -> int:
+        """
+        See CounterSeries#total_count_since.
+        """
+        window = self.collection.window_ranges(current_time, since_number_of_seconds)
+
+        return self.collection.row_total(self.row, window)
+
+    def points_since(
+        self, current_time: datetime, since_number_of_seconds: int = 10
+    ) -> list[tuple[datetime, int]]:
+        """
+        See CounterSeries#points_since.
+        """
+        return self.collection.row_points(
+            self.row, current_time, since_number_of_seconds
+        )
+
+    def approximate_bytes(self) -> int:
+        """
+        Returns
+        -------
+        int
+                The memory used by this view and its row of the matrix,
+                not counting its (shared) labels.
+        """
+        return sys.getsizeof(self) + 4 * (
+            self.collection.ring_size + self.collection.bucket_ring_size
+        )
+
+
+class ColumnarCountersCollection(CountersCollection):
+    """
+    A CountersCollection that stores every series in a single flat
+    series × time-bucket matrix (struct-of-arrays) rather than as a
+    dict of individual CounterSeries objects. Row i of the matrix is
+    series id i, and each row is a ring of one-second buckets shared by
+    every series, so bucket (seconds % ring_size) always holds the same
+    second for every row.
+
+    That turns "sum every matching series over the last N seconds" into
+    summing a few contiguous slices per row (or, when every series
+    matches, one strided column slice per bucket), and a group-by into
+    a single pass over the rows.
+
+    Every row also has a second, coarser ring of pre-aggregated
+    bucket_width_in_seconds buckets, updated alongside the one-second
+    ring on ingest. Long windows are summed from whole coarse buckets,
+    with one-second buckets only for the ragged ends, so a 120 second
+    window is at most 12 + 18 buckets rather than 120.
+
+    Attributes
+    ----------
+    max_series_length : int, optional
+            Accepted for compatibility with CountersCollection, but
+            retention here is by time; see retention_in_seconds.
+    self_metrics : SelfMetrics or None, optional
+            See MetricsCollection.
+    retention_in_seconds : int, optional
+            How many seconds of buckets to keep, counting back from the
+            newest second seen. Anything older is dropped (and counted in
+            self.dropped_points). This needs to cover the longest window
+            anything queries. Defaults to 300.
+    bucket_width_in_seconds : int, optional
+            The width of the pre-aggregated buckets. Defaults to 10.
+
+    Notes
+    -----
+    This uses the stdlib array module rather than NumPy, so sums are
+    over array slices instead of vectorized masks. Buckets are cleared
+    as the newest second moves forward, which costs one strided slice
+    assignment per second of log time rather than anything per line.
+
+    After a warm start (see statefile#load_state) the matrices are
+    typed memoryviews over a copy-on-write mapping of the state file
+    rather than arrays, which index, slice and sum the same way. They
+    can't grow, so they're copied into arrays (see #_own_columns) the
+    first time a new series is added.
+    """
+
+    def __init__(
+        self,
+        max_series_length: int = 100,
+        self_metrics: SelfMetrics | None = None,
+        retention_in_seconds: int = 300,
+        bucket_width_in_seconds: int = 10,
+    ) -> None:
+        super().__init__(max_series_length, self_metrics)
+        self.ring_size = retention_in_seconds
+        self.counts: array = array("I")
+        self.bucket_width = bucket_width_in_seconds
+        # enough coarse buckets that any one overlapping the retained
+        # seconds is never reused while we still need it.
+        self.bucket_ring_size = retention_in_seconds // bucket_width_in_seconds + 2
+        self.bucket_counts: array = array("I")
+        # every count ever added to each row, see CounterSeries#total.
+        self.totals: array = array("Q")
+        self.newest_second: int | None = None
+        self.dropped_points: int = 0
+
+        self.series: dict[str, ColumnarSeries] = {}  # type: ignore[assignment]
+        self.series_sections: array = array("I")
+        self.section_ids: dict[str, int] = {}
+
+        self._zero_row: array = array("I", bytes(4 * self.ring_size))
+        self._zero_bucket_row: array = array("I", bytes(4 * self.bucket_ring_size))
+        self._zero_column: array = array("I")
+        self._namespace_rows: dict[str, tuple[int, list[int]]] = {}
+
+    def _own_columns(self) -> None:
+        """
+        Swap any memoryview columns for arrays of our own, so they can
+        grow.
+        """
+        for name in ["counts", "bucket_counts", "totals", "series_sections"]:
+            column = getattr(self, name)
+            if not isinstance(column, array):
+                setattr(self, name, copy_column(column))
+
+    def _add_series(
+        self, counter_name: str, parsed_log_file: dict
+    ) -> dict[str, ColumnarSeries]:  # type: ignore[override]
+        """
+        Adds a new row to the matrix. See CountersCollection#_add_series.
+        """
+        self._own_columns()
+        section = parsed_log_file["section"]
+        section_id = self.section_ids.get(section)
+        if section_id is None:
+            section_id = self.section_ids[section] = len(self.sections)
+            self.sections.append(section)
+
+        row = len(self.series)
+        series = ColumnarSeries(
+            self, row, counter_name, self.intern_labels(series_labels(parsed_log_file))
+        )
+        self.series[counter_name] = series
+        self._index_series(series)
+        self.series_sections.append(section_id)
+        self.counts.extend(self._zero_row)
+        self.bucket_counts.extend(self._zero_bucket_row)
+        self.totals.append(0)
+        self._zero_column.append(0)
+
+        return self.series
+
+    def _advance_to(self, seconds: int) -> None:
+        """
+        Move the newest second forward, clearing the buckets of every
+        second we've skipped over (and the new one) so they don't still
+        hold counts from one ring_size ago.
+        """
+        if self.newest_second is None:
+            self.newest_second = seconds
+            return
+
+        ring_size = self.ring_size
+        bucket_width = self.bucket_width
+        if self.dirty_seconds is not None:
+            # whatever falls out of either ring changes every cached
+            # window it was in, just like a write would
+            newest_bucket = self.newest_second // bucket_width
+            first_dropped_bucket = newest_bucket - self.bucket_ring_size + 1
+            last_dropped_bucket = min(
+                newest_bucket, seconds // bucket_width - self.bucket_ring_size
+            )
+            self.dirty_seconds.update(
+                range(
+                    first_dropped_bucket * bucket_width,
+                    (last_dropped_bucket + 1) * bucket_width,
+                )
+            )
+            self.dirty_seconds.update(
+                range(
+                    self.newest_second - ring_size + 1,
+                    min(self.newest_second, seconds - ring_size) + 1,
+                )
+            )
+
+        if seconds - self.newest_second >= ring_size:
+            self.counts[:] = array("I", bytes(4 * len(self.counts)))
+        else:
+            for skipped in range(self.newest_second + 1, seconds + 1):
+                self.counts[skipped % ring_size :: ring_size] = self._zero_column
+
+        bucket_ring_size = self.bucket_ring_size
+        newest_bucket = self.newest_second // self.bucket_width
+        bucket = seconds // self.bucket_width
+        if bucket - newest_bucket >= bucket_ring_size:
+            self.bucket_counts[:] = array("I", bytes(4 * len(self.bucket_counts)))
+        else:
+            for skipped in range(newest_bucket + 1, bucket + 1):
+                self.bucket_counts[
+                    skipped % bucket_ring_size :: bucket_ring_size
+                ] = self._zero_column
+
+        self.newest_second = seconds
+
+    @instrumented("counterscollection.add_or_update_series")
+    def add_or_update_series(
+        self, counter_name: str, parsed_log_file: dict, count: int = 1
+    ) -> dict[str, ColumnarSeries]:  # type: ignore[override]
+        """
+        See CountersCollection#add_or_update_series. Data points older
+        than the retained window are dropped rather than stored.
+        """
+        series = self.series.get(counter_name)
+        if series is None:
+            self._add_series(counter_name, parsed_log_file)
+            series = self.series[counter_name]
+
+        self.totals[series.row] += count
+        seconds = to_seconds(parsed_log_file["date"])
+        if self.newest_second is None or seconds > self.newest_second:
+            self._advance_to(seconds)
+        elif seconds <= self.newest_second - self.ring_size:
+            self.dropped_points += count
+            return self.series
+
+        self.counts[series.row * self.ring_size + seconds % self.ring_size] += count
+        if self.dirty_seconds is not None:
+            self.dirty_seconds.add(seconds)
+        self.bucket_counts[
+            series.row * self.bucket_ring_size
+            + (seconds // self.bucket_width) % self.bucket_ring_size
+        ] += count
+
+        return self.series
+
+    def snapshot(self) -> "ColumnarCountersCollection":  # type: ignore[override]
+        """
+        See CountersCollection#snapshot. The matrices are copied whole,
+        which is a handful of memcpys rather than one copy per series.
+        """
+        snapshot = copy(self)
+        snapshot.counts = copy_column(self.counts)
+        snapshot.bucket_counts = copy_column(self.bucket_counts)
+        snapshot.totals = copy_column(self.totals)
+        snapshot.series_sections = copy_column(self.series_sections)
+        snapshot._zero_column = self._zero_column[:]
+        snapshot.section_ids = dict(self.section_ids)
+        snapshot.sections = list(self.sections)
+        snapshot.series = {
+            name: ColumnarSeries(snapshot, series.row, name, series.label_pairs)
+            for name, series in self.series.items()
+        }
+        snapshot.label_index = {
+            pair: list(names) for pair, names in self.label_index.items()
+        }
+        snapshot._namespace_rows = {}
+        snapshot.dirty_seconds = None
+        snapshot.self_metrics = None
+
+        return snapshot
+
+    def window_ranges(
+        self, current_time: datetime, since_number_of_seconds: int
+    ) -> Window:
+        """
+        Translate a query window into bucket ranges within a row: whole
+        pre-aggregated buckets where the window covers them, and
+        one-second buckets for whatever is left over at either end.
+
+        Parameters
+        ----------
+        current_time : datetime
+                The (inclusive) upper bound of the window.
+        since_number_of_seconds : int
+                The (exclusive) lower bound of the window, in seconds
+                before current_time.
+
+        Returns
+        -------
+        Window
+                The [start, end) ranges to sum in self.counts and in
+                self.bucket_counts. Only retained seconds are included.
+        """
+        if self.newest_second is None:
+            return [], []
+
+        until_seconds = min(to_seconds(current_time), self.newest_second)
+        after_seconds = max(
+            to_seconds(current_time) - since_number_of_seconds,
+            self.newest_second - self.ring_size,
+        )
+        if until_seconds <= after_seconds:
+            return [], []
+
+        width = self.bucket_width
+        first_bucket = (after_seconds + width) // width
+        last_bucket = (until_seconds + 1) // width - 1
+        if first_bucket > last_bucket:
+            return (
+                ring_ranges(
+                    after_seconds + 1, until_seconds - after_seconds, self.ring_size
+                ),
+                [],
+            )
+
+        head_until = first_bucket * width - 1
+        tail_after = (last_bucket + 1) * width - 1
+
+        return (
+            ring_ranges(after_seconds + 1, head_until - after_seconds, self.ring_size)
+            + ring_ranges(tail_after + 1, until_seconds - tail_after, self.ring_size),
+            ring_ranges(
+                first_bucket, last_bucket - first_bucket + 1, self.bucket_ring_size
+            ),
+        )
+
+    def row_total(self, row: int, window: Window) -> int:
+        """
+        Sum one series' buckets over a #window_ranges.
+        """
+        return self.row_totals(window, [row])[0]
+
+    def row_totals(
+        self, window: Window, rows: Iterable[int] | None = None
+    ) -> list[int]:
+        """
+        Sum series' buckets over a #window_ranges.
+
+        Parameters
+        ----------
+        window : Window
+                The bucket ranges to sum.
+        rows : iterable of int or None, optional
+                The series ids to sum. Defaults to all of them.
+
+        Returns
+        -------
+        list of int
+                The total for each series, in the same order as rows.
+        """
+        if rows is None:
+            rows = range(len(self.series))
+
+        ranges, bucket_ranges = window
+        slices = [(self.counts, self.ring_size, start, end) for start, end in ranges]
+        slices.extend(
+            (self.bucket_counts, self.bucket_ring_size, start, end)
+            for start, end in bucket_ranges
+        )
+
+        if len(slices) == 1:
+            # by far the most common case for short windows, so skip
+            # the inner loop.
+            matrix, size, start, end = slices[0]
+            return [sum(matrix[row * size + start : row * size + end]) for row in rows]
+
+        return [
+            sum(
+                [
+                    sum(matrix[row * size + start : row * size + end])
+                    for matrix, size, start, end in slices
+                ]
+            )
+            for row in rows
+        ]
+
+    def totals_for_series(
+        self,
+        series: list[ColumnarSeries],  # type: ignore[override]
+        current_time: datetime,
+        since_number_of_seconds: int,
+    ) -> list[int]:
+        """
+        See CountersCollection#totals_for_series. The window is only
+        translated into bucket ranges once for all of them.
+        """
+        window = self.window_ranges(current_time, since_number_of_seconds)
+        if not window[0] and not window[1]:
+            return [0] * len(series)
+
+        return self.row_totals(window, [each.row for each in series])
+
+    def row_points(
+        self, row: int, current_time: datetime, since_number_of_seconds: int
+    ) -> list[tuple[datetime, int]]:
+        """
+        List one series' non-empty one-second buckets within a window,
+        oldest first.
+        """
+        if self.newest_second is None:
+            return []
+
+        until_seconds = min(to_seconds(current_time), self.newest_second)
+        after_seconds = max(
+            to_seconds(current_time) - since_number_of_seconds,
+            self.newest_second - self.ring_size,
+        )
+        base = row * self.ring_size
+        points = []
+        for seconds in range(after_seconds + 1, until_seconds + 1):
+            count = self.counts[base + seconds % self.ring_size]
+            if count:
+                points.append((from_seconds(seconds), count))
+
+        return points
+
+    def _rows_matching(self, metrics_namespace: str) -> list[int]:
+        """
+        Find (and remember) which series ids match a namespace. Series
+        are only ever added, so a cached answer just needs topping up
+        with any series added since.
+        """
+        seen, rows = self._namespace_rows.get(metrics_namespace, (0, []))
+        if seen < len(self.series):
+            for series in list(self.series.values())[seen:]:
+                if matches_namespace(series, metrics_namespace):
+                    rows.append(series.row)
+            self._namespace_rows[metrics_namespace] = (len(self.series), rows)
+
+        return rows
+
+    def total_count_since(
+        self,
+        current_time: datetime = datetime.now(),
+        since_number_of_seconds: int = 10,
+        metrics_namespace: str = "",
+    ) -> int:
+        """
+        See CountersCollection#total_count_since.
+        """
+        window = self.window_ranges(current_time, since_number_of_seconds)
+        ranges, bucket_ranges = window
+        if not ranges and not bucket_ranges:
+            return 0
+
+        rows = self._rows_matching(metrics_namespace)
+        columns = sum(end - start for start, end in ranges + bucket_ranges)
+
+        if len(rows) == len(self.series) and columns < len(rows):
+            # everything matches, so it's cheaper to sum whole columns
+            # (one per bucket) than to sum row by row.
+            ring_size = self.ring_size
+            bucket_ring_size = self.bucket_ring_size
+            return sum(
+                sum(self.counts[slot::ring_size])
+                for start, end in ranges
+                for slot in range(start, end)
+            ) + sum(
+                sum(self.bucket_counts[slot::bucket_ring_size])
+                for start, end in bucket_ranges
+                for slot in range(start, end)
+            )
+
+        return sum(self.row_totals(window, rows))
+
+    def total_counts_by_label(
+        self,
+        current_time: datetime = datetime.now(),
+        since_number_of_seconds: int = 10,
+        label: str = "section",
+    ) -> dict[str, int]:
+        """
+        See CountersCollection#total_counts_by_label. Grouping by
+        section uses the per-row section ids instead of label lookups.
+        """
+        window = self.window_ranges(current_time, since_number_of_seconds)
+        if not window[0] and not window[1]:
+            return {}
+
+        if label == "section":
+            group_names = self.sections
+            group_of_row = self.series_sections
+        else:
+            group_names = []
+            group_ids: dict[str, int] = {}
+            group_of_row = array("i")
+            for series in self.series.values():
+                value = dict(series.label_pairs).get(label)
+                if value is None:
+                    # left out, like CountersCollection#total_counts_by_label
+                    # leaves out series without the label (ex: host, when
+                    # reading a single log)
+                    group_of_row.append(-1)
+                    continue
+                if value not in group_ids:
+                    group_ids[value] = len(group_names)
+                    group_names.append(value)
+                group_of_row.append(group_ids[value])
+
+        group_totals = [0] * len(group_names)
+        for row, total in enumerate(self.row_totals(window)):
+            if total and group_of_row[row] >= 0:
+                group_totals[group_of_row[row]] += total
+
+        return {name: total for name, total in zip(group_names, group_totals) if total}
+
+    def approximate_bytes_per_series(self, sample_size: int = 32) -> float:
+        """
+        See CountersCollection#approximate_bytes_per_series. Every row
+        is the same size, so this is exact for the matrix itself.
+        """
+        if not self.series:
+            return 0.0
+
+        matrix_bytes = (
+            sys.getsizeof(self.counts)
+            + sys.getsizeof(self.bucket_counts)
+            + sys.getsizeof(self.series_sections)
+            + sys.getsizeof(self.totals)
+        )
+
+        return matrix_bytes / len(self.series) + sys.getsizeof(
+            next(iter(self.series.values()))
+        )
+
+    def downsample_series(self, series, resolution: int) -> int:  # type: ignore[override]
+        raise TypeError("Every row is a ring of one second buckets")
+
+    def shrink_series(self, series, max_length: int) -> int:  # type: ignore[override]
+        raise TypeError("Retention is the same for every row, see retention_in_seconds")
+
+    def evict_series(self, names: list[str]) -> int:
+        raise TypeError("Rows can't be removed from the matrix")
@@ -0,0 +1,203 @@
+import bz2
+import gzip
+import io
+import lzma
+import queue
+import threading
+from typing import BinaryIO, Callable, TextIO
+
+
+# how much decompressed data to ask for at a time. the decompressors
+# are all C, so big blocks keep the per-call overhead out of the way.
+BLOCK_SIZE = 1 << 20
+# how many blocks a BackgroundReader reads ahead
+BLOCKS_AHEAD = 4
+
+
+def open_zstd(path: str) -> BinaryIO:
+    # zstandard isn't in the standard library, so it's only needed once
+    # someone actually hands us a .zst.
+    try:
+        import zstandard  # type: ignore[import-not-found]
+    except ImportError as e:
+        raise ValueError(
+            "Reading zstd-compressed logs needs the zstandard package"
+        ) from e
+
+    # the reader closes the file when it's closed
+    return zstandard.ZstdDecompressor().stream_reader(
+        open(path, "rb"), read_across_frames=True
+    )
+
+
+# the magic bytes each compression format starts with, and how to open
+# it for streaming decompression.
+FORMATS: dict[str, tuple[bytes, Callable[[str], BinaryIO]]] = {
+    # gzip reads every member of a multi-member file in turn.
+    "gzip": (b"\x1f\x8b", lambda path: gzip.open(path, "rb")),
+    "bz2": (b"BZh", lambda path: bz2.open(path, "rb")),
+    "xz": (b"\xfd7zXZ\x00", lambda path: lzma.open(path, "rb")),
+    "zstd": (b"\x28\xb5\x2f\xfd", open_zstd),
+}
+
+
+def detect_compression(head: bytes) -> str | None:
+    """
+    Work out how a file is compressed from its first few bytes, rather
+    than trusting its extension.
+
+    Parameters
+    ----------
+    head : bytes
+            At least the first six bytes of the file (or all of it, if
+            it's shorter).
+
+    Returns
+    -------
+    str or None
+            The compression format (a key of FORMATS), or None for an
+            uncompressed file.
+    """
+    for name, (magic, _) in FORMATS.items():
+        if head.startswith(magic):
+            return name
+
+    return None
+
+
+class BackgroundReader(io.RawIOBase):
+    """
+    Reads a stream in blocks on a worker thread, a few blocks ahead of
+    whoever's reading from this. Decompressors release the GIL while
+    they work, so wrapping a decompressing stream in this lets
+    decompression of the next block overlap with parsing this one.
+
+    Attributes
+    ----------
+    stream : BinaryIO
+            The (usually decompressing) stream to read from.
+    block_size : int, optional
+            How much to read from the stream at a time. Defaults to
+            BLOCK_SIZE.
+    blocks_ahead : int, optional
+            The most blocks to read ahead, which bounds memory use.
+            Defaults to BLOCKS_AHEAD.
+    """
+
+    def __init__(
+        self,
+        stream: BinaryIO,
+        block_size: int = BLOCK_SIZE,
+        blocks_ahead: int = BLOCKS_AHEAD,
+    ) -> None:
+        super().__init__()
+        self.stream = stream
+        self.block_size = block_size
+        self.blocks: queue.Queue = queue.Queue(blocks_ahead)
+        self.pending = memoryview(b"")
+        self.finished = False
+        self.stopping = threading.Event()
+        self.thread = threading.Thread(
+            target=self._read_ahead, name="decompressor", daemon=True
+        )
+        self.thread.start()
+
+    def _put(self, block: bytes | Exception) -> bool:
+        while not self.stopping.is_set():
+            try:
+                self.blocks.put(block, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def _read_ahead(self) -> None:
+        try:
+            while block := self.stream.read(self.block_size):
+                if not self._put(block):
+                    return
+        except Exception as e:
+            self._put(e)
+            return
+
+        self._put(b"")
+
+    def readable(self) -> bool:
+        return True
+
+    def readinto(self, buffer) -> int:
+        if not self.pending:
+            if self.finished:
+                return 0
+
+            block = self.blocks.get()
+            if isinstance(block, Exception):
+                self.finished = True
+                raise block
+            if not block:
+                self.finished = True
+                return 0
+            self.pending = memoryview(block)
+
+        size = min(len(buffer), len(self.pending))
+        buffer[:size] = self.pending[:size]
+        self.pending = self.pending[size:]
+
+        return size
+
+    def close(self) -> None:
+        if not self.closed:
+            self.stopping.set()
+            self.thread.join()
+            self.stream.close()
+        super().close()
+
+
+def open_log_file(
+    path: str, buffering: int = -1, decompress_in_thread: bool = False
+) -> TextIO:
+    """
+    Open a log file for reading as text, transparently decompressing it
+    if it's gzip, bz2, xz or zstd compressed (going by its magic bytes,
+    not its name). Decompression streams in BLOCK_SIZE blocks straight
+    into the reader, so nothing is ever decompressed to disk.
+
+    Parameters
+    ----------
+    path : str
+            The file to open.
+    buffering : int, optional
+            Passed on to open for uncompressed files. Compressed ones are
+            read in blocks of this size if it's more than 1, or BLOCK_SIZE
+            otherwise. Defaults to -1.
+    decompress_in_thread : bool, optional
+            Whether to decompress on a worker thread (see
+            BackgroundReader). Ignored for uncompressed files. Defaults
+            to False.
+
+    Returns
+    -------
+    TextIO
+            The (decompressed) text, ready for a csv.DictReader.
+
+    Raises
+    ------
+    ValueError
+            If the file is zstd compressed and zstandard isn't
+            installed.
+    """
+    with open(path, "rb") as f:
+        compression = detect_compression(f.read(8))
+
+    if compression is None:
+        return open(path, buffering=buffering, newline="")
+
+    block_size = buffering if buffering > 1 else BLOCK_SIZE
+    stream = FORMATS[compression][1](path)
+    if decompress_in_thread:
+        stream = BackgroundReader(stream, block_size)  # type: ignore[assignment]
+
+    return io.TextIOWrapper(
+        io.BufferedReader(stream, buffer_size=block_size),  # type: ignore[arg-type]
+        newline="",
+    )
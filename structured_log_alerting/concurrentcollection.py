@@ -0,0 +1,256 @@
+import threading
+from datetime import datetime
+from typing import Any
+
+from structured_log_alerting.metricscollection import (
+    CountersCollection,
+    matches_namespace,
+)
+from structured_log_alerting.selfmetrics import SelfMetrics, instrumented
+from structured_log_alerting.sortedarraydict import to_seconds
+from structured_log_alerting.timeseries import CounterSeries
+
+
+class ConcurrentCountersCollection(CountersCollection):
+    """
+    A CountersCollection that any number of threads can add to and
+    query at the same time (ex: a reader thread ingesting, an evaluator
+    running alert rules and an HTTP server answering queries).
+
+    A plain CountersCollection isn't safe for that: adding a data point
+    to the middle of a series inserts into its seconds array and then
+    its counts array, and dropping the oldest point deletes from each
+    in turn, so a reader in between sees the arrays out of step. And a
+    new series changes the size of the series dict under anyone
+    iterating it. This uses two different approaches for the two kinds
+    of change:
+
+    - Data points are guarded by striped locks: each series belongs to
+      one of stripe_count stripes (by the hash of its name), and its
+      stripe's lock is held while a point is added to it or while it's
+      read from. Readers only ever hold one stripe at a time, and only
+      for as long as it takes to sum one series, so ingest into every
+      other stripe carries on and ingest into the same stripe waits for
+      at most that long.
+    - The series dict is copy-on-write: a new series is added to a copy
+      of the dict, which then replaces it in a single assignment. New
+      series are rare, and this way anything iterating self.series
+      (ex: QueryEngine) never needs a lock or sees it change size.
+
+    Every stripe also counts its writes, and the sum of those counts
+    (see #epoch) goes up with every write. #snapshot takes every stripe
+    lock at once for a consistent cut across all series, and reuses the
+    last one if the epoch hasn't moved since.
+
+    Attributes
+    ----------
+    max_series_length : int, optional
+            See CountersCollection.
+    self_metrics : SelfMetrics or None, optional
+            See CountersCollection. Histograms and counters in it aren't
+            locked, so with several writers they're approximate.
+    stripe_count : int, optional
+            How many locks to spread series across. More stripes means
+            less contention between writers to different series.
+            Defaults to 16.
+
+    Notes
+    -----
+    A QueryCache should only be used from a single thread, since its
+    invalidation reads self.dirty_seconds while writers add to it.
+    """
+
+    def __init__(
+        self,
+        max_series_length: int = 100,
+        self_metrics: SelfMetrics | None = None,
+        stripe_count: int = 16,
+    ) -> None:
+        super().__init__(max_series_length, self_metrics)
+        self.stripes: list[threading.Lock] = [
+            threading.Lock() for _ in range(stripe_count)
+        ]
+        self.stripe_epochs: list[int] = [0] * stripe_count
+        # only held to add series (and to snapshot), never to read.
+        self.series_lock = threading.Lock()
+        self._snapshot: tuple[tuple[int, int], Any] | None = None
+
+    @property
+    def epoch(self) -> int:
+        """
+        How many writes the collection has had, which only ever goes up.
+        Exact while holding every stripe lock, and a lower bound
+        otherwise.
+        """
+        return sum(self.stripe_epochs)
+
+    def stripe_of(self, counter_name: str) -> int:
+        """
+        Find which stripe (and lock) a series belongs to.
+        """
+        return hash(counter_name) % len(self.stripes)
+
+    def _add_series(
+        self, counter_name: str, parsed_log_file: dict
+    ) -> dict[str, CounterSeries]:
+        """
+        See CountersCollection#_add_series. Must be called with
+        self.series_lock held.
+        """
+        new_counter = self._new_series(counter_name, parsed_log_file)
+        # index it before anyone can find it in self.series, so a query
+        # that finds it there is guaranteed to find it in the index too.
+        self._index_series(new_counter)
+        if parsed_log_file["section"] not in self.sections:
+            self.sections.append(parsed_log_file["section"])
+
+        series = dict(self.series)
+        series[counter_name] = new_counter
+        self.series = series
+
+        return self.series
+
+    @instrumented("counterscollection.add_or_update_series")
+    def add_or_update_series(
+        self, counter_name: str, parsed_log_file: dict, count: int = 1
+    ) -> dict[str, CounterSeries]:
+        """
+        See CountersCollection#add_or_update_series. Safe to call from
+        any number of threads.
+        """
+        series = self.series.get(counter_name)
+        if series is None:
+            with self.series_lock:
+                # someone else may have added it while we waited
+                if counter_name not in self.series:
+                    self._add_series(counter_name, parsed_log_file)
+                series = self.series[counter_name]
+
+        stripe = self.stripe_of(counter_name)
+        with self.stripes[stripe]:
+            self._add_data_point(series, parsed_log_file["date"], count)
+            self.stripe_epochs[stripe] += 1
+
+        return self.series
+
+    def snapshot(self) -> "ConcurrentCountersCollection":  # type: ignore[override]
+        """
+        See CountersCollection#snapshot. The copy is taken with every
+        lock held, so it's consistent across series (writes to all of
+        them wait until it's done), and is reused until the next write.
+        """
+        with self.series_lock:
+            for lock in self.stripes:
+                lock.acquire()
+            try:
+                key = (self.epoch, len(self.series))
+                if self._snapshot is not None and self._snapshot[0] == key:
+                    return self._snapshot[1]
+
+                snapshot = super().snapshot()
+                stripe_epochs = list(self.stripe_epochs)
+            finally:
+                for lock in self.stripes:
+                    lock.release()
+
+        # the copy's only ever read, but give it its own locks anyway so
+        # reading it never waits on writers to this one.
+        snapshot.stripes = [threading.Lock() for _ in self.stripes]
+        snapshot.stripe_epochs = stripe_epochs
+        snapshot.series_lock = threading.Lock()
+        snapshot._snapshot = None
+        self._snapshot = (key, snapshot)
+
+        return snapshot  # type: ignore[return-value]
+
+    def total_count_since(
+        self,
+        current_time: datetime = datetime.now(),
+        since_number_of_seconds: int = 10,
+        metrics_namespace: str = "",
+    ) -> int:
+        """
+        See CountersCollection#total_count_since. Each series is read
+        with its stripe locked.
+        """
+        until_seconds = to_seconds(current_time)
+        after_seconds = until_seconds - since_number_of_seconds
+        stripes = self.stripes
+
+        count = 0
+        for series_name, series in self.series.items():
+            if matches_namespace(series, metrics_namespace):
+                with stripes[hash(series_name) % len(stripes)]:
+                    count += series.data_points.sum_between(
+                        after_seconds, until_seconds
+                    )
+
+        return count
+
+    def totals_for_series(
+        self,
+        series: list[CounterSeries],
+        current_time: datetime,
+        since_number_of_seconds: int,
+    ) -> list[int]:
+        """
+        See CountersCollection#totals_for_series. Each series is read
+        with its stripe locked.
+        """
+        until_seconds = to_seconds(current_time)
+        after_seconds = until_seconds - since_number_of_seconds
+        stripes = self.stripes
+
+        totals = []
+        for each in series:
+            with stripes[hash(each.name) % len(stripes)]:
+                totals.append(
+                    each.data_points.sum_between(after_seconds, until_seconds)
+                )
+
+        return totals
+
+    def points_for_series(
+        self,
+        series: list[CounterSeries],
+        current_time: datetime,
+        since_number_of_seconds: int,
+    ) -> list[list[tuple[datetime, int]]]:
+        """
+        See CountersCollection#points_for_series. Each series is read
+        with its stripe locked.
+        """
+        stripes = self.stripes
+
+        points = []
+        for each in series:
+            with stripes[hash(each.name) % len(stripes)]:
+                points.append(each.points_since(current_time, since_number_of_seconds))
+
+        return points
+
+    def total_counts_by_label(
+        self,
+        current_time: datetime = datetime.now(),
+        since_number_of_seconds: int = 10,
+        label: str = "section",
+    ) -> dict[str, int]:
+        """
+        See CountersCollection#total_counts_by_label. Each series is read
+        with its stripe locked.
+        """
+        all_series = list(self.series.values())
+        totals: dict[str, int] = {}
+        for series, count in zip(
+            all_series,
+            self.totals_for_series(all_series, current_time, since_number_of_seconds),
+        ):
+            if not count:
+                continue
+
+            for key, value in series.label_pairs:
+                if key == label:
+                    totals[value] = totals.get(value, 0) + count
+                    break
+
+        return totals
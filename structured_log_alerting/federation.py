@@ -0,0 +1,731 @@
+import asyncio
+import queue
+import random
+import socket
+import struct
+import threading
+import time
+from typing import Iterator, NamedTuple
+
+from structured_log_alerting.metricscollection import series_labels
+from structured_log_alerting.receiver import parse_address
+from structured_log_alerting.selfmetrics import SelfMetrics
+from structured_log_alerting.sortedarraydict import from_seconds, to_seconds
+from structured_log_alerting.timeseries import Labels
+
+
+MAGIC = b"SLAD"
+VERSION = 1
+
+# every message is framed by its length, and acked with its sequence
+FRAME_LENGTH = struct.Struct(">I")
+ACK = struct.Struct(">Q")
+# anything bigger than this is garbage, not a delta
+MAX_FRAME_LENGTH = 64 << 20
+
+
+class SeriesDelta(NamedTuple):
+    """
+    How much one series went up by, per second, since the last delta.
+    """
+
+    name: str
+    labels: Labels
+    # (seconds since the epoch, count), oldest first
+    points: list[tuple[int, int]]
+
+
+class Delta(NamedTuple):
+    """
+    Everything an edge counted between two shipments.
+    """
+
+    edge_id: str
+    # when the edge started, so a restarted edge (whose sequence
+    # numbers start over) isn't mistaken for retries of the old one.
+    epoch: int
+    # 1 for an edge's first delta, then counting up
+    sequence: int
+    series: list[SeriesDelta]
+
+
+def _write_varint(out: bytearray, value: int) -> None:
+    # unsigned LEB128: 7 bits at a time, low bits first, with the high
+    # bit set on every byte but the last.
+    while value > 0x7F:
+        out.append((value & 0x7F) | 0x80)
+        value >>= 7
+    out.append(value)
+
+
+def _read_varint(payload: bytes, offset: int) -> tuple[int, int]:
+    value = 0
+    shift = 0
+    while True:
+        if offset >= len(payload):
+            raise ValueError("Invalid delta, it's been cut short")
+        byte = payload[offset]
+        offset += 1
+        value |= (byte & 0x7F) << shift
+        if byte < 0x80:
+            return value, offset
+        shift += 7
+
+
+def _write_string(out: bytearray, value: str) -> None:
+    encoded = value.encode()
+    _write_varint(out, len(encoded))
+    out += encoded
+
+
+def _read_string(payload: bytes, offset: int) -> tuple[str, int]:
+    length, offset = _read_varint(payload, offset)
+    if offset + length > len(payload):
+        raise ValueError("Invalid delta, it's been cut short")
+    return payload[offset : offset + length].decode(), offset + length
+
+
+def encode_delta(delta: Delta) -> bytes:
+    """
+    Encode a delta compactly: every string (series names, label keys
+    and values) once, in a table at the front, then each series as
+    indexes into it and its points as varints, with each second stored
+    as the gap from the one before.
+
+    Parameters
+    ----------
+    delta : Delta
+            The delta to encode.
+
+    Returns
+    -------
+    bytes
+            The encoded delta, see #decode_delta.
+    """
+    strings: dict[str, int] = {}
+    for series in delta.series:
+        strings.setdefault(series.name, len(strings))
+        for key, value in series.labels:
+            strings.setdefault(key, len(strings))
+            strings.setdefault(value, len(strings))
+
+    out = bytearray(MAGIC)
+    out.append(VERSION)
+    _write_string(out, delta.edge_id)
+    _write_varint(out, delta.epoch)
+    _write_varint(out, delta.sequence)
+    _write_varint(out, len(strings))
+    for string in strings:
+        _write_string(out, string)
+
+    _write_varint(out, len(delta.series))
+    for series in delta.series:
+        _write_varint(out, strings[series.name])
+        _write_varint(out, len(series.labels))
+        for key, value in series.labels:
+            _write_varint(out, strings[key])
+            _write_varint(out, strings[value])
+        _write_varint(out, len(series.points))
+        previous = 0
+        for seconds, count in series.points:
+            _write_varint(out, seconds - previous)
+            _write_varint(out, count)
+            previous = seconds
+
+    return bytes(out)
+
+
+def decode_delta(payload: bytes) -> Delta:
+    """
+    The inverse of #encode_delta.
+
+    Parameters
+    ----------
+    payload : bytes
+            The encoded delta.
+
+    Returns
+    -------
+    Delta
+            The delta.
+
+    Raises
+    ------
+    ValueError
+            If the payload isn't a delta this version can read.
+    """
+    if payload[: len(MAGIC)] != MAGIC:
+        raise ValueError("Invalid delta, it doesn't start with " + repr(MAGIC))
+    if len(payload) <= len(MAGIC) or payload[len(MAGIC)] != VERSION:
+        raise ValueError("Unsupported delta version")
+
+    offset = len(MAGIC) + 1
+    edge_id, offset = _read_string(payload, offset)
+    epoch, offset = _read_varint(payload, offset)
+    sequence, offset = _read_varint(payload, offset)
+
+    string_count, offset = _read_varint(payload, offset)
+    strings = []
+    for _ in range(string_count):
+        string, offset = _read_string(payload, offset)
+        strings.append(string)
+
+    try:
+        series_count, offset = _read_varint(payload, offset)
+        series = []
+        for _ in range(series_count):
+            name_id, offset = _read_varint(payload, offset)
+            label_count, offset = _read_varint(payload, offset)
+            labels = []
+            for _ in range(label_count):
+                key_id, offset = _read_varint(payload, offset)
+                value_id, offset = _read_varint(payload, offset)
+                labels.append((strings[key_id], strings[value_id]))
+            point_count, offset = _read_varint(payload, offset)
+            points = []
+            seconds = 0
+            for _ in range(point_count):
+                gap, offset = _read_varint(payload, offset)
+                count, offset = _read_varint(payload, offset)
+                seconds += gap
+                points.append((seconds, count))
+            series.append(SeriesDelta(strings[name_id], tuple(labels), points))
+    except IndexError:
+        raise ValueError("Invalid delta, it refers to a string it doesn't have")
+
+    if offset != len(payload):
+        raise ValueError("Invalid delta, it has trailing bytes")
+
+    return Delta(edge_id, epoch, sequence, series)
+
+
+def parse_delta_address(address: str) -> tuple[str, str, int | None]:
+    """
+    Parse a central node's address, like receiver.parse_address but
+    for the stream-oriented schemes only, since a lost delta has to be
+    noticed and sent again.
+
+    Parameters
+    ----------
+    address : str
+            tcp://host:port or unix:///path/to/socket.
+
+    Returns
+    -------
+    tuple of (str, str, int or None)
+            See receiver.parse_address.
+
+    Raises
+    ------
+    ValueError
+            If the address can't be parsed, or is udp://.
+    """
+    scheme, host, port = parse_address(address)
+    if scheme not in ["tcp", "unix"]:
+        raise ValueError(
+            f"Invalid central address {address!r}, deltas go over tcp:// or unix://"
+        )
+
+    return scheme, host, port
+
+
+def _connect(address: str, timeout: float) -> socket.socket:
+    scheme, host, port = parse_delta_address(address)
+    if scheme == "tcp":
+        return socket.create_connection((host, port), timeout)
+
+    connection = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    connection.settimeout(timeout)
+    try:
+        connection.connect(host)
+    except OSError:
+        connection.close()
+        raise
+    return connection
+
+
+def _receive_exactly(connection: socket.socket, size: int) -> bytes:
+    data = b""
+    while len(data) < size:
+        chunk = connection.recv(size - len(data))
+        if not chunk:
+            raise ConnectionError("connection closed mid-message")
+        data += chunk
+    return data
+
+
+class DeltaShipper:
+    """
+    The edge role: rather than alerting, count parsed lines into
+    per-series, per-second deltas and ship them every interval seconds
+    to a central node (see DeltaReceiver), which merges the deltas
+    from every edge and alerts on the lot. Shipping pre-aggregated
+    counts instead of lines means the central node's work grows with
+    the number of series rather than with traffic.
+
+    Each delta gets the next sequence number and is sent (by a
+    background thread, so shipping never holds up parsing) until the
+    central node acks it. A delta whose ack got lost is sent again, and
+    the central node recognises the sequence number and doesn't count
+    it twice.
+
+    Deltas are shipped by #tick on busy streams, and otherwise by a
+    timer thread, so counts don't sit unshipped when lines stop coming
+    (ex: a quiet --listen). Counting and shipping share a lock.
+
+    Attributes
+    ----------
+    address : str
+            The central node, as tcp://host:port or unix:///path.
+    edge_id : str
+            What this edge is called. It should be unique among the
+            edges shipping to the same central node.
+    interval : float, optional
+            How often (in wall-clock seconds) to ship a delta. Defaults
+            to 1.
+    max_pending_deltas : int, optional
+            How many deltas can wait to be acked before #add blocks, so
+            an edge that can't reach its central node falls behind
+            instead of running out of memory. Defaults to 100.
+    timeout : float, optional
+            How long (in seconds) to wait on the central node before
+            trying again. Defaults to 5.
+    backoff : float, optional
+            How long (in seconds) to wait before reconnecting the first
+            time, doubling (with jitter) for every failure in a row up
+            to max_backoff. Defaults to 0.1.
+    max_backoff : float, optional
+            Defaults to 5.
+    self_metrics : SelfMetrics or None, optional
+            If given, what's shipped is counted as "edge.*" counters.
+            Defaults to None.
+    ticks_between_clock_checks : int, optional
+            See SelfMetrics. Defaults to 1000.
+    shipped_deltas : int
+    shipped_points : int
+    shipped_bytes : int
+            How much the central node has acked.
+    retries : int
+            How many times a delta had to be sent again.
+    """
+
+    def __init__(
+        self,
+        address: str,
+        edge_id: str,
+        interval: float = 1.0,
+        max_pending_deltas: int = 100,
+        timeout: float = 5.0,
+        backoff: float = 0.1,
+        max_backoff: float = 5.0,
+        self_metrics: SelfMetrics | None = None,
+        ticks_between_clock_checks: int = 1000,
+    ) -> None:
+        parse_delta_address(address)
+
+        self.address = address
+        self.edge_id = edge_id
+        self.interval = interval
+        self.timeout = timeout
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.self_metrics = self_metrics
+        self.ticks_between_clock_checks = ticks_between_clock_checks
+
+        self.epoch = time.time_ns()
+        self.sequence: int = 0
+        # series name: its labels, and its counts by second
+        self.pending: dict[str, tuple[Labels, dict[int, int]]] = {}
+        self.outbox: queue.Queue = queue.Queue(max_pending_deltas)
+        self.ticks: int = 0
+        self.last_shipment: float = time.monotonic()
+        self.lock = threading.Lock()
+
+        self.shipped_deltas: int = 0
+        self.shipped_points: int = 0
+        self.shipped_bytes: int = 0
+        self.retries: int = 0
+        self.reported: dict[str, int] = {}
+
+        self.stopping = threading.Event()
+        self.closing = threading.Event()
+        self.connection: socket.socket | None = None
+        self.thread = threading.Thread(target=self._send, name="edge", daemon=True)
+        self.thread.start()
+        self.timer = threading.Thread(
+            target=self._ship_when_quiet, name="edge-timer", daemon=True
+        )
+        self.timer.start()
+
+    def add(self, metric_name: str, parsed_log_line: dict, count: int = 1) -> None:
+        """
+        Count a parsed line into the next delta. The same arguments as
+        CountersCollection#add_or_update_series, so it can stand in for
+        one.
+
+        Parameters
+        ----------
+        metric_name : str
+                The series the line belongs to.
+        parsed_log_line : dict
+                The parsed line.
+        count : int, optional
+                How many events it stands for. Defaults to 1.
+        """
+        seconds = to_seconds(parsed_log_line["date"])
+        with self.lock:
+            pending = self.pending.get(metric_name)
+            if pending is None:
+                pending = self.pending[metric_name] = (
+                    tuple(series_labels(parsed_log_line).items()),
+                    {},
+                )
+            counts = pending[1]
+            counts[seconds] = counts.get(seconds, 0) + count
+
+    def tick(self) -> None:
+        """
+        Cheap enough to call once per line; ships a delta whenever
+        self.interval has passed.
+        """
+        self.ticks += 1
+        if self.ticks % self.ticks_between_clock_checks:
+            return
+
+        if time.monotonic() - self.last_shipment >= self.interval:
+            self.ship()
+
+    def ship(self) -> None:
+        """
+        Queue everything counted since the last delta as a new delta.
+        This only blocks if max_pending_deltas are still waiting to be
+        acked.
+        """
+        self._report()
+        self._ship()
+
+    def _ship(self) -> None:
+        # queued with the lock held, so deltas from #tick and the timer
+        # go out in sequence order
+        with self.lock:
+            self.last_shipment = time.monotonic()
+            if not self.pending:
+                return
+
+            pending, self.pending = self.pending, {}
+            self.sequence += 1
+            self.outbox.put(
+                Delta(
+                    self.edge_id,
+                    self.epoch,
+                    self.sequence,
+                    [
+                        SeriesDelta(name, labels, sorted(counts.items()))
+                        for name, (labels, counts) in pending.items()
+                    ],
+                )
+            )
+
+    def _ship_when_quiet(self) -> None:
+        # no lines means no #tick, so this ships what's pending once
+        # interval has passed without a shipment. it leaves self_metrics
+        # to #tick, since that's not thread-safe.
+        while not self.closing.wait(
+            max(self.last_shipment + self.interval - time.monotonic(), 0.05)
+        ):
+            if time.monotonic() - self.last_shipment >= self.interval:
+                self._ship()
+
+    def _disconnect(self) -> None:
+        if self.connection is not None:
+            self.connection.close()
+            self.connection = None
+
+    def _deliver(self, delta: Delta, payload: bytes) -> bool:
+        # one attempt at sending a delta and reading its ack
+        try:
+            if self.connection is None:
+                self.connection = _connect(self.address, self.timeout)
+            self.connection.sendall(FRAME_LENGTH.pack(len(payload)) + payload)
+            (acked,) = ACK.unpack(_receive_exactly(self.connection, ACK.size))
+        except OSError:
+            self._disconnect()
+            return False
+
+        if acked != delta.sequence:
+            self._disconnect()
+            return False
+        return True
+
+    def _send(self) -> None:
+        failures = 0
+        while (delta := self.outbox.get()) is not None:
+            payload = encode_delta(delta)
+            while not self._deliver(delta, payload):
+                if self.stopping.is_set():
+                    return
+                self.retries += 1
+                failures += 1
+                time.sleep(
+                    random.uniform(
+                        0, min(self.max_backoff, self.backoff * 2 ** (failures - 1))
+                    )
+                )
+            failures = 0
+            self.shipped_deltas += 1
+            self.shipped_points += sum(len(series.points) for series in delta.series)
+            self.shipped_bytes += len(payload)
+
+        self._disconnect()
+
+    def _report(self) -> None:
+        # the sender thread only touches plain ints, which are copied into
+        # self_metrics from the thread calling #ship.
+        if self.self_metrics is None:
+            return
+
+        for name, count in [
+            ("shipped_deltas", self.shipped_deltas),
+            ("shipped_points", self.shipped_points),
+            ("shipped_bytes", self.shipped_bytes),
+            ("retries", self.retries),
+        ]:
+            delta = count - self.reported.get(name, 0)
+            if delta:
+                self.self_metrics.increment(f"edge.{name}", delta)
+                self.reported[name] = count
+
+    def close(self, timeout: float | None = 30.0) -> bool:
+        """
+        Ship whatever's left, and wait (up to timeout seconds) for every
+        delta to be acked.
+
+        Parameters
+        ----------
+        timeout : float or None, optional
+                The longest to wait. Defaults to 30 seconds.
+
+        Returns
+        -------
+        bool
+                Whether everything was acked in time.
+        """
+        self.closing.set()
+        self.timer.join()
+        self.ship()
+        self.outbox.put(None)
+        self.thread.join(timeout)
+        delivered = not self.thread.is_alive()
+        # if not, give up on whatever's left
+        self.stopping.set()
+        self._report()
+
+        return delivered
+
+
+class DeltaReceiver:
+    """
+    The central role: receives deltas from DeltaShippers and hands
+    every point of every new delta to whoever's iterating over it, in
+    the same (metric name, parsed line, count) form as an
+    IngestPipeline, so the usual loop can add them to a collection and
+    alert on them.
+
+    Every edge's latest sequence number is remembered, and a delta
+    that's been seen before (ie a retry whose ack got lost) is acked
+    again but otherwise ignored, so retries never count twice. A
+    delta's ack is only sent once it's been queued, and the queue is
+    bounded, so an edge sending faster than deltas are merged waits for
+    its acks instead of piling up here.
+
+    Attributes
+    ----------
+    address : str
+            Where to listen, as tcp://host:port (a port of 0 picks a
+            free one, see self.bound_address) or unix:///path.
+    max_pending_deltas : int, optional
+            How many deltas can wait to be merged. Defaults to 100.
+    self_metrics : SelfMetrics or None, optional
+            If given, what's received is counted as "central.*"
+            counters. Defaults to None.
+    line_num : int
+            How many points have been handed over, for error messages
+            that expect a reader.
+    received_deltas : int
+    duplicate_deltas : int
+    invalid_deltas : int
+    received_points : int
+    """
+
+    def __init__(
+        self,
+        address: str,
+        max_pending_deltas: int = 100,
+        self_metrics: SelfMetrics | None = None,
+    ) -> None:
+        self.scheme, self.host, self.port = parse_delta_address(address)
+
+        self.address = address
+        self.self_metrics = self_metrics
+        self.deltas: queue.Queue = queue.Queue(max_pending_deltas)
+        # edge id: the epoch and sequence number of its latest delta
+        self.latest: dict[str, tuple[int, int]] = {}
+        self.bound_address = None
+        self.line_num: int = 0
+
+        # only ever written to by the event loop's thread
+        self.received_deltas: int = 0
+        self.duplicate_deltas: int = 0
+        self.invalid_deltas: int = 0
+        self.received_points: int = 0
+        self.reported: dict[str, int] = {}
+
+        self.loop: asyncio.AbstractEventLoop | None = None
+        self.thread: threading.Thread | None = None
+        self.ready = threading.Event()
+        self.closed = threading.Event()
+        self.startup_error: BaseException | None = None
+        self._stopped: asyncio.Event | None = None
+
+    def _is_new(self, delta: Delta) -> bool:
+        latest = self.latest.get(delta.edge_id)
+        if latest is not None and (delta.epoch, delta.sequence) <= latest:
+            return False
+
+        self.latest[delta.edge_id] = (delta.epoch, delta.sequence)
+        return True
+
+    async def _handle_edge(
+        self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter
+    ) -> None:
+        loop = asyncio.get_running_loop()
+        try:
+            while True:
+                (length,) = FRAME_LENGTH.unpack(
+                    await reader.readexactly(FRAME_LENGTH.size)
+                )
+                if length > MAX_FRAME_LENGTH:
+                    self.invalid_deltas += 1
+                    return
+                try:
+                    delta = decode_delta(await reader.readexactly(length))
+                except ValueError:
+                    self.invalid_deltas += 1
+                    return
+
+                if self._is_new(delta):
+                    # waiting for room on another thread, so this edge
+                    # waits for its ack but the others don't
+                    await loop.run_in_executor(None, self.deltas.put, delta)
+                    self.received_deltas += 1
+                    self.received_points += sum(
+                        len(series.points) for series in delta.series
+                    )
+                else:
+                    self.duplicate_deltas += 1
+
+                writer.write(ACK.pack(delta.sequence))
+                await writer.drain()
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            writer.close()
+
+    async def _serve(self) -> None:
+        self.loop = asyncio.get_running_loop()
+        self._stopped = asyncio.Event()
+        server = None
+        try:
+            if self.scheme == "tcp":
+                server = await asyncio.start_server(
+                    self._handle_edge, self.host, self.port
+                )
+                self.bound_address = server.sockets[0].getsockname()
+            else:
+                server = await asyncio.start_unix_server(self._handle_edge, self.host)
+                self.bound_address = self.host
+        except BaseException as e:
+            self.startup_error = e
+        self.ready.set()
+
+        if server is not None:
+            await self._stopped.wait()
+            server.close()
+            await server.wait_closed()
+
+    def start(self) -> "DeltaReceiver":
+        """
+        Start listening on a background thread.
+
+        Returns
+        -------
+        DeltaReceiver
+                self, for chaining.
+
+        Raises
+        ------
+        OSError
+                If the address couldn't be listened on.
+        """
+        self.thread = threading.Thread(
+            target=asyncio.run, args=(self._serve(),), name="central", daemon=True
+        )
+        self.thread.start()
+        self.ready.wait()
+        if self.startup_error is not None:
+            self.thread.join()
+            raise self.startup_error
+
+        return self
+
+    def close(self) -> None:
+        """
+        Stop listening. Deltas already received can still be read.
+        """
+        self.closed.set()
+        if self.loop is not None and self._stopped is not None:
+            self.loop.call_soon_threadsafe(self._stopped.set)
+        if self.thread is not None:
+            self.thread.join()
+
+    def __enter__(self) -> "DeltaReceiver":
+        return self.start()
+
+    def __exit__(self, *exc_info) -> None:
+        self.close()
+
+    def _report(self) -> None:
+        # the counters are written on the event loop's thread, so they're
+        # copied into self_metrics from this one as deltas.
+        if self.self_metrics is None:
+            return
+
+        for name, count in [
+            ("received_deltas", self.received_deltas),
+            ("duplicate_deltas", self.duplicate_deltas),
+            ("invalid_deltas", self.invalid_deltas),
+            ("received_points", self.received_points),
+        ]:
+            delta = count - self.reported.get(name, 0)
+            if delta:
+                self.self_metrics.increment(f"central.{name}", delta)
+                self.reported[name] = count
+
+    def __iter__(self) -> Iterator[tuple[str, dict, int]]:
+        if self.thread is None:
+            self.start()
+
+        while True:
+            try:
+                delta = self.deltas.get(timeout=0.1)
+            except queue.Empty:
+                if self.closed.is_set() and not self.thread.is_alive():  # type: ignore[union-attr]
+                    return
+                continue
+
+            self._report()
+            for series in delta.series:
+                labels = dict(series.labels)
+                for seconds, count in series.points:
+                    self.line_num += 1
+                    yield series.name, dict(labels, date=from_seconds(seconds)), count
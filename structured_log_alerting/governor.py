@@ -0,0 +1,213 @@
+import time
+
+from structured_log_alerting.metricscollection import CountersCollection
+from structured_log_alerting.selfmetrics import SelfMetrics, instrumented
+from structured_log_alerting.timeseries import CounterSeries
+
+
+def traffic(series: CounterSeries) -> tuple[int, int]:
+    """
+    How busy a series is, for ranking: its retained count, then how
+    recently it was last written to.
+    """
+    data_points = series.data_points
+    return sum(data_points.counts), data_points.seconds[-1] if data_points else 0
+
+
+class MemoryGovernor:
+    """
+    Keeps a CountersCollection under a memory budget, since otherwise
+    it grows with the number of series times max_series_length with
+    nothing to stop it.
+
+    Every interval (wall-clock) seconds, the collection's footprint is
+    measured (see CountersCollection#approximate_bytes). Nothing happens
+    until it's over high_water of the budget; then the quietest series
+    (see #traffic) give memory back, quietest first, until it's down to
+    low_water of the budget, in three steps, each only if the one
+    before didn't free enough:
+
+    1. Downsampling, to one data point per downsample_resolution
+       seconds (see CounterSeries#downsample). Totals over whole buckets
+       stay exact, but windows that cut a bucket in half don't.
+    2. Shortening, to min_series_length data points (see
+       CounterSeries#shrink), which drops their oldest data.
+    3. Evicting them altogether (see CountersCollection#evict_series).
+
+    Series are ranked by how much traffic they've had in the data they
+    still have, so busy series (the ones alerts are most likely about)
+    are the last to lose anything. A series that comes back after being
+    evicted starts from scratch.
+
+    Attributes
+    ----------
+    budget_in_bytes : int
+            The most the collection should take up.
+    interval : float, optional
+            How often (in wall-clock seconds) to measure it. Defaults
+            to 1.
+    high_water : float, optional
+            The fraction of the budget to start freeing memory at.
+            Defaults to 0.9.
+    low_water : float, optional
+            The fraction of the budget to free memory down to. Defaults
+            to 0.8.
+    downsample_resolution : int, optional
+            How many seconds each data point of a downsampled series
+            covers. Defaults to 10.
+    min_series_length : int, optional
+            How many data points shortened series keep. Defaults to 10.
+    self_metrics : SelfMetrics or None, optional
+            If given, every action is counted as
+            "governor.downsampled_series", "governor.shortened_series",
+            "governor.evicted_series" and "governor.freed_bytes", the
+            last measurement is the "governor.bytes" gauge and the budget
+            is the "governor.budget_bytes" gauge. Defaults to None.
+    ticks_between_clock_checks : int, optional
+            See SelfMetrics. Defaults to 1000.
+    approximate_bytes : int
+            The last measurement.
+    downsampled_series, shortened_series, evicted_series : int
+            How many series each step has been applied to.
+
+    Notes
+    -----
+    This only ever runs on the thread that ingests, between lines, so
+    it's not for a ConcurrentCountersCollection. Columnar collections
+    are already a fixed size for their series (see
+    ColumnarCountersCollection), and can't give any of it back.
+    """
+
+    def __init__(
+        self,
+        budget_in_bytes: int,
+        interval: float = 1.0,
+        high_water: float = 0.9,
+        low_water: float = 0.8,
+        downsample_resolution: int = 10,
+        min_series_length: int = 10,
+        self_metrics: SelfMetrics | None = None,
+        ticks_between_clock_checks: int = 1000,
+    ) -> None:
+        if budget_in_bytes <= 0:
+            raise ValueError("The memory budget should be more than 0")
+        if not 0 < low_water <= high_water <= 1:
+            raise ValueError(
+                "low_water and high_water should be fractions of the budget, low first"
+            )
+        if downsample_resolution < 2 or min_series_length < 1:
+            raise ValueError(
+                "downsample_resolution should be at least 2 and min_series_length at least 1"
+            )
+
+        self.budget_in_bytes = budget_in_bytes
+        self.interval = interval
+        self.high_water = high_water
+        self.low_water = low_water
+        self.downsample_resolution = downsample_resolution
+        self.min_series_length = min_series_length
+        self.self_metrics = self_metrics
+        self.ticks_between_clock_checks = ticks_between_clock_checks
+
+        self.ticks: int = 0
+        self.last_check: float = time.monotonic()
+        self.approximate_bytes: int = 0
+        self.downsampled_series: int = 0
+        self.shortened_series: int = 0
+        self.evicted_series: int = 0
+
+    def _record(self, name: str, series_count: int, freed_bytes: int) -> None:
+        setattr(self, name, getattr(self, name) + series_count)
+        self.approximate_bytes -= freed_bytes
+        if self.self_metrics is not None and series_count:
+            self.self_metrics.increment(f"governor.{name}", series_count)
+            self.self_metrics.increment("governor.freed_bytes", freed_bytes)
+
+    @instrumented("governor.enforce")
+    def enforce(self, collection: CountersCollection) -> int:
+        """
+        Measure the collection, and free memory now if it's over
+        high_water of the budget.
+
+        Parameters
+        ----------
+        collection : CountersCollection
+                The collection to keep under budget.
+
+        Returns
+        -------
+        int
+                Its approximate size afterwards, in bytes.
+        """
+        self.last_check = time.monotonic()
+        self.approximate_bytes = collection.approximate_bytes()
+        if self.self_metrics is not None:
+            self.self_metrics.set_gauge("governor.budget_bytes", self.budget_in_bytes)
+
+        if self.approximate_bytes > self.high_water * self.budget_in_bytes:
+            target = self.low_water * self.budget_in_bytes
+            quietest_first = sorted(collection.series.values(), key=traffic)
+
+            series_count = freed_bytes = 0
+            for series in quietest_first:
+                if self.approximate_bytes - freed_bytes <= target:
+                    break
+                if series.resolution < self.downsample_resolution:
+                    freed_bytes += collection.downsample_series(
+                        series, self.downsample_resolution
+                    )
+                    series_count += 1
+            self._record("downsampled_series", series_count, freed_bytes)
+
+            series_count = freed_bytes = 0
+            for series in quietest_first:
+                if self.approximate_bytes - freed_bytes <= target:
+                    break
+                if series.max_length > self.min_series_length:
+                    freed_bytes += collection.shrink_series(
+                        series, self.min_series_length
+                    )
+                    series_count += 1
+            self._record("shortened_series", series_count, freed_bytes)
+
+            evicted: list[str] = []
+            freed_bytes = 0
+            # evicting a series also frees its share of the labels and
+            # indexes, if nothing else shares them. this guesses an even
+            # share, and anything it's off by is made up for next time.
+            shared_bytes = (
+                self.approximate_bytes
+                - sum(series.approximate_bytes() for series in quietest_first)
+            ) / max(len(quietest_first), 1)
+            for series in quietest_first:
+                if self.approximate_bytes - freed_bytes <= target:
+                    break
+                evicted.append(series.name)
+                freed_bytes += series.approximate_bytes() + shared_bytes
+            if evicted:
+                freed_bytes = collection.evict_series(evicted)
+            self._record("evicted_series", len(evicted), freed_bytes)
+            # what was freed is only roughly what was counted as freed
+            self.approximate_bytes = collection.approximate_bytes()
+
+        if self.self_metrics is not None:
+            self.self_metrics.set_gauge("governor.bytes", self.approximate_bytes)
+
+        return self.approximate_bytes
+
+    def tick(self, collection: CountersCollection) -> None:
+        """
+        Cheap enough to call once per log line; #enforce-s the budget
+        whenever self.interval has passed.
+
+        Parameters
+        ----------
+        collection : CountersCollection
+                The collection to keep under budget.
+        """
+        self.ticks += 1
+        if self.ticks % self.ticks_between_clock_checks:
+            return
+
+        if time.monotonic() - self.last_check >= self.interval:
+            self.enforce(collection)
@@ -0,0 +1,525 @@
+import heapq
+import math
+from array import array
+from datetime import datetime
+from typing import NamedTuple
+
+from structured_log_alerting.selfmetrics import SelfMetrics
+from structured_log_alerting.sortedarraydict import from_seconds, to_seconds
+
+
+# how many time constants the landmark can fall behind before the
+# sketch is rescaled (e^100 is nowhere near overflowing a double)
+RESCALE_AFTER_TIME_CONSTANTS = 100
+
+
+class DecayedCountMinSketch:
+    """
+    A Count-Min sketch (see Cormode and Muthukrishnan, "An improved
+    data stream summary: the count-min sketch and its applications",
+    2005) of exponentially decayed counts: a count of n at second t is
+    worth n * e^-((now - t) / time_constant) by now.
+
+    Decaying every cell every second would be O(width * depth), so
+    counts are forward decayed instead (see Cormode et al., "Forward
+    decay: a practical time decay model for streaming systems", 2009):
+    each is scaled *up* by e^((t - landmark) / time_constant) when it's
+    added, and the whole sketch is scaled down by #decay only when it's
+    read. Every cell (and every estimate) is in the same units, so
+    comparing two of them needs no decaying at all. Once the landmark
+    falls RESCALE_AFTER_TIME_CONSTANTS time constants behind, every cell
+    is decayed once for real and the landmark moves up.
+
+    Adding uses the conservative update (Estan and Varghese, "New
+    directions in traffic measurement and accounting", 2002): only the
+    cells that would otherwise end up below the key's new estimate are
+    raised, which keeps estimates tighter and never below the truth.
+    With width = ceil(e / epsilon) and depth = ceil(ln(1 / delta)), an
+    estimate is more than epsilon times the decayed total too high with
+    probability at most delta.
+
+    Attributes
+    ----------
+    width : int
+            How many cells there are per row.
+    depth : int
+            How many rows (ie independent hashes) there are.
+    time_constant : float
+            How many seconds it takes a count to decay by a factor of e.
+    counts : array of float
+            The rows of cells, one after the other, in forward decayed
+            units.
+    total : float
+            The total of everything added, in forward decayed units.
+    landmark : int or None
+            The second (since the epoch) forward decay is relative to,
+            or None before anything's been added.
+    """
+
+    def __init__(self, width: int, depth: int, time_constant: float) -> None:
+        if width < 1 or depth < 1:
+            raise ValueError("A sketch needs at least one row and one column")
+        if time_constant <= 0:
+            raise ValueError("The time constant should be more than 0")
+
+        self.width = width
+        self.depth = depth
+        self.time_constant = time_constant
+        self.counts = array("d", bytes(8 * width * depth))
+        self.total: float = 0.0
+        self.landmark: int | None = None
+        self._row_offsets = range(0, width * depth, width)
+        # the forward decay scale for the last second added to
+        self._scale_second: int | None = None
+        self._scale: float = 1.0
+
+    @classmethod
+    def for_error(
+        cls, epsilon: float, delta: float, time_constant: float
+    ) -> "DecayedCountMinSketch":
+        """
+        Size a sketch for an error bound.
+
+        Parameters
+        ----------
+        epsilon : float
+                The most an estimate should be too high by, as a fraction
+                of the decayed total.
+        delta : float
+                The most the chance of exceeding that should be.
+        time_constant : float
+                How many seconds it takes a count to decay by a factor of
+                e.
+
+        Returns
+        -------
+        DecayedCountMinSketch
+                An empty sketch.
+        """
+        if not 0 < epsilon < 1 or not 0 < delta < 1:
+            raise ValueError("epsilon and delta should be between 0 and 1")
+
+        return cls(
+            math.ceil(math.e / epsilon), math.ceil(math.log(1 / delta)), time_constant
+        )
+
+    def indexes(self, key: str) -> list[int]:
+        """
+        Find a key's cell in every row.
+
+        Parameters
+        ----------
+        key : str
+                The key.
+
+        Returns
+        -------
+        list of int
+                Indexes into self.counts, one per row.
+        """
+        # double hashing (Kirsch and Mitzenmacher, "Less hashing, same
+        # performance", 2006): depth hashes from the two halves of one.
+        # str hashes are cached on the string and salted per process,
+        # which is fine since nothing outlives the process.
+        key_hash = hash(key)
+        first = key_hash & 0xFFFFFFFF
+        second = ((key_hash >> 32) & 0xFFFFFFFF) | 1
+        width = self.width
+        return [
+            offset + (first + row * second) % width
+            for row, offset in enumerate(self._row_offsets)
+        ]
+
+    def _rescale(self, seconds: int) -> None:
+        # decay everything to the new landmark for real
+        factor = math.exp((self.landmark - seconds) / self.time_constant)  # type: ignore[operator]
+        counts = self.counts
+        for i in range(len(counts)):
+            counts[i] *= factor
+        self.total *= factor
+        self.landmark = seconds
+        self._scale_second = None
+
+    def scale(self, seconds: int) -> float:
+        """
+        The forward decay scale for counts at a second, moving the
+        landmark up first if it's fallen too far behind.
+
+        Parameters
+        ----------
+        seconds : int
+                The second, since the epoch.
+
+        Returns
+        -------
+        float
+                What to multiply a count at that second by.
+        """
+        if seconds == self._scale_second:
+            return self._scale
+        if self.landmark is None:
+            self.landmark = seconds
+        elif (
+            seconds - self.landmark > RESCALE_AFTER_TIME_CONSTANTS * self.time_constant
+        ):
+            self._rescale(seconds)
+
+        self._scale_second = seconds
+        self._scale = math.exp((seconds - self.landmark) / self.time_constant)
+        return self._scale
+
+    def add(self, key: str, seconds: int, count: int = 1) -> float:
+        """
+        Count a key, in O(depth).
+
+        Parameters
+        ----------
+        key : str
+                What to count.
+        seconds : int
+                When, in seconds since the epoch.
+        count : int, optional
+                How many times. Defaults to 1.
+
+        Returns
+        -------
+        float
+                The key's new estimate, in forward decayed units.
+        """
+        return self.add_scaled(key, count * self.scale(seconds))
+
+    def add_scaled(self, key: str, scaled_count: float) -> float:
+        """
+        #add, for a count that's already been multiplied by its #scale.
+
+        Parameters
+        ----------
+        key : str
+                What to count.
+        scaled_count : float
+                How many times, in forward decayed units.
+
+        Returns
+        -------
+        float
+                The key's new estimate, in forward decayed units.
+        """
+        self.total += scaled_count
+        counts = self.counts
+        indexes = self.indexes(key)
+        estimate = min(map(counts.__getitem__, indexes)) + scaled_count
+        for i in indexes:
+            if counts[i] < estimate:
+                counts[i] = estimate
+
+        return estimate
+
+    def raise_to(self, key: str, estimate: float) -> None:
+        """
+        Make sure a key's estimate is at least as high as one counted
+        outside the sketch, ex: while it was a HeavyHitterDetector
+        candidate. Nothing's added to self.total.
+
+        Parameters
+        ----------
+        key : str
+                The key.
+        estimate : float
+                Its estimate, in forward decayed units.
+        """
+        counts = self.counts
+        for i in self.indexes(key):
+            if counts[i] < estimate:
+                counts[i] = estimate
+
+    def estimate(self, key: str) -> float:
+        """
+        Estimate a key's count, which is never too low.
+
+        Parameters
+        ----------
+        key : str
+                What to look up.
+
+        Returns
+        -------
+        float
+                The estimate, in forward decayed units.
+        """
+        counts = self.counts
+        return min(map(counts.__getitem__, self.indexes(key)))
+
+    def decay(self, seconds: int) -> float:
+        """
+        What to multiply a forward decayed count by to decay it to a
+        second.
+
+        Parameters
+        ----------
+        seconds : int
+                The second to decay to, in seconds since the epoch.
+
+        Returns
+        -------
+        float
+                The factor.
+        """
+        if self.landmark is None:
+            return 0.0
+        return math.exp((self.landmark - seconds) / self.time_constant)
+
+
+class HeavyHitter(NamedTuple):
+    """
+    A key going over or back under its rate threshold.
+    """
+
+    key: str
+    # "firing" or "resolved"
+    state: str
+    timestamp: datetime
+    # the estimated requests per second, and how far too high it might be
+    rate: float
+    error: float
+
+
+class HeavyHitterDetector:
+    """
+    Alerts on any single value of a label (ex: one remotehost) sending
+    more than a threshold of requests per second, without a series per
+    value: with millions of clients, one CounterSeries each in a
+    CountersCollection would take gigabytes.
+
+    Every line is counted into a DecayedCountMinSketch by its label
+    value as it's ingested, in O(depth). A key's rate is its decayed
+    count divided by the decayed count one request a second would have
+    built up, ie an exponentially weighted average of its requests per
+    second over roughly the last window_in_seconds (rather than exactly
+    the last window_in_seconds: a key that suddenly starts sending r a
+    second is estimated at 63% of r after a window, 95% after three).
+
+    The sketch can only answer for keys we ask about, so the heaviest
+    keys are kept as candidates in a min-heap of at most max_candidates,
+    ordered by estimate: a key is only admitted if its estimate beats
+    the lightest candidate's, which it then replaces. Since estimates
+    are all forward decayed by the same landmark, a key that's gone
+    quiet sinks relative to ones still sending without the heap ever
+    being reordered. Any key sending more than 1 / max_candidates of all
+    traffic stays a candidate. Candidates are counted in place, on top
+    of the estimate they were admitted with, rather than in the sketch
+    (so the busiest keys, which most lines are for, skip hashing
+    altogether), and written back to the sketch if they're pushed out.
+
+    Estimates are never too low, and are too high by more than
+    epsilon times the total rate (reported with every alert) with
+    probability at most delta, so a key can alert a little below the
+    threshold but never fails to alert above it. Memory is fixed by
+    epsilon, delta and max_candidates, however many keys there are.
+
+    Attributes
+    ----------
+    threshold : float
+            The requests per second a key alerts at.
+    label : str, optional
+            The series label to key by. Defaults to "remotehost".
+    window_in_seconds : float, optional
+            Roughly how many seconds to average rates over (the decay's
+            time constant). Defaults to 60.
+    max_candidates : int, optional
+            How many of the heaviest keys to track. Defaults to 1000.
+    epsilon : float, optional
+            See above. Defaults to 0.0001.
+    delta : float, optional
+            See above. Defaults to 0.001, which with the default
+            epsilon makes a sketch of 7 rows of 27183 cells, about 1.5MB.
+    self_metrics : SelfMetrics or None, optional
+            If given, #evaluate sets "heavyhitters.candidates" and
+            "heavyhitters.firing" gauges. Defaults to None.
+    sketch : DecayedCountMinSketch
+    candidates : dict of str: float
+            Every candidate's estimate, in forward decayed units.
+    firing : set of str
+            Every key that's over the threshold.
+    """
+
+    def __init__(
+        self,
+        threshold: float,
+        label: str = "remotehost",
+        window_in_seconds: float = 60,
+        max_candidates: int = 1000,
+        epsilon: float = 0.0001,
+        delta: float = 0.001,
+        self_metrics: SelfMetrics | None = None,
+    ) -> None:
+        if threshold <= 0:
+            raise ValueError("The rate threshold should be more than 0")
+        if max_candidates < 1:
+            raise ValueError("There should be room for at least one candidate")
+
+        self.threshold = threshold
+        self.label = label
+        self.window_in_seconds = window_in_seconds
+        self.max_candidates = max_candidates
+        self.epsilon = epsilon
+        self.delta = delta
+        self.self_metrics = self_metrics
+        self.sketch = DecayedCountMinSketch.for_error(epsilon, delta, window_in_seconds)
+        # what one request a second adds up to once decayed, ie the sum
+        # of e^(-k / window_in_seconds) for every second k
+        self.steady_count = 1 / (1 - math.exp(-1 / window_in_seconds))
+
+        self.candidates: dict[str, float] = {}
+        # one (estimate, key) per candidate, see #add
+        self._heap: list[tuple[float, str]] = []
+        self.firing: set[str] = set()
+
+    def _rescale_candidates(self, factor: float) -> None:
+        for key in self.candidates:
+            self.candidates[key] *= factor
+        self._heap = [(estimate, key) for key, estimate in self.candidates.items()]
+        heapq.heapify(self._heap)
+
+    def add(self, parsed_log_line: dict, count: int = 1) -> None:
+        """
+        Count a line.
+
+        Parameters
+        ----------
+        parsed_log_line : dict
+                The parsed line.
+        count : int, optional
+                How many events it stands for. Defaults to 1.
+        """
+        key = parsed_log_line[self.label]
+        sketch = self.sketch
+        landmark = sketch.landmark
+        scaled_count = count * sketch.scale(to_seconds(parsed_log_line["date"]))
+        if landmark is not None and sketch.landmark != landmark:
+            # the sketch was rescaled, so the candidates have to be too
+            self._rescale_candidates(
+                math.exp((landmark - sketch.landmark) / sketch.time_constant)  # type: ignore[operator]
+            )
+
+        candidates = self.candidates
+        estimate = candidates.get(key)
+        if estimate is not None:
+            # candidates are counted here rather than in the sketch, which
+            # is what most lines will be
+            candidates[key] = estimate + scaled_count
+            sketch.total += scaled_count
+            return
+
+        estimate = sketch.add_scaled(key, scaled_count)
+        heap = self._heap
+        if len(candidates) < self.max_candidates:
+            candidates[key] = estimate
+            heapq.heappush(heap, (estimate, key))
+            return
+
+        # heap entries are only updated once they get to the top, so
+        # they're never higher than the candidate's estimate: refresh
+        # the top until it's up to date, and it's the lightest candidate
+        while True:
+            lightest, lightest_key = heap[0]
+            current = candidates[lightest_key]
+            if current == lightest:
+                break
+            heapq.heapreplace(heap, (current, lightest_key))
+        if estimate <= lightest:
+            return
+
+        heapq.heapreplace(heap, (estimate, key))
+        del candidates[lightest_key]
+        candidates[key] = estimate
+        # so it's not underestimated once it's only in the sketch again
+        sketch.raise_to(lightest_key, lightest)
+
+    def rate(self, key: str, current_time: datetime) -> float:
+        """
+        Estimate a key's rate, candidate or not.
+
+        Parameters
+        ----------
+        key : str
+                The label value to look up.
+        current_time : datetime
+                The timestamp we should treat as the present.
+
+        Returns
+        -------
+        float
+                Its estimated requests per second, which is never too
+                low.
+        """
+        estimate = self.candidates.get(key)
+        if estimate is None:
+            estimate = self.sketch.estimate(key)
+        return (
+            estimate * self.sketch.decay(to_seconds(current_time)) / self.steady_count
+        )
+
+    def error_bound(self, current_time: datetime) -> float:
+        """
+        How far too high (in requests per second) any rate estimate
+        could be, with probability 1 - delta.
+
+        Parameters
+        ----------
+        current_time : datetime
+                The timestamp we should treat as the present.
+
+        Returns
+        -------
+        float
+                epsilon times the total rate.
+        """
+        return (
+            self.epsilon
+            * self.sketch.total
+            * self.sketch.decay(to_seconds(current_time))
+            / self.steady_count
+        )
+
+    def evaluate(self, current_time: datetime) -> list[HeavyHitter]:
+        """
+        Find every key that's gone over the threshold, or back under
+        it, in O(max_candidates).
+
+        Parameters
+        ----------
+        current_time : datetime
+                The timestamp we should treat as the present.
+
+        Returns
+        -------
+        list of HeavyHitter
+                Every state change, by key.
+        """
+        seconds = to_seconds(current_time)
+        timestamp = from_seconds(seconds)
+        to_rate = self.sketch.decay(seconds) / self.steady_count
+        error = self.error_bound(current_time)
+        # in forward decayed units, so candidates are compared as is
+        scaled_threshold = self.threshold / to_rate if to_rate > 0 else math.inf
+
+        transitions: list[HeavyHitter] = []
+        for key, estimate in self.candidates.items():
+            if estimate >= scaled_threshold and key not in self.firing:
+                self.firing.add(key)
+                transitions.append(
+                    HeavyHitter(key, "firing", timestamp, estimate * to_rate, error)
+                )
+        for key in list(self.firing):
+            # keys that are firing but were pushed out of the candidates
+            # are looked up in the sketch
+            rate = self.rate(key, current_time)
+            if rate < self.threshold:
+                self.firing.discard(key)
+                transitions.append(HeavyHitter(key, "resolved", timestamp, rate, error))
+
+        if self.self_metrics is not None:
+            self.self_metrics.set_gauge("heavyhitters.candidates", len(self.candidates))
+            self.self_metrics.set_gauge("heavyhitters.firing", len(self.firing))
+
+        return sorted(transitions)
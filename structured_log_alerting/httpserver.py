@@ -0,0 +1,344 @@
+import json
+import re
+import threading
+import time
+from datetime import datetime
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import NamedTuple
+from urllib.parse import parse_qs, urlsplit
+
+from structured_log_alerting.metricscollection import CountersCollection
+from structured_log_alerting.query import QueryEngine, parse_query
+from structured_log_alerting.selfmetrics import SelfMetrics
+from structured_log_alerting.sortedarraydict import to_seconds
+
+
+PROMETHEUS_CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+# only the labels every line in a series shares. the others (ex:
+# remotehost) are just whatever the series' first line had.
+EXPORTED_LABELS: list[str] = ["section", "status"]
+
+
+class MetricsSnapshot(NamedTuple):
+    """
+    Everything the server reads from, copied off the ingest thread in
+    one go and then never written to again.
+    """
+
+    counters_collection: CountersCollection
+    query_engine: QueryEngine
+    current_time: datetime
+    self_metrics_counters: dict[str, int]
+
+
+def escape_label_value(value: str) -> str:
+    """
+    Escape a label value for the Prometheus text format.
+    """
+    return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def render_metrics(snapshot: MetricsSnapshot) -> str:
+    """
+    Format a snapshot in the Prometheus text exposition format: every
+    series' lifetime total as a log_requests_total counter, plus a few
+    gauges about the collection and any self-metrics counters.
+
+    Parameters
+    ----------
+    snapshot : MetricsSnapshot
+            The snapshot to format.
+
+    Returns
+    -------
+    str
+            The formatted metrics.
+    """
+    lines = [
+        "# HELP log_requests_total Requests seen in the log, by series.",
+        "# TYPE log_requests_total counter",
+    ]
+    collection = snapshot.counters_collection
+    for name, series in sorted(collection.series.items()):
+        labels = dict(series.label_pairs)
+        label_text = ",".join(
+            [f'series="{escape_label_value(name)}"']
+            + [
+                f'{label}="{escape_label_value(labels[label])}"'
+                for label in EXPORTED_LABELS
+                if label in labels
+            ]
+        )
+        lines.append(f"log_requests_total{{{label_text}}} {series.total}")
+
+    lines += [
+        "# HELP log_series How many series are being tracked.",
+        "# TYPE log_series gauge",
+        f"log_series {len(collection.series)}",
+        "# HELP log_newest_timestamp_seconds The log's idea of the present.",
+        "# TYPE log_newest_timestamp_seconds gauge",
+        f"log_newest_timestamp_seconds {to_seconds(snapshot.current_time)}",
+    ]
+
+    for name, count in sorted(snapshot.self_metrics_counters.items()):
+        metric_name = "structured_log_alerting_" + re.sub(r"\W", "_", name)
+        lines += [f"# TYPE {metric_name}_total counter", f"{metric_name}_total {count}"]
+
+    return "\n".join(lines) + "\n"
+
+
+def run_query(snapshot: MetricsSnapshot, parameters: dict[str, list[str]]) -> dict:
+    """
+    Answer a /query request from a snapshot. With a "q" parameter, this
+    runs it through the snapshot's QueryEngine (see #parse_query for the
+    syntax). Without one, it's a plain windowed count like the alert
+    rules use: every series whose name contains "namespace" (defaulting
+    to all of them) over the last "window" seconds (defaulting to 10).
+
+    Parameters
+    ----------
+    snapshot : MetricsSnapshot
+            The snapshot to query.
+    parameters : dict of str: list of str
+            The request's query string, as parsed by urllib's parse_qs.
+            "time" optionally sets the end of the window as an ISO 8601
+            timestamp, and defaults to the snapshot's current time. One
+            with a UTC offset is converted to local time, like the log
+            timestamps are.
+
+    Returns
+    -------
+    dict
+            The JSON-serializable result.
+
+    Raises
+    ------
+    ValueError
+            If any of the parameters are invalid.
+    """
+    current_time = snapshot.current_time
+    if "time" in parameters:
+        current_time = datetime.fromisoformat(parameters["time"][0])
+        if current_time.tzinfo is not None:
+            # the collection's timestamps are naive local times
+            current_time = current_time.astimezone().replace(tzinfo=None)
+    response: dict = {"time": current_time.isoformat()}
+
+    if "q" not in parameters:
+        window = int(parameters.get("window", ["10"])[0])
+        if window <= 0:
+            raise ValueError("The window must be at least 1s")
+        namespace = parameters.get("namespace", [""])[0]
+        response.update(
+            type="count",
+            namespace=namespace,
+            window=window,
+            value=snapshot.counters_collection.total_count_since(
+                current_time, window, namespace
+            ),
+        )
+        return response
+
+    query = parse_query(parameters["q"][0])
+    response["query"] = parameters["q"][0]
+    if query.function is None:
+        vectors = snapshot.query_engine.range_vector(query, current_time)
+        response.update(
+            type="matrix",
+            result=[
+                {
+                    "series": name,
+                    "values": [[point.isoformat(), count] for point, count in points],
+                }
+                for name, points in vectors.items()
+            ],
+        )
+        return response
+
+    groups = snapshot.query_engine.evaluate(query, current_time)
+    response.update(
+        type="vector",
+        result=[
+            {"labels": dict(zip(query.by, group)), "value": value}
+            for group, value in groups.items()
+        ],
+    )
+
+    return response
+
+
+class MetricsRequestHandler(BaseHTTPRequestHandler):
+    """
+    Serves /metrics and /query from the owning MetricsServer's latest
+    snapshot.
+    """
+
+    server: "_HTTPServer"
+
+    def do_GET(self) -> None:
+        url = urlsplit(self.path)
+        snapshot = self.server.metrics_server.snapshot
+
+        if url.path not in ("/metrics", "/query"):
+            self._respond_json(404, {"error": f"Unknown path {url.path}"})
+        elif snapshot is None:
+            self._respond_json(503, {"error": "No data has been ingested yet"})
+        elif url.path == "/metrics":
+            self._respond(200, PROMETHEUS_CONTENT_TYPE, render_metrics(snapshot))
+        else:
+            try:
+                result = run_query(snapshot, parse_qs(url.query))
+            except ValueError as e:
+                self._respond_json(400, {"error": str(e)})
+            else:
+                self._respond_json(200, result)
+
+    def _respond(self, status: int, content_type: str, body: str) -> None:
+        encoded = body.encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(encoded)))
+        self.end_headers()
+        self.wfile.write(encoded)
+
+    def _respond_json(self, status: int, body: dict) -> None:
+        self._respond(status, "application/json", json.dumps(body))
+
+    def log_message(self, format: str, *args) -> None:
+        # the default writes a line to stderr for every request, which
+        # would drown out the stats dumps.
+        pass
+
+
+class _HTTPServer(ThreadingHTTPServer):
+    daemon_threads = True
+    metrics_server: "MetricsServer"
+
+
+class MetricsServer:
+    """
+    An embedded HTTP server exposing a collection's metrics in the
+    Prometheus text format on /metrics, and windowed counts and queries
+    as JSON on /query.
+
+    Requests are handled on their own threads and never touch the
+    collection being ingested into. Instead the ingest thread calls
+    #tick (or #publish) to copy the collection (see
+    CountersCollection#snapshot) every refresh_interval seconds, and
+    swaps the copy in as self.snapshot in a single assignment. Requests
+    read whichever snapshot is current when they arrive, so they can be
+    up to refresh_interval seconds stale, but neither side ever waits on
+    the other.
+
+    Attributes
+    ----------
+    counters_collection : CountersCollection
+            The collection to serve.
+    host : str, optional
+            The address to listen on. Defaults to "127.0.0.1".
+    port : int, optional
+            The port to listen on. Defaults to 0, which picks a free one
+            (see self.port once it's bound).
+    refresh_interval : float, optional
+            How often (in wall-clock seconds) #tick should publish a new
+            snapshot. Defaults to 1.
+    self_metrics : SelfMetrics or None, optional
+            If given, its counters are exported on /metrics too.
+            Defaults to None.
+    """
+
+    # see SelfMetrics.ticks_between_clock_checks
+    ticks_between_clock_checks: int = 1024
+
+    def __init__(
+        self,
+        counters_collection: CountersCollection,
+        host: str = "127.0.0.1",
+        port: int = 0,
+        refresh_interval: float = 1.0,
+        self_metrics: SelfMetrics | None = None,
+    ) -> None:
+        self.counters_collection = counters_collection
+        self.refresh_interval = refresh_interval
+        self.self_metrics = self_metrics
+
+        self.snapshot: MetricsSnapshot | None = None
+        self.last_publish: float = 0.0
+        self.ticks: int = 0
+
+        self.http_server = _HTTPServer((host, port), MetricsRequestHandler)
+        self.http_server.metrics_server = self
+        self.host, self.port = self.http_server.server_address[:2]
+        self.thread: threading.Thread | None = None
+
+    @property
+    def url(self) -> str:
+        return f"http://{self.host}:{self.port}"
+
+    def start(self) -> "MetricsServer":
+        """
+        Start serving on a background (daemon) thread.
+
+        Returns
+        -------
+        MetricsServer
+                self, for chaining.
+        """
+        self.thread = threading.Thread(
+            target=self.http_server.serve_forever,
+            name="metrics-server",
+            daemon=True,
+        )
+        self.thread.start()
+
+        return self
+
+    def stop(self) -> None:
+        """
+        Stop serving and close the listening socket.
+        """
+        if self.thread is not None:
+            self.http_server.shutdown()
+            self.thread.join()
+            self.thread = None
+        self.http_server.server_close()
+
+    def publish(self, current_time: datetime) -> None:
+        """
+        Snapshot the collection and start serving from the snapshot.
+        This should only be called from the thread ingesting into the
+        collection.
+
+        Parameters
+        ----------
+        current_time : datetime
+                The log's idea of the present, used as the default end
+                of /query windows.
+        """
+        snapshot = self.counters_collection.snapshot()
+        self.snapshot = MetricsSnapshot(
+            snapshot,
+            QueryEngine(snapshot),
+            current_time,
+            dict(self.self_metrics.counters) if self.self_metrics is not None else {},
+        )
+        self.last_publish = time.monotonic()
+
+    def tick(self, current_time: datetime) -> None:
+        """
+        Cheap enough to call once per log line; publishes a new snapshot
+        whenever self.refresh_interval has passed.
+
+        Parameters
+        ----------
+        current_time : datetime
+                See #publish.
+        """
+        self.ticks += 1
+        if self.snapshot is None:
+            self.publish(current_time)
+        elif self.ticks % self.ticks_between_clock_checks:
+            return
+        elif time.monotonic() - self.last_publish >= self.refresh_interval:
+            self.publish(current_time)
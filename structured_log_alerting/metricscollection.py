@@ -1,7 +1,59 @@
+import sys
 from abc import ABC, abstractmethod
+from copy import copy
 from datetime import datetime
+from itertools import islice
 
-from structured_log_alerting.timeseries import CounterSeries
+from structured_log_alerting.parser import without_host
+from structured_log_alerting.selfmetrics import SelfMetrics, instrumented
+from structured_log_alerting.sortedarraydict import to_seconds
+from structured_log_alerting.timeseries import CounterSeries, Labels
+
+
+# the fields of a parsed log line every series is labelled with, plus
+# the optional ones it's labelled with when they're there.
+SERIES_LABELS: list[str] = ["remotehost", "section", "endpoint", "http_verb", "status"]
+OPTIONAL_SERIES_LABELS: list[str] = ["host", "route"]
+
+
+def series_labels(parsed_log_file: dict) -> dict[str, str]:
+    """
+    Pick the labels a new series gets out of its first parsed log line.
+
+    Parameters
+    ----------
+    parsed_log_file : dict
+            The pre-parsed log line.
+
+    Returns
+    -------
+    dict of str: str
+            The labels.
+    """
+    # this should be put somewhere else, probably ideally some sort of
+    # parsed log class so we can grab via attr rather than hardcoding
+    # these strings everywhere.
+    labels = {label: parsed_log_file[label] for label in SERIES_LABELS}
+    for label in OPTIONAL_SERIES_LABELS:
+        if label in parsed_log_file:
+            labels[label] = parsed_log_file[label]
+
+    return labels
+
+
+def matches_namespace(series: CounterSeries, metrics_namespace: str) -> bool:
+    """
+    Whether a series is in a namespace, ie the namespace is in its name,
+    not counting its host (see parser.without_host).
+    """
+    if not metrics_namespace:
+        return True
+
+    for key, value in series.label_pairs:
+        if key == "host":
+            return without_host(series.name, value).find(metrics_namespace) >= 0
+
+    return series.name.find(metrics_namespace) >= 0
 
 
 class MetricsCollection(ABC):
@@ -15,6 +67,9 @@ class MetricsCollection(ABC):
         collection.
     sections : list of str
         The main API sections being tracked with metrics.
+    self_metrics : SelfMetrics or None, optional
+        Where to record the collection's own latency and error metrics.
+        Defaults to None, which skips recording them.
 
     Notes
     -----
@@ -24,9 +79,12 @@ class MetricsCollection(ABC):
     """
 
     @abstractmethod
-    def __init__(self, max_series_length: int = 100) -> None:
+    def __init__(
+        self, max_series_length: int = 100, self_metrics: SelfMetrics | None = None
+    ) -> None:
         self.max_series_length = max_series_length
         self.sections: list[str] = []
+        self.self_metrics = self_metrics
 
 
 class CountersCollection(MetricsCollection):
@@ -34,11 +92,72 @@ class CountersCollection(MetricsCollection):
     A collection of all counters specifically, so we can do counter-
     specific aggregations and queries (ex: summations) that wouldn't
     necessarily make sense for other types of metrics.
+
+    Label pairs and label sets are interned in self.label_table, so
+    series with the same labels (or some of the same labels) share
+    them rather than each carrying a copy. self.label_index maps each
+    label pair to the names of the series that have it, so queries can
+    find series by label without scanning all of them.
+
+    When self.dirty_seconds is a set rather than None (ex: a QueryCache
+    is attached), every second written to is added to it, so cached
+    results for windows containing that second can be thrown out.
+
+    Series are only ever added, except by #evict_series, which bumps
+    self.generation so anything that relies on that (ex: a QueryEngine's
+    plans) knows to start over.
+
+    Nothing here is locked, so other threads should read from a
+    #snapshot rather than from a collection that's still ingesting.
     """
 
-    def __init__(self, max_series_length: int = 100) -> None:
-        super().__init__(max_series_length)
+    def __init__(
+        self, max_series_length: int = 100, self_metrics: SelfMetrics | None = None
+    ) -> None:
+        super().__init__(max_series_length, self_metrics)
         self.series: dict[str, CounterSeries] = {}
+        self.label_table: dict = {}
+        self.label_index: dict[tuple[str, str], list[str]] = {}
+        self.dirty_seconds: set[int] | None = None
+        self.generation: int = 0
+
+    def intern_labels(self, labels: dict[str, str]) -> Labels:
+        """
+        Find or add the shared copy of a label set.
+
+        Parameters
+        ----------
+        labels : dict of str: str
+                The labels to intern.
+
+        Returns
+        -------
+        Labels
+                A tuple of (key, value) pairs, shared with every other
+                series with the same labels.
+        """
+        label_pairs = tuple(
+            self.label_table.setdefault(pair, pair) for pair in labels.items()
+        )
+
+        return self.label_table.setdefault(label_pairs, label_pairs)
+
+    def _index_series(self, series) -> None:
+        """
+        Add a new series to self.label_index.
+        """
+        for pair in series.label_pairs:
+            self.label_index.setdefault(pair, []).append(series.name)
+
+    def _new_series(self, counter_name: str, parsed_log_file: dict) -> CounterSeries:
+        """
+        Create (but don't add) a new counter series for a log line.
+        """
+        return CounterSeries(
+            counter_name,
+            self.intern_labels(series_labels(parsed_log_file)),
+            self.max_series_length,
+        )
 
     def _add_series(
         self, counter_name: str, parsed_log_file: dict
@@ -50,31 +169,17 @@ class CountersCollection(MetricsCollection):
         entire series. Use #add_or_update_series as your entry
         point into this class to avoid doing so.
         """
-        # cherry-pick the labels we care about from the log file
-        # this should be put somewhere else, probably ideally some
-        # sort of parsed log class so we can grab via attr rather
-        # than hardcoding these strings everywhere.
-        valid_labels: list[str] = [
-            "remotehost",
-            "section",
-            "endpoint",
-            "http_verb",
-            "status",
-        ]
-        labels: dict[str, str] = {}
-
-        for label in valid_labels:
-            labels[label] = parsed_log_file[label]
-
-        new_counter = CounterSeries(counter_name, labels, self.max_series_length)
+        new_counter = self._new_series(counter_name, parsed_log_file)
         self.series[counter_name] = new_counter
+        self._index_series(new_counter)
         if parsed_log_file["section"] not in self.sections:
             self.sections.append(parsed_log_file["section"])
 
         return self.series
 
+    @instrumented("counterscollection.add_or_update_series")
     def add_or_update_series(
-        self, counter_name: str, parsed_log_file: dict
+        self, counter_name: str, parsed_log_file: dict, count: int = 1
     ) -> dict[str, CounterSeries]:
         """
         Finds and updates or creates the appropriate counter series
@@ -86,6 +191,8 @@ class CountersCollection(MetricsCollection):
                 The counter series to find or add.
         parsed_log_file : dict
                 The pre-parsed log file as a dictionary.
+        count : int, optional
+                How many events the log file represents. Defaults to 1.
 
         Returns
         -------
@@ -95,10 +202,30 @@ class CountersCollection(MetricsCollection):
         if counter_name not in self.series:
             self._add_series(counter_name, parsed_log_file)
 
-        self.series[counter_name].add_data_point(parsed_log_file["date"])
+        self._add_data_point(self.series[counter_name], parsed_log_file["date"], count)
 
         return self.series
 
+    def _add_data_point(
+        self, series: CounterSeries, timestamp: datetime, count: int
+    ) -> None:
+        """
+        Add to a series, marking the second written to as dirty, and
+        the oldest second too if that fell off the end to make room.
+        """
+        if self.dirty_seconds is None:
+            series.add_data_point(timestamp, count)
+            return
+
+        data_points = series.data_points
+        oldest = (
+            data_points.seconds[0] if len(data_points) >= data_points.max_len else None
+        )
+        series.add_data_point(timestamp, count)
+        self.dirty_seconds.add(to_seconds(timestamp))
+        if oldest is not None and data_points.seconds[0] != oldest:
+            self.dirty_seconds.add(oldest)
+
     def total_count_since(
         self,
         current_time: datetime = datetime.now(),
@@ -127,9 +254,295 @@ class CountersCollection(MetricsCollection):
         int
                 The total count of events.
         """
+        # same as CounterSeries#total_count_since, but only converting
+        # current_time once rather than once per series.
+        until_seconds = to_seconds(current_time)
+        after_seconds = until_seconds - since_number_of_seconds
+
         count = 0
-        for series_name, series in self.series.items():
-            if series_name.find(metrics_namespace) >= 0:
-                count += series.total_count_since(current_time, since_number_of_seconds)
+        for series in self.series.values():
+            if matches_namespace(series, metrics_namespace):
+                count += series.data_points.sum_between(after_seconds, until_seconds)
 
         return count
+
+    def snapshot(self) -> "CountersCollection":
+        """
+        Take a point-in-time copy of the collection that later writes
+        won't show up in, so it can be queried from another thread (ex:
+        by a MetricsServer) while this one keeps ingesting.
+
+        Returns
+        -------
+        CountersCollection
+                The copy. It shares the label table, since interned
+                labels never change, but nothing it's queried through.
+        """
+        snapshot = copy(self)
+        snapshot.series = {name: series.copy() for name, series in self.series.items()}
+        snapshot.sections = list(self.sections)
+        snapshot.label_index = {
+            pair: list(names) for pair, names in self.label_index.items()
+        }
+        snapshot.dirty_seconds = None
+        snapshot.self_metrics = None
+
+        return snapshot
+
+    def totals_for_series(
+        self,
+        series: list[CounterSeries],
+        current_time: datetime,
+        since_number_of_seconds: int,
+    ) -> list[int]:
+        """
+        Total up each of a list of series since a specific time. This is
+        what queries use once they've worked out which series match.
+
+        Parameters
+        ----------
+        series : list of CounterSeries
+                The series to total up.
+        current_time : datetime
+                See #total_count_since.
+        since_number_of_seconds : int
+                See #total_count_since.
+
+        Returns
+        -------
+        list of int
+                Each series' total count of events, in the same order.
+        """
+        return [
+            each.total_count_since(current_time, since_number_of_seconds)
+            for each in series
+        ]
+
+    def points_for_series(
+        self,
+        series: list[CounterSeries],
+        current_time: datetime,
+        since_number_of_seconds: int,
+    ) -> list[list[tuple[datetime, int]]]:
+        """
+        List each of a list of series' data points within a window. This
+        is what range vector queries use once they've worked out which
+        series match.
+
+        Parameters
+        ----------
+        series : list of CounterSeries
+                The series to list the data points of.
+        current_time : datetime
+                See #total_count_since.
+        since_number_of_seconds : int
+                See #total_count_since.
+
+        Returns
+        -------
+        list of list of tuple of (datetime, int)
+                Each series' timestamps and counts, oldest first, in the
+                same order as series.
+        """
+        return [
+            each.points_since(current_time, since_number_of_seconds) for each in series
+        ]
+
+    def total_counts_by_label(
+        self,
+        current_time: datetime = datetime.now(),
+        since_number_of_seconds: int = 10,
+        label: str = "section",
+    ) -> dict[str, int]:
+        """
+        Total up every series since a specific time, grouped by the
+        value of one of their labels, in a single pass over the series
+        (rather than one #total_count_since scan per group).
+
+        Parameters
+        ----------
+        current_time : datetime, optional
+                See #total_count_since.
+        since_number_of_seconds : int, optional
+                See #total_count_since.
+        label : str, optional
+                The label to group by. Defaults to "section".
+
+        Returns
+        -------
+        dict of str: int
+                The total count of events for each label value, leaving
+                out values with no events in the window.
+        """
+        totals: dict[str, int] = {}
+        for series in self.series.values():
+            count = series.total_count_since(current_time, since_number_of_seconds)
+            if not count:
+                continue
+
+            for key, value in series.label_pairs:
+                if key == label:
+                    totals[value] = totals.get(value, 0) + count
+                    break
+
+        return totals
+
+    def approximate_bytes_per_series(self, sample_size: int = 32) -> float:
+        """
+        Estimate how much memory each series takes up by measuring a
+        small sample of them. This is only an approximation (it doesn't
+        count shared labels or the series dict itself) but it's cheap
+        enough to call from a periodic stats dump.
+
+        Parameters
+        ----------
+        sample_size : int, optional
+                How many series to measure. Defaults to 32.
+
+        Returns
+        -------
+        float
+                The mean estimated size of a series in bytes, or 0 if
+                there are no series yet.
+        """
+        sample = list(islice(self.series.values(), sample_size))
+        if not sample:
+            return 0.0
+
+        total_bytes = sum(series.approximate_bytes() for series in sample)
+
+        return total_bytes / len(sample)
+
+    def approximate_bytes(self) -> int:
+        """
+        Estimate the collection's whole footprint: every series (see
+        #approximate_bytes_per_series), the interned labels and the
+        indexes over them. Unlike #approximate_bytes_per_series this
+        measures everything, so it's O(series).
+
+        Returns
+        -------
+        int
+                The estimated size in bytes.
+        """
+        total_bytes = sys.getsizeof(self.series) + sys.getsizeof(self.label_table)
+        total_bytes += sum(
+            series.approximate_bytes() for series in self.series.values()
+        )
+        for interned in self.label_table:
+            # label pairs hold their strings, label sets hold pairs
+            total_bytes += sys.getsizeof(interned)
+            if interned and isinstance(interned[0], str):
+                total_bytes += sum(sys.getsizeof(string) for string in interned)
+        total_bytes += sys.getsizeof(self.label_index)
+        total_bytes += sum(sys.getsizeof(names) for names in self.label_index.values())
+
+        return total_bytes
+
+    def _mark_dirty(self, series: CounterSeries) -> None:
+        """
+        Throw out cached results for every second a series has a data
+        point at, before it's changed other than by adding to it.
+        """
+        if self.dirty_seconds is not None:
+            self.dirty_seconds.update(series.data_points.seconds)
+
+    def downsample_series(self, series: CounterSeries, resolution: int) -> int:
+        """
+        See CounterSeries#downsample.
+
+        Returns
+        -------
+        int
+                Roughly how many bytes that freed.
+        """
+        before = series.approximate_bytes()
+        self._mark_dirty(series)
+        series.downsample(resolution)
+        self._mark_dirty(series)
+
+        return before - series.approximate_bytes()
+
+    def shrink_series(self, series: CounterSeries, max_length: int) -> int:
+        """
+        See CounterSeries#shrink.
+
+        Returns
+        -------
+        int
+                Roughly how many bytes that freed.
+        """
+        before = series.approximate_bytes()
+        self._mark_dirty(series)
+        series.shrink(max_length)
+
+        return before - series.approximate_bytes()
+
+    def evict_series(self, names: list[str]) -> int:
+        """
+        Remove series altogether, ex: to stay under a memory budget.
+        Their sections stay in self.sections, but labels no other series
+        has any more are no longer interned.
+
+        Parameters
+        ----------
+        names : list of str
+                The series to remove.
+
+        Returns
+        -------
+        int
+                Roughly how many bytes that freed.
+        """
+        evicted = set(names)
+        self.generation += 1
+        freed = 0
+        label_sets = set()
+        for name in evicted:
+            series = self.series.pop(name)
+            self._mark_dirty(series)
+            freed += series.approximate_bytes()
+            label_sets.add(series.label_pairs)
+
+        # one pass per label pair rather than a list#remove per series,
+        # since pairs like ("status", "200") can have most series
+        for pair in {pair for label_set in label_sets for pair in label_set}:
+            names_with_pair = [
+                name for name in self.label_index[pair] if name not in evicted
+            ]
+            if names_with_pair:
+                self.label_index[pair] = names_with_pair
+            else:
+                del self.label_index[pair]
+                del self.label_table[pair]
+                freed += sys.getsizeof(pair) + sum(map(sys.getsizeof, pair))
+
+        for label_set in label_sets:
+            # a series that's still using it has all of its pairs, so
+            # it's enough to look through the series with the rarest one
+            names_with_pair = min(
+                (self.label_index.get(pair, []) for pair in label_set), key=len
+            )
+            if not any(
+                self.series[name].label_pairs is label_set for name in names_with_pair
+            ):
+                del self.label_table[label_set]
+                freed += sys.getsizeof(label_set)
+
+        # dicts don't give memory back as they empty out, so copy them
+        # into ones sized for what's left
+        before = (
+            sys.getsizeof(self.series)
+            + sys.getsizeof(self.label_table)
+            + sys.getsizeof(self.label_index)
+        )
+        self.series = dict(self.series)
+        self.label_table = dict(self.label_table)
+        self.label_index = dict(self.label_index)
+        freed += before - (
+            sys.getsizeof(self.series)
+            + sys.getsizeof(self.label_table)
+            + sys.getsizeof(self.label_index)
+        )
+
+        return freed
@@ -0,0 +1,431 @@
+import http.client
+import json
+import random
+import threading
+import time
+from typing import Callable
+from urllib.parse import urlsplit
+
+from structured_log_alerting.alertmanager import Alert
+from structured_log_alerting.pipeline import DROP_OLDEST, END_OF_QUEUE, BoundedQueue
+from structured_log_alerting.selfmetrics import SelfMetrics
+
+
+def alert_kind(alert: Alert) -> str:
+    """
+    What kind of alert this is, ie its name up to the first dot (ex:
+    "anomaly" for "anomaly.api"), so every section alerting on the same
+    problem at once ends up in one notification.
+    """
+    return alert.name.split(".", 1)[0]
+
+
+def alert_name(alert: Alert) -> str:
+    """
+    The alert's whole name, for a notification per alert.
+    """
+    return alert.name
+
+
+# how Notifier can group alerts into notifications
+GROUP_BY: dict[str, Callable[[Alert], str]] = {
+    "kind": alert_kind,
+    "name": alert_name,
+}
+
+# status codes worth trying again, rather than giving up on
+RETRYABLE_STATUSES = {408, 425, 429, 500, 502, 503, 504}
+
+
+def alert_record(alert: Alert) -> dict:
+    """
+    An alert as JSON-friendly data, for a notification payload.
+    """
+    return {
+        "name": alert.name,
+        "state": alert.state,
+        "time": alert.timestamp.isoformat(),
+        "value": round(alert.value, 2),
+        "message": alert.message,
+    }
+
+
+class WebhookClient:
+    """
+    POSTs JSON to a webhook over a small pool of keep-alive
+    connections, so a burst of notifications doesn't pay for a new TCP
+    (and TLS) handshake each, retrying failures with exponential
+    backoff and jitter.
+
+    Attributes
+    ----------
+    url : str
+            The http:// or https:// URL to POST to.
+    timeout : float, optional
+            How long (in seconds) to wait on a connection before giving
+            up on an attempt. Defaults to 5.
+    max_retries : int, optional
+            How many times to retry a failed attempt. Connection errors,
+            timeouts and RETRYABLE_STATUSES are retried, anything else
+            (ex: a 400) isn't. Defaults to 3.
+    backoff : float, optional
+            How long (in seconds) to wait before the first retry. Each
+            retry waits up to twice as long as the last, picked at
+            random so a lot of clients retrying together spread out.
+            Defaults to 0.5.
+    max_backoff : float, optional
+            The longest to wait between retries. Defaults to 10.
+    pool_size : int, optional
+            How many idle connections to keep open. Defaults to 2.
+    requests : int
+            How many requests were attempted, including retries.
+    retries : int
+            How many of those were retries.
+    """
+
+    def __init__(
+        self,
+        url: str,
+        timeout: float = 5.0,
+        max_retries: int = 3,
+        backoff: float = 0.5,
+        max_backoff: float = 10.0,
+        pool_size: int = 2,
+    ) -> None:
+        parts = urlsplit(url)
+        if parts.scheme not in ("http", "https") or not parts.hostname:
+            raise ValueError(f"Invalid webhook URL {url!r}, it should be http(s)://")
+
+        self.url = url
+        self.timeout = timeout
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.pool_size = pool_size
+
+        self.connection_class = (
+            http.client.HTTPSConnection
+            if parts.scheme == "https"
+            else http.client.HTTPConnection
+        )
+        self.host = parts.hostname
+        self.port = parts.port
+        self.path = (parts.path or "/") + (f"?{parts.query}" if parts.query else "")
+
+        self.idle: list[http.client.HTTPConnection] = []
+        self.lock = threading.Lock()
+        self.requests: int = 0
+        self.retries: int = 0
+
+    def _connection(self) -> tuple[http.client.HTTPConnection, bool]:
+        # a connection, and whether it's an idle one being reused
+        with self.lock:
+            if self.idle:
+                # the most recently used one, the least likely to have
+                # been closed by the other end for idling
+                return self.idle.pop(), True
+
+        return self.connection_class(self.host, self.port, timeout=self.timeout), False
+
+    def _release(self, connection: http.client.HTTPConnection) -> None:
+        with self.lock:
+            if len(self.idle) < self.pool_size:
+                self.idle.append(connection)
+                return
+
+        connection.close()
+
+    def _attempt(self, body: bytes) -> int:
+        while True:
+            connection, reused = self._connection()
+            try:
+                connection.request(
+                    "POST",
+                    self.path,
+                    body,
+                    {"Content-Type": "application/json", "Connection": "keep-alive"},
+                )
+                response = connection.getresponse()
+                # read it all, or the connection can't be reused
+                response.read()
+                break
+            except (ConnectionError, http.client.RemoteDisconnected):
+                connection.close()
+                # the other end closed it while it sat idle, which isn't
+                # the webhook failing, so try again on a new one.
+                if not reused:
+                    raise
+            except (OSError, http.client.HTTPException):
+                connection.close()
+                raise
+
+        if response.will_close:
+            connection.close()
+        else:
+            self._release(connection)
+        return response.status
+
+    def post(self, payload: dict) -> bool:
+        """
+        POST a payload, retrying until it succeeds or runs out of
+        retries. This blocks for as long as that takes, so it belongs
+        on a background thread.
+
+        Parameters
+        ----------
+        payload : dict
+                The payload, serialized as JSON.
+
+        Returns
+        -------
+        bool
+                Whether the webhook accepted it with a 2xx.
+        """
+        body = json.dumps(payload, separators=(",", ":")).encode()
+        for attempt in range(self.max_retries + 1):
+            if attempt > 0:
+                with self.lock:
+                    self.retries += 1
+                time.sleep(
+                    random.uniform(
+                        0, min(self.max_backoff, self.backoff * 2 ** (attempt - 1))
+                    )
+                )
+
+            with self.lock:
+                self.requests += 1
+            try:
+                status = self._attempt(body)
+            except (OSError, http.client.HTTPException):
+                continue
+
+            if 200 <= status < 300:
+                return True
+            if status not in RETRYABLE_STATUSES:
+                return False
+
+        return False
+
+    def close(self) -> None:
+        """
+        Close every idle connection.
+        """
+        with self.lock:
+            idle, self.idle = self.idle, []
+        for connection in idle:
+            connection.close()
+
+
+class Notifier:
+    """
+    The notification stage: sends alert transitions somewhere a person
+    will see them (via a WebhookClient) without ever holding up alert
+    evaluation, and without paging anyone 50 times when a shared
+    backend takes down 50 sections at once.
+
+    #notify only ever takes a lock and appends to a list. A dispatcher
+    thread wakes up every group_interval seconds, groups whatever came
+    in since (ex: every "anomaly.*" alert together) and queues a
+    notification per group of up to batch_size alerts. Sender threads
+    deliver them. If the webhook is slow or down and notifications pile
+    up, the oldest are dropped rather than blocking anything.
+
+    An alert that repeats the state it was last notified in (ex: firing
+    twice) within repeat_interval is left out of notifications
+    altogether.
+
+    Attributes
+    ----------
+    client : WebhookClient
+            Where to deliver notifications.
+    group_by : str, optional
+            One of GROUP_BY: "kind" (the default) groups alerts by the
+            first part of their name, "name" gives every alert its own
+            notification.
+    group_interval : float, optional
+            How long (in wall-clock seconds) to collect alerts before
+            sending what's been grouped. Defaults to 1.
+    repeat_interval : float, optional
+            How long (in seconds of log time) to suppress an alert in a
+            state it's already been notified in. Defaults to an hour.
+    batch_size : int, optional
+            The most alerts in one notification. Defaults to 100.
+    max_pending : int, optional
+            The most notifications waiting to be delivered (and, times
+            batch_size, alerts waiting to be grouped) before the oldest
+            are dropped. Defaults to 1000.
+    senders : int, optional
+            How many threads deliver notifications. Defaults to the
+            client's pool_size.
+    self_metrics : SelfMetrics or None, optional
+            If given, delivery is counted as "notifier.*" counters.
+            Defaults to None.
+    sent_alerts : int
+    deduplicated_alerts : int
+    dropped_alerts : int
+            How many alerts were delivered, suppressed as repeats, or
+            dropped (because they piled up, or the webhook never took
+            them).
+    sent_notifications : int
+    failed_notifications : int
+    """
+
+    def __init__(
+        self,
+        client: WebhookClient,
+        group_by: str = "kind",
+        group_interval: float = 1.0,
+        repeat_interval: float = 3600.0,
+        batch_size: int = 100,
+        max_pending: int = 1000,
+        senders: int | None = None,
+        self_metrics: SelfMetrics | None = None,
+    ) -> None:
+        if group_by not in GROUP_BY:
+            raise ValueError(
+                f"Invalid group_by {group_by!r}, it should be one of "
+                + ", ".join(GROUP_BY)
+            )
+        if batch_size < 1 or max_pending < 1:
+            raise ValueError("batch_size and max_pending should be at least 1")
+
+        self.client = client
+        self.group_by = group_by
+        self.group_key = GROUP_BY[group_by]
+        self.group_interval = group_interval
+        self.repeat_interval = repeat_interval
+        self.batch_size = batch_size
+        self.max_pending = max_pending
+        self.self_metrics = self_metrics
+
+        # alert name: the last state it was notified in, and when
+        self.last_notified: dict[str, tuple[str, float]] = {}
+        self.pending: dict[str, list[Alert]] = {}
+        self.pending_count: int = 0
+        self.lock = threading.Lock()
+        self.outbox = BoundedQueue("notifications", max_pending, DROP_OLDEST)
+
+        self.sent_alerts: int = 0
+        self.deduplicated_alerts: int = 0
+        self.dropped_alerts: int = 0
+        self.sent_notifications: int = 0
+        self.failed_notifications: int = 0
+        self.reported: dict[str, int] = {}
+
+        self.stopping = threading.Event()
+        self.threads: list[threading.Thread] = [
+            threading.Thread(target=self._dispatch, name="notify-dispatch", daemon=True)
+        ] + [
+            threading.Thread(target=self._send, name=f"notify-send-{i}", daemon=True)
+            for i in range(senders if senders is not None else client.pool_size)
+        ]
+        for thread in self.threads:
+            thread.start()
+
+    def _is_repeat(self, alert: Alert) -> bool:
+        seconds = alert.timestamp.timestamp()
+        last = self.last_notified.get(alert.name)
+        if (
+            last is not None
+            and last[0] == alert.state
+            and seconds - last[1] < self.repeat_interval
+        ):
+            return True
+
+        self.last_notified[alert.name] = (alert.state, seconds)
+        return False
+
+    def notify(self, alert: Alert) -> None:
+        """
+        Queue an alert transition to be grouped and delivered. This
+        never waits on the webhook.
+
+        Parameters
+        ----------
+        alert : Alert
+                The alert transition.
+        """
+        if self._is_repeat(alert):
+            self.deduplicated_alerts += 1
+        else:
+            with self.lock:
+                if self.pending_count >= self.max_pending * self.batch_size:
+                    self.dropped_alerts += 1
+                else:
+                    self.pending.setdefault(self.group_key(alert), []).append(alert)
+                    self.pending_count += 1
+
+        self._report()
+
+    def _queue_pending(self) -> None:
+        with self.lock:
+            pending, self.pending = self.pending, {}
+            self.pending_count = 0
+
+        for group, alerts in pending.items():
+            for start in range(0, len(alerts), self.batch_size):
+                batch = alerts[start : start + self.batch_size]
+                # weighted, so what the outbox drops is counted in alerts
+                self.outbox.put([(group, batch)], weight=len(batch))
+
+    def _dispatch(self) -> None:
+        while not self.stopping.wait(self.group_interval):
+            self._queue_pending()
+
+        self._queue_pending()
+        self.outbox.close()
+
+    def _send(self) -> None:
+        while (batch := self.outbox.get()) is not END_OF_QUEUE:
+            [(group, alerts)], _ = batch
+            payload = {
+                "group": group,
+                "alerts": [alert_record(alert) for alert in alerts],
+            }
+            delivered = self.client.post(payload)
+            with self.lock:
+                if delivered:
+                    self.sent_notifications += 1
+                    self.sent_alerts += len(alerts)
+                else:
+                    self.failed_notifications += 1
+                    self.dropped_alerts += len(alerts)
+
+    def _report(self) -> None:
+        # the sender threads only touch plain ints, which are copied into
+        # self_metrics from the thread calling #notify.
+        if self.self_metrics is None:
+            return
+
+        counts = {
+            "notifier.sent_alerts": self.sent_alerts,
+            "notifier.deduplicated_alerts": self.deduplicated_alerts,
+            "notifier.dropped_alerts": self.dropped_alerts + self.outbox.dropped,
+            "notifier.sent_notifications": self.sent_notifications,
+            "notifier.failed_notifications": self.failed_notifications,
+            "notifier.retries": self.client.retries,
+        }
+        for name, count in counts.items():
+            delta = count - self.reported.get(name, 0)
+            if delta:
+                self.self_metrics.increment(name, delta)
+                self.reported[name] = count
+
+    def close(self, timeout: float | None = 30.0) -> None:
+        """
+        Send anything still pending, and wait (up to timeout seconds)
+        for it to be delivered before closing the client.
+
+        Parameters
+        ----------
+        timeout : float or None, optional
+                The longest to wait for delivery. Defaults to 30 seconds.
+        """
+        self.stopping.set()
+        deadline = None if timeout is None else time.monotonic() + timeout
+        for thread in self.threads:
+            thread.join(
+                None if deadline is None else max(0.0, deadline - time.monotonic())
+            )
+        self._report()
+        self.client.close()
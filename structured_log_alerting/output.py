@@ -0,0 +1,296 @@
+import json
+import sys
+import threading
+import time
+from abc import ABC, abstractmethod
+from datetime import datetime
+from typing import TextIO
+
+from structured_log_alerting.alertmanager import Alert
+from structured_log_alerting.notify import Notifier
+
+
+class OutputSink(ABC):
+    """
+    Generic buffered output sink for summaries and alert transitions,
+    used to subclass specific output formats. Formatted lines are held
+    in a buffer and written to the stream in a single call once the
+    buffer is full or the flush interval has passed. With a flush
+    interval, a timer thread also flushes the buffer when nothing new
+    is written for that long, and writing and flushing share a lock.
+
+    Attributes
+    ----------
+    stream : TextIO
+            Where formatted lines are written.
+    buffer_size : int, optional
+            How many lines to hold before writing them out. Defaults to 1,
+            which writes every line as soon as it's formatted (like print).
+    flush_interval : float or None, optional
+            The most time (in wall-clock seconds) a line should sit in the
+            buffer before being written, checked whenever something new is
+            written and by the timer thread. Defaults to None, which only
+            flushes on buffer_size.
+    notifier : Notifier or None, optional
+            If given, every alert transition written is also sent on to
+            it, to be grouped and delivered elsewhere (ex: a webhook).
+            Defaults to None.
+    """
+
+    def __init__(
+        self,
+        stream: TextIO,
+        buffer_size: int = 1,
+        flush_interval: float | None = None,
+        notifier: Notifier | None = None,
+    ) -> None:
+        self.stream = stream
+        self.buffer_size = buffer_size
+        self.flush_interval = flush_interval
+        self.notifier = notifier
+
+        self.buffer: list[str] = []
+        self.last_flush: float = time.monotonic()
+        self.lock = threading.Lock()
+
+        self.closing = threading.Event()
+        self.timer: threading.Thread | None = None
+        if flush_interval is not None:
+            self.timer = threading.Thread(
+                target=self._flush_when_quiet,
+                args=(flush_interval,),
+                name="output-timer",
+                daemon=True,
+            )
+            self.timer.start()
+
+    @abstractmethod
+    def format_summary(self, current_time: datetime, summary: list[str]) -> list[str]:
+        pass
+
+    @abstractmethod
+    def format_alert(self, alert: Alert) -> str:
+        pass
+
+    def write_summary(self, current_time: datetime, summary: list[str]) -> None:
+        """
+        Write a summary from AlertManager#provide_summary_for_interval.
+
+        Parameters
+        ----------
+        current_time : datetime
+                The time the summary was generated for.
+        summary : list of str
+                The summary statements.
+        """
+        self.write_lines(self.format_summary(current_time, summary))
+
+    def write_alert(self, alert: Alert) -> None:
+        """
+        Write a single alert transition.
+
+        Parameters
+        ----------
+        alert : Alert
+                The alert transition to write.
+        """
+        self.write_lines([self.format_alert(alert)])
+        if self.notifier is not None:
+            self.notifier.notify(alert)
+
+    def write_lines(self, lines: list[str]) -> None:
+        """
+        Add already-formatted lines to the buffer, flushing if the
+        buffer is full or it's been too long since the last flush.
+
+        Parameters
+        ----------
+        lines : list of str
+                The lines to write, each ending in a newline.
+        """
+        with self.lock:
+            self.buffer.extend(lines)
+
+            if len(self.buffer) >= self.buffer_size or (
+                self.flush_interval is not None
+                and time.monotonic() - self.last_flush >= self.flush_interval
+            ):
+                self._flush()
+
+    def flush(self) -> None:
+        """
+        Write everything in the buffer to the stream with a single call.
+        """
+        with self.lock:
+            self._flush()
+
+    def _flush(self) -> None:
+        if self.buffer:
+            self.stream.write("".join(self.buffer))
+            self.buffer.clear()
+
+        self.stream.flush()
+        self.last_flush = time.monotonic()
+
+    def _flush_when_quiet(self, flush_interval: float) -> None:
+        # a quiet stream means no #write_lines to notice the interval
+        # passing, so this flushes whatever's been sitting that long
+        while not self.closing.wait(
+            max(self.last_flush + flush_interval - time.monotonic(), 0.05)
+        ):
+            if time.monotonic() - self.last_flush >= flush_interval:
+                self.flush()
+
+    def close(self) -> None:
+        """
+        Flush anything left in the buffer (and deliver anything left
+        with the notifier). Subclasses that own their stream should also
+        close it here.
+        """
+        self.closing.set()
+        if self.timer is not None:
+            self.timer.join()
+        self.flush()
+        if self.notifier is not None:
+            self.notifier.close()
+
+
+class TextSink(OutputSink):
+    """
+    Human-readable output, in the same format main has always printed.
+
+    See OutputSink for attribute descriptions.
+    """
+
+    def format_summary(self, current_time: datetime, summary: list[str]) -> list[str]:
+        return [f"{line}\n" for line in summary]
+
+    def format_alert(self, alert: Alert) -> str:
+        return f"{alert.message}\n"
+
+
+class JSONLinesSink(OutputSink):
+    """
+    Machine-readable output, with one compact JSON object per summary
+    or alert transition.
+
+    See OutputSink for attribute descriptions.
+    """
+
+    def format_summary(self, current_time: datetime, summary: list[str]) -> list[str]:
+        record = {
+            "type": "summary",
+            "time": current_time.isoformat(),
+            "lines": summary,
+        }
+        return [json.dumps(record, separators=(",", ":")) + "\n"]
+
+    def format_alert(self, alert: Alert) -> str:
+        record = {
+            "type": "alert",
+            "time": alert.timestamp.isoformat(),
+            "alert": alert.name,
+            "state": alert.state,
+            "value": round(alert.value, 2),
+        }
+        return json.dumps(record, separators=(",", ":")) + "\n"
+
+
+class BatchedFileSink(JSONLinesSink):
+    """
+    Appends JSON lines to a file in large batches instead of a write
+    per line.
+
+    Attributes
+    ----------
+    path : str
+            The file to append to.
+    batch_size : int, optional
+            How many lines to collect before writing. Defaults to 1000.
+    flush_interval : float or None, optional
+            See OutputSink. Defaults to 5 seconds, so a quiet log doesn't
+            leave alerts stuck in memory indefinitely.
+    notifier : Notifier or None, optional
+            See OutputSink. Defaults to None.
+    """
+
+    def __init__(
+        self,
+        path: str,
+        batch_size: int = 1000,
+        flush_interval: float | None = 5.0,
+        notifier: Notifier | None = None,
+    ) -> None:
+        self.path = path
+        super().__init__(
+            open(path, "a", buffering=1 << 20), batch_size, flush_interval, notifier
+        )
+
+    def close(self) -> None:
+        super().close()
+        self.stream.close()
+
+
+class RateLimitedLogger:
+    """
+    A stand-in for print for noisy diagnostics (ex: malformed log lines)
+    that writes the first few messages in each interval and then only
+    counts the rest, reporting how many were suppressed once the
+    interval is over.
+
+    Attributes
+    ----------
+    stream : TextIO, optional
+            Where to write messages. Defaults to sys.stderr.
+    burst : int, optional
+            How many messages to write as-is per interval. Defaults to 5.
+    interval : float, optional
+            The length (in wall-clock seconds) of each rate limiting
+            interval. Defaults to 10.
+    """
+
+    def __init__(
+        self, stream: TextIO | None = None, burst: int = 5, interval: float = 10.0
+    ) -> None:
+        self.stream = stream if stream is not None else sys.stderr
+        self.burst = burst
+        self.interval = interval
+
+        self.interval_start: float = time.monotonic()
+        self.count_this_interval: int = 0
+        self.suppressed: int = 0
+        self.total_suppressed: int = 0
+
+    def __call__(self, message: str) -> None:
+        """
+        Log a message, or count it if we're over this interval's burst.
+
+        Parameters
+        ----------
+        message : str
+                The message to log.
+        """
+        now = time.monotonic()
+        if now - self.interval_start >= self.interval:
+            self.flush()
+            self.interval_start = now
+
+        if self.count_this_interval < self.burst:
+            self.count_this_interval += 1
+            self.stream.write(f"{message}\n")
+        else:
+            self.suppressed += 1
+            self.total_suppressed += 1
+
+    def flush(self) -> None:
+        """
+        Report how many messages were suppressed since the last report,
+        and start counting the burst from zero again.
+        """
+        if self.suppressed > 0:
+            self.stream.write(
+                f"...and {self.suppressed} more similar messages suppressed\n"
+            )
+        self.suppressed = 0
+        self.count_this_interval = 0
+        self.stream.flush()
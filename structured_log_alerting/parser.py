@@ -1,5 +1,11 @@
+import sys
+from collections import OrderedDict
 from datetime import datetime
-from typing import NamedTuple
+from typing import Callable, NamedTuple
+
+from structured_log_alerting.paths import PathNormalizer
+from structured_log_alerting.selfmetrics import SelfMetrics, instrumented
+from structured_log_alerting.sortedarraydict import to_seconds
 
 
 class Request(NamedTuple):
@@ -9,16 +15,100 @@ class Request(NamedTuple):
     http_version: str
 
 
+class ParsedRequest(NamedTuple):
+    """
+    Everything a request field works out to, as cached by
+    Parser#lookup_request.
+    """
+
+    request: Request
+    # what the metric name starts with (before the status), ex: api, or
+    # api.user.ID with a path normalizer
+    metric_prefix: str
+    # the route template, if there's a path normalizer
+    route: str | None
+
+
+def without_host(metric_name: str, host: str | None) -> str:
+    """
+    The part of a metric name that namespaces (ex: "404" or "api") are
+    matched against. Lines merged from several logs have the host they
+    came from in front of their metric names (see Parser#parse_log_line),
+    which is left out so a host named ex: server500 doesn't match "500".
+
+    Parameters
+    ----------
+    metric_name : str
+            The metric name.
+    host : str or None
+            The line's (or series') host label, if it has one.
+
+    Returns
+    -------
+    str
+            The metric name, without the host.
+    """
+    if host is None:
+        return metric_name
+
+    return metric_name[len(host) + 1 :]
+
+
 class Parser:
     """
     Parser to parse out of different types of log files. Currently only
     used to parse from the nginx log format (from a csv) provided for
     the toy version of this project.
+
+    Attributes
+    ----------
+    valid_fields : list of str
+            The fields every log line is expected to have.
+    log : callable, optional
+            Called with a message for every line or timestamp that can't
+            be parsed. Defaults to print, but under error storms something
+            rate-limited (ex: output.RateLimitedLogger) is much cheaper.
+    self_metrics : SelfMetrics or None, optional
+            Where to record parse latency and failures. Defaults to None,
+            which skips recording them.
+    path_normalizer : PathNormalizer or None, optional
+            If given, metric names keep the request's subpaths, rewritten
+            to a route template (ex: api.user.ID.200 rather than
+            api.200), and the template is added to the line as "route".
+            Defaults to None, which keeps just the section.
+    request_cache_size : int, optional
+            How many distinct request fields (ex: "GET /api/user
+            HTTP/1.0") to remember the parsed form of, evicting the least
+            recently used. A handful of requests usually make up nearly
+            all traffic, so most lines skip splitting (and normalizing)
+            the request entirely, and share one interned Request rather
+            than allocating new strings. 0 turns the cache off. Defaults
+            to 4096.
+    request_cache_hits : int
+            How many lines' requests were found in the cache.
+    request_cache_misses : int
+            How many had to be parsed from scratch.
     """
 
-    def __init__(self, valid_fields: list[str]) -> None:
+    def __init__(
+        self,
+        valid_fields: list[str],
+        log: Callable[[str], None] = print,
+        self_metrics: SelfMetrics | None = None,
+        path_normalizer: PathNormalizer | None = None,
+        request_cache_size: int = 4096,
+    ) -> None:
         self.valid_fields: set[str] = set(valid_fields)
+        self.log = log
+        self.self_metrics = self_metrics
+        self.path_normalizer = path_normalizer
+
+        self.request_cache_size = request_cache_size
+        self.request_cache: OrderedDict[str, ParsedRequest] = OrderedDict()
+        self.request_cache_hits: int = 0
+        self.request_cache_misses: int = 0
 
+    @instrumented("parser.parse_log_line")
     def parse_log_line(self, log_line: dict[str, str]) -> tuple[str, dict]:
         """
         Parse an entire structured log line from a log file. This
@@ -41,7 +131,7 @@ class Parser:
                 with some additional fields added and the date reformatted.
         """
         try:
-            request: Request = self.parse_request(log_line)
+            request, metric_prefix, route = self.lookup_request(log_line)
 
             # we're losing some granularity here since we're not adding the rest
             # (if any) of the endpoint into the metric name. i don't think this
@@ -50,14 +140,24 @@ class Parser:
             # a) that's the most sophisticated level of granularity asked for by
             # the take home, and b) it means metric names are all at the same
             # level of granularity (useful for parsing/clustering/querying/etc).
-            metric_name = f"{request.section}.{log_line['status']}"
+            metric_name = f"{metric_prefix}.{log_line['status']}"
+            if "host" in log_line:
+                # lines merged from several logs (see sources.py) are
+                # kept in separate series per host, under the host.
+                metric_name = f"{log_line['host']}.{metric_name}"
 
             # copy and add our extra fields
             parsed_log_line: dict = log_line.copy()
             parsed_log_line["date"] = self.parse_timestamp(log_line)
+            if parsed_log_line["date"] is None:
+                # a line without a usable timestamp can't be placed in
+                # any series, so it's just as malformed as a bad request.
+                raise ValueError
             parsed_log_line["http_verb"] = request.http_verb
             parsed_log_line["section"] = request.section
             parsed_log_line["endpoint"] = request.endpoint
+            if route is not None:
+                parsed_log_line["route"] = route
             return metric_name, parsed_log_line
 
         # i could hold onto the malformed line and try to combine it with
@@ -69,9 +169,54 @@ class Parser:
         # aggregation attempt. improperly formatted lines can manifest in a
         # variety of ways, and definitely in these two errors.
         except (AttributeError, ValueError):
-            print(f"Malformed log line, skipping: {log_line}")
+            self.log(f"Malformed log line, skipping: {log_line}")
             raise ValueError
 
+    def lookup_request(self, log_line: dict[str, str]) -> ParsedRequest:
+        """
+        Parse a log line's request field, or find it already parsed in
+        self.request_cache.
+
+        Parameters
+        ----------
+        log_line : dict of str: str
+                The full log line.
+
+        Returns
+        -------
+        ParsedRequest
+                The request, its metric name prefix and route. Every line
+                with the same request field gets the same (interned)
+                ParsedRequest for as long as it's cached.
+        """
+        raw_request = log_line["request"]
+        cached = self.request_cache.get(raw_request)
+        if cached is not None:
+            self.request_cache_hits += 1
+            self.request_cache.move_to_end(raw_request)
+            if self.self_metrics is not None:
+                self.self_metrics.increment("parser.request_cache.hits")
+            return cached
+
+        self.request_cache_misses += 1
+        if self.self_metrics is not None:
+            self.self_metrics.increment("parser.request_cache.misses")
+
+        # interned, so every series' labels share the same strings too
+        request = Request(*map(sys.intern, self.parse_request(log_line)))
+        if self.path_normalizer is None:
+            parsed_request = ParsedRequest(request, request.section, None)
+        else:
+            route = self.path_normalizer.normalize(request.endpoint)
+            parsed_request = ParsedRequest(request, route.metric_path, route.template)
+
+        if self.request_cache_size > 0:
+            self.request_cache[raw_request] = parsed_request
+            if len(self.request_cache) > self.request_cache_size:
+                self.request_cache.popitem(last=False)
+
+        return parsed_request
+
     def parse_request(self, log_line: dict[str, str]) -> Request:
         """
         A helper method to parse the parts of the request field of a
@@ -113,11 +258,17 @@ class Parser:
         -------
         datetime or None
                 The timestamp, converted from UNIX epoch, or None (with a
-                printed error) if the conversion was unsuccessful.
+                logged error) if the conversion was unsuccessful.
         """
         try:
             timestamp = log_line["date"]
             converted_to_datetime = datetime.fromtimestamp(int(timestamp))
+            # an access log from before 1970 is garbage, and deltas and
+            # shards count on seconds since the epoch not being negative.
+            # this checks the local time that's actually stored rather
+            # than the raw timestamp, since west of UTC even 0 is 1969.
+            if to_seconds(converted_to_datetime) < 0:
+                raise ValueError
             return converted_to_datetime
 
         # this does not feel like it lines up with the possible errors
@@ -125,6 +276,6 @@ class Parser:
         # replicate these two specific errors via the python repl).
         # this will also catch a string timestamp that cannot be turned
         # into an int (which is a ValueError).
-        except (OSError, ValueError):
-            print(f"Invalid timestamp, failed to parse: {timestamp}")
+        except (OSError, OverflowError, ValueError):
+            self.log(f"Invalid timestamp, failed to parse: {timestamp}")
             return None
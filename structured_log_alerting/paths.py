@@ -0,0 +1,236 @@
+import re
+import sys
+from collections import OrderedDict
+from typing import NamedTuple
+
+
+# what a segment of a path has to look like to be rewritten to a
+# placeholder without a route template saying so, in the order they're
+# tried (ex: a long run of digits is an id before it's a hash).
+PLACEHOLDER_PATTERNS: list[tuple[str, re.Pattern]] = [
+    ("id", re.compile(r"^\d+$")),
+    (
+        "uuid",
+        re.compile(
+            r"^[0-9a-fA-F]{8}-[0-9a-fA-F]{4}-[0-9a-fA-F]{4}-[0-9a-fA-F]{4}-[0-9a-fA-F]{12}$"
+        ),
+    ),
+    ("hash", re.compile(r"^[0-9a-fA-F]{16,}$")),
+]
+
+# ex: {id} in /api/user/{id}
+TEMPLATE_PLACEHOLDER = re.compile(r"^\{(\w+)\}$")
+
+# anything that would break up (or not be allowed in) a metric name
+METRIC_NAME_UNSAFE = re.compile(r"\W")
+
+
+class Route(NamedTuple):
+    """
+    What a path normalizes to.
+    """
+
+    # ex: /api/user/{id}
+    template: str
+    # the same, as a dot-namespaced metric name prefix, ex: api.user.ID
+    metric_path: str
+
+
+class _TrieNode:
+    __slots__ = ("children", "placeholder", "wildcard", "template")
+
+    def __init__(self) -> None:
+        self.children: dict[str, "_TrieNode"] = {}
+        self.placeholder: str | None = None
+        self.wildcard: "_TrieNode | None" = None
+        self.template: str | None = None
+
+
+def metric_segment(segment: str) -> str:
+    """
+    Turn a segment of a route template into part of a metric name.
+    Placeholders become their name in capitals (so {id} can't be
+    mistaken for a literal /id), and anything that isn't a word
+    character (ex: the dot in app.js) becomes an underscore.
+    """
+    match = TEMPLATE_PLACEHOLDER.match(segment)
+    if match is not None:
+        return match.group(1).upper()
+
+    return METRIC_NAME_UNSAFE.sub("_", segment)
+
+
+class PathNormalizer:
+    """
+    Rewrites request paths to route templates, so metric names can keep
+    subpaths (ex: api.user.ID rather than just api) without an id in a
+    path creating a new series for every user.
+
+    Known route templates (ex: /api/user/{id}/photos) are compiled into
+    a prefix trie of path segments, where a {placeholder} segment
+    matches any single segment. A path takes the longest template that
+    matches a prefix of it, preferring literal segments over
+    placeholders. Any segments past that (or the whole path, if no
+    template matches) are rewritten by PLACEHOLDER_PATTERNS: numbers
+    become {id}, UUIDs {uuid} and long hex strings {hash}.
+
+    Normalizing a path is a regex or two per segment, so results are
+    memoized in a bounded LRU keyed by the raw path. Real traffic
+    repeats the same paths over and over, so most lines cost a single
+    dict lookup.
+
+    Attributes
+    ----------
+    templates : list of str, optional
+            Known route templates. Defaults to none, relying entirely on
+            PLACEHOLDER_PATTERNS.
+    max_segments : int, optional
+            The most segments to keep, as a backstop on cardinality for
+            paths whose segments are unbounded without looking like ids
+            (ex: /user/<username>). Paths matching a longer template
+            keep the whole template. Defaults to 3.
+    max_entries : int, optional
+            How many normalized paths to memoize before evicting the
+            least recently used. Defaults to 10000.
+    hits : int
+            How many lookups were memoized.
+    misses : int
+            How many lookups had to be normalized from scratch.
+    """
+
+    def __init__(
+        self,
+        templates: list[str] | None = None,
+        max_segments: int = 3,
+        max_entries: int = 10000,
+    ) -> None:
+        if max_segments < 1:
+            raise ValueError("max_segments should be at least 1")
+
+        self.max_segments = max_segments
+        self.max_entries = max_entries
+        self.memo: OrderedDict[str, Route] = OrderedDict()
+        self.hits: int = 0
+        self.misses: int = 0
+
+        self.root = _TrieNode()
+        self.templates: list[str] = []
+        for template in templates or []:
+            self.add_template(template)
+
+    def add_template(self, template: str) -> None:
+        """
+        Add a route template to the trie.
+
+        Parameters
+        ----------
+        template : str
+                The template, ex: /api/user/{id}. Every segment is either
+                literal or a whole {placeholder}.
+
+        Raises
+        ------
+        ValueError
+                If the template doesn't start with a slash, or names a
+                placeholder differently from a template that's already
+                been added (ex: /user/{id} and /user/{name}).
+        """
+        if not template.startswith("/"):
+            raise ValueError(f"Invalid route template {template!r}, it needs a /")
+
+        node = self.root
+        for segment in template.strip("/").split("/"):
+            match = TEMPLATE_PLACEHOLDER.match(segment)
+            if match is None:
+                node = node.children.setdefault(segment, _TrieNode())
+                continue
+
+            if node.wildcard is None:
+                node.wildcard = _TrieNode()
+                node.placeholder = segment
+            elif node.placeholder != segment:
+                raise ValueError(
+                    f"Route template {template!r} names a placeholder {segment}, "
+                    f"but another template already named it {node.placeholder}"
+                )
+            node = node.wildcard
+
+        node.template = template
+        self.templates.append(template)
+        # anything memoized before might have matched differently
+        self.memo.clear()
+
+    def _match(
+        self, node: _TrieNode, segments: list[str], depth: int
+    ) -> tuple[int, list[str]] | None:
+        # the longest template prefix from here: how many segments it
+        # covers and what they're rewritten to.
+        best: tuple[int, list[str]] | None = (
+            (depth, []) if node.template is not None else None
+        )
+        if depth == len(segments):
+            return best
+
+        segment = segments[depth]
+        for child, rewritten in [
+            (node.children.get(segment), segment),
+            (node.wildcard, node.placeholder),
+        ]:
+            if child is None:
+                continue
+            match = self._match(child, segments, depth + 1)
+            if match is not None and (best is None or match[0] > best[0]):
+                best = (match[0], [rewritten] + match[1])  # type: ignore[list-item]
+
+        return best
+
+    def _rewrite(self, segment: str) -> str:
+        for name, pattern in PLACEHOLDER_PATTERNS:
+            if pattern.match(segment):
+                return f"{{{name}}}"
+        return segment
+
+    def _normalize(self, path: str) -> Route:
+        segments = path.split("?", 1)[0].strip("/").split("/")
+
+        match = self._match(self.root, segments, 0)
+        matched, rewritten = match if match is not None else (0, [])
+        rewritten += [self._rewrite(segment) for segment in segments[matched:]]
+        # templates are kept whole, they're bounded already
+        rewritten = rewritten[: max(matched, self.max_segments)]
+
+        return Route(
+            template="/" + "/".join(rewritten),
+            # interned, since every line on this route shares it
+            metric_path=sys.intern(".".join(map(metric_segment, rewritten))),
+        )
+
+    def normalize(self, path: str) -> Route:
+        """
+        Find the route template for a request path.
+
+        Parameters
+        ----------
+        path : str
+                The path (ex: /api/user/12345?verbose=1). Query strings
+                are ignored.
+
+        Returns
+        -------
+        Route
+                The template and its metric name prefix, ex:
+                /api/user/{id} and api.user.ID.
+        """
+        route = self.memo.get(path)
+        if route is not None:
+            self.hits += 1
+            self.memo.move_to_end(path)
+            return route
+
+        self.misses += 1
+        route = self._normalize(path)
+        self.memo[path] = route
+        if len(self.memo) > self.max_entries:
+            self.memo.popitem(last=False)
+
+        return route
@@ -0,0 +1,340 @@
+import threading
+from collections import deque
+from itertools import islice
+from typing import Iterable, Iterator
+
+from structured_log_alerting.parser import Parser
+from structured_log_alerting.selfmetrics import SelfMetrics
+
+
+# what a full queue does with more work, see BoundedQueue
+BLOCK = "block"
+DROP_OLDEST = "drop-oldest"
+SAMPLE = "sample"
+OVERFLOW_POLICIES: list[str] = [BLOCK, DROP_OLDEST, SAMPLE]
+
+# what #get returns once a closed queue has been drained
+END_OF_QUEUE = None
+
+
+class BoundedQueue:
+    """
+    A queue of batches between two pipeline stages, bounded by the
+    number of items (not batches) it holds. Each batch carries a weight:
+    how many events each of its items stands for.
+
+    What happens when a producer puts a batch that doesn't fit depends
+    on the overflow policy:
+
+    - "block" waits for the consumer to make room, so nothing is lost
+      but the producer (and whatever's feeding it) falls behind.
+    - "drop-oldest" throws away the oldest batches to make room, so the
+      consumer always works on the most recent data.
+    - "sample" keeps only every sample_rate-th item of the batch and
+      multiplies its weight by sample_rate, so counts stay (roughly)
+      right at a fraction of the cost. If even that doesn't fit, the
+      oldest batches are dropped as well.
+
+    Attributes
+    ----------
+    name : str
+            What to call the queue in metrics.
+    maxsize : int
+            The most items the queue holds. A single batch bigger than
+            this is still let into an empty queue.
+    policy : str, optional
+            One of OVERFLOW_POLICIES. Defaults to "block".
+    sample_rate : int, optional
+            With the "sample" policy, keep 1 in this many items of a
+            batch that doesn't fit. Defaults to 10.
+    depth : int
+            How many items the queue holds right now.
+    max_depth : int
+            The most items it's ever held.
+    dropped : int
+            How many events (items times weight) were dropped.
+    sampled_out : int
+            How many events were sampled out. Their counts live on in the
+            weight of the items that were kept.
+    """
+
+    def __init__(
+        self, name: str, maxsize: int, policy: str = BLOCK, sample_rate: int = 10
+    ) -> None:
+        if policy not in OVERFLOW_POLICIES:
+            raise ValueError(
+                f"Invalid overflow policy {policy!r}, it should be one of "
+                + ", ".join(OVERFLOW_POLICIES)
+            )
+        if maxsize < 1 or sample_rate < 1:
+            raise ValueError("maxsize and sample_rate should be at least 1")
+
+        self.name = name
+        self.maxsize = maxsize
+        self.policy = policy
+        self.sample_rate = sample_rate
+
+        self.batches: deque[tuple[list, int]] = deque()
+        self.depth: int = 0
+        self.max_depth: int = 0
+        self.dropped: int = 0
+        self.sampled_out: int = 0
+        self.closed: bool = False
+        # so sampling keeps every nth item across batches, not the first
+        # of each batch.
+        self.sample_phase: int = 0
+
+        self.lock = threading.Lock()
+        self.not_empty = threading.Condition(self.lock)
+        self.not_full = threading.Condition(self.lock)
+
+    def _fits(self, size: int) -> bool:
+        return self.depth + size <= self.maxsize or not self.batches
+
+    def _drop_oldest_until_fits(self, size: int) -> None:
+        while not self._fits(size):
+            items, weight = self.batches.popleft()
+            self.depth -= len(items)
+            self.dropped += len(items) * weight
+
+    def _sample(self, items: list, weight: int) -> tuple[list, int]:
+        kept = items[self.sample_phase :: self.sample_rate]
+        self.sample_phase = (self.sample_phase - len(items)) % self.sample_rate
+        self.sampled_out += (len(items) - len(kept)) * weight
+
+        return kept, weight * self.sample_rate
+
+    def put(self, items: list, weight: int = 1, timeout: float | None = None) -> bool:
+        """
+        Add a batch, handling overflow according to self.policy.
+
+        Parameters
+        ----------
+        items : list
+                The batch.
+        weight : int, optional
+                How many events each item stands for. Defaults to 1.
+        timeout : float or None, optional
+                With the "block" policy, the longest to wait for room.
+                Defaults to None, waiting as long as it takes.
+
+        Returns
+        -------
+        bool
+                Whether the batch was added (possibly sampled), ie False
+                only if a blocking put timed out or the queue was closed.
+        """
+        with self.lock:
+            if not self._fits(len(items)):
+                if self.policy == BLOCK:
+                    self.not_full.wait_for(
+                        lambda: self._fits(len(items)) or self.closed, timeout
+                    )
+                    if self.closed or not self._fits(len(items)):
+                        return False
+                elif self.policy == SAMPLE:
+                    items, weight = self._sample(items, weight)
+                    self._drop_oldest_until_fits(len(items))
+                else:
+                    self._drop_oldest_until_fits(len(items))
+
+            if items:
+                self.batches.append((items, weight))
+                self.depth += len(items)
+                self.max_depth = max(self.max_depth, self.depth)
+                self.not_empty.notify()
+
+        return True
+
+    def get(self) -> tuple[list, int] | None:
+        """
+        Take the oldest batch, waiting for one if the queue is empty.
+
+        Returns
+        -------
+        tuple of (list, int) or None
+                The batch and its weight, or END_OF_QUEUE once the queue
+                is closed and empty.
+        """
+        with self.lock:
+            self.not_empty.wait_for(lambda: self.batches or self.closed)
+            if not self.batches:
+                return END_OF_QUEUE
+
+            items, weight = self.batches.popleft()
+            self.depth -= len(items)
+            self.not_full.notify()
+
+        return items, weight
+
+    def close(self) -> None:
+        """
+        Mark the queue as finished: nothing more will be put on it, and
+        #get returns END_OF_QUEUE once it's drained.
+        """
+        with self.lock:
+            self.closed = True
+            self.not_empty.notify_all()
+            # a blocked producer can stop waiting too
+            self.not_full.notify_all()
+
+
+class IngestPipeline:
+    """
+    Splits ingest into stages connected by BoundedQueues, so a slow
+    stage degrades predictably instead of the whole tool quietly
+    falling further and further behind the present:
+
+        reader --lines--> parse --parsed lines--> aggregate
+
+    The reader and parse stages run on their own threads. The aggregate
+    stage is whoever iterates over the pipeline, which gets every parsed
+    line with the count it stands for (more than 1 once lines have been
+    sampled) to add to a collection and evaluate alerts on.
+
+    Attributes
+    ----------
+    reader : iterable of dict of str: str
+            Where to read log lines from, ex: a csv.DictReader.
+    parser : Parser
+            The parser the parse stage runs every line through.
+    queue_size : int, optional
+            How many lines each queue holds. Defaults to 100000.
+    policy : str, optional
+            What full queues do, see BoundedQueue. Defaults to "block".
+    sample_rate : int, optional
+            See BoundedQueue. Defaults to 10.
+    batch_size : int, optional
+            How many lines to move between stages at a time, to keep
+            locking off the per-line path. Defaults to 1000.
+    self_metrics : SelfMetrics or None, optional
+            If given, each queue's depth is recorded as a
+            "pipeline.<queue>.depth" gauge, and lines dropped, sampled
+            out or malformed as "pipeline.*" counters. Defaults to None.
+    """
+
+    def __init__(
+        self,
+        reader: Iterable[dict[str, str]],
+        parser: Parser,
+        queue_size: int = 100000,
+        policy: str = BLOCK,
+        sample_rate: int = 10,
+        batch_size: int = 1000,
+        self_metrics: SelfMetrics | None = None,
+    ) -> None:
+        self.reader = reader
+        self.parser = parser
+        self.batch_size = max(1, min(batch_size, queue_size))
+        self.self_metrics = self_metrics
+
+        self.lines = BoundedQueue("lines", queue_size, policy, sample_rate)
+        self.parsed_lines = BoundedQueue(
+            "parsed_lines", queue_size, policy, sample_rate
+        )
+        self.queues: list[BoundedQueue] = [self.lines, self.parsed_lines]
+
+        self.malformed_lines: int = 0
+        self.error: BaseException | None = None
+        self.stopping = threading.Event()
+        self.threads: list[threading.Thread] = []
+        self.reported: dict[str, int] = {}
+
+    def _put(self, queue: BoundedQueue, items: list, weight: int) -> bool:
+        # wait for room, but give up if the pipeline's been closed.
+        while not self.stopping.is_set():
+            if queue.put(items, weight, timeout=0.1):
+                return True
+        return False
+
+    def _read(self) -> None:
+        try:
+            iterator = iter(self.reader)
+            while batch := list(islice(iterator, self.batch_size)):
+                if not self._put(self.lines, batch, 1):
+                    return
+        except Exception as e:
+            self.error = e
+        finally:
+            self.lines.close()
+
+    def _parse(self) -> None:
+        parse_log_line = self.parser.parse_log_line
+        try:
+            while (batch := self.lines.get()) is not END_OF_QUEUE:
+                lines, weight = batch
+                parsed = []
+                for line in lines:
+                    try:
+                        parsed.append(parse_log_line(line))
+                    except ValueError:
+                        # the parser's already logged it
+                        self.malformed_lines += weight
+                if parsed and not self._put(self.parsed_lines, parsed, weight):
+                    return
+        except Exception as e:
+            self.error = e
+        finally:
+            self.parsed_lines.close()
+
+    def start(self) -> None:
+        """
+        Start the reader and parse stages.
+        """
+        for name, target in [("read", self._read), ("parse", self._parse)]:
+            thread = threading.Thread(target=target, name=name, daemon=True)
+            self.threads.append(thread)
+            thread.start()
+
+    def close(self) -> None:
+        """
+        Stop the reader and parse stages, even if the reader hasn't run
+        out. This waits for the parse stage, but the reader stage may
+        be stuck waiting on its reader (ex: a LogReceiver nobody's
+        sending to), so it's left to notice at its next batch. It's a
+        daemon thread, so it never holds up exiting.
+        """
+        self.stopping.set()
+        for queue in self.queues:
+            queue.close()
+        for thread in self.threads[1:]:
+            thread.join()
+
+    def __enter__(self) -> "IngestPipeline":
+        self.start()
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self.close()
+
+    def _report(self) -> None:
+        # the stage threads only touch plain ints, which are copied into
+        # self_metrics from the aggregate stage's thread.
+        if self.self_metrics is None:
+            return
+
+        counts = {"pipeline.malformed_lines": self.malformed_lines}
+        for queue in self.queues:
+            self.self_metrics.set_gauge(f"pipeline.{queue.name}.depth", queue.depth)
+            counts[f"pipeline.{queue.name}.dropped"] = queue.dropped
+            counts[f"pipeline.{queue.name}.sampled_out"] = queue.sampled_out
+
+        for name, count in counts.items():
+            delta = count - self.reported.get(name, 0)
+            if delta:
+                self.self_metrics.increment(name, delta)
+                self.reported[name] = count
+
+    def __iter__(self) -> Iterator[tuple[str, dict, int]]:
+        if not self.threads:
+            self.start()
+
+        while (batch := self.parsed_lines.get()) is not END_OF_QUEUE:
+            self._report()
+            parsed, weight = batch
+            for metric_name, parsed_log_line in parsed:
+                yield metric_name, parsed_log_line, weight
+
+        self._report()
+        if self.error is not None:
+            raise self.error
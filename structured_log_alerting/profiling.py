@@ -0,0 +1,233 @@
+import cProfile
+import sys
+import time
+import tracemalloc
+from contextlib import contextmanager
+from typing import Any, Callable, Iterable, Iterator, TextIO
+
+from structured_log_alerting.alertmanager import AlertManager
+from structured_log_alerting.metricscollection import CountersCollection
+from structured_log_alerting.output import OutputSink
+from structured_log_alerting.parser import Parser
+
+
+class StageProfiler:
+    """
+    Attributes wall time to each stage of the ingest pipeline (csv
+    decoding, parsing, series updates, alert evaluation and output) so
+    we don't have to guess which one got slower.
+
+    Timers are attached by shadowing methods on the pipeline's instances
+    (see #instrument_method), so the ingest loops themselves don't need
+    to know whether they're being profiled, and nothing is timed at all
+    unless --profile is on.
+
+    Attributes
+    ----------
+    stage_nanoseconds : dict of str: int
+            Total time spent in each stage.
+    lines : int
+            The number of lines read, for per-line costs.
+    total_nanoseconds : int
+            The wall time of the whole profiled run, set by #profile.
+    """
+
+    def __init__(self) -> None:
+        self.stage_nanoseconds: dict[str, int] = {}
+        self.lines: int = 0
+        self.total_nanoseconds: int = 0
+
+    def time_stage(self, stage: str, function: Callable) -> Callable:
+        """
+        Wrap a callable so the time spent in it is added to a stage.
+
+        Parameters
+        ----------
+        stage : str
+                The stage to attribute the time to.
+        function : callable
+                The callable to time.
+
+        Returns
+        -------
+        callable
+                The timed callable.
+        """
+        stage_nanoseconds = self.stage_nanoseconds
+        stage_nanoseconds.setdefault(stage, 0)
+        perf_counter_ns = time.perf_counter_ns
+
+        def timed(*args, **kwargs):
+            start = perf_counter_ns()
+            try:
+                return function(*args, **kwargs)
+            finally:
+                stage_nanoseconds[stage] += perf_counter_ns() - start
+
+        return timed
+
+    def time_iterator(self, stage: str, iterable: Iterable) -> Iterator:
+        """
+        Wrap an iterable (ex: a csv.DictReader) so the time spent
+        producing each item is added to a stage and each item is counted
+        as a line.
+
+        Parameters
+        ----------
+        stage : str
+                The stage to attribute the time to.
+        iterable : iterable
+                The iterable to time.
+
+        Yields
+        ------
+        Any
+                Each item from the iterable.
+        """
+        self.stage_nanoseconds.setdefault(stage, 0)
+        perf_counter_ns = time.perf_counter_ns
+        iterator = iter(iterable)
+
+        while True:
+            start = perf_counter_ns()
+            try:
+                item = next(iterator)
+            except StopIteration:
+                return
+            finally:
+                self.stage_nanoseconds[stage] += perf_counter_ns() - start
+
+            self.lines += 1
+            yield item
+
+    def instrument_method(self, instance: Any, method_name: str, stage: str) -> None:
+        """
+        Shadow a bound method on a single instance with a timed version.
+
+        Parameters
+        ----------
+        instance : Any
+                The instance to instrument.
+        method_name : str
+                The method to time.
+        stage : str
+                The stage to attribute the method's time to.
+        """
+        setattr(
+            instance,
+            method_name,
+            self.time_stage(stage, getattr(instance, method_name)),
+        )
+
+    def instrument_pipeline(
+        self,
+        parser: Parser,
+        counters_collection: CountersCollection,
+        alertmanager: AlertManager,
+        sink: OutputSink,
+    ) -> None:
+        """
+        Instrument every stage of the usual ingest pipeline at once.
+
+        Parameters
+        ----------
+        parser : Parser
+        counters_collection : CountersCollection
+        alertmanager : AlertManager
+        sink : OutputSink
+        """
+        self.instrument_method(parser, "parse_log_line", "parse")
+        self.instrument_method(
+            counters_collection, "add_or_update_series", "series_update"
+        )
+        self.instrument_method(alertmanager, "evaluate_elevated_requests", "evaluate")
+        self.instrument_method(alertmanager, "provide_summary_for_interval", "evaluate")
+        self.instrument_method(sink, "write_alert", "output")
+        self.instrument_method(sink, "write_summary", "output")
+
+    @contextmanager
+    def profile(
+        self, pstats_path: str | None = None, tracemalloc_path: str | None = None
+    ) -> Iterator["StageProfiler"]:
+        """
+        Time a whole run, optionally under cProfile and/or tracemalloc.
+
+        Parameters
+        ----------
+        pstats_path : str or None, optional
+                If given, run under cProfile and dump pstats here.
+        tracemalloc_path : str or None, optional
+                If given, trace allocations and dump a snapshot here.
+
+        Yields
+        ------
+        StageProfiler
+                This profiler.
+        """
+        profile = cProfile.Profile() if pstats_path else None
+        if tracemalloc_path:
+            tracemalloc.start()
+        if profile is not None:
+            profile.enable()
+
+        start = time.perf_counter_ns()
+        try:
+            yield self
+        finally:
+            self.total_nanoseconds = time.perf_counter_ns() - start
+
+            if profile is not None:
+                profile.disable()
+                profile.dump_stats(pstats_path)
+            if tracemalloc_path:
+                tracemalloc.take_snapshot().dump(tracemalloc_path)
+                tracemalloc.stop()
+
+    def breakdown(self) -> list[tuple[str, int, float, float]]:
+        """
+        Summarize where the time went. Anything not attributed to a
+        stage (the loops themselves, timekeeping, etc) is reported as
+        "other".
+
+        Returns
+        -------
+        list of tuple of (str, int, float, float)
+                Each stage's name, total nanoseconds, nanoseconds per line
+                and percent of the total, most expensive first.
+        """
+        total = max(self.total_nanoseconds, sum(self.stage_nanoseconds.values()))
+        stages = dict(self.stage_nanoseconds)
+        stages["other"] = total - sum(stages.values())
+
+        lines = max(self.lines, 1)
+        rows = [
+            (
+                stage,
+                nanoseconds,
+                nanoseconds / lines,
+                100 * nanoseconds / total if total else 0.0,
+            )
+            for stage, nanoseconds in stages.items()
+        ]
+
+        return sorted(rows, key=lambda row: row[1], reverse=True)
+
+    def write_breakdown(self, stream: TextIO | None = None) -> None:
+        """
+        Write #breakdown as a small table.
+
+        Parameters
+        ----------
+        stream : TextIO or None, optional
+                Where to write the table. Defaults to sys.stderr.
+        """
+        stream = stream if stream is not None else sys.stderr
+        stream.write(
+            f"Profiled {self.lines} lines in {self.total_nanoseconds / 1e9:.2f}s\n"
+            f"{'stage':<15}{'total (s)':>12}{'ns/line':>12}{'% of total':>12}\n"
+        )
+        for stage, nanoseconds, per_line, percent in self.breakdown():
+            stream.write(
+                f"{stage:<15}{nanoseconds / 1e9:>12.3f}{per_line:>12.0f}{percent:>11.1f}%\n"
+            )
+        stream.flush()
@@ -0,0 +1,426 @@
+import re
+from datetime import datetime
+from typing import NamedTuple
+
+from structured_log_alerting.metricscollection import CountersCollection
+from structured_log_alerting.querycache import QueryCache
+from structured_log_alerting.sortedarraydict import to_seconds
+
+
+# the label matchers can use to match on a series' name rather than one
+# of its labels, borrowed from Prometheus.
+NAME_LABEL = "__name__"
+
+AGGREGATIONS: list[str] = ["sum", "avg", "max", "min", "count", "rate"]
+
+
+class Matcher(NamedTuple):
+    """
+    A single label matcher, ex: status!="200" or section=~"api|report".
+    Regular expressions are anchored at both ends, like Prometheus'.
+    """
+
+    label: str
+    operator: str
+    value: str
+
+    def matches(self, label_value: str) -> bool:
+        if self.operator == "=":
+            return label_value == self.value
+        if self.operator == "!=":
+            return label_value != self.value
+
+        # re keeps its own cache of compiled patterns, so this doesn't
+        # recompile every time.
+        matched = re.fullmatch(self.value, label_value) is not None
+        return matched if self.operator == "=~" else not matched
+
+
+class Query(NamedTuple):
+    """
+    A parsed query. With no aggregation function it's a range vector:
+    every matching series' individual data points within the window.
+    """
+
+    function: str | None
+    matchers: tuple[Matcher, ...]
+    window_in_seconds: int
+    by: tuple[str, ...] = ()
+
+
+class QueryPlan(NamedTuple):
+    """
+    The series a query's matchers resolved to and the group each one
+    belongs to, worked out once and reused until new series show up.
+    """
+
+    series: list
+    group_keys: list[tuple[str, ...]]
+    series_seen: int
+
+
+# ex: sum by (section) ({status=~"5.."}[120s])
+QUERY_PATTERN = re.compile(
+    r"""^\s*(?:(?P<function>\w+)\s*
+    (?:by\s*\((?P<by>[\w\s,]*)\)\s*)?
+    \(\s*(?P<inner_selector>.*?)\s*\)|(?P<selector>.*?))\s*$""",
+    re.VERBOSE | re.DOTALL,
+)
+SELECTOR_PATTERN = re.compile(
+    r"^(?P<name>[\w.]*)\s*(?:\{(?P<matchers>.*)\})?\s*\[(?P<window>\d+)s\]$",
+    re.DOTALL,
+)
+MATCHER_PATTERN = re.compile(r'\s*(\w+)\s*(=~|!~|!=|=)\s*"((?:[^"\\]|\\.)*)"\s*(,|$)')
+
+
+def parse_matchers(text: str) -> tuple[Matcher, ...]:
+    """
+    Parse the comma-separated matchers between a selector's braces.
+
+    Parameters
+    ----------
+    text : str
+            ex: section="api", status=~"5.."
+
+    Returns
+    -------
+    tuple of Matcher
+            The parsed matchers.
+
+    Raises
+    ------
+    ValueError
+            If the matchers can't be parsed, or a regex doesn't compile.
+    """
+    matchers: list[Matcher] = []
+    position = 0
+    while position < len(text.strip()):
+        match = MATCHER_PATTERN.match(text, position)
+        if match is None:
+            raise ValueError(f"Invalid label matcher at: {text[position:]!r}")
+
+        label, operator, value, _ = match.groups()
+        value = value.replace('\\"', '"')
+        if operator in ("=~", "!~"):
+            try:
+                re.compile(value)
+            except re.error as e:
+                raise ValueError(f"Invalid regex {value!r}: {e}") from e
+
+        matchers.append(Matcher(label, operator, value))
+        position = match.end()
+
+    return tuple(matchers)
+
+
+def parse_query(text: str) -> Query:
+    """
+    Parse a small PromQL-flavored query. Every query selects series
+    over a window (a range vector), optionally aggregated:
+
+        {section="api", status!="200"}[120s]
+        sum by (section) ({status=~"5.."}[10s])
+        rate(api.200[60s])
+
+    A bare name before the braces matches the series name exactly.
+
+    Parameters
+    ----------
+    text : str
+            The query.
+
+    Returns
+    -------
+    Query
+            The parsed query.
+
+    Raises
+    ------
+    ValueError
+            If the query can't be parsed.
+    """
+    match = QUERY_PATTERN.match(text)
+    function = match.group("function") if match else None
+    selector_text = match.group("inner_selector" if function else "selector")
+    if function is not None and function not in AGGREGATIONS:
+        raise ValueError(f"Unknown aggregation {function!r}")
+
+    selector = SELECTOR_PATTERN.match(selector_text.strip())
+    if selector is None:
+        raise ValueError(f"Invalid selector {selector_text!r}")
+
+    matchers = parse_matchers(selector.group("matchers") or "")
+    if selector.group("name"):
+        matchers = (Matcher(NAME_LABEL, "=", selector.group("name")),) + matchers
+
+    by: tuple[str, ...] = ()
+    if match.group("by"):
+        by = tuple(label.strip() for label in match.group("by").split(","))
+    if function is None and by:
+        raise ValueError("by (...) needs an aggregation")
+
+    window_in_seconds = int(selector.group("window"))
+    if window_in_seconds <= 0:
+        raise ValueError("The window must be at least 1s")
+
+    return Query(function, matchers, window_in_seconds, by)
+
+
+class QueryEngine:
+    """
+    Plans and runs queries against a CountersCollection.
+
+    Planning uses the collection's label index: equality matchers pick
+    out candidate series by intersecting the index's lists (smallest
+    first), and only those candidates are checked against the other
+    matchers. Plans are cached per (matchers, by), and since series are
+    only ever added, a cached plan just gets topped up with any series
+    added since it was made. Series being evicted (see
+    CountersCollection#evict_series) throws every plan out.
+
+    Running a plan totals up every matching series in one call to the
+    collection's #totals_for_series (which on a ColumnarCountersCollection
+    sums pre-aggregated buckets), then folds those totals into groups in
+    the same pass, rather than scanning once per group.
+
+    Attributes
+    ----------
+    counters_collection : CountersCollection
+            The collection to query.
+    query_cache : QueryCache or None, optional
+            If given, aggregation results are cached here. Defaults to
+            None.
+    """
+
+    def __init__(
+        self,
+        counters_collection: CountersCollection,
+        query_cache: QueryCache | None = None,
+    ) -> None:
+        self.counters_collection = counters_collection
+        self.query_cache = query_cache
+        self.plans: dict[tuple, QueryPlan] = {}
+        self.generation: int = counters_collection.generation
+
+    def _series_matches(self, series, matchers: tuple[Matcher, ...]) -> bool:
+        labels = dict(series.label_pairs)
+        for matcher in matchers:
+            if matcher.label == NAME_LABEL:
+                label_value = series.name
+            else:
+                label_value = labels.get(matcher.label, "")
+            if not matcher.matches(label_value):
+                return False
+
+        return True
+
+    def _group_key(self, series, by: tuple[str, ...]) -> tuple[str, ...]:
+        labels = dict(series.label_pairs)
+
+        return tuple(
+            series.name if label == NAME_LABEL else labels.get(label, "")
+            for label in by
+        )
+
+    def _candidates(self, matchers: tuple[Matcher, ...], all_series: dict) -> list:
+        collection = self.counters_collection
+        equalities = [
+            matcher
+            for matcher in matchers
+            if matcher.operator == "=" and matcher.label != NAME_LABEL
+        ]
+        if not equalities:
+            return list(all_series.values())
+
+        name_lists = sorted(
+            (
+                collection.label_index.get((matcher.label, matcher.value), [])
+                for matcher in equalities
+            ),
+            key=len,
+        )
+        names = set(name_lists[0])
+        for other_names in name_lists[1:]:
+            names.intersection_update(other_names)
+
+        # keep series in the order they were added, so results are stable.
+        # this also leaves out anything the index has that all_series
+        # doesn't yet (see ConcurrentCountersCollection).
+        return [series for name, series in all_series.items() if name in names]
+
+    def plan(self, query: Query) -> QueryPlan:
+        """
+        Find (or top up) the plan for a query.
+
+        Parameters
+        ----------
+        query : Query
+                The query to plan.
+
+        Returns
+        -------
+        QueryPlan
+                The matching series and their group keys.
+        """
+        key = (query.matchers, query.by)
+        if self.counters_collection.generation != self.generation:
+            self.plans.clear()
+            self.generation = self.counters_collection.generation
+        # only look at the series dict once, so the count and the series
+        # agree even if another thread adds series while we plan.
+        all_series = self.counters_collection.series
+        series_count = len(all_series)
+        plan = self.plans.get(key)
+
+        if plan is None:
+            candidates = self._candidates(query.matchers, all_series)
+        elif plan.series_seen < series_count:
+            candidates = list(all_series.values())[plan.series_seen :]
+        else:
+            return plan
+
+        series = [
+            each for each in candidates if self._series_matches(each, query.matchers)
+        ]
+        group_keys = [self._group_key(each, query.by) for each in series]
+        if plan is not None:
+            series = plan.series + series
+            group_keys = plan.group_keys + group_keys
+
+        plan = self.plans[key] = QueryPlan(series, group_keys, series_count)
+
+        return plan
+
+    def evaluate(
+        self, query: Query, current_time: datetime
+    ) -> dict[tuple[str, ...], float]:
+        """
+        Run an aggregation query.
+
+        Each series contributes its total count over the window; "sum",
+        "max" and "min" combine those per group, "avg" averages over the
+        series with any data in the window, "count" counts those series,
+        and "rate" is the group's sum per second.
+
+        Parameters
+        ----------
+        query : Query
+                The query to run. Must have a function.
+        current_time : datetime
+                The (inclusive) end of the window.
+
+        Returns
+        -------
+        dict of tuple of str: float
+                The result for each group, keyed by the values of the
+                query's "by" labels in order (or () with no "by"). Groups
+                with no data in the window are left out.
+
+        Raises
+        ------
+        ValueError
+                If the query has no aggregation function.
+        """
+        if query.function is None:
+            raise ValueError("Range vector queries should use #range_vector")
+
+        if self.query_cache is not None:
+            return dict(
+                self.query_cache.get(
+                    query,
+                    query.window_in_seconds,
+                    to_seconds(current_time),
+                    lambda end, window: self._aggregate(query, end),
+                )
+            )
+
+        return self._aggregate(query, current_time)
+
+    def _aggregate(
+        self, query: Query, current_time: datetime
+    ) -> dict[tuple[str, ...], float]:
+        plan = self.plan(query)
+        totals = self.counters_collection.totals_for_series(
+            plan.series, current_time, query.window_in_seconds
+        )
+
+        sums: dict[tuple[str, ...], int] = {}
+        counts: dict[tuple[str, ...], int] = {}
+        extremes: dict[tuple[str, ...], int] = {}
+        pick = max if query.function == "max" else min
+        for group_key, total in zip(plan.group_keys, totals):
+            if not total:
+                continue
+
+            sums[group_key] = sums.get(group_key, 0) + total
+            counts[group_key] = counts.get(group_key, 0) + 1
+            if group_key in extremes:
+                extremes[group_key] = pick(extremes[group_key], total)
+            else:
+                extremes[group_key] = total
+
+        if query.function == "sum":
+            return {group: float(total) for group, total in sums.items()}
+        if query.function == "rate":
+            return {
+                group: total / query.window_in_seconds for group, total in sums.items()
+            }
+        if query.function == "avg":
+            return {group: sums[group] / counts[group] for group in sums}
+        if query.function == "count":
+            return {group: float(count) for group, count in counts.items()}
+
+        return {group: float(extreme) for group, extreme in extremes.items()}
+
+    def range_vector(
+        self, query: Query, current_time: datetime
+    ) -> dict[str, list[tuple[datetime, int]]]:
+        """
+        Fetch every matching series' data points within the window.
+
+        Parameters
+        ----------
+        query : Query
+                The query to run. Any function or "by" is ignored.
+        current_time : datetime
+                The (inclusive) end of the window.
+
+        Returns
+        -------
+        dict of str: list of tuple of (datetime, int)
+                Each matching series' name and its data points, oldest
+                first. Series with no points in the window are left out.
+        """
+        plan = self.plan(query)
+        all_points = self.counters_collection.points_for_series(
+            plan.series, current_time, query.window_in_seconds
+        )
+        vectors: dict[str, list[tuple[datetime, int]]] = {}
+        for series, points in zip(plan.series, all_points):
+            if points:
+                vectors[series.name] = points
+
+        return vectors
+
+    def query(self, text: str, current_time: datetime) -> dict:
+        """
+        Parse and run a query in one go.
+
+        Parameters
+        ----------
+        text : str
+                See #parse_query.
+        current_time : datetime
+                The (inclusive) end of the window.
+
+        Returns
+        -------
+        dict
+                See #evaluate for aggregations and #range_vector for
+                range vectors.
+        """
+        query = parse_query(text)
+        if query.function is None:
+            return self.range_vector(query, current_time)
+
+        return self.evaluate(query, current_time)
@@ -0,0 +1,287 @@
+from bisect import bisect_left, bisect_right, insort
+from collections import OrderedDict
+from datetime import datetime
+from typing import Any, Callable, Hashable
+
+from structured_log_alerting.metricscollection import CountersCollection
+from structured_log_alerting.selfmetrics import SelfMetrics
+from structured_log_alerting.sortedarraydict import from_seconds, to_seconds
+
+
+# (what was queried, window length in seconds, end of the window in
+# seconds since the epoch)
+CacheKey = tuple[Hashable, int, int]
+
+
+class QueryCache:
+    """
+    A bounded LRU cache of query results, keyed by (matcher, window,
+    end), where the end is aligned to a whole second.
+
+    The collection records which seconds have been written to since the
+    cache last looked (see CountersCollection#dirty_seconds), and before
+    every lookup the cache drops exactly the entries whose windows
+    contain one of those seconds. New data at the newest second only
+    ever touches the newest windows, and late data only the windows
+    it lands in, so everything else stays cached.
+
+    Sums over long windows ending on a block boundary (see #get_sum,
+    ex: replay's evaluations) are built out of aligned block_in_seconds
+    blocks. Once a block is closed (nothing more will be written to
+    it), it's computed once and reused by every overlapping window
+    after it, so sliding a 120 second window along by a block costs one
+    short scan rather than a full one.
+
+    Attributes
+    ----------
+    counters_collection : CountersCollection
+            The collection to cache queries against. The cache turns on
+            the collection's write tracking, so there should only be one
+            cache per collection.
+    max_entries : int, optional
+            How many results to keep before evicting the least recently
+            used. Defaults to 4096.
+    block_in_seconds : int, optional
+            The size of the aligned blocks long windows are split into.
+            Defaults to 10.
+    self_metrics : SelfMetrics or None, optional
+            Where to count hits, misses and invalidations. Defaults to
+            None, which only counts them in attributes.
+    """
+
+    def __init__(
+        self,
+        counters_collection: CountersCollection,
+        max_entries: int = 4096,
+        block_in_seconds: int = 10,
+        self_metrics: SelfMetrics | None = None,
+    ) -> None:
+        self.counters_collection = counters_collection
+        self.max_entries = max_entries
+        self.block_in_seconds = block_in_seconds
+        self.self_metrics = self_metrics
+
+        self.entries: OrderedDict[CacheKey, Any] = OrderedDict()
+        self.keys_by_end: dict[int, set[CacheKey]] = {}
+        # every end in keys_by_end, sorted, so invalidation can jump
+        # straight to the ends a written second could affect.
+        self.ends: list[int] = []
+        self.max_window: int = 0
+
+        self.hits: int = 0
+        self.misses: int = 0
+        self.invalidations: int = 0
+
+        if counters_collection.dirty_seconds is None:
+            counters_collection.dirty_seconds = set()
+
+    def __len__(self) -> int:
+        return len(self.entries)
+
+    def _count(self, name: str, count: int = 1) -> None:
+        if self.self_metrics is not None:
+            self.self_metrics.increment(f"querycache.{name}", count)
+
+    def _remove(self, key: CacheKey) -> None:
+        del self.entries[key]
+        end = key[2]
+        keys = self.keys_by_end[end]
+        keys.discard(key)
+        if not keys:
+            del self.keys_by_end[end]
+            del self.ends[bisect_left(self.ends, end)]
+
+    def _store(self, key: CacheKey, value: Any) -> None:
+        end = key[2]
+        keys = self.keys_by_end.get(end)
+        if keys is None:
+            keys = self.keys_by_end[end] = set()
+            insort(self.ends, end)
+        keys.add(key)
+
+        self.entries[key] = value
+        self.max_window = max(self.max_window, key[1])
+        while len(self.entries) > self.max_entries:
+            self._remove(next(iter(self.entries)))
+
+    def sync(self) -> None:
+        """
+        Drop every entry whose window contains a second that's been
+        written to since the last sync. A window ending at end with
+        length window contains second s if end - window < s <= end.
+        """
+        dirty_seconds = self.counters_collection.dirty_seconds
+        if not dirty_seconds:
+            return
+
+        invalidated = 0
+        for seconds in dirty_seconds:
+            first = bisect_left(self.ends, seconds)
+            last = bisect_right(self.ends, seconds + self.max_window - 1)
+            for end in self.ends[first:last]:
+                for key in list(self.keys_by_end.get(end, ())):
+                    if end - key[1] < seconds:
+                        self._remove(key)
+                        invalidated += 1
+        dirty_seconds.clear()
+
+        self.invalidations += invalidated
+        if invalidated:
+            self._count("invalidations", invalidated)
+
+    def get(
+        self,
+        matcher: Hashable,
+        window_in_seconds: int,
+        end_seconds: int,
+        compute: Callable[[datetime, int], Any],
+    ) -> Any:
+        """
+        Look up a query result, computing and caching it on a miss.
+
+        Parameters
+        ----------
+        matcher : Hashable
+                Identifies what's being queried (ex: a namespace).
+        window_in_seconds : int
+                The length of the window.
+        end_seconds : int
+                The (inclusive) end of the window, in seconds since the
+                epoch.
+        compute : callable
+                Called with (current_time, window_in_seconds) on a miss.
+
+        Returns
+        -------
+        Any
+                The (possibly cached) result. Don't modify it.
+        """
+        self.sync()
+
+        key = (matcher, window_in_seconds, end_seconds)
+        if key in self.entries:
+            self.entries.move_to_end(key)
+            self.hits += 1
+            self._count("hits")
+            return self.entries[key]
+
+        self.misses += 1
+        self._count("misses")
+        value = compute(from_seconds(end_seconds), window_in_seconds)
+        self._store(key, value)
+
+        return value
+
+    def get_sum(
+        self,
+        matcher: Hashable,
+        window_in_seconds: int,
+        end_seconds: int,
+        compute: Callable[[datetime, int], Any],
+        add: Callable[[Any, Any], Any],
+    ) -> Any:
+        """
+        Like #get, but for results that can be added together across
+        adjacent windows (ex: counts). Windows at least two blocks long
+        that end on a block boundary are put together from the cached
+        blocks inside them (and whatever is left over at the start).
+
+        Parameters
+        ----------
+        matcher : Hashable
+                See #get.
+        window_in_seconds : int
+                See #get.
+        end_seconds : int
+                See #get.
+        compute : callable
+                See #get.
+        add : callable
+                Adds two results together.
+
+        Returns
+        -------
+        Any
+                See #get.
+        """
+        self.sync()
+
+        key = (matcher, window_in_seconds, end_seconds)
+        if key in self.entries:
+            self.entries.move_to_end(key)
+            self.hits += 1
+            self._count("hits")
+            return self.entries[key]
+
+        block = self.block_in_seconds
+        after_seconds = end_seconds - window_in_seconds
+        first_block_end = -(-(after_seconds + block) // block) * block
+        if (
+            end_seconds % block
+            or window_in_seconds < 2 * block
+            or first_block_end > end_seconds
+        ):
+            # a window ending partway through a block would need scans
+            # for both ragged ends, which costs more than the one scan
+            # it'd replace, so just cache it whole.
+            return self.get(matcher, window_in_seconds, end_seconds, compute)
+
+        value = self.get(matcher, block, first_block_end, compute)
+        for block_end in range(first_block_end + block, end_seconds + 1, block):
+            value = add(value, self.get(matcher, block, block_end, compute))
+
+        head = first_block_end - block - after_seconds
+        if head:
+            value = add(
+                value, self.get(matcher, head, first_block_end - block, compute)
+            )
+
+        self._store(key, value)
+
+        return value
+
+    def total_count_since(
+        self,
+        current_time: datetime = datetime.now(),
+        since_number_of_seconds: int = 10,
+        metrics_namespace: str = "",
+    ) -> int:
+        """
+        A cached CountersCollection#total_count_since.
+        """
+        collection = self.counters_collection
+
+        return self.get_sum(
+            ("total_count_since", metrics_namespace),
+            since_number_of_seconds,
+            to_seconds(current_time),
+            lambda end, window: collection.total_count_since(
+                end, window, metrics_namespace
+            ),
+            int.__add__,
+        )
+
+    def total_counts_by_label(
+        self,
+        current_time: datetime = datetime.now(),
+        since_number_of_seconds: int = 10,
+        label: str = "section",
+    ) -> dict[str, int]:
+        """
+        A cached CountersCollection#total_counts_by_label.
+        """
+        collection = self.counters_collection
+
+        def add(first: dict[str, int], second: dict[str, int]) -> dict[str, int]:
+            totals = dict(first)
+            for value, count in second.items():
+                totals[value] = totals.get(value, 0) + count
+            return totals
+
+        return self.get_sum(
+            ("total_counts_by_label", label),
+            since_number_of_seconds,
+            to_seconds(current_time),
+            lambda end, window: collection.total_counts_by_label(end, window, label),
+            add,
+        )
@@ -0,0 +1,348 @@
+import asyncio
+import csv
+import os
+import queue
+import re
+import threading
+from typing import Iterator
+from urllib.parse import urlsplit
+
+from structured_log_alerting.selfmetrics import SelfMetrics
+from structured_log_alerting.synthetic import FIELDNAMES
+
+
+SCHEMES: list[str] = ["udp", "tcp", "unix"]
+
+# the <PRI> a syslog-style sender puts in front of each message
+SYSLOG_PRIORITY = re.compile(rb"^<\d{1,3}>")
+
+
+def parse_address(address: str) -> tuple[str, str, int | None]:
+    """
+    Parse a listen address: udp://host:port, tcp://host:port or
+    unix:///path/to/socket.
+
+    Parameters
+    ----------
+    address : str
+            The address to parse.
+
+    Returns
+    -------
+    tuple of (str, str, int or None)
+            The scheme, the host (or socket path) and the port (or None
+            for a Unix socket).
+
+    Raises
+    ------
+    ValueError
+            If the address can't be parsed.
+    """
+    url = urlsplit(address)
+    if url.scheme not in SCHEMES:
+        raise ValueError(
+            f"Invalid listen address {address!r}, it should start with one of "
+            + ", ".join(f"{scheme}://" for scheme in SCHEMES)
+        )
+
+    if url.scheme == "unix":
+        path = url.netloc + url.path
+        if not path:
+            raise ValueError(f"Invalid listen address {address!r}, it needs a path")
+        return url.scheme, path, None
+
+    if url.hostname is None or url.port is None:
+        raise ValueError(f"Invalid listen address {address!r}, it needs host:port")
+
+    return url.scheme, url.hostname, url.port
+
+
+class _DatagramProtocol(asyncio.DatagramProtocol):
+    def __init__(self, receiver: "LogReceiver") -> None:
+        self.receiver = receiver
+
+    def datagram_received(self, data: bytes, address) -> None:
+        self.receiver._receive_datagram(data)
+
+
+class LogReceiver:
+    """
+    Receives log lines over the network rather than from a file: on a
+    UDP or TCP port, or a Unix domain socket. Each line is a row in the
+    same CSV format as the log files (without the header), optionally
+    with a syslog-style <PRI> in front. Iterating over a LogReceiver
+    yields parsed rows like a csv.DictReader over a file, so it can be
+    read by the same loops.
+
+    The sockets are served by asyncio on a background thread, which
+    hands lines over to whoever's iterating in batches on a bounded
+    queue:
+
+    - A TCP or Unix socket connection hands over all the complete lines
+      from each read as one batch. When the queue is full it stops
+      reading from the connection until there's room, so the kernel's
+      buffers fill and flow control pushes back on the sender.
+    - UDP datagrams can't be pushed back on, so they're collected into
+      batches of up to batch_size lines (or whatever's arrived after
+      flush_interval seconds), and a batch that doesn't fit on the
+      queue is dropped and counted in self.dropped_lines.
+
+    Attributes
+    ----------
+    addresses : list of str
+            Where to listen, see #parse_address. A port of 0 picks a
+            free one (see self.bound_addresses once started).
+    fieldnames : list of str, optional
+            The CSV columns each line has. Defaults to the columns of
+            the example log.
+    batch_size : int, optional
+            How many UDP lines to collect into a batch. Defaults to 1000.
+    max_pending_batches : int, optional
+            How many batches can wait to be ingested before senders are
+            pushed back on (or datagrams dropped). Defaults to 100.
+    flush_interval : float, optional
+            The longest (in seconds) a partial UDP batch waits for more
+            lines. Defaults to 0.1.
+    self_metrics : SelfMetrics or None, optional
+            If given, received, dropped and pushed back lines are
+            counted here as "receiver.*". Defaults to None.
+    reuse_port : bool, optional
+            Listen with SO_REUSEPORT, so several receivers (ex: one per
+            shard process, see sharding.ShardedIngest) can listen on the
+            same UDP or TCP port and the kernel spreads senders across
+            them. Defaults to False.
+    """
+
+    read_size: int = 1 << 16
+
+    def __init__(
+        self,
+        addresses: list[str],
+        fieldnames: list[str] = FIELDNAMES,
+        batch_size: int = 1000,
+        max_pending_batches: int = 100,
+        flush_interval: float = 0.1,
+        self_metrics: SelfMetrics | None = None,
+        reuse_port: bool = False,
+    ) -> None:
+        self.listen_addresses = [parse_address(address) for address in addresses]
+        self.fieldnames = fieldnames
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.self_metrics = self_metrics
+        self.reuse_port = reuse_port
+
+        self.batches: queue.Queue = queue.Queue(max_pending_batches)
+        self.bound_addresses: list = []
+        self.line_num: int = 0
+
+        # only ever written to by the event loop's thread
+        self.received_lines: int = 0
+        self.dropped_lines: int = 0
+        self.backpressure_waits: int = 0
+        self.reported: dict[str, int] = {}
+
+        self.loop: asyncio.AbstractEventLoop | None = None
+        self.thread: threading.Thread | None = None
+        self.ready = threading.Event()
+        self.closed = threading.Event()
+        self.startup_error: BaseException | None = None
+
+        self._datagram_lines: list[bytes] = []
+        self._flush_handle: asyncio.TimerHandle | None = None
+        self._stopped: asyncio.Event | None = None
+        self._room: asyncio.Event | None = None
+
+    def _offer(self, lines: list[bytes]) -> None:
+        try:
+            self.batches.put_nowait(lines)
+            self.received_lines += len(lines)
+        except queue.Full:
+            self.dropped_lines += len(lines)
+
+    async def _enqueue(self, lines: list[bytes]) -> None:
+        while not self.closed.is_set():
+            try:
+                self.batches.put_nowait(lines)
+                self.received_lines += len(lines)
+                return
+            except queue.Full:
+                # not reading any more from this connection until there's
+                # room is what pushes back on the sender. #__iter__ sets
+                # self._room whenever it takes a batch off the queue.
+                self.backpressure_waits += 1
+                self._room.clear()  # type: ignore[union-attr]
+                try:
+                    await asyncio.wait_for(self._room.wait(), 0.1)  # type: ignore[union-attr]
+                except asyncio.TimeoutError:
+                    pass
+
+        self.dropped_lines += len(lines)
+
+    def _flush_datagrams(self) -> None:
+        self._flush_handle = None
+        if self._datagram_lines:
+            lines = self._datagram_lines
+            self._datagram_lines = []
+            self._offer(lines)
+
+    def _receive_datagram(self, data: bytes) -> None:
+        self._datagram_lines.extend(data.splitlines())
+        if len(self._datagram_lines) >= self.batch_size:
+            self._flush_datagrams()
+        elif self._flush_handle is None and self.loop is not None:
+            self._flush_handle = self.loop.call_later(
+                self.flush_interval, self._flush_datagrams
+            )
+
+    async def _handle_stream(
+        self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter
+    ) -> None:
+        remainder = b""
+        try:
+            while chunk := await reader.read(self.read_size):
+                lines = (remainder + chunk).split(b"\n")
+                remainder = lines.pop()
+                if lines:
+                    await self._enqueue(lines)
+            if remainder:
+                await self._enqueue([remainder])
+        except ConnectionError:
+            pass
+        finally:
+            writer.close()
+
+    async def _serve(self) -> None:
+        self.loop = asyncio.get_running_loop()
+        self._stopped = asyncio.Event()
+        self._room = asyncio.Event()
+        servers: list[asyncio.AbstractServer] = []
+        transports: list[asyncio.BaseTransport] = []
+        try:
+            for scheme, host, port in self.listen_addresses:
+                if scheme == "udp":
+                    transport, _ = await self.loop.create_datagram_endpoint(
+                        lambda: _DatagramProtocol(self),
+                        local_addr=(host, port),
+                        reuse_port=self.reuse_port or None,
+                    )
+                    transports.append(transport)
+                    self.bound_addresses.append(transport.get_extra_info("sockname"))
+                elif scheme == "tcp":
+                    server = await asyncio.start_server(
+                        self._handle_stream,
+                        host,
+                        port,
+                        reuse_port=self.reuse_port or None,
+                    )
+                    servers.append(server)
+                    self.bound_addresses.append(server.sockets[0].getsockname())
+                else:
+                    server = await asyncio.start_unix_server(self._handle_stream, host)
+                    servers.append(server)
+                    self.bound_addresses.append(host)
+        except BaseException as e:
+            self.startup_error = e
+        self.ready.set()
+
+        if self.startup_error is None:
+            await self._stopped.wait()
+
+        for transport in transports:
+            transport.close()
+        for server in servers:
+            server.close()
+            await server.wait_closed()
+        self._flush_datagrams()
+        for scheme, host, _ in self.listen_addresses:
+            if scheme == "unix" and os.path.exists(host):
+                os.unlink(host)
+
+    def start(self) -> "LogReceiver":
+        """
+        Start listening on a background thread.
+
+        Returns
+        -------
+        LogReceiver
+                self, for chaining.
+
+        Raises
+        ------
+        OSError
+                If any of the addresses couldn't be listened on.
+        """
+        self.thread = threading.Thread(
+            target=asyncio.run, args=(self._serve(),), name="receiver", daemon=True
+        )
+        self.thread.start()
+        self.ready.wait()
+        if self.startup_error is not None:
+            self.thread.join()
+            raise self.startup_error
+
+        return self
+
+    def close(self) -> None:
+        """
+        Stop listening. Anything already received can still be read.
+        """
+        self.closed.set()
+        if self.loop is not None and self._stopped is not None:
+            self.loop.call_soon_threadsafe(self._stopped.set)
+        if self.thread is not None:
+            self.thread.join()
+
+    def __enter__(self) -> "LogReceiver":
+        return self.start()
+
+    def __exit__(self, *exc_info) -> None:
+        self.close()
+
+    def _report(self) -> None:
+        # the counters are written on the event loop's thread, so they're
+        # copied into self_metrics from this one as deltas.
+        if self.self_metrics is None:
+            return
+
+        for name, count in [
+            ("received_lines", self.received_lines),
+            ("dropped_lines", self.dropped_lines),
+            ("backpressure_waits", self.backpressure_waits),
+        ]:
+            delta = count - self.reported.get(name, 0)
+            if delta:
+                self.self_metrics.increment(f"receiver.{name}", delta)
+                self.reported[name] = count
+
+    def _wake_senders(self) -> None:
+        try:
+            self.loop.call_soon_threadsafe(self._room.set)  # type: ignore[union-attr]
+        except RuntimeError:
+            # the loop's already shut down, so nobody's waiting
+            pass
+
+    def _decode(self, lines: list[bytes]) -> Iterator[str]:
+        for line in lines:
+            yield SYSLOG_PRIORITY.sub(b"", line.rstrip(b"\r")).decode(
+                "utf-8", "replace"
+            )
+
+    def __iter__(self) -> Iterator[dict[str, str]]:
+        if self.thread is None:
+            self.start()
+
+        while True:
+            try:
+                lines = self.batches.get(timeout=0.1)
+            except queue.Empty:
+                if self.closed.is_set() and not self.thread.is_alive():  # type: ignore[union-attr]
+                    return
+                continue
+
+            if self.backpressure_waits and not self.closed.is_set():
+                self._wake_senders()
+            self._report()
+            for row in csv.DictReader(self._decode(lines), self.fieldnames):
+                self.line_num += 1
+                yield row
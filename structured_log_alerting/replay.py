@@ -0,0 +1,221 @@
+import time
+from datetime import datetime, timedelta
+from itertools import islice
+from typing import Iterable, NamedTuple
+
+from structured_log_alerting.alertmanager import AlertManager
+from structured_log_alerting.governor import MemoryGovernor
+from structured_log_alerting.httpserver import MetricsServer
+from structured_log_alerting.metricscollection import CountersCollection
+from structured_log_alerting.output import OutputSink
+from structured_log_alerting.parser import Parser
+from structured_log_alerting.selfmetrics import SelfMetrics
+from structured_log_alerting.sortedarraydict import to_seconds
+
+
+class ReplayStats(NamedTuple):
+    """
+    What a single replay run did, and how long it took to do it.
+    """
+
+    lines: int
+    malformed_lines: int
+    alerts: int
+    wall_time_in_seconds: float
+
+    @property
+    def lines_per_second(self) -> float:
+        if self.wall_time_in_seconds <= 0:
+            return float(self.lines)
+        return self.lines / self.wall_time_in_seconds
+
+
+class Replayer:
+    """
+    Ingests an archived log as fast as possible, only evaluating alert
+    rules when the log's own clock crosses a window boundary rather than
+    on every new timestamp the way the streaming loop in main does.
+
+    Attributes
+    ----------
+    parser : Parser
+            The parser to run every log line through.
+    counters_collection : CountersCollection
+            The collection parsed lines are added to.
+    alertmanager : AlertManager
+            The AlertManager whose rules should be evaluated at each
+            window boundary.
+    output : OutputSink
+            Where to write alert transitions, usually a JSONLinesSink or
+            BatchedFileSink.
+    evaluation_interval : int, optional
+            The size (in seconds) of the windows to checkpoint evaluation
+            on. Boundaries are aligned to multiples of this from the UNIX
+            epoch, so the same log always evaluates at the same points in
+            time. Defaults to 10.
+    batch_size : int, optional
+            How many lines to pull off the reader at a time. Defaults to
+            10000.
+    self_metrics : SelfMetrics or None, optional
+            If given, ticked once per line so it can dump stats
+            periodically. Defaults to None.
+    metrics_server : MetricsServer or None, optional
+            If given, ticked once per line so it can publish snapshots
+            periodically (with the next boundary as the present), and
+            given a final snapshot once the log runs out. Defaults to
+            None.
+    memory_governor : MemoryGovernor or None, optional
+            If given, ticked once per line to keep the collection under
+            its memory budget. Defaults to None.
+
+    Notes
+    -----
+    Because every query on CountersCollection is bounded on the right by
+    the time we pass in, evaluating at a boundary is unaffected by data
+    from later in the log. We still evaluate a boundary as soon as the
+    first line past it shows up rather than after a whole batch, though,
+    because max_series_length would otherwise evict points a large batch
+    still needs. When the log skips ahead, only the boundaries either
+    side of the gap are evaluated.
+    """
+
+    def __init__(
+        self,
+        parser: Parser,
+        counters_collection: CountersCollection,
+        alertmanager: AlertManager,
+        output: OutputSink,
+        evaluation_interval: int = 10,
+        batch_size: int = 10000,
+        self_metrics: SelfMetrics | None = None,
+        metrics_server: MetricsServer | None = None,
+        memory_governor: MemoryGovernor | None = None,
+    ) -> None:
+        self.parser = parser
+        self.counters_collection = counters_collection
+        self.alertmanager = alertmanager
+        self.output = output
+        self.evaluation_interval = evaluation_interval
+        self.batch_size = batch_size
+        self.self_metrics = self_metrics
+        self.metrics_server = metrics_server
+        self.memory_governor = memory_governor
+
+        self.next_boundary: datetime | None = None
+        self.alert_count: int = 0
+
+    def first_boundary_for(self, timestamp: datetime) -> datetime:
+        """
+        Find the first window boundary at or after a timestamp.
+
+        Parameters
+        ----------
+        timestamp : datetime
+                The earliest timestamp seen in the log.
+
+        Returns
+        -------
+        datetime
+                The aligned boundary.
+        """
+        seconds = to_seconds(timestamp)
+        seconds_until_boundary = -seconds % self.evaluation_interval
+
+        return timestamp.replace(microsecond=0) + timedelta(
+            seconds=seconds_until_boundary
+        )
+
+    def evaluate(self, boundary: datetime) -> None:
+        """
+        Evaluate every alert rule at a single window boundary.
+
+        Parameters
+        ----------
+        boundary : datetime
+                The boundary to treat as the present.
+        """
+        alert = self.alertmanager.evaluate_elevated_requests(boundary)
+        if alert is not None:
+            self.output.write_alert(alert)
+            self.alert_count += 1
+
+        for alert in self.alertmanager.evaluate_anomalies(boundary):
+            self.output.write_alert(alert)
+            self.alert_count += 1
+
+        for alert in self.alertmanager.evaluate_heavy_hitters(boundary):
+            self.output.write_alert(alert)
+            self.alert_count += 1
+
+    def run(self, reader: Iterable[dict[str, str]]) -> ReplayStats:
+        """
+        Replay every line from the reader, then evaluate the final
+        (possibly partial) window once the log runs out.
+
+        Parameters
+        ----------
+        reader : iterable of dict of str: str
+                The log lines to replay, ex: a csv.DictReader.
+
+        Returns
+        -------
+        ReplayStats
+                Line counts and wall time for the run.
+        """
+        interval = timedelta(seconds=self.evaluation_interval)
+        heavy_hitter_detector = self.alertmanager.heavy_hitter_detector
+        lines: int = 0
+        malformed_lines: int = 0
+        start = time.perf_counter()
+
+        iterator = iter(reader)
+        while batch := list(islice(iterator, self.batch_size)):
+            lines += len(batch)
+
+            for line in batch:
+                try:
+                    metric_name, parsed_log_line = self.parser.parse_log_line(line)
+                except ValueError:
+                    malformed_lines += 1
+                    continue
+
+                timestamp = parsed_log_line["date"]
+                if self.next_boundary is None:
+                    self.next_boundary = self.first_boundary_for(timestamp)
+
+                if timestamp > self.next_boundary:
+                    self.evaluate(self.next_boundary)
+                    # nothing lands between here and this line, so skip
+                    # ahead instead of evaluating every empty boundary in
+                    # a gap (one line from years in the future would spin)
+                    next_boundary = self.first_boundary_for(timestamp)
+                    if next_boundary - interval > self.next_boundary:
+                        self.evaluate(next_boundary - interval)
+                    self.next_boundary = next_boundary
+
+                self.counters_collection.add_or_update_series(
+                    metric_name, parsed_log_line
+                )
+                if heavy_hitter_detector is not None:
+                    heavy_hitter_detector.add(parsed_log_line)
+
+                if self.self_metrics is not None:
+                    self.self_metrics.tick(timestamp, self.counters_collection)
+                if self.metrics_server is not None:
+                    self.metrics_server.tick(self.next_boundary)
+                if self.memory_governor is not None:
+                    self.memory_governor.tick(self.counters_collection)
+
+        if self.next_boundary is not None:
+            self.evaluate(self.next_boundary)
+            if self.metrics_server is not None:
+                self.metrics_server.publish(self.next_boundary)
+
+        self.output.flush()
+
+        return ReplayStats(
+            lines=lines,
+            malformed_lines=malformed_lines,
+            alerts=self.alert_count,
+            wall_time_in_seconds=time.perf_counter() - start,
+        )
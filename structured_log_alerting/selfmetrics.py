@@ -0,0 +1,360 @@
+import functools
+import sys
+import time
+from datetime import datetime
+from typing import TYPE_CHECKING, Any, Callable, TextIO, TypeVar
+
+if TYPE_CHECKING:
+    from structured_log_alerting.metricscollection import CountersCollection
+
+
+F = TypeVar("F", bound=Callable[..., Any])
+
+
+class LatencyHistogram:
+    """
+    A latency histogram with fixed power-of-two buckets (in
+    nanoseconds), so recording an observation is just a bit_length and
+    a list increment with no allocation.
+
+    Attributes
+    ----------
+    buckets : list of int
+            Bucket i counts observations between 2**(i-1) and 2**i ns.
+    count : int
+            The total number of observations.
+    total_nanoseconds : int
+            The sum of every observation, for calculating the mean.
+    """
+
+    def __init__(self) -> None:
+        self.buckets: list[int] = [0] * 64
+        self.count: int = 0
+        self.total_nanoseconds: int = 0
+
+    def observe(self, nanoseconds: int) -> None:
+        """
+        Record a single observation.
+
+        Parameters
+        ----------
+        nanoseconds : int
+                The observed latency.
+        """
+        self.buckets[min(nanoseconds.bit_length(), 63)] += 1
+        self.count += 1
+        self.total_nanoseconds += nanoseconds
+
+    def mean(self) -> float:
+        """
+        Returns
+        -------
+        float
+                The mean observed latency in nanoseconds, or 0 if nothing
+                has been observed yet.
+        """
+        if self.count == 0:
+            return 0.0
+        return self.total_nanoseconds / self.count
+
+    def percentile(self, percentile: float) -> int:
+        """
+        Find the upper bound of the bucket the given percentile falls in.
+        Because buckets are powers of two this is only accurate to within
+        a factor of two, which is plenty for spotting regressions.
+
+        Parameters
+        ----------
+        percentile : float
+                The percentile to find, between 0 and 100.
+
+        Returns
+        -------
+        int
+                The upper bound (in nanoseconds) of the percentile's bucket.
+        """
+        threshold = self.count * percentile / 100
+        running_count = 0
+        for bucket, bucket_count in enumerate(self.buckets):
+            running_count += bucket_count
+            if bucket_count and running_count >= threshold:
+                return 1 << bucket
+
+        return 0
+
+
+class SelfMetrics:
+    """
+    A registry of the tool's own counters and latency histograms.
+
+    Counters are plain ints in a dict while we're running, since that's
+    all the hot path can afford, but #flush periodically writes their
+    deltas into a CountersCollection as "selfmetrics.<name>" series. That
+    collection can then be summarized and alerted on by an AlertManager
+    like any other.
+
+    Attributes
+    ----------
+    counters_collection : CountersCollection
+            Where flushed counter deltas are stored. This should not be
+            the same collection that's being instrumented.
+    dump_interval : float, optional
+            How often (in wall-clock seconds) #tick should flush and write
+            a stats dump. Defaults to 10.
+    stream : TextIO, optional
+            Where stats dumps are written. Defaults to sys.stderr.
+    """
+
+    # checking the clock on every tick would cost about as much as some
+    # of the things we're measuring, so only check it every so often.
+    ticks_between_clock_checks: int = 1024
+
+    def __init__(
+        self,
+        counters_collection: "CountersCollection",
+        dump_interval: float = 10.0,
+        stream: TextIO | None = None,
+    ) -> None:
+        self.counters_collection = counters_collection
+        self.dump_interval = dump_interval
+        self.stream = stream if stream is not None else sys.stderr
+
+        self.counters: dict[str, int] = {}
+        self.flushed_counters: dict[str, int] = {}
+        self.histograms: dict[str, LatencyHistogram] = {}
+        self.gauges: dict[str, int] = {}
+        self.started_at: float = time.monotonic()
+        self.last_dump: float = self.started_at
+        self.ticks: int = 0
+
+    def increment(self, name: str, count: int = 1) -> None:
+        """
+        Increment a counter, creating it if it doesn't exist yet.
+
+        Parameters
+        ----------
+        name : str
+                The counter to increment.
+        count : int, optional
+                How much to increment it by. Defaults to 1.
+        """
+        self.counters[name] = self.counters.get(name, 0) + count
+
+    def set_gauge(self, name: str, value: int) -> None:
+        """
+        Set a gauge: a value that goes up and down (ex: a queue's
+        depth), so unlike a counter only its latest value is kept.
+        Gauges show up in stats dumps but aren't flushed.
+
+        Parameters
+        ----------
+        name : str
+                The gauge to set.
+        value : int
+                Its current value.
+        """
+        self.gauges[name] = value
+
+    def observe(self, name: str, nanoseconds: int) -> None:
+        """
+        Record a latency observation, creating the histogram if it
+        doesn't exist yet.
+
+        Parameters
+        ----------
+        name : str
+                The histogram to record to.
+        nanoseconds : int
+                The observed latency.
+        """
+        histogram = self.histograms.get(name)
+        if histogram is None:
+            histogram = self.histograms[name] = LatencyHistogram()
+        histogram.observe(nanoseconds)
+
+    def flush(self, current_time: datetime) -> None:
+        """
+        Write every counter's change since the last flush into
+        self.counters_collection as a single data point.
+
+        Parameters
+        ----------
+        current_time : datetime
+                The timestamp to record the deltas at. This should be the
+                log's idea of the present, so self-metrics line up with
+                the metrics they describe.
+        """
+        # copied first, since pipeline stages can add counters from
+        # other threads while we're iterating.
+        for name, count in list(self.counters.items()):
+            delta = count - self.flushed_counters.get(name, 0)
+            if delta <= 0:
+                continue
+
+            self.counters_collection.add_or_update_series(
+                f"selfmetrics.{name}",
+                {
+                    "remotehost": "localhost",
+                    "section": "selfmetrics",
+                    "endpoint": name,
+                    "http_verb": "",
+                    "status": "",
+                    "date": current_time,
+                },
+                delta,
+            )
+            self.flushed_counters[name] = count
+
+    def stats(self, instrumented_collection: "CountersCollection") -> dict[str, Any]:
+        """
+        Gather a point-in-time view of the tool's own health.
+
+        Parameters
+        ----------
+        instrumented_collection : CountersCollection
+                The collection being instrumented, for series counts and
+                memory estimates.
+
+        Returns
+        -------
+        dict of str: Any
+                Counters, histogram summaries, series counts, and
+                throughput since this registry was created.
+        """
+        elapsed = time.monotonic() - self.started_at
+        lines = self.histograms.get("parser.parse_log_line")
+        line_count = lines.count if lines else 0
+        series_count = len(instrumented_collection.series)
+
+        return {
+            "elapsed_seconds": elapsed,
+            "lines": line_count,
+            "lines_per_second": line_count / elapsed if elapsed > 0 else 0.0,
+            "series": series_count,
+            "bytes_per_series": instrumented_collection.approximate_bytes_per_series(),
+            "counters": dict(self.counters),
+            "gauges": dict(self.gauges),
+            "latencies": {
+                name: {
+                    "count": histogram.count,
+                    "mean_ns": histogram.mean(),
+                    "p50_ns": histogram.percentile(50),
+                    "p99_ns": histogram.percentile(99),
+                }
+                for name, histogram in list(self.histograms.items())
+            },
+        }
+
+    def format_stats(self, instrumented_collection: "CountersCollection") -> list[str]:
+        """
+        Format #stats as human-readable lines.
+
+        Parameters
+        ----------
+        instrumented_collection : CountersCollection
+                See #stats.
+
+        Returns
+        -------
+        list of str
+                The lines of the stats dump.
+        """
+        stats = self.stats(instrumented_collection)
+        lines = [
+            f"Self-metrics after {stats['elapsed_seconds']:.1f}s: {stats['lines']} lines "
+            f"({stats['lines_per_second']:.0f} lines/sec), {stats['series']} series "
+            f"(~{stats['bytes_per_series']:.0f} bytes/series)"
+        ]
+        for name, count in sorted(stats["counters"].items()):
+            lines.append(f"  {name}: {count}")
+        for name, value in sorted(stats["gauges"].items()):
+            lines.append(f"  {name}: {value} (now)")
+        for name, latency in sorted(stats["latencies"].items()):
+            lines.append(
+                f"  {name}: {latency['count']} calls, mean {latency['mean_ns'] / 1000:.1f}us, "
+                f"p50 <{latency['p50_ns'] / 1000:.1f}us, p99 <{latency['p99_ns'] / 1000:.1f}us"
+            )
+
+        return lines
+
+    def dump(
+        self,
+        current_time: datetime | None,
+        instrumented_collection: "CountersCollection",
+    ) -> None:
+        """
+        Flush counters and write a stats dump to self.stream.
+
+        Parameters
+        ----------
+        current_time : datetime or None
+                See #flush. If None (ex: we haven't seen a valid line
+                yet, so there is no present), skip the flush.
+        instrumented_collection : CountersCollection
+                See #stats.
+        """
+        if current_time is not None:
+            self.flush(current_time)
+        self.stream.write("\n".join(self.format_stats(instrumented_collection)) + "\n")
+        self.stream.flush()
+        self.last_dump = time.monotonic()
+
+    def tick(
+        self, current_time: datetime, instrumented_collection: "CountersCollection"
+    ) -> None:
+        """
+        Cheap enough to call once per log line; dumps stats whenever
+        self.dump_interval has passed.
+
+        Parameters
+        ----------
+        current_time : datetime
+                See #flush.
+        instrumented_collection : CountersCollection
+                See #stats.
+        """
+        self.ticks += 1
+        if self.ticks % self.ticks_between_clock_checks:
+            return
+
+        if time.monotonic() - self.last_dump >= self.dump_interval:
+            self.dump(current_time, instrumented_collection)
+
+
+def instrumented(name: str) -> Callable[[F], F]:
+    """
+    Decorate a method of any class with a self_metrics attribute so
+    each call is timed into the "<name>" histogram and each exception
+    counted as "<name>.errors". When self_metrics is None, the only cost
+    is the extra call and attribute check.
+
+    Parameters
+    ----------
+    name : str
+            The name to record the method's metrics under.
+
+    Returns
+    -------
+    callable
+            The decorator.
+    """
+
+    def decorator(method: F) -> F:
+        @functools.wraps(method)
+        def wrapper(self, *args, **kwargs):
+            self_metrics: SelfMetrics | None = self.self_metrics
+            if self_metrics is None:
+                return method(self, *args, **kwargs)
+
+            start = time.perf_counter_ns()
+            try:
+                return method(self, *args, **kwargs)
+            except Exception:
+                self_metrics.increment(f"{name}.errors")
+                raise
+            finally:
+                self_metrics.observe(name, time.perf_counter_ns() - start)
+
+        return wrapper  # type: ignore[return-value]
+
+    return decorator
@@ -0,0 +1,777 @@
+import json
+import multiprocessing
+import queue
+import signal
+import threading
+import time
+from array import array
+from datetime import datetime
+from multiprocessing.shared_memory import SharedMemory
+
+from structured_log_alerting.columnarcollection import (
+    ColumnarCountersCollection,
+    ColumnarSeries,
+)
+from structured_log_alerting.metricscollection import (
+    CountersCollection,
+    series_labels,
+)
+from structured_log_alerting.parser import Parser
+from structured_log_alerting.paths import PathNormalizer
+from structured_log_alerting.receiver import LogReceiver, parse_address
+from structured_log_alerting.selfmetrics import SelfMetrics
+from structured_log_alerting.sortedarraydict import from_seconds
+from structured_log_alerting.synthetic import FIELDNAMES
+
+
+# the header at the start of every shard's block is a handful of int64s,
+# only ever written by the shard's own process:
+# - the newest second seen, or -1 before the first line
+NEWEST_SECOND = 0
+# - how far into the series table it's written
+TABLE_BYTES = 1
+# - points dropped for being too old, or for a full shard
+DROPPED_POINTS = 2
+# - lines added, and lines that couldn't be parsed
+LINES = 3
+MALFORMED_LINES = 4
+HEADER_SLOTS = 8
+
+# room in the series table for each series' name and labels, as a line
+# of JSON
+BYTES_PER_SERIES_RECORD = 512
+
+
+def shard_layout(
+    capacity: int, retention_in_seconds: int, bucket_width_in_seconds: int
+) -> tuple[list[tuple[str, str, int, int]], int]:
+    """
+    Work out where everything goes in a shard's shared memory block.
+
+    Parameters
+    ----------
+    capacity : int
+            How many series the shard has room for.
+    retention_in_seconds : int
+            See ColumnarCountersCollection.
+    bucket_width_in_seconds : int
+            See ColumnarCountersCollection.
+
+    Returns
+    -------
+    tuple of (list of tuple of (str, str, int, int), int)
+            The name, typecode, offset and length (in items) of each
+            region, and the size of the whole block. Every region
+            starts on a multiple of 8 bytes.
+    """
+    bucket_ring_size = retention_in_seconds // bucket_width_in_seconds + 2
+    regions = []
+    offset = 0
+    for name, typecode, length in [
+        ("header", "q", HEADER_SLOTS),
+        ("counts", "I", capacity * retention_in_seconds),
+        ("bucket_counts", "I", capacity * bucket_ring_size),
+        ("totals", "Q", capacity),
+        ("table", "B", capacity * BYTES_PER_SERIES_RECORD),
+    ]:
+        regions.append((name, typecode, offset, length))
+        offset += length * array(typecode).itemsize
+        offset += -offset % 8
+
+    return regions, offset
+
+
+class SharedColumnarCollection(ColumnarCountersCollection):
+    """
+    A ColumnarCountersCollection whose matrices live in a
+    multiprocessing.shared_memory block, so one process (a shard, see
+    ShardedIngest) can write to it while others read it in place,
+    without copying, pickling or messages.
+
+    The matrices are allocated for capacity series up front, since a
+    shared block can't grow, and a new series takes the next row. Its
+    name and labels are appended to a series table in the same block,
+    which readers pick up in #refresh. Nothing is locked: there's only
+    ever one writer, and counts are aligned machine words, so a reader
+    sees each count either before or after an increment. A reader
+    querying while the writer moves on to a new second can miss
+    (or still see) the counts of the second being cleared, which is
+    as stale as a query a moment earlier would have been.
+
+    Attributes
+    ----------
+    memory : SharedMemory
+            The shared block.
+    capacity : int
+            How many series there's room for. Lines for any series
+            beyond that are dropped and counted in self.dropped_points.
+    retention_in_seconds : int, optional
+            See ColumnarCountersCollection. Defaults to 300.
+    bucket_width_in_seconds : int, optional
+            See ColumnarCountersCollection. Defaults to 10.
+    self_metrics : SelfMetrics or None, optional
+            See MetricsCollection. Defaults to None.
+    """
+
+    def __init__(
+        self,
+        memory: SharedMemory,
+        capacity: int,
+        retention_in_seconds: int = 300,
+        bucket_width_in_seconds: int = 10,
+        self_metrics: SelfMetrics | None = None,
+    ) -> None:
+        super().__init__(
+            self_metrics=self_metrics,
+            retention_in_seconds=retention_in_seconds,
+            bucket_width_in_seconds=bucket_width_in_seconds,
+        )
+        self.memory = memory
+        self.capacity = capacity
+
+        regions, size = shard_layout(
+            capacity, retention_in_seconds, bucket_width_in_seconds
+        )
+        if memory.size < size:
+            raise ValueError(
+                f"A shard of {capacity} series needs {size} bytes, "
+                f"not {memory.size}"
+            )
+        views = {
+            name: memory.buf[offset : offset + length * array(typecode).itemsize].cast(
+                typecode
+            )
+            for name, typecode, offset, length in regions
+        }
+        self.header: memoryview = views.pop("header")
+        self.table: memoryview = views.pop("table")
+        # the matrices for every row there's room for. self.counts etc
+        # only span the rows in use (see #_use_rows), so that summing a
+        # column doesn't sum capacity rows of zeros.
+        self.matrices: dict[str, memoryview] = views
+        self._use_rows(0)
+        # how much of the series table this copy has read
+        self.table_read: int = 0
+
+    @classmethod
+    def create(
+        cls,
+        capacity: int,
+        retention_in_seconds: int = 300,
+        bucket_width_in_seconds: int = 10,
+    ) -> "SharedColumnarCollection":
+        """
+        Allocate a new, empty shared block and a collection over it.
+
+        Parameters
+        ----------
+        capacity : int
+        retention_in_seconds : int, optional
+        bucket_width_in_seconds : int, optional
+                See SharedColumnarCollection.
+
+        Returns
+        -------
+        SharedColumnarCollection
+                The collection. Other processes can attach to it by
+                self.memory.name.
+        """
+        _, size = shard_layout(capacity, retention_in_seconds, bucket_width_in_seconds)
+        collection = cls(
+            SharedMemory(create=True, size=size),
+            capacity,
+            retention_in_seconds,
+            bucket_width_in_seconds,
+        )
+        collection.header[NEWEST_SECOND] = -1
+
+        return collection
+
+    def _own_columns(self) -> None:
+        # the shared matrices are already as big as they'll ever be
+        pass
+
+    def _add_series(
+        self, counter_name: str, parsed_log_file: dict
+    ) -> dict[str, ColumnarSeries]:  # type: ignore[override]
+        """
+        Give a new series the next row. See CountersCollection#_add_series.
+        """
+        section = parsed_log_file["section"]
+        section_id = self.section_ids.get(section)
+        if section_id is None:
+            section_id = self.section_ids[section] = len(self.sections)
+            self.sections.append(section)
+
+        series = ColumnarSeries(
+            self,
+            len(self.series),
+            counter_name,
+            self.intern_labels(series_labels(parsed_log_file)),
+        )
+        self.series[counter_name] = series
+        self._index_series(series)
+        self.series_sections.append(section_id)
+        self._use_rows(len(self.series))
+
+        return self.series
+
+    def _use_rows(self, rows: int) -> None:
+        for name, size in [
+            ("counts", self.ring_size),
+            ("bucket_counts", self.bucket_ring_size),
+            ("totals", 1),
+        ]:
+            column = getattr(self, name)
+            if isinstance(column, memoryview):
+                column.release()
+            setattr(self, name, self.matrices[name][: rows * size])
+        self._zero_column = array("I", bytes(4 * rows))
+
+    def _publish_series(self, counter_name: str, parsed_log_file: dict) -> bool:
+        """
+        Append a new series to the series table, if there's room for
+        it.
+        """
+        record = (
+            json.dumps(
+                [counter_name, list(series_labels(parsed_log_file).items())],
+                separators=(",", ":"),
+            ).encode()
+            + b"\n"
+        )
+        start = self.header[TABLE_BYTES]
+        end = start + len(record)
+        if len(self.series) >= self.capacity or end > len(self.table):
+            return False
+
+        self.table[start:end] = record
+        # only once the record's all there
+        self.header[TABLE_BYTES] = end
+        self.table_read = end
+        return True
+
+    def _advance_to(self, seconds: int) -> None:
+        """
+        See ColumnarCountersCollection#_advance_to. The new second is
+        published once the buckets it reuses have been cleared.
+        """
+        super()._advance_to(seconds)
+        self.header[NEWEST_SECOND] = seconds
+
+    def add_or_update_series(
+        self, counter_name: str, parsed_log_file: dict, count: int = 1
+    ) -> dict[str, ColumnarSeries]:  # type: ignore[override]
+        """
+        See ColumnarCountersCollection#add_or_update_series. Only the
+        shard's own process should call this.
+        """
+        if counter_name not in self.series and not self._publish_series(
+            counter_name, parsed_log_file
+        ):
+            self.dropped_points += count
+            self.header[DROPPED_POINTS] = self.dropped_points
+            return self.series
+
+        super().add_or_update_series(counter_name, parsed_log_file, count)
+        self.header[DROPPED_POINTS] = self.dropped_points
+
+        return self.series
+
+    def refresh(self) -> list[ColumnarSeries]:
+        """
+        Catch up with the shard's process: pick up any series it's added
+        since the last refresh, and the newest second it's seen. Only
+        readers need this.
+
+        Returns
+        -------
+        list of ColumnarSeries
+                The series that are new since the last refresh.
+        """
+        new_series = []
+        end = self.header[TABLE_BYTES]
+        if end > self.table_read:
+            for record in bytes(self.table[self.table_read : end]).splitlines():
+                counter_name, labels = json.loads(record)
+                self._add_series(counter_name, dict(labels))
+                new_series.append(self.series[counter_name])
+            self.table_read = end
+
+        newest_second = self.header[NEWEST_SECOND]
+        self.newest_second = newest_second if newest_second >= 0 else None
+        self.dropped_points = self.header[DROPPED_POINTS]
+
+        return new_series
+
+    def snapshot(self) -> "SharedColumnarCollection":  # type: ignore[override]
+        """
+        See ColumnarCountersCollection#snapshot. Everything, header and
+        series table included, is copied out of the shared block, so
+        the snapshot outlives it.
+        """
+        snapshot = super().snapshot()
+        snapshot.header = memoryview(array("q", self.header))
+        # as of the last #refresh, like the rest of it
+        snapshot.header[TABLE_BYTES] = self.table_read
+        snapshot.table = memoryview(bytes(self.table[: self.table_read]))
+        snapshot.matrices = {}
+
+        return snapshot  # type: ignore[return-value]
+
+    def close(self) -> None:
+        """
+        Let go of the shared block. The collection can't be used after
+        this, though a #snapshot of it can.
+        """
+        for view in [
+            self.header,
+            self.counts,
+            self.bucket_counts,
+            self.totals,
+            self.table,
+            *self.matrices.values(),
+        ]:
+            view.release()  # type: ignore[union-attr]
+        self.memory.close()
+
+
+class ShardedSeries:
+    """
+    One series, as the sum of its rows in every shard that's seen it,
+    so code that looks series up by name (ex: QueryEngine) works the
+    same against a ShardedCollection.
+
+    Attributes
+    ----------
+    parts : list of ColumnarSeries
+            The series' row in each shard that has one.
+    """
+
+    __slots__ = ("parts", "name", "label_pairs")
+
+    kind = "counter"
+
+    def __init__(self, parts: list[ColumnarSeries]) -> None:
+        self.parts = parts
+        self.name = parts[0].name
+        self.label_pairs = parts[0].label_pairs
+
+    @property
+    def labels(self) -> dict[str, str]:
+        return dict(self.label_pairs)
+
+    @property
+    def total(self) -> int:
+        """
+        See CounterSeries#total.
+        """
+        return sum(part.total for part in self.parts)
+
+    def total_count_since(
+        self, current_time: datetime, since_number_of_seconds: int = 10
+    ) -> int:
+        """
+        See CounterSeries#total_count_since.
+        """
+        return sum(
+            part.total_count_since(current_time, since_number_of_seconds)
+            for part in self.parts
+        )
+
+    def points_since(
+        self, current_time: datetime, since_number_of_seconds: int = 10
+    ) -> list[tuple[datetime, int]]:
+        """
+        See CounterSeries#points_since.
+        """
+        points: dict[datetime, int] = {}
+        for part in self.parts:
+            for timestamp, count in part.points_since(
+                current_time, since_number_of_seconds
+            ):
+                points[timestamp] = points.get(timestamp, 0) + count
+
+        return sorted(points.items())
+
+    def approximate_bytes(self) -> int:
+        """
+        See ColumnarSeries#approximate_bytes.
+        """
+        return sum(part.approximate_bytes() for part in self.parts)
+
+
+class ShardedCollection(CountersCollection):
+    """
+    A read-only view over every shard's SharedColumnarCollection, which
+    AlertManagers, QueryEngines and MetricsServers can use like any
+    other collection. Shards split up lines rather than series, so the
+    same series can have a row in several of them, and a query sums
+    them all.
+
+    Attributes
+    ----------
+    shards : list of SharedColumnarCollection
+            The shards, read in place.
+    self_metrics : SelfMetrics or None, optional
+            If given, every shard's lines, malformed lines and dropped
+            points are counted as "shards.*" counters by #refresh.
+            Defaults to None.
+    """
+
+    def __init__(
+        self,
+        shards: list[SharedColumnarCollection],
+        self_metrics: SelfMetrics | None = None,
+    ) -> None:
+        super().__init__(self_metrics=self_metrics)
+        self.shards = shards
+        self.series: dict[str, ShardedSeries] = {}  # type: ignore[assignment]
+        self.reported: dict[str, int] = {}
+
+    def _replace_shards(self, shards: list[SharedColumnarCollection]) -> None:
+        self.shards = shards
+        self.series = {}
+        self.label_index = {}
+        for shard in shards:
+            self._merge(list(shard.series.values()))
+
+    def _merge(self, new_series: list[ColumnarSeries]) -> None:
+        for part in new_series:
+            series = self.series.get(part.name)
+            if series is not None:
+                series.parts.append(part)
+                continue
+
+            series = self.series[part.name] = ShardedSeries([part])
+            self._index_series(series)
+            section = part.labels["section"]
+            if section not in self.sections:
+                self.sections.append(section)
+
+    def refresh(self) -> datetime | None:
+        """
+        Catch up with every shard (see SharedColumnarCollection#refresh).
+        Cheap enough to call before every evaluation.
+
+        Returns
+        -------
+        datetime or None
+                The newest second any shard has seen, or None before the
+                first line.
+        """
+        newest_second = None
+        for shard in self.shards:
+            self._merge(shard.refresh())
+            if shard.newest_second is not None and (
+                newest_second is None or shard.newest_second > newest_second
+            ):
+                newest_second = shard.newest_second
+
+        self._report()
+
+        return None if newest_second is None else from_seconds(newest_second)
+
+    def _report(self) -> None:
+        # the shards' counters are written by their own processes, so
+        # they're copied into self_metrics from here as deltas.
+        if self.self_metrics is None:
+            return
+
+        for name, slot in [
+            ("lines", LINES),
+            ("malformed_lines", MALFORMED_LINES),
+            ("dropped_points", DROPPED_POINTS),
+        ]:
+            count = sum(shard.header[slot] for shard in self.shards)
+            delta = count - self.reported.get(name, 0)
+            if delta:
+                self.self_metrics.increment(f"shards.{name}", delta)
+                self.reported[name] = count
+
+    def add_or_update_series(
+        self, counter_name: str, parsed_log_file: dict, count: int = 1
+    ) -> dict[str, ShardedSeries]:  # type: ignore[override]
+        raise TypeError("Shards are only written to by their own processes")
+
+    def total_count_since(
+        self,
+        current_time: datetime = datetime.now(),
+        since_number_of_seconds: int = 10,
+        metrics_namespace: str = "",
+    ) -> int:
+        """
+        See CountersCollection#total_count_since.
+        """
+        return sum(
+            shard.total_count_since(
+                current_time, since_number_of_seconds, metrics_namespace
+            )
+            for shard in self.shards
+        )
+
+    def total_counts_by_label(
+        self,
+        current_time: datetime = datetime.now(),
+        since_number_of_seconds: int = 10,
+        label: str = "section",
+    ) -> dict[str, int]:
+        """
+        See CountersCollection#total_counts_by_label.
+        """
+        totals: dict[str, int] = {}
+        for shard in self.shards:
+            for value, count in shard.total_counts_by_label(
+                current_time, since_number_of_seconds, label
+            ).items():
+                totals[value] = totals.get(value, 0) + count
+
+        return totals
+
+    def snapshot(self) -> "ShardedCollection":  # type: ignore[override]
+        """
+        See CountersCollection#snapshot. Each shard's matrices are
+        copied out of shared memory whole.
+        """
+        snapshot = ShardedCollection([])
+        snapshot._replace_shards([shard.snapshot() for shard in self.shards])
+
+        return snapshot
+
+    def detach(self) -> None:
+        """
+        Swap every shard for a #snapshot of it, so the shared blocks
+        can be freed and this can still be queried.
+        """
+        self.refresh()
+        self._replace_shards([shard.snapshot() for shard in self.shards])
+
+    def approximate_bytes_per_series(self, sample_size: int = 32) -> float:
+        """
+        See CountersCollection#approximate_bytes_per_series. This counts
+        the whole of every shard's block, used or not.
+        """
+        if not self.series:
+            return 0.0
+
+        return sum(shard.memory.size for shard in self.shards) / len(self.series)
+
+
+def _ingest_shard(
+    memory_name: str,
+    capacity: int,
+    retention_in_seconds: int,
+    bucket_width_in_seconds: int,
+    addresses: list[str],
+    path_normalizer: PathNormalizer | None,
+    request_cache_size: int,
+    started: "multiprocessing.Queue",
+    stopping: "multiprocessing.synchronize.Event",
+) -> None:
+    # what each shard's process runs: receive, parse and count lines
+    # into the shared block until told to stop.
+    # Ctrl-C goes to the whole process group, but it's up to the process
+    # that started the shards to stop them, once it's done reading them.
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    shard = SharedColumnarCollection(
+        SharedMemory(memory_name),
+        capacity,
+        retention_in_seconds,
+        bucket_width_in_seconds,
+    )
+    parser = Parser(
+        FIELDNAMES,
+        lambda message: None,
+        path_normalizer=path_normalizer,
+        request_cache_size=request_cache_size,
+    )
+    receiver = LogReceiver(addresses, reuse_port=True)
+    try:
+        receiver.start()
+    except OSError as e:
+        started.put(str(e))
+        shard.close()
+        return
+    started.put(None)
+
+    def stop() -> None:
+        stopping.wait()
+        receiver.close()
+
+    threading.Thread(target=stop, daemon=True).start()
+    header = shard.header
+    for line in receiver:
+        try:
+            metric_name, parsed_log_line = parser.parse_log_line(line)
+        except ValueError:
+            header[MALFORMED_LINES] += 1
+            continue
+        shard.add_or_update_series(metric_name, parsed_log_line)
+        header[LINES] += 1
+
+    shard.close()
+
+
+class ShardedIngest:
+    """
+    Spreads receiving, parsing and counting live log lines (see
+    LogReceiver) across shard_count processes, so ingest isn't held to
+    one core by the GIL. Every shard listens on the same addresses with
+    SO_REUSEPORT, so the kernel spreads senders (TCP connections, or
+    UDP sources) across them, and counts its lines into its own
+    SharedColumnarCollection. The process that started them reads every
+    shard in place through self.collection (a ShardedCollection) to
+    evaluate alerts, with nothing sent between processes but the lines
+    themselves.
+
+    Attributes
+    ----------
+    addresses : list of str
+            Where to listen: udp:// or tcp:// addresses with a port
+            given (unix:// sockets and port 0 can't be shared).
+    shard_count : int
+            How many processes to ingest with.
+    capacity : int, optional
+            How many series each shard has room for. Defaults to 10000.
+    retention_in_seconds : int, optional
+    bucket_width_in_seconds : int, optional
+            See ColumnarCountersCollection.
+    path_normalizer : PathNormalizer or None, optional
+    request_cache_size : int, optional
+            See Parser.
+    self_metrics : SelfMetrics or None, optional
+            See ShardedCollection. Defaults to None.
+    collection : ShardedCollection
+            Every shard, for alerting on.
+    """
+
+    def __init__(
+        self,
+        addresses: list[str],
+        shard_count: int,
+        capacity: int = 10000,
+        retention_in_seconds: int = 300,
+        bucket_width_in_seconds: int = 10,
+        path_normalizer: PathNormalizer | None = None,
+        request_cache_size: int = 4096,
+        self_metrics: SelfMetrics | None = None,
+    ) -> None:
+        if shard_count < 1:
+            raise ValueError("There has to be at least one shard")
+        for address in addresses:
+            scheme, _, port = parse_address(address)
+            if scheme == "unix" or not port:
+                raise ValueError(
+                    f"Shards can't share {address!r}, they need udp:// or tcp:// "
+                    "addresses with a port given"
+                )
+
+        self.addresses = addresses
+        self.shard_count = shard_count
+        self.capacity = capacity
+        self.retention_in_seconds = retention_in_seconds
+        self.bucket_width_in_seconds = bucket_width_in_seconds
+        self.path_normalizer = path_normalizer
+        self.request_cache_size = request_cache_size
+        self.self_metrics = self_metrics
+
+        # forked children would inherit every other thread's locks
+        self.context = multiprocessing.get_context("spawn")
+        self.stopping: "multiprocessing.synchronize.Event | None" = None
+        self.processes: list = []
+        self.collection = ShardedCollection([], self_metrics)
+
+    def start(self, timeout: float = 30.0) -> "ShardedIngest":
+        """
+        Start every shard's process, and wait for them to be listening.
+
+        Parameters
+        ----------
+        timeout : float, optional
+                The longest to wait. Defaults to 30 seconds.
+
+        Returns
+        -------
+        ShardedIngest
+                self, for chaining.
+
+        Raises
+        ------
+        OSError
+                If a shard couldn't listen, or didn't start in time.
+        """
+        self.stopping = self.context.Event()
+        started = self.context.Queue()
+        for _ in range(self.shard_count):
+            shard = SharedColumnarCollection.create(
+                self.capacity, self.retention_in_seconds, self.bucket_width_in_seconds
+            )
+            self.collection.shards.append(shard)
+            process = self.context.Process(
+                target=_ingest_shard,
+                args=(
+                    shard.memory.name,
+                    self.capacity,
+                    self.retention_in_seconds,
+                    self.bucket_width_in_seconds,
+                    self.addresses,
+                    self.path_normalizer,
+                    self.request_cache_size,
+                    started,
+                    self.stopping,
+                ),
+                name=f"shard-{len(self.processes)}",
+                daemon=True,
+            )
+            process.start()
+            self.processes.append(process)
+
+        deadline = time.monotonic() + timeout
+        waiting_for = len(self.processes)
+        while waiting_for:
+            try:
+                error = started.get(timeout=0.1)
+                waiting_for -= 1
+            except queue.Empty:
+                if all(process.is_alive() for process in self.processes):
+                    if time.monotonic() < deadline:
+                        continue
+                    error = "timed out starting"
+                else:
+                    error = "a shard's process died starting"
+            if error is not None:
+                self.close()
+                raise OSError(f"A shard couldn't listen: {error}")
+
+        return self
+
+    def close(self, timeout: float = 30.0) -> None:
+        """
+        Stop every shard, once they've counted whatever they've already
+        received, and free their shared blocks. self.collection keeps a
+        copy of the shards' final counts (see ShardedCollection#detach).
+
+        Parameters
+        ----------
+        timeout : float, optional
+                The longest to wait for each shard. Defaults to 30 seconds.
+        """
+        if self.stopping is not None:
+            self.stopping.set()
+        for process in self.processes:
+            process.join(timeout)
+            if process.is_alive():
+                process.terminate()
+                process.join()
+
+        shards = self.collection.shards
+        self.collection.detach()
+        for shard in shards:
+            shard.close()
+            shard.memory.unlink()
+
+    def __enter__(self) -> "ShardedIngest":
+        return self.start()
+
+    def __exit__(self, *exc_info) -> None:
+        self.close()
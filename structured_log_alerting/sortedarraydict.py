@@ -0,0 +1,280 @@
+import sys
+from array import array
+from bisect import bisect_left, bisect_right
+from datetime import datetime, timedelta
+from typing import Iterator
+
+
+# naive on purpose, to match the naive datetimes Parser hands back.
+UNIX_EPOCH = datetime(1970, 1, 1)
+ONE_SECOND = timedelta(seconds=1)
+
+
+def to_seconds(timestamp: datetime) -> int:
+    """
+    Convert a (naive) datetime to whole seconds since UNIX_EPOCH. This
+    is plain arithmetic rather than datetime#timestamp, which would go
+    through the local timezone and is several times slower.
+
+    Parameters
+    ----------
+    timestamp : datetime
+            The timestamp to convert.
+
+    Returns
+    -------
+    int
+            Whole seconds since UNIX_EPOCH, rounded down.
+    """
+    return (timestamp - UNIX_EPOCH) // ONE_SECOND
+
+
+def from_seconds(seconds: int) -> datetime:
+    """
+    The inverse of #to_seconds.
+
+    Parameters
+    ----------
+    seconds : int
+            Whole seconds since UNIX_EPOCH.
+
+    Returns
+    -------
+    datetime
+            The equivalent naive datetime.
+    """
+    return UNIX_EPOCH + timedelta(seconds=seconds)
+
+
+class SortedArrayDict:
+    """
+    A compact stand-in for SortedOrderedDict, keyed by datetime (at one
+    second granularity) with int values. Keys and values are stored as
+    two parallel typed arrays instead of a linked hash map of datetime
+    and int objects, which takes 16 bytes per data point instead of
+    well over 100.
+
+    Keys stay sorted in ascending order, and like SortedOrderedDict the
+    oldest keys are dropped once there are more than max_len of them.
+
+    Attributes
+    ----------
+    max_len : int
+            The maximum number of keys to keep.
+    seconds : array of int64
+            The keys, as whole seconds since UNIX_EPOCH. 64 bits covers
+            any date a datetime can hold.
+    counts : array of int64
+            The values, which can't overflow however busy a second is.
+
+    Notes
+    -----
+    Inserting into the middle of an array means shifting everything
+    after it, but with a hundred-ish points per series that's a short
+    memmove, and in-order keys (by far the common case) are just an
+    append. Finding a key is a binary search rather than a hash lookup.
+    """
+
+    __slots__ = ("max_len", "seconds", "counts")
+
+    def __init__(self, max_len: int) -> None:
+        self.max_len = max_len
+        self.seconds: array = array("q")
+        self.counts: array = array("q")
+
+    def __len__(self) -> int:
+        return len(self.seconds)
+
+    def __contains__(self, key: datetime) -> bool:
+        seconds = to_seconds(key)
+        index = bisect_left(self.seconds, seconds)
+        return index < len(self.seconds) and self.seconds[index] == seconds
+
+    def __getitem__(self, key: datetime) -> int:
+        seconds = to_seconds(key)
+        index = bisect_left(self.seconds, seconds)
+        if index < len(self.seconds) and self.seconds[index] == seconds:
+            return self.counts[index]
+        raise KeyError(key)
+
+    def __setitem__(self, key: datetime, value: int) -> None:
+        seconds = to_seconds(key)
+        index = bisect_left(self.seconds, seconds)
+        if index < len(self.seconds) and self.seconds[index] == seconds:
+            self.counts[index] = value
+        else:
+            self._insert(index, seconds, value)
+
+    def __iter__(self) -> Iterator[datetime]:
+        for seconds in self.seconds:
+            yield from_seconds(seconds)
+
+    def items(self) -> Iterator[tuple[datetime, int]]:
+        for seconds, count in zip(self.seconds, self.counts):
+            yield from_seconds(seconds), count
+
+    def popitem(self, last: bool = True) -> tuple[datetime, int]:
+        """
+        Remove and return the newest (or oldest) key and its value,
+        like OrderedDict#popitem.
+        """
+        if not self.seconds:
+            raise KeyError("popitem(): dictionary is empty")
+
+        index = -1 if last else 0
+        item = from_seconds(self.seconds[index]), self.counts[index]
+        del self.seconds[index]
+        del self.counts[index]
+
+        return item
+
+    def _insert(self, index: int, seconds: int, count: int) -> None:
+        if index == len(self.seconds):
+            self.seconds.append(seconds)
+            self.counts.append(count)
+        else:
+            self.seconds.insert(index, seconds)
+            self.counts.insert(index, count)
+
+        if len(self.seconds) > self.max_len:
+            del self.seconds[0]
+            del self.counts[0]
+
+    def increment(self, seconds: int, count: int = 1) -> None:
+        """
+        Add to the value at a key (given in seconds), creating it if it
+        doesn't exist yet. This is the hot path for counters, so it
+        checks the last key before falling back to a binary search.
+
+        Parameters
+        ----------
+        seconds : int
+                The key, as whole seconds since UNIX_EPOCH.
+        count : int, optional
+                How much to add. Defaults to 1.
+        """
+        keys = self.seconds
+        if keys and keys[-1] == seconds:
+            self.counts[-1] += count
+            return
+
+        index = bisect_left(keys, seconds)
+        if index < len(keys) and keys[index] == seconds:
+            self.counts[index] += count
+        else:
+            self._insert(index, seconds, count)
+
+    def sum_between(self, after_seconds: int, until_seconds: int) -> int:
+        """
+        Sum the values with keys in (after_seconds, until_seconds].
+
+        Parameters
+        ----------
+        after_seconds : int
+                The exclusive lower bound, in seconds since UNIX_EPOCH.
+        until_seconds : int
+                The inclusive upper bound, in seconds since UNIX_EPOCH.
+
+        Returns
+        -------
+        int
+                The sum of the values in range.
+        """
+        start = bisect_right(self.seconds, after_seconds)
+        end = bisect_right(self.seconds, until_seconds)
+
+        return sum(self.counts[start:end])
+
+    def items_between(
+        self, after_seconds: int, until_seconds: int
+    ) -> Iterator[tuple[datetime, int]]:
+        """
+        Like #items, but only for keys in (after_seconds, until_seconds].
+        See #sum_between.
+        """
+        start = bisect_right(self.seconds, after_seconds)
+        end = bisect_right(self.seconds, until_seconds)
+        for index in range(start, end):
+            yield from_seconds(self.seconds[index]), self.counts[index]
+
+    def downsample(self, resolution: int) -> int:
+        """
+        Merge every key into the start of its resolution-second bucket
+        (aligned to UNIX_EPOCH), so there's at most one key per bucket.
+
+        Parameters
+        ----------
+        resolution : int
+                How many seconds each bucket is.
+
+        Returns
+        -------
+        int
+                How many keys were merged away.
+        """
+        seconds: array = array("q")
+        counts: array = array("q")
+        for key, count in zip(self.seconds, self.counts):
+            key -= key % resolution
+            if seconds and seconds[-1] == key:
+                counts[-1] += count
+            else:
+                seconds.append(key)
+                counts.append(count)
+
+        merged = len(self.seconds) - len(seconds)
+        # new arrays rather than deleting in place, which wouldn't give
+        # back what the old ones had allocated
+        self.seconds = seconds
+        self.counts = counts
+
+        return merged
+
+    def shrink(self, max_len: int) -> int:
+        """
+        Lower max_len, dropping the oldest keys past it.
+
+        Parameters
+        ----------
+        max_len : int
+                The new maximum number of keys to keep.
+
+        Returns
+        -------
+        int
+                How many keys were dropped.
+        """
+        dropped = max(len(self.seconds) - max_len, 0)
+        self.max_len = max_len
+        # see #downsample
+        self.seconds = self.seconds[dropped:]
+        self.counts = self.counts[dropped:]
+
+        return dropped
+
+    def approximate_bytes(self) -> int:
+        """
+        Returns
+        -------
+        int
+                The memory used by this object and its arrays.
+        """
+        return (
+            sys.getsizeof(self)
+            + sys.getsizeof(self.seconds)
+            + sys.getsizeof(self.counts)
+        )
+
+    def copy(self) -> "SortedArrayDict":
+        """
+        Returns
+        -------
+        SortedArrayDict
+                A copy with its own arrays, so later writes to this one
+                don't show up in it.
+        """
+        copy = SortedArrayDict(self.max_len)
+        copy.seconds = self.seconds[:]
+        copy.counts = self.counts[:]
+
+        return copy
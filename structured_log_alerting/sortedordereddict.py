@@ -1,4 +1,5 @@
 from collections import deque, OrderedDict
+from typing import Any, Iterable, cast
 
 
 class SortedOrderedDict(OrderedDict):
@@ -0,0 +1,311 @@
+import csv
+import heapq
+import io
+import os
+import queue
+import threading
+from contextlib import contextmanager
+from glob import glob
+from itertools import islice
+from typing import Iterator
+
+from structured_log_alerting.compression import (
+    BLOCK_SIZE,
+    BLOCKS_AHEAD,
+    open_log_file,
+)
+
+
+# the characters that make a location a glob rather than a single path
+GLOB_CHARACTERS = "*?["
+
+# what a reader thread puts on its queue once its file runs out
+END_OF_SOURCE = None
+
+
+def expand_locations(locations: list[str]) -> list[str]:
+    """
+    Turn log locations into a list of log files. Each location can be a
+    file, a directory (every file directly inside it) or a glob.
+
+    Parameters
+    ----------
+    locations : list of str
+            The locations to expand.
+
+    Returns
+    -------
+    list of str
+            The paths of every log file, in the order given (and sorted
+            within each directory or glob), without duplicates.
+
+    Raises
+    ------
+    ValueError
+            If a directory or glob doesn't contain any files.
+    """
+    paths: list[str] = []
+    for location in locations:
+        if os.path.isdir(location):
+            matches = sorted(glob(os.path.join(glob_escape(location), "*")))
+        elif not os.path.exists(location) and any(
+            character in location for character in GLOB_CHARACTERS
+        ):
+            matches = sorted(glob(location))
+        else:
+            matches = [location]
+
+        matches = [path for path in matches if not os.path.isdir(path)]
+        if not matches:
+            raise ValueError(f"No log files found at {location}")
+
+        for path in matches:
+            if path not in paths:
+                paths.append(path)
+
+    return paths
+
+
+def glob_escape(path: str) -> str:
+    """
+    Escape any glob characters in a literal path.
+    """
+    return "".join(
+        f"[{character}]" if character in GLOB_CHARACTERS else character
+        for character in path
+    )
+
+
+def hosts_for(paths: list[str]) -> list[str]:
+    """
+    Name the host each log file came from, after the file (ex:
+    logs/web-1.csv is from web-1). Dots would split up a hierarchical
+    metric name, so they're replaced with underscores, and any names
+    that would clash get numbered.
+
+    Parameters
+    ----------
+    paths : list of str
+            The log files.
+
+    Returns
+    -------
+    list of str
+            Each file's host, in the same order.
+    """
+    hosts: list[str] = []
+    for path in paths:
+        host = os.path.splitext(os.path.basename(path))[0].replace(".", "_")
+        unique_host = host
+        suffix = 2
+        while unique_host in hosts:
+            unique_host = f"{host}_{suffix}"
+            suffix += 1
+        hosts.append(unique_host)
+
+    return hosts
+
+
+def timestamp_key(log_line: dict[str, str]) -> int:
+    """
+    Order log lines by their raw timestamps. Lines without a valid one
+    sort first, so the parser sees (and rejects) them straight away.
+    """
+    try:
+        return int(log_line["date"])
+    except (KeyError, TypeError, ValueError):
+        return -1
+
+
+class MergedLogReader:
+    """
+    Reads several csv-formatted log files at once (ex: one per web
+    server) and merges them into a single stream ordered by timestamp,
+    so everything downstream sees one log.
+
+    Each file is read on its own thread, which puts batches of lines on
+    a bounded queue, and the merge is a heap-based k-way merge over the
+    heads of those queues. A thread whose queue is full waits for the
+    merge to catch up, so at most buffered_lines lines are held in
+    memory in total (plus the one line per file at the head of the
+    heap) however many files there are. Likewise, the files' read (and
+    decompression) buffers share buffered_bytes between them. What
+    does grow with the number of files is a thread, an open file and a
+    minimum io.DEFAULT_BUFFER_SIZE buffer each (plus, for compressed
+    files, the decompressor's own state, which for bz2 is a few MB).
+
+    Like a single log, each file only needs to be roughly in order: the
+    merge is exactly ordered across files, but within a file lines come
+    out in the order they were written.
+
+    Attributes
+    ----------
+    paths : list of str
+            The log files to read. Each one needs a header row.
+    label_hosts : bool, optional
+            Whether to add a "host" field to every line, naming the file
+            it came from (see #hosts_for). Defaults to True.
+    buffered_lines : int, optional
+            The most lines to hold in memory across every file's queue.
+            Defaults to 100000.
+    batch_size : int, optional
+            The most lines a reader thread puts on its queue at a time,
+            to keep locking off the per-line path. Defaults to 1000, and
+            is reduced to fit buffered_lines.
+    buffered_bytes : int, optional
+            The most to buffer across every file's reads. Defaults to 16
+            MiB.
+    buffering : int, optional
+            The buffer size to ask for each file, passed on to
+            open_log_file, but cut down to its share of buffered_bytes.
+            Defaults to -1, which asks for BLOCK_SIZE.
+    decompress_in_thread : bool, optional
+            Passed on to open_log_file for each file. Defaults to False.
+    """
+
+    def __init__(
+        self,
+        paths: list[str],
+        label_hosts: bool = True,
+        buffered_lines: int = 100000,
+        batch_size: int = 1000,
+        buffered_bytes: int = 1 << 24,
+        buffering: int = -1,
+        decompress_in_thread: bool = False,
+    ) -> None:
+        self.paths = paths
+        self.hosts: list[str | None] = (
+            list(hosts_for(paths)) if label_hosts else [None] * len(paths)
+        )
+        self.decompress_in_thread = decompress_in_thread
+
+        # a BackgroundReader keeps blocks read ahead on top of the buffer
+        buffers_per_source = 1 + (BLOCKS_AHEAD if decompress_in_thread else 0)
+        bytes_per_source = buffered_bytes // (max(1, len(paths)) * buffers_per_source)
+        self.buffering = max(
+            io.DEFAULT_BUFFER_SIZE,
+            min(buffering if buffering > 1 else BLOCK_SIZE, bytes_per_source),
+        )
+
+        lines_per_source = max(1, buffered_lines // max(1, len(paths)))
+        self.batch_size = max(1, min(batch_size, lines_per_source))
+        self.batches_per_source = max(1, lines_per_source // self.batch_size)
+
+        with open_log_file(paths[0]) as f:
+            self.fieldnames: list[str] = next(csv.reader(f), [])
+
+        self.line_num: int = 0
+        self.stopping = threading.Event()
+        self.queues: list[queue.Queue] = []
+        self.threads: list[threading.Thread] = []
+
+    def _put(self, batches: queue.Queue, item) -> bool:
+        # wait for room, but give up if the reader's been closed.
+        while not self.stopping.is_set():
+            try:
+                batches.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def _read(self, path: str, host: str | None, batches: queue.Queue) -> None:
+        try:
+            with open_log_file(path, self.buffering, self.decompress_in_thread) as f:
+                reader = csv.DictReader(f)
+                while batch := list(islice(reader, self.batch_size)):
+                    if host is not None:
+                        for line in batch:
+                            line["host"] = host
+                    if not self._put(batches, batch):
+                        return
+        except Exception as e:
+            # hand it to the merge to raise, rather than losing it here
+            self._put(batches, e)
+            return
+
+        self._put(batches, END_OF_SOURCE)
+
+    def _lines_from(self, batches: queue.Queue) -> Iterator[dict[str, str]]:
+        while (batch := batches.get()) is not END_OF_SOURCE:
+            if isinstance(batch, Exception):
+                raise batch
+            yield from batch
+
+    def start(self) -> None:
+        """
+        Start a reader thread for every file.
+        """
+        for path, host in zip(self.paths, self.hosts):
+            batches: queue.Queue = queue.Queue(self.batches_per_source)
+            thread = threading.Thread(
+                target=self._read,
+                args=(path, host, batches),
+                name=f"reader-{host or path}",
+                daemon=True,
+            )
+            self.queues.append(batches)
+            self.threads.append(thread)
+            thread.start()
+
+    def close(self) -> None:
+        """
+        Stop every reader thread, even if its file hasn't run out.
+        """
+        self.stopping.set()
+        for thread in self.threads:
+            thread.join()
+
+    def __iter__(self) -> Iterator[dict[str, str]]:
+        if not self.threads:
+            self.start()
+
+        for line in heapq.merge(
+            *[self._lines_from(batches) for batches in self.queues],
+            key=timestamp_key,
+        ):
+            self.line_num += 1
+            yield line
+
+
+@contextmanager
+def open_logs(
+    locations: list[str], buffering: int = -1, decompress_in_thread: bool = False
+) -> Iterator["csv.DictReader | MergedLogReader"]:
+    """
+    Open one or more log locations (see #expand_locations) for reading.
+
+    A single file is read directly with a csv.DictReader, exactly as
+    before there was a choice. Several files are read concurrently and
+    merged by a MergedLogReader, with every line labeled with its host.
+    Either way, compressed files are decompressed as they're read (see
+    #open_log_file).
+
+    Parameters
+    ----------
+    locations : list of str
+            The files, directories or globs to read.
+    buffering : int, optional
+            Passed on to open_log_file. Defaults to -1.
+    decompress_in_thread : bool, optional
+            Passed on to open_log_file. Defaults to False.
+
+    Yields
+    ------
+    csv.DictReader or MergedLogReader
+            An iterable of log lines, with fieldnames and line_num
+            attributes.
+    """
+    paths = expand_locations(locations)
+    if len(paths) == 1:
+        with open_log_file(paths[0], buffering, decompress_in_thread) as f:
+            yield csv.DictReader(f)
+        return
+
+    reader = MergedLogReader(
+        paths, buffering=buffering, decompress_in_thread=decompress_in_thread
+    )
+    try:
+        yield reader
+    finally:
+        reader.close()
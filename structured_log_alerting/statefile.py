@@ -0,0 +1,407 @@
+import json
+import mmap
+import os
+import struct
+import sys
+import tempfile
+import time
+from array import array
+
+from structured_log_alerting.columnarcollection import (
+    ColumnarCountersCollection,
+    ColumnarSeries,
+)
+from structured_log_alerting.metricscollection import CountersCollection
+from structured_log_alerting.selfmetrics import SelfMetrics, instrumented
+from structured_log_alerting.timeseries import CounterSeries, Labels
+
+
+MAGIC = b"SLASTATE"
+VERSION = 1
+
+# which collection a state file holds
+SERIES_KIND = 0
+COLUMNAR_KIND = 1
+
+# magic, version, kind, whether it's little endian, how many arrays
+# follow, and where the metadata is (offset, length)
+HEADER = struct.Struct("<8sHHBxH4xQQ")
+# one per array: its typecode, offset and length (in items)
+ARRAY_ENTRY = struct.Struct("<c7xQQ")
+# arrays start on a multiple of this, so every typed view is aligned
+ALIGNMENT = 8
+
+# the arrays in each kind of file, in order
+COLUMNAR_ARRAYS: list[tuple[str, str]] = [
+    ("counts", "I"),
+    ("bucket_counts", "I"),
+    ("totals", "Q"),
+    ("series_sections", "I"),
+]
+SERIES_ARRAYS: list[tuple[str, str]] = [
+    # every series' data points, one series after another
+    ("seconds", "q"),
+    ("counts", "q"),
+    # how many of them belong to each series
+    ("lengths", "I"),
+    ("totals", "Q"),
+]
+
+
+def _padding(offset: int) -> int:
+    return -offset % ALIGNMENT
+
+
+def _label_tables(collection: CountersCollection) -> tuple[list, list, list]:
+    # the label intern table flattened into unique pairs and label sets
+    # (as indexes into the pairs), plus every series' name and label set.
+    pair_ids: dict[tuple[str, str], int] = {}
+    set_ids: dict[Labels, int] = {}
+    label_sets: list[list[int]] = []
+    series: list[tuple[str, int]] = []
+    for name, each in collection.series.items():
+        set_id = set_ids.get(each.label_pairs)
+        if set_id is None:
+            set_id = set_ids[each.label_pairs] = len(label_sets)
+            label_sets.append(
+                [pair_ids.setdefault(pair, len(pair_ids)) for pair in each.label_pairs]
+            )
+        series.append((name, set_id))
+
+    return [list(pair) for pair in pair_ids], label_sets, series
+
+
+def write_state(collection: CountersCollection, path: str) -> int:
+    """
+    Write a collection's whole state to a file that #load_state can
+    map straight back into memory: a small header, the series index and
+    label intern table (as JSON), and then the raw data arrays.
+
+    The file is written alongside path under a temporary name, synced
+    and renamed over path, so a crash mid-write leaves the previous
+    state file intact rather than half of a new one.
+
+    Parameters
+    ----------
+    collection : CountersCollection or ColumnarCountersCollection
+            The collection to save.
+    path : str
+            Where to save it.
+
+    Returns
+    -------
+    int
+            The size of the file in bytes.
+    """
+    pairs, label_sets, series = _label_tables(collection)
+    metadata: dict = {
+        "max_series_length": collection.max_series_length,
+        "sections": collection.sections,
+        "label_pairs": pairs,
+        "label_sets": label_sets,
+        "series": series,
+    }
+
+    columns: list[tuple[str, array | memoryview]]
+    if isinstance(collection, ColumnarCountersCollection):
+        kind = COLUMNAR_KIND
+        metadata.update(
+            retention_in_seconds=collection.ring_size,
+            bucket_width_in_seconds=collection.bucket_width,
+            newest_second=collection.newest_second,
+            dropped_points=collection.dropped_points,
+        )
+        columns = [(name, getattr(collection, name)) for name, _ in COLUMNAR_ARRAYS]
+    else:
+        kind = SERIES_KIND
+        seconds, counts, lengths, totals = (
+            array(typecode) for _, typecode in SERIES_ARRAYS
+        )
+        for each in collection.series.values():
+            seconds.extend(each.data_points.seconds)
+            counts.extend(each.data_points.counts)
+            lengths.append(len(each.data_points))
+            totals.append(each.total)
+        columns = list(
+            zip(
+                [name for name, _ in SERIES_ARRAYS],
+                [seconds, counts, lengths, totals],
+            )
+        )
+
+    metadata_bytes = json.dumps(metadata, separators=(",", ":")).encode()
+    offset = HEADER.size + ARRAY_ENTRY.size * len(columns)
+    metadata_offset = offset
+    offset += len(metadata_bytes)
+
+    entries = []
+    for (_, column), (_, typecode) in zip(
+        columns, COLUMNAR_ARRAYS if kind == COLUMNAR_KIND else SERIES_ARRAYS
+    ):
+        offset += _padding(offset)
+        entries.append(ARRAY_ENTRY.pack(typecode.encode(), offset, len(column)))
+        offset += len(column) * array(typecode).itemsize
+
+    directory = os.path.dirname(os.path.abspath(path))
+    descriptor, temporary_path = tempfile.mkstemp(
+        prefix=f".{os.path.basename(path)}.", dir=directory
+    )
+    try:
+        with os.fdopen(descriptor, "wb") as file:
+            file.write(
+                HEADER.pack(
+                    MAGIC,
+                    VERSION,
+                    kind,
+                    sys.byteorder == "little",
+                    len(columns),
+                    metadata_offset,
+                    len(metadata_bytes),
+                )
+            )
+            file.write(b"".join(entries))
+            file.write(metadata_bytes)
+            for _, column in columns:
+                file.write(bytes(_padding(file.tell())))
+                # straight from the array's (or mapping's) buffer
+                file.write(column)
+            file.flush()
+            os.fsync(file.fileno())
+        os.replace(temporary_path, path)
+    except BaseException:
+        os.unlink(temporary_path)
+        raise
+
+    return offset
+
+
+def _read_header(mapping: mmap.mmap) -> tuple[int, dict, list[memoryview]]:
+    # the kind, metadata and a typed view of every array in a state file
+    if len(mapping) < HEADER.size:
+        raise ValueError("Invalid state file, it's too short to have a header")
+
+    (
+        magic,
+        version,
+        kind,
+        little_endian,
+        array_count,
+        metadata_offset,
+        metadata_length,
+    ) = HEADER.unpack_from(mapping)
+    if magic != MAGIC:
+        raise ValueError("Invalid state file, it doesn't start with " + repr(MAGIC))
+    if version != VERSION:
+        raise ValueError(f"Unsupported state file version {version}")
+    if bool(little_endian) != (sys.byteorder == "little"):
+        raise ValueError(
+            "This state file was written on a machine of the other byte order"
+        )
+
+    raw = memoryview(mapping)
+    metadata = json.loads(
+        bytes(raw[metadata_offset : metadata_offset + metadata_length])
+    )
+    views = []
+    for i in range(array_count):
+        typecode, offset, length = ARRAY_ENTRY.unpack_from(
+            mapping, HEADER.size + ARRAY_ENTRY.size * i
+        )
+        end = offset + length * array(typecode.decode()).itemsize
+        if end > len(mapping):
+            raise ValueError("Invalid state file, it's been cut short")
+        views.append(raw[offset:end].cast(typecode.decode()))
+
+    return kind, metadata, views
+
+
+def _intern_label_sets(collection: CountersCollection, metadata: dict) -> list[Labels]:
+    pairs = [
+        collection.label_table.setdefault(pair, pair)
+        for pair in (
+            (sys.intern(key), sys.intern(value))
+            for key, value in metadata["label_pairs"]
+        )
+    ]
+    label_sets = []
+    for pair_ids in metadata["label_sets"]:
+        label_set = tuple(pairs[pair_id] for pair_id in pair_ids)
+        label_sets.append(collection.label_table.setdefault(label_set, label_set))
+
+    return label_sets
+
+
+def load_state(
+    path: str, self_metrics: SelfMetrics | None = None
+) -> CountersCollection:
+    """
+    Rebuild a collection from a #write_state file, of whichever kind
+    was saved.
+
+    The file is mapped copy-on-write. A ColumnarCountersCollection uses
+    its matrices in place, so however big they are, loading them costs
+    nothing until their pages are touched (and changes never make it
+    back to the file). A CountersCollection copies each series' data
+    points out with a single memcpy. Either way the series index has to
+    be rebuilt one series at a time, but nothing is parsed per data
+    point.
+
+    Parameters
+    ----------
+    path : str
+            The state file.
+    self_metrics : SelfMetrics or None, optional
+            See MetricsCollection. Defaults to None.
+
+    Returns
+    -------
+    CountersCollection or ColumnarCountersCollection
+            The collection, as it was when the file was written.
+
+    Raises
+    ------
+    ValueError
+            If the file isn't a state file this version can read.
+    """
+    with open(path, "rb") as file:
+        mapping = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_COPY)
+
+    kind, metadata, views = _read_header(mapping)
+    names = [
+        name
+        for name, _ in (COLUMNAR_ARRAYS if kind == COLUMNAR_KIND else SERIES_ARRAYS)
+    ]
+    columns = dict(zip(names, views))
+
+    collection: CountersCollection
+    if kind == COLUMNAR_KIND:
+        collection = ColumnarCountersCollection(
+            metadata["max_series_length"],
+            self_metrics,
+            metadata["retention_in_seconds"],
+            metadata["bucket_width_in_seconds"],
+        )
+        # the mapping stays open for as long as these views do
+        for name, view in columns.items():
+            setattr(collection, name, view)
+        collection.newest_second = metadata["newest_second"]
+        collection.dropped_points = metadata["dropped_points"]
+        collection._zero_column = array("I", bytes(4 * len(metadata["series"])))
+        collection.sections = metadata["sections"]
+        collection.section_ids = {
+            section: i for i, section in enumerate(collection.sections)
+        }
+
+        label_sets = _intern_label_sets(collection, metadata)
+        for row, (name, set_id) in enumerate(metadata["series"]):
+            series = ColumnarSeries(collection, row, name, label_sets[set_id])
+            collection.series[name] = series
+            collection._index_series(series)
+
+        return collection
+
+    collection = CountersCollection(metadata["max_series_length"], self_metrics)
+    collection.sections = metadata["sections"]
+    label_sets = _intern_label_sets(collection, metadata)
+
+    # the raw bytes of the data point arrays, so each series' run of
+    # them can be copied out whole. files from before series kept 64 bit
+    # data points are widened first.
+    seconds, counts = (
+        (
+            columns[name]
+            if columns[name].format == "q"
+            else memoryview(array("q", columns[name]))
+        ).cast("B")
+        for name in ["seconds", "counts"]
+    )
+    size = array("q").itemsize
+    start = 0
+    for (name, set_id), length, total in zip(
+        metadata["series"], columns["lengths"], columns["totals"]
+    ):
+        series = CounterSeries(name, label_sets[set_id], collection.max_series_length)
+        series.data_points.seconds.frombytes(
+            seconds[size * start : size * (start + length)]
+        )
+        series.data_points.counts.frombytes(
+            counts[size * start : size * (start + length)]
+        )
+        series.total = total
+        start += length
+        collection.series[name] = series
+        collection._index_series(series)
+
+    # nothing refers to the mapping any more, so it can be let go
+    del seconds, counts, columns, views
+    mapping.close()
+
+    return collection
+
+
+class StateWriter:
+    """
+    Writes a collection's state file (see #write_state) every so often,
+    so a restart can pick up from there (see #load_state) rather than
+    re-reading the log from the start.
+
+    Attributes
+    ----------
+    path : str
+            The state file.
+    interval : float, optional
+            How often (in wall-clock seconds) to write it. Defaults to 60.
+    self_metrics : SelfMetrics or None, optional
+            Where to record how long writes take, as the
+            "statefile.write" histogram. Defaults to None.
+    ticks_between_clock_checks : int, optional
+            See SelfMetrics. Defaults to 1000.
+    bytes_written : int
+            The size of the last file written.
+    """
+
+    def __init__(
+        self,
+        path: str,
+        interval: float = 60.0,
+        self_metrics: SelfMetrics | None = None,
+        ticks_between_clock_checks: int = 1000,
+    ) -> None:
+        self.path = path
+        self.interval = interval
+        self.self_metrics = self_metrics
+        self.ticks_between_clock_checks = ticks_between_clock_checks
+
+        self.ticks: int = 0
+        self.last_write: float = time.monotonic()
+        self.bytes_written: int = 0
+
+    @instrumented("statefile.write")
+    def write(self, collection: CountersCollection) -> None:
+        """
+        Write the state file now.
+
+        Parameters
+        ----------
+        collection : CountersCollection
+                The collection to save.
+        """
+        self.bytes_written = write_state(collection, self.path)
+        self.last_write = time.monotonic()
+
+    def tick(self, collection: CountersCollection) -> None:
+        """
+        Cheap enough to call once per log line; writes the state file
+        whenever self.interval has passed.
+
+        Parameters
+        ----------
+        collection : CountersCollection
+                The collection to save.
+        """
+        self.ticks += 1
+        if self.ticks % self.ticks_between_clock_checks:
+            return
+
+        if time.monotonic() - self.last_write >= self.interval:
+            self.write(collection)
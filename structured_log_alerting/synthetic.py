@@ -0,0 +1,190 @@
+import argparse
+import csv
+import random
+import sys
+from typing import Iterator, TextIO
+
+
+FIELDNAMES: list[str] = [
+    "remotehost",
+    "rfc931",
+    "authuser",
+    "date",
+    "request",
+    "status",
+    "bytes",
+]
+
+# a handful of realistic-looking sections to use before we fall back
+# to numbered ones for higher cardinalities.
+SECTION_NAMES: list[str] = ["api", "report", "user", "admin", "static", "search"]
+
+HTTP_VERBS: list[str] = ["GET", "GET", "GET", "POST", "PUT", "DELETE"]
+
+
+class SyntheticLogGenerator:
+    """
+    Generates access log lines in the same format as example_log.csv,
+    for benchmarks and for trying out thresholds on more than four
+    lines. Everything is driven from a single seeded random.Random, so
+    the same settings always produce exactly the same log.
+
+    Attributes
+    ----------
+    requests_per_second : int, optional
+            How many lines to generate for each second of log time.
+            Defaults to 20.
+    section_count : int, optional
+            How many distinct top-level sections requests are spread
+            across. Defaults to 5.
+    status_mix : dict of str: float, optional
+            Relative weights of each status code. Defaults to mostly
+            200s with a few 404s and 500s.
+    out_of_order_ratio : float, optional
+            The fraction of lines whose timestamp is pushed up to
+            max_disorder_in_seconds into the past, like the sample log.
+            Defaults to 0.05.
+    host_count : int, optional
+            How many distinct remote hosts make requests. Defaults to 10.
+    start_timestamp : int, optional
+            The UNIX timestamp of the first second of the log. Defaults
+            to the start of the sample log.
+    seed : int, optional
+            The random seed. Defaults to 0.
+    max_disorder_in_seconds : int, optional
+            The furthest back an out-of-order line can be pushed.
+            Defaults to 5.
+    """
+
+    def __init__(
+        self,
+        requests_per_second: int = 20,
+        section_count: int = 5,
+        status_mix: dict[str, float] | None = None,
+        out_of_order_ratio: float = 0.05,
+        host_count: int = 10,
+        start_timestamp: int = 1549573860,
+        seed: int = 0,
+        max_disorder_in_seconds: int = 5,
+    ) -> None:
+        self.requests_per_second = requests_per_second
+        self.section_count = section_count
+        self.status_mix = status_mix or {"200": 0.9, "404": 0.07, "500": 0.03}
+        self.out_of_order_ratio = out_of_order_ratio
+        self.host_count = host_count
+        self.start_timestamp = start_timestamp
+        self.seed = seed
+        self.max_disorder_in_seconds = max_disorder_in_seconds
+
+        self.sections: list[str] = [
+            SECTION_NAMES[i] if i < len(SECTION_NAMES) else f"section{i}"
+            for i in range(section_count)
+        ]
+        self.hosts: list[str] = [
+            f"10.0.{i // 256}.{i % 256}" for i in range(1, host_count + 1)
+        ]
+
+    def lines(self, duration_in_seconds: int) -> Iterator[dict[str, str]]:
+        """
+        Generate log lines, shaped the way csv.DictReader would hand them
+        to Parser.
+
+        Parameters
+        ----------
+        duration_in_seconds : int
+                How many seconds of log time to generate.
+
+        Yields
+        ------
+        dict of str: str
+                One log line.
+        """
+        rng = random.Random(self.seed)
+        statuses = list(self.status_mix)
+        status_weights = list(self.status_mix.values())
+
+        for offset in range(duration_in_seconds):
+            timestamp = self.start_timestamp + offset
+            for _ in range(self.requests_per_second):
+                line_timestamp = timestamp
+                if rng.random() < self.out_of_order_ratio:
+                    line_timestamp -= rng.randint(1, self.max_disorder_in_seconds)
+
+                section = rng.choice(self.sections)
+                subpath = rng.choice(["", "/user", "/list", "/detail"])
+                yield {
+                    "remotehost": rng.choice(self.hosts),
+                    "rfc931": "-",
+                    "authuser": "apache",
+                    "date": str(line_timestamp),
+                    "request": f"{rng.choice(HTTP_VERBS)} /{section}{subpath} HTTP/1.0",
+                    "status": rng.choices(statuses, status_weights)[0],
+                    "bytes": str(rng.randint(1000, 1400)),
+                }
+
+    def write_csv(self, output: TextIO, duration_in_seconds: int) -> int:
+        """
+        Write a full log, header included, in the CSV format main
+        expects.
+
+        Parameters
+        ----------
+        output : TextIO
+                Where to write the log.
+        duration_in_seconds : int
+                How many seconds of log time to generate.
+
+        Returns
+        -------
+        int
+                The number of lines written, not counting the header.
+        """
+        writer = csv.DictWriter(output, FIELDNAMES)
+        writer.writeheader()
+        line_count = 0
+        for line in self.lines(duration_in_seconds):
+            writer.writerow(line)
+            line_count += 1
+
+        return line_count
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(
+        description="write a deterministic synthetic access log to stdout"
+    )
+    parser.add_argument("duration", help="seconds of log time to generate", type=int)
+    parser.add_argument("--rps", type=int, default=20)
+    parser.add_argument("--sections", type=int, default=5)
+    parser.add_argument(
+        "--status-mix",
+        help="comma-separated status=weight pairs, ex: 200=0.9,404=0.07,500=0.03",
+        type=str,
+    )
+    parser.add_argument("--out-of-order-ratio", type=float, default=0.05)
+    parser.add_argument("--hosts", type=int, default=10)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    status_mix = None
+    if args.status_mix:
+        status_mix = {
+            status: float(weight)
+            for status, weight in (
+                pair.split("=") for pair in args.status_mix.split(",")
+            )
+        }
+
+    generator = SyntheticLogGenerator(
+        requests_per_second=args.rps,
+        section_count=args.sections,
+        status_mix=status_mix,
+        out_of_order_ratio=args.out_of_order_ratio,
+        host_count=args.hosts,
+        seed=args.seed,
+    )
+    generator.write_csv(sys.stdout, args.duration)
+
+
+if __name__ == "__main__":
+    main()
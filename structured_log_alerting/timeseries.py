@@ -1,7 +1,14 @@
+import sys
 from abc import ABC, abstractmethod
-from datetime import datetime, timedelta
+from datetime import datetime
 
-from structured_log_alerting.sortedordereddict import SortedOrderedDict
+from structured_log_alerting.sortedarraydict import SortedArrayDict, to_seconds
+
+
+# a label set, stored as a tuple of (key, value) pairs so identical sets
+# (and identical pairs) can be shared between series instead of every
+# series carrying its own dict.
+Labels = tuple[tuple[str, str], ...]
 
 
 class TimeSeries(ABC):
@@ -13,44 +20,86 @@ class TimeSeries(ABC):
     ----------
     name : str
             The short name of the metric.
-    labels : dict of str: str
-            A dictionary of key/value label pairs to be used to aggregate metrics.
+    labels : dict of str: str or Labels
+            Key/value label pairs to be used to aggregate metrics. These
+            are stored as a (shareable) tuple of pairs, see #labels.
     max_length : int, optional
             The max_length of the TimeSeries' data_points for individual
             data point storage. Defaults to 10.
+
+    Notes
+    -----
+    With tens of thousands of series, per-series overhead ends up
+    dominating memory, so series use __slots__ rather than an instance
+    __dict__ and keep their data points in typed arrays.
     """
 
+    __slots__ = ("name", "label_pairs", "max_length", "data_points")
+
     kind: None | str = None
 
     @abstractmethod
-    def __init__(self, name: str, labels: dict, max_length: int = 10) -> None:
+    def __init__(self, name: str, labels: dict | Labels, max_length: int = 10) -> None:
         self.name = name
-        self.labels = labels
+        self.label_pairs: Labels = (
+            tuple(labels.items()) if isinstance(labels, dict) else labels
+        )
         self.max_length = max_length
 
-        self.data_points: SortedOrderedDict = SortedOrderedDict(
-            max_length
-        )
+        self.data_points: SortedArrayDict = SortedArrayDict(max_length)
+
+    @property
+    def labels(self) -> dict[str, str]:
+        """
+        The series' labels as a dictionary. This builds a new dict every
+        time, so hot paths should use self.label_pairs instead.
+        """
+        return dict(self.label_pairs)
 
     @abstractmethod
-    def add_data_point(self, data_point) -> SortedOrderedDict:
+    def add_data_point(self, data_point) -> SortedArrayDict:
         return self.data_points
 
+    def approximate_bytes(self) -> int:
+        """
+        Returns
+        -------
+        int
+                The memory used by this series, not counting its (shared)
+                labels.
+        """
+        return sys.getsizeof(self) + self.data_points.approximate_bytes()
+
 
 class CounterSeries(TimeSeries):
     """
     Non-abstract counter metric series class subclassed from the ABC TimeSeries.
     Counters here are monotonically increasing.
 
-    See TimeSeries for attribute descriptions.
+    See TimeSeries for the other attribute descriptions.
+
+    Attributes
+    ----------
+    total : int
+            Every count ever added to the series, including ones that
+            have since been dropped from self.data_points. This is what
+            gets exported as a Prometheus counter.
+    resolution : int
+            How many seconds each data point covers, 1 unless the series
+            has been downsampled (see #downsample). A point is kept at
+            the start of the seconds it covers.
     """
 
+    __slots__ = ("total", "resolution")
+
     kind = "counter"
 
     def __init__(self, *args) -> None:
         super().__init__(*args)
+        self.total: int = 0
+        self.resolution: int = 1
 
-    def add_data_point(self, timestamp: datetime, count: int = 1) -> SortedOrderedDict:
+    def add_data_point(self, timestamp: datetime, count: int = 1) -> SortedArrayDict:
         """
         Add a data point to self.data_points
 
@@ -63,16 +112,70 @@ class CounterSeries(TimeSeries):
 
         Returns
         -------
-        SortedOrderedDict
+        SortedArrayDict
                 self.data_points
         """
-        if timestamp in self.data_points:
-            self.data_points[timestamp] += count
-        else:
-            self.data_points[timestamp] = count
+        seconds = to_seconds(timestamp)
+        if self.resolution != 1:
+            seconds -= seconds % self.resolution
+        self.data_points.increment(seconds, count)
+        self.total += count
 
         return self.data_points
 
+    def downsample(self, resolution: int) -> int:
+        """
+        Keep one data point per resolution seconds from now on, merging
+        the ones we already have. Queries on windows that don't line up
+        with the new resolution become approximate.
+
+        Parameters
+        ----------
+        resolution : int
+                How many seconds each data point should cover.
+
+        Returns
+        -------
+        int
+                How many data points were merged away.
+        """
+        self.resolution = resolution
+
+        return self.data_points.downsample(resolution)
+
+    def shrink(self, max_length: int) -> int:
+        """
+        Keep fewer data points, dropping the oldest.
+
+        Parameters
+        ----------
+        max_length : int
+                The new self.max_length.
+
+        Returns
+        -------
+        int
+                How many data points were dropped.
+        """
+        self.max_length = max_length
+
+        return self.data_points.shrink(max_length)
+
+    def copy(self) -> "CounterSeries":
+        """
+        Returns
+        -------
+        CounterSeries
+                A copy of this series with its own data points, sharing
+                only its (immutable) labels.
+        """
+        copy = CounterSeries(self.name, self.label_pairs, self.max_length)
+        copy.data_points = self.data_points.copy()
+        copy.total = self.total
+        copy.resolution = self.resolution
+
+        return copy
+
     def total_count_since(
         self, current_time: datetime = datetime.now(), since_number_of_seconds: int = 10
     ) -> int:
@@ -93,16 +196,29 @@ class CounterSeries(TimeSeries):
         int
                 The total count of events.
         """
-        now = current_time
-        past_time = now - timedelta(seconds=since_number_of_seconds)
+        now = to_seconds(current_time)
+
+        return self.data_points.sum_between(now - since_number_of_seconds, now)
+
+    def points_since(
+        self, current_time: datetime, since_number_of_seconds: int = 10
+    ) -> list[tuple[datetime, int]]:
+        """
+        List the individual data points within a window, for range
+        vector queries.
 
-        count = 0
+        Parameters
+        ----------
+        current_time : datetime
+                See #total_count_since.
+        since_number_of_seconds : int, optional
+                See #total_count_since.
 
-        # i think there's probably a neat way to do this with pandas
-        # but i looked at the docs and haven't figured out what i might
-        # need so we're punting on that for now.
-        for key, value in self.data_points.items():
-            if key > past_time and key <= now:
-                count += value
+        Returns
+        -------
+        list of tuple of (datetime, int)
+                Each timestamp and its count, oldest first.
+        """
+        now = to_seconds(current_time)
 
-        return count
+        return list(self.data_points.items_between(now - since_number_of_seconds, now))
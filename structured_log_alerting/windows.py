@@ -0,0 +1,217 @@
+from collections import deque
+from datetime import datetime
+from typing import Iterable, NamedTuple
+
+from structured_log_alerting.parser import without_host
+from structured_log_alerting.selfmetrics import SelfMetrics
+from structured_log_alerting.sortedarraydict import from_seconds, to_seconds
+
+
+class WindowSummary(NamedTuple):
+    """
+    Everything a summary says about one closed window, frozen when the
+    window closed, so it can be written out (see
+    AlertManager#summarize_window) or rolled up into longer windows
+    (see #rollup) without querying the collection again.
+    """
+
+    # the first and last seconds in the window, inclusive
+    start: datetime
+    end: datetime
+    total: int
+    section_counts: dict[str, int]
+    # for every interesting counter, how many requests matched it
+    counter_counts: dict[str, int]
+    # the busiest section and its count, or "" and 0 for an empty window
+    top_section: str
+    top_count: int
+
+
+def rollup(windows: Iterable[WindowSummary]) -> WindowSummary:
+    """
+    Merge consecutive windows into one spanning all of them, ex: six
+    10 second windows into a minute.
+
+    Parameters
+    ----------
+    windows : iterable of WindowSummary
+            The windows to merge, oldest first.
+
+    Returns
+    -------
+    WindowSummary
+            The merged window.
+
+    Raises
+    ------
+    ValueError
+            If there are no windows to merge.
+    """
+    windows = list(windows)
+    if not windows:
+        raise ValueError("There are no windows to roll up")
+
+    section_counts: dict[str, int] = {}
+    counter_counts: dict[str, int] = {}
+    for window in windows:
+        for section, count in window.section_counts.items():
+            section_counts[section] = section_counts.get(section, 0) + count
+        for counter, count in window.counter_counts.items():
+            counter_counts[counter] = counter_counts.get(counter, 0) + count
+
+    top_section, top_count = "", 0
+    for section, count in section_counts.items():
+        if count > top_count:
+            top_section, top_count = section, count
+
+    return WindowSummary(
+        windows[0].start,
+        windows[-1].end,
+        sum(window.total for window in windows),
+        section_counts,
+        counter_counts,
+        top_section,
+        top_count,
+    )
+
+
+class TumblingWindows:
+    """
+    Accumulates the 10s summary as lines come in, rather than querying
+    the collection for it afterwards: for the current window, a count
+    per section, a count per interesting counter and the busiest
+    section so far (which only ever needs comparing with the section
+    that just went up, since counts only go up within a window).
+    Summarizing a window is then just reading those off.
+
+    Windows tumble: they're window_in_seconds long, back to back and
+    aligned to multiples of window_in_seconds since the epoch, so every
+    line belongs to exactly one of them. A line for a later window
+    closes the current one, which is frozen into a WindowSummary and
+    kept (up to history_length of them) for longer rollups. Lines for a
+    window that's already closed are too late to count, and are only
+    counted in self.late_points.
+
+    Attributes
+    ----------
+    interesting_counters : list of str, optional
+            Substrings of metric names to count separately, like
+            AlertManager's. Defaults to none.
+    window_in_seconds : int, optional
+            How long each window is. Defaults to 10.
+    history_length : int, optional
+            How many closed windows to keep. Defaults to 360 (an hour of
+            10 second windows).
+    self_metrics : SelfMetrics or None, optional
+            If given, late points are counted as
+            "summaries.late_points". Defaults to None.
+    history : deque of WindowSummary
+            The most recently closed windows, oldest first.
+    late_points : int
+            How many points arrived after their window had closed.
+    """
+
+    def __init__(
+        self,
+        interesting_counters: list[str] | None = None,
+        window_in_seconds: int = 10,
+        history_length: int = 360,
+        self_metrics: SelfMetrics | None = None,
+    ) -> None:
+        if window_in_seconds < 1:
+            raise ValueError("Windows have to be at least a second long")
+
+        self.interesting_counters = interesting_counters or []
+        self.window_in_seconds = window_in_seconds
+        self.self_metrics = self_metrics
+        self.history: deque[WindowSummary] = deque(maxlen=history_length)
+        self.late_points: int = 0
+
+        # the current window: its first second, or None before any lines
+        self.start_seconds: int | None = None
+        self.total: int = 0
+        self.section_counts: dict[str, int] = {}
+        self.counter_counts: dict[str, int] = {}
+        self.top_section: str = ""
+        self.top_count: int = 0
+        # which interesting counters each metric name matches
+        self._matches: dict[str, list[str]] = {}
+
+    def _close(self) -> WindowSummary:
+        """
+        Freeze the current window, and start an empty one.
+        """
+        window = WindowSummary(
+            from_seconds(self.start_seconds),  # type: ignore[arg-type]
+            from_seconds(self.start_seconds + self.window_in_seconds - 1),  # type: ignore[operator]
+            self.total,
+            self.section_counts,
+            self.counter_counts,
+            self.top_section,
+            self.top_count,
+        )
+        self.history.append(window)
+
+        self.total = 0
+        self.section_counts = {}
+        self.counter_counts = {}
+        self.top_section = ""
+        self.top_count = 0
+
+        return window
+
+    def add(
+        self, metric_name: str, parsed_log_line: dict, count: int = 1
+    ) -> WindowSummary | None:
+        """
+        Count a line into its window.
+
+        Parameters
+        ----------
+        metric_name : str
+                The series the line belongs to.
+        parsed_log_line : dict
+                The parsed line.
+        count : int, optional
+                How many events it stands for. Defaults to 1.
+
+        Returns
+        -------
+        WindowSummary or None
+                The window this line closed, if it's the first line of a
+                later window.
+        """
+        seconds = to_seconds(parsed_log_line["date"])
+        start_seconds = seconds - seconds % self.window_in_seconds
+        closed = None
+        if self.start_seconds is None:
+            self.start_seconds = start_seconds
+        elif start_seconds != self.start_seconds:
+            if start_seconds < self.start_seconds:
+                self.late_points += count
+                if self.self_metrics is not None:
+                    self.self_metrics.increment("summaries.late_points", count)
+                return None
+            closed = self._close()
+            self.start_seconds = start_seconds
+
+        self.total += count
+        section = parsed_log_line["section"]
+        section_count = self.section_counts.get(section, 0) + count
+        self.section_counts[section] = section_count
+        if section_count > self.top_count:
+            self.top_section = section
+            self.top_count = section_count
+
+        matches = self._matches.get(metric_name)
+        if matches is None:
+            namespace = without_host(metric_name, parsed_log_line.get("host"))
+            matches = self._matches[metric_name] = [
+                counter
+                for counter in self.interesting_counters
+                if namespace.find(counter) >= 0
+            ]
+        for counter in matches:
+            self.counter_counts[counter] = self.counter_counts.get(counter, 0) + count
+
+        return closed
@@ -0,0 +1,154 @@
+from datetime import datetime
+import math
+
+import pytest
+
+from structured_log_alerting.alertmanager import AlertManager
+from structured_log_alerting.anomaly import (
+    AnomalyDetector,
+    EWMABaseline,
+    HoltWintersBaseline,
+)
+from structured_log_alerting.metricscollection import CountersCollection
+from structured_log_alerting.sortedarraydict import from_seconds
+
+
+START = int(datetime(2019, 2, 7, 16, 0, 0).timestamp())
+
+
+def parsed_log_line(timestamp, section="api"):
+    return {
+        "remotehost": "10.0.0.1",
+        "rfc931": "-",
+        "authuser": "apache",
+        "date": from_seconds(timestamp),
+        "request": f"GET /{section}/user HTTP/1.0",
+        "status": "200",
+        "bytes": "1234",
+        "http_verb": "GET",
+        "section": section,
+        "endpoint": f"/{section}/user",
+    }
+
+
+def add_bucket(counters_collection, bucket, counts, bucket_in_seconds=10):
+    # every count lands in the middle of the bucket
+    timestamp = START + bucket * bucket_in_seconds + bucket_in_seconds // 2
+    for section, count in counts.items():
+        counters_collection.add_or_update_series(
+            f"{section}.200", parsed_log_line(timestamp, section), count
+        )
+
+
+def test_ewma_baseline_converges():
+    baseline = EWMABaseline(alpha=0.1)
+    for i in range(500):
+        baseline.update(100 + (10 if i % 2 else -10))
+
+    assert baseline.observations == 500
+    assert math.isclose(baseline.expected(), 100, abs_tol=1)
+    assert math.isclose(baseline.deviation(), 10, rel_tol=0.1)
+
+
+def test_holt_winters_baseline_learns_a_season():
+    baseline = HoltWintersBaseline(season_length=4, alpha=0.2, beta=0.01, gamma=0.3)
+    pattern = [10, 50, 90, 50]
+    for i in range(400):
+        baseline.update(pattern[i % 4])
+
+    # it expects the next one in the pattern, not the average
+    for value in pattern:
+        assert math.isclose(baseline.expected(), value, abs_tol=2)
+        baseline.update(value)
+
+
+def test_anomaly_detector_rejects_bad_settings():
+    for kwargs in [
+        {"method": "magic"},
+        {"bucket_in_seconds": 0},
+        {"season_length": 0},
+        {"alpha": 0},
+        {"gamma": 1.5},
+    ]:
+        with pytest.raises(ValueError):
+            AnomalyDetector(**kwargs)
+
+
+def test_holt_winters_warms_up_for_a_season():
+    detector = AnomalyDetector(method="holt-winters", season_length=60)
+
+    assert detector.warmup_buckets == 60
+
+
+@pytest.mark.parametrize("unusual", [300, 0])
+def test_spikes_and_drops_fire_then_resolve(unusual):
+    detector = AnomalyDetector(warmup_buckets=5)
+    observed = [100] * 10 + [unusual, 100, 100]
+    transitions = [
+        (anomaly.state, anomaly.observed)
+        for bucket, count in enumerate(observed)
+        for anomaly in detector.observe(from_seconds(START + bucket), {"api": count})
+    ]
+
+    assert transitions == [("firing", unusual), ("resolved", 100)]
+
+
+def test_nothing_fires_while_warming_up():
+    detector = AnomalyDetector(warmup_buckets=5)
+    for bucket, count in enumerate([1, 1000, 1, 1000, 1]):
+        assert detector.observe(from_seconds(START + bucket), {"api": count}) == []
+
+
+def test_quiet_groups_count_as_zero():
+    detector = AnomalyDetector(warmup_buckets=5)
+    for bucket in range(10):
+        detector.observe(from_seconds(START + bucket), {"api": 100, "report": 100})
+
+    [anomaly] = detector.observe(from_seconds(START + 10), {"report": 100})
+
+    assert (anomaly.group, anomaly.state, anomaly.observed) == ("api", "firing", 0)
+
+
+def test_evaluate_closes_whole_aligned_buckets():
+    counters_collection = CountersCollection()
+    for bucket in range(6):
+        add_bucket(counters_collection, bucket, {"api": 20})
+    detector = AnomalyDetector(warmup_buckets=3)
+
+    # the bucket the present is in is still filling up, so it's skipped
+    assert detector.evaluate(counters_collection, from_seconds(START + 5)) == []
+    assert detector.next_bucket_end == START + 20
+    assert detector.evaluate(counters_collection, from_seconds(START + 45)) == []
+    assert detector.baselines["api"].observations == 3
+    assert detector.baselines["api"].expected() == 20
+
+    add_bucket(counters_collection, 6, {"api": 200})
+    [anomaly] = detector.evaluate(counters_collection, from_seconds(START + 71))
+
+    assert anomaly.timestamp == from_seconds(START + 70)
+    assert anomaly.observed == 200
+
+
+def test_alertmanager_alerts_on_anomalies():
+    counters_collection = CountersCollection()
+    alertmanager = AlertManager(
+        counters_collection, anomaly_detector=AnomalyDetector(warmup_buckets=5)
+    )
+    for bucket, count in enumerate([20] * 8 + [200, 20]):
+        add_bucket(counters_collection, bucket, {"api": count, "report": 20})
+    # the first evaluation only lines up the buckets
+    assert alertmanager.evaluate_anomalies(from_seconds(START)) == []
+    alerts = alertmanager.evaluate_anomalies(from_seconds(START + 101))
+
+    assert [(alert.name, alert.state, alert.value) for alert in alerts] == [
+        ("anomaly.api", "firing", 200),
+        ("anomaly.api", "resolved", 20),
+    ]
+    assert "Anomalous traffic for api generated an alert - 200" in alerts[0].message
+    assert "no longer anomalous" in alerts[1].message
+
+
+def test_alertmanager_without_a_detector_never_alerts_on_anomalies():
+    alertmanager = AlertManager(CountersCollection())
+
+    assert alertmanager.evaluate_anomalies(from_seconds(START)) == []
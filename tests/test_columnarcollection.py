@@ -0,0 +1,136 @@
+from datetime import datetime, timedelta
+import pytest
+
+from structured_log_alerting.alertmanager import AlertManager
+from structured_log_alerting.columnarcollection import ColumnarCountersCollection
+from structured_log_alerting.metricscollection import CountersCollection
+from structured_log_alerting.parser import Parser
+from structured_log_alerting.synthetic import FIELDNAMES, SyntheticLogGenerator
+
+
+@pytest.fixture
+def counters_collection(
+    api_200_metric_name,
+    api_200_parsed_log,
+    api_200_newer_parsed_log,
+    report_200_metric_name,
+    report_200_parsed_log,
+    report_404_metric_name,
+    report_404_parsed_log,
+):
+    counters_collection = ColumnarCountersCollection(retention_in_seconds=30)
+    counters_collection.add_or_update_series(api_200_metric_name, api_200_parsed_log)
+    counters_collection.add_or_update_series(
+        api_200_metric_name, api_200_newer_parsed_log
+    )
+    counters_collection.add_or_update_series(
+        report_200_metric_name, report_200_parsed_log
+    )
+    counters_collection.add_or_update_series(
+        report_404_metric_name, report_404_parsed_log
+    )
+
+    return counters_collection
+
+
+@pytest.fixture
+def most_recent_time(api_200_newer_parsed_log):
+    return api_200_newer_parsed_log["date"]
+
+
+def test_columnar_collection_tracks_series_and_sections(counters_collection):
+    assert len(counters_collection.series) == 3
+    assert counters_collection.sections == ["api", "report"]
+    assert counters_collection.series["report.404"].row == 2
+    assert counters_collection.series["report.404"].labels["status"] == "404"
+
+
+def test_columnar_collection_totals_match_namespaces(
+    counters_collection, most_recent_time
+):
+    assert counters_collection.total_count_since(most_recent_time, 10) == 4
+    assert counters_collection.total_count_since(most_recent_time, 10, "api") == 2
+    assert counters_collection.total_count_since(most_recent_time, 10, "404") == 1
+    # exclusive lower bound, same as CountersCollection
+    assert counters_collection.total_count_since(most_recent_time, 1) == 1
+
+
+def test_columnar_collection_groups_by_label(counters_collection, most_recent_time):
+    by_section = counters_collection.total_counts_by_label(most_recent_time, 10)
+    by_status = counters_collection.total_counts_by_label(
+        most_recent_time, 10, "status"
+    )
+
+    assert by_section == {"api": 2, "report": 2}
+    assert by_status == {"200": 3, "404": 1}
+
+
+def test_columnar_collection_drops_points_older_than_retention(
+    counters_collection, api_200_metric_name, api_200_parsed_log, most_recent_time
+):
+    too_old = dict(api_200_parsed_log, date=most_recent_time - timedelta(seconds=30))
+    counters_collection.add_or_update_series(api_200_metric_name, too_old)
+
+    assert counters_collection.dropped_points == 1
+    assert counters_collection.total_count_since(most_recent_time, 60) == 4
+
+
+def test_columnar_collection_clears_buckets_as_time_moves_on(
+    counters_collection, api_200_metric_name, api_200_parsed_log, most_recent_time
+):
+    # 25s later the report.404 point (5s older than the newest) has
+    # fallen out of the 30s ring, and its bucket has been reused.
+    later = most_recent_time + timedelta(seconds=25)
+    counters_collection.add_or_update_series(
+        api_200_metric_name, dict(api_200_parsed_log, date=later)
+    )
+
+    assert counters_collection.total_count_since(later, 120) == 4
+    assert counters_collection.total_count_since(later, 120, "404") == 0
+
+
+def test_columnar_collection_matches_counters_collection():
+    parser = Parser(FIELDNAMES, lambda message: None)
+    generator = SyntheticLogGenerator(requests_per_second=10, section_count=4)
+    counters_collection = CountersCollection(max_series_length=1000)
+    columnar_collection = ColumnarCountersCollection(retention_in_seconds=200)
+
+    for line in generator.lines(300):
+        metric_name, parsed_log_line = parser.parse_log_line(line)
+        counters_collection.add_or_update_series(metric_name, parsed_log_line)
+        columnar_collection.add_or_update_series(metric_name, parsed_log_line)
+
+    end = datetime.fromtimestamp(generator.start_timestamp + 299)
+    for seconds, namespace in [(10, ""), (120, ""), (120, "api"), (37, "500")]:
+        assert columnar_collection.total_count_since(
+            end, seconds, namespace
+        ) == counters_collection.total_count_since(end, seconds, namespace)
+    assert columnar_collection.total_counts_by_label(
+        end, 120
+    ) == counters_collection.total_counts_by_label(end, 120)
+
+
+def test_series_without_the_label_are_left_out(
+    counters_collection, api_200_metric_name, api_200_parsed_log, most_recent_time
+):
+    counters_collection.add_or_update_series(
+        f"web1.{api_200_metric_name}", dict(api_200_parsed_log, host="web1")
+    )
+
+    assert counters_collection.total_counts_by_label(most_recent_time, 120, "host") == {
+        "web1": 1
+    }
+    assert (
+        counters_collection.total_counts_by_label(most_recent_time, 120, "route") == {}
+    )
+
+
+def test_alertmanager_works_with_columnar_collection(
+    counters_collection, most_recent_time
+):
+    alertmanager = AlertManager(counters_collection, ["404", "500"])
+    summary = alertmanager.provide_summary_for_interval(most_recent_time)
+
+    assert "(2)" in summary[1]
+    assert "api" in summary[1]
+    assert " 1 " in summary[2]
@@ -0,0 +1,115 @@
+import bz2
+import csv
+import gzip
+import io
+import lzma
+import pytest
+
+from structured_log_alerting.compression import (
+    BackgroundReader,
+    detect_compression,
+    open_log_file,
+)
+from structured_log_alerting.sources import open_logs
+from structured_log_alerting.synthetic import SyntheticLogGenerator
+
+
+@pytest.fixture
+def log_text():
+    output = io.StringIO()
+    SyntheticLogGenerator(requests_per_second=20).write_csv(output, 120)
+    return output.getvalue()
+
+
+COMPRESSORS = {
+    "gzip": gzip.compress,
+    "bz2": bz2.compress,
+    "xz": lzma.compress,
+}
+
+
+@pytest.mark.parametrize("compression", sorted(COMPRESSORS))
+@pytest.mark.parametrize("decompress_in_thread", [False, True])
+def test_open_log_file_decompresses_transparently(
+    tmp_path, log_text, compression, decompress_in_thread
+):
+    # no telltale extension, so it has to go by the magic bytes
+    path = tmp_path / "access_log"
+    path.write_bytes(COMPRESSORS[compression](log_text.encode()))
+
+    with open_log_file(str(path), decompress_in_thread=decompress_in_thread) as f:
+        assert f.read() == log_text
+
+
+def test_open_log_file_reads_uncompressed_logs_as_is(tmp_path, log_text):
+    path = tmp_path / "access_log.csv"
+    path.write_text(log_text)
+
+    with open_log_file(str(path)) as f:
+        assert f.read() == log_text
+
+
+def test_open_log_file_reads_every_gzip_member(tmp_path, log_text):
+    # ex: a log rotated by appending a freshly compressed chunk each time
+    lines = log_text.splitlines(keepends=True)
+    chunks = ["".join(lines[:100]), "".join(lines[100:1000]), "".join(lines[1000:])]
+    path = tmp_path / "access_log.gz"
+    path.write_bytes(b"".join(gzip.compress(chunk.encode()) for chunk in chunks))
+
+    for decompress_in_thread in [False, True]:
+        with open_log_file(str(path), decompress_in_thread=decompress_in_thread) as f:
+            rows = list(csv.DictReader(f))
+        assert len(rows) == len(lines) - 1
+
+
+def test_open_log_file_needs_zstandard_for_zstd(tmp_path):
+    try:
+        import zstandard  # type: ignore[import-not-found]
+    except ImportError:
+        path = tmp_path / "access_log.zst"
+        path.write_bytes(b"\x28\xb5\x2f\xfd" + bytes(16))
+        with pytest.raises(ValueError):
+            open_log_file(str(path))
+    else:
+        path = tmp_path / "access_log.zst"
+        path.write_bytes(zstandard.ZstdCompressor().compress(b"date\n1\n"))
+        with open_log_file(str(path)) as f:
+            assert f.read() == "date\n1\n"
+
+
+def test_detect_compression():
+    assert detect_compression(b"\x1f\x8b\x08\x00") == "gzip"
+    assert detect_compression(b"BZh91AY") == "bz2"
+    assert detect_compression(b"\xfd7zXZ\x00\x00") == "xz"
+    assert detect_compression(b"\x28\xb5\x2f\xfd\x00") == "zstd"
+    assert detect_compression(b'"remotehost","rfc931"') is None
+    assert detect_compression(b"") is None
+
+
+def test_background_reader_raises_read_errors(tmp_path, log_text):
+    path = tmp_path / "access_log.gz"
+    path.write_bytes(gzip.compress(log_text.encode())[:-100])
+
+    with pytest.raises(EOFError):
+        with open_log_file(str(path), decompress_in_thread=True) as f:
+            f.read()
+
+
+def test_background_reader_can_be_closed_early(log_text):
+    reader = BackgroundReader(io.BytesIO(log_text.encode()), block_size=16)
+    reader.read(16)
+    reader.close()
+
+    assert not reader.thread.is_alive()
+
+
+def test_open_logs_merges_compressed_logs(tmp_path):
+    for host, compress in enumerate([gzip.compress, bz2.compress, lambda data: data]):
+        output = io.StringIO()
+        SyntheticLogGenerator(requests_per_second=5, seed=host).write_csv(output, 30)
+        (tmp_path / f"web{host}.log").write_bytes(compress(output.getvalue().encode()))
+
+    with open_logs([str(tmp_path)]) as reader:
+        timestamps = [int(line["date"]) for line in reader]
+
+    assert len(timestamps) == 3 * 5 * 30
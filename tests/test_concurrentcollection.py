@@ -0,0 +1,155 @@
+import sys
+import threading
+from datetime import datetime, timedelta
+import pytest
+
+from structured_log_alerting.concurrentcollection import ConcurrentCountersCollection
+from structured_log_alerting.query import QueryEngine
+
+
+START = datetime(2019, 2, 7, 16, 18, 0)
+WRITERS = 4
+WRITES_PER_WRITER = 3000
+SECTIONS = ["api", "report", "user", "admin", "static"]
+
+
+@pytest.fixture(autouse=True)
+def frequent_thread_switches():
+    # switch threads far more often than usual, so writers and readers
+    # actually interleave mid-update.
+    interval = sys.getswitchinterval()
+    sys.setswitchinterval(1e-6)
+    yield
+    sys.setswitchinterval(interval)
+
+
+def parsed_log(section, status, seconds):
+    return {
+        "remotehost": "10.0.0.1",
+        "section": section,
+        "endpoint": f"/{section}",
+        "http_verb": "GET",
+        "status": status,
+        "date": START + timedelta(seconds=seconds),
+    }
+
+
+def write(counters_collection, writer):
+    for i in range(WRITES_PER_WRITER):
+        section = SECTIONS[(writer + i) % len(SECTIONS)]
+        # mostly in order, with some late data landing mid-series, and
+        # new series turning up throughout.
+        seconds = i // 10 - (7 if i % 13 == 0 else 0)
+        status = str(200 + i % 40)
+        counters_collection.add_or_update_series(
+            f"{section}.{status}", parsed_log(section, status, seconds)
+        )
+
+
+def run_concurrently(counters_collection, reader, reader_count=3):
+    stop = threading.Event()
+    errors: list[BaseException] = []
+
+    def read():
+        try:
+            while not stop.is_set():
+                reader()
+        except BaseException as e:
+            errors.append(e)
+
+    readers = [threading.Thread(target=read) for _ in range(reader_count)]
+    writers = [
+        threading.Thread(target=write, args=(counters_collection, writer))
+        for writer in range(WRITERS)
+    ]
+    for thread in readers + writers:
+        thread.start()
+    for thread in writers:
+        thread.join()
+    stop.set()
+    for thread in readers:
+        thread.join()
+
+    assert errors == []
+
+
+def test_concurrent_collection_loses_no_writes():
+    counters_collection = ConcurrentCountersCollection(max_series_length=1000)
+    end = START + timedelta(seconds=WRITES_PER_WRITER)
+    totals_seen: dict[int, list[int]] = {}
+
+    def reader():
+        totals_seen.setdefault(threading.get_ident(), []).append(
+            counters_collection.total_count_since(end, 3600)
+        )
+
+    run_concurrently(counters_collection, reader)
+
+    assert counters_collection.total_count_since(end, 3600) == (
+        WRITERS * WRITES_PER_WRITER
+    )
+    assert counters_collection.epoch == WRITERS * WRITES_PER_WRITER
+    # counts only ever go up, so no reader should have seen them go down
+    # (by reading a series halfway through an update).
+    for reader_totals in totals_seen.values():
+        assert reader_totals == sorted(reader_totals)
+
+
+def test_concurrent_collection_snapshots_are_consistent():
+    counters_collection = ConcurrentCountersCollection(max_series_length=1000)
+    snapshots = []
+
+    def reader():
+        snapshots.append(counters_collection.snapshot())
+
+    run_concurrently(counters_collection, reader, reader_count=2)
+
+    assert snapshots
+    for snapshot in snapshots:
+        # every write is one count, so a consistent cut has exactly as
+        # many counts in its series as writes in its epoch.
+        series_totals = [series.total for series in snapshot.series.values()]
+        point_totals = [
+            sum(series.data_points.counts) for series in snapshot.series.values()
+        ]
+        assert sum(series_totals) == snapshot.epoch
+        assert point_totals == series_totals
+        assert all(
+            name in snapshot.label_index[("section", name.split(".")[0])]
+            for name in snapshot.series
+        )
+
+
+def test_concurrent_collection_reuses_snapshots_until_written_to(api_200_parsed_log):
+    counters_collection = ConcurrentCountersCollection()
+    counters_collection.add_or_update_series("api.200", api_200_parsed_log)
+    first = counters_collection.snapshot()
+
+    assert counters_collection.snapshot() is first
+
+    counters_collection.add_or_update_series("api.200", api_200_parsed_log)
+    second = counters_collection.snapshot()
+
+    assert second is not first
+    assert first.series["api.200"].total == 1
+    assert second.series["api.200"].total == 2
+
+
+def test_concurrent_collection_answers_queries_during_ingest():
+    counters_collection = ConcurrentCountersCollection(max_series_length=1000)
+    engine = QueryEngine(counters_collection)
+    end = START + timedelta(seconds=WRITES_PER_WRITER)
+
+    def reader():
+        grouped = engine.query("sum by (section) ({}[3600s])", end)
+        assert set(key for (key,) in grouped) <= set(SECTIONS)
+        engine.query('{status="200"}[3600s]', end)
+        counters_collection.total_counts_by_label(end, 3600)
+
+    run_concurrently(counters_collection, reader)
+
+    grouped = engine.query("sum by (section) ({}[3600s])", end)
+    assert sum(grouped.values()) == WRITERS * WRITES_PER_WRITER
+    assert {section: int(total) for (section,), total in grouped.items()} == (
+        counters_collection.total_counts_by_label(end, 3600)
+    )
@@ -0,0 +1,205 @@
+import socket
+import threading
+import time
+from datetime import datetime
+
+import pytest
+
+from structured_log_alerting.federation import (
+    ACK,
+    FRAME_LENGTH,
+    Delta,
+    DeltaReceiver,
+    DeltaShipper,
+    SeriesDelta,
+    decode_delta,
+    encode_delta,
+    parse_delta_address,
+)
+from structured_log_alerting.metricscollection import CountersCollection
+from structured_log_alerting.parser import Parser
+from structured_log_alerting.selfmetrics import SelfMetrics
+from structured_log_alerting.synthetic import FIELDNAMES, SyntheticLogGenerator
+
+
+def labels(section, status):
+    return (
+        ("remotehost", "10.0.0.1"),
+        ("section", section),
+        ("endpoint", f"/{section}"),
+        ("http_verb", "GET"),
+        ("status", status),
+    )
+
+
+def delta(edge_id="edge-1", epoch=1, sequence=1, count=3):
+    return Delta(
+        edge_id,
+        epoch,
+        sequence,
+        [
+            SeriesDelta("api.200", labels("api", "200"), [(1549555138, count)]),
+            SeriesDelta(
+                "report.404",
+                labels("report", "404"),
+                [(1549555138, 1), (1549555139, 2), (1549555200, 1)],
+            ),
+        ],
+    )
+
+
+def send(connection, payload):
+    # one frame, returning the sequence number it was acked with
+    connection.sendall(FRAME_LENGTH.pack(len(payload)) + payload)
+    (acked,) = ACK.unpack(connection.recv(ACK.size, socket.MSG_WAITALL))
+    return acked
+
+
+def merge(receiver, counters_collection, points):
+    # what the usual loop does with a central node's output
+    for _, (metric_name, parsed_log_line, count) in zip(range(points), receiver):
+        counters_collection.add_or_update_series(metric_name, parsed_log_line, count)
+
+
+def test_parse_delta_address():
+    assert parse_delta_address("tcp://127.0.0.1:0") == ("tcp", "127.0.0.1", 0)
+    for address in ["udp://127.0.0.1:5140", "127.0.0.1:5140"]:
+        with pytest.raises(ValueError):
+            parse_delta_address(address)
+
+
+def test_deltas_round_trip():
+    original = delta(epoch=1_700_000_000_000_000_000, sequence=300)
+    payload = encode_delta(original)
+
+    assert decode_delta(payload) == original
+    # every label string is written once however many series use it
+    assert payload.count(b"GET") == 1
+
+
+def test_bad_deltas_are_rejected():
+    payload = encode_delta(delta())
+    for bad_payload in [
+        b"",
+        b"JUNK" + payload[4:],
+        payload[:4] + b"\x02" + payload[5:],
+        payload[:-1],
+        payload + b"\x00",
+    ]:
+        with pytest.raises(ValueError):
+            decode_delta(bad_payload)
+
+
+def test_retried_deltas_are_only_merged_once():
+    self_metrics = SelfMetrics(CountersCollection())
+    counters_collection = CountersCollection()
+    with DeltaReceiver("tcp://127.0.0.1:0", self_metrics=self_metrics) as receiver:
+        with socket.create_connection(receiver.bound_address) as connection:
+            assert send(connection, encode_delta(delta(sequence=1))) == 1
+            # the ack got lost, say
+            assert send(connection, encode_delta(delta(sequence=1))) == 1
+            assert send(connection, encode_delta(delta(sequence=2, count=5))) == 2
+            # and an edge that restarted starts counting again
+            assert send(connection, encode_delta(delta(epoch=2, sequence=1))) == 1
+        merge(receiver, counters_collection, 12)
+
+    assert counters_collection.series["api.200"].total == 3 + 5 + 3
+    assert counters_collection.series["report.404"].total == 3 * 4
+    assert counters_collection.series["api.200"].labels == dict(labels("api", "200"))
+    assert receiver.received_deltas == 3
+    assert receiver.duplicate_deltas == 1
+    assert self_metrics.counters["central.received_deltas"] == 3
+
+
+def test_invalid_deltas_hang_up():
+    with DeltaReceiver("tcp://127.0.0.1:0") as receiver:
+        with socket.create_connection(receiver.bound_address) as connection:
+            connection.sendall(FRAME_LENGTH.pack(4) + b"junk")
+            assert connection.recv(ACK.size) == b""
+
+    assert receiver.invalid_deltas == 1
+
+
+def test_edges_merge_into_the_same_totals_as_ingesting_directly():
+    parser = Parser(FIELDNAMES, lambda message: None)
+    generator = SyntheticLogGenerator(requests_per_second=10, section_count=4)
+    parsed_lines = [parser.parse_log_line(line) for line in generator.lines(120)]
+    direct_collection = CountersCollection(max_series_length=1000)
+    for metric_name, parsed_log_line in parsed_lines:
+        direct_collection.add_or_update_series(metric_name, parsed_log_line)
+
+    counters_collection = CountersCollection(max_series_length=1000)
+    with DeltaReceiver("tcp://127.0.0.1:0") as receiver:
+        address = "tcp://{}:{}".format(*receiver.bound_address)
+
+        def ship(edge_id, lines):
+            shipper = DeltaShipper(
+                address, edge_id, interval=0, ticks_between_clock_checks=100
+            )
+            for metric_name, parsed_log_line in lines:
+                shipper.add(metric_name, parsed_log_line)
+                shipper.tick()
+            assert shipper.close()
+            assert shipper.shipped_deltas > 1
+
+        edges = [
+            threading.Thread(target=ship, args=(f"edge-{i}", parsed_lines[i::3]))
+            for i in range(3)
+        ]
+        for thread in edges:
+            thread.start()
+        for thread in edges:
+            thread.join()
+        merge(receiver, counters_collection, receiver.received_points)
+
+    end = datetime.fromtimestamp(generator.start_timestamp + 119)
+    assert {
+        name: series.total for name, series in counters_collection.series.items()
+    } == {name: series.total for name, series in direct_collection.series.items()}
+    for seconds, namespace in [(10, ""), (120, ""), (60, "api"), (37, "500")]:
+        assert counters_collection.total_count_since(
+            end, seconds, namespace
+        ) == direct_collection.total_count_since(end, seconds, namespace)
+
+
+def test_shipper_retries_until_the_central_node_is_up(
+    api_200_metric_name, api_200_parsed_log, tmp_path
+):
+    address = f"unix://{tmp_path}/central.sock"
+    shipper = DeltaShipper(address, "edge-1", backoff=0.01, max_backoff=0.05)
+    shipper.add(api_200_metric_name, api_200_parsed_log, 4)
+    shipper.ship()
+    deadline = time.monotonic() + 5
+    while not shipper.retries and time.monotonic() < deadline:
+        time.sleep(0.01)
+
+    counters_collection = CountersCollection()
+    with DeltaReceiver(address) as receiver:
+        assert shipper.close()
+        merge(receiver, counters_collection, 1)
+
+    assert shipper.retries > 0
+    assert shipper.shipped_deltas == 1
+    assert counters_collection.series["api.200"].total == 4
+    assert counters_collection.series["api.200"].labels["endpoint"] == "/api/user"
+
+
+def test_quiet_edges_still_ship_every_interval(api_200_metric_name, api_200_parsed_log):
+    counters_collection = CountersCollection()
+    with DeltaReceiver("tcp://127.0.0.1:0") as receiver:
+        address = "tcp://{}:{}".format(*receiver.bound_address)
+        shipper = DeltaShipper(address, "edge-1", interval=0.1)
+        for _ in range(3):
+            shipper.add(api_200_metric_name, api_200_parsed_log)
+            shipper.tick()
+
+        # a few lines, then nothing: far fewer than a clock check's worth
+        # of ticks, but they're shipped anyway
+        deadline = time.monotonic() + 5
+        while not shipper.shipped_deltas and time.monotonic() < deadline:
+            time.sleep(0.01)
+        assert shipper.shipped_deltas == 1
+        merge(receiver, counters_collection, 1)
+        assert shipper.close()
+
+    assert counters_collection.series[api_200_metric_name].total == 3
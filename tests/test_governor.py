@@ -0,0 +1,92 @@
+from datetime import datetime
+
+import pytest
+
+from structured_log_alerting.governor import MemoryGovernor
+from structured_log_alerting.metricscollection import CountersCollection
+from structured_log_alerting.selfmetrics import SelfMetrics
+
+START = 1549573860
+
+
+@pytest.fixture
+def collection():
+    # 100 series with a point every second for 100 seconds, series i
+    # getting i + 1 requests a second, so they're all the same size but
+    # busier and busier
+    counters_collection = CountersCollection(max_series_length=100)
+    for seconds in range(START, START + 100):
+        for i in range(100):
+            counters_collection.add_or_update_series(
+                f"section{i}.200",
+                {
+                    "remotehost": "10.0.0.1",
+                    "section": f"section{i}",
+                    "endpoint": f"/section{i}",
+                    "http_verb": "GET",
+                    "status": "200",
+                    "date": datetime.fromtimestamp(seconds),
+                },
+                i + 1,
+            )
+
+    return counters_collection
+
+
+def test_nothing_happens_under_the_budget(collection):
+    size = collection.approximate_bytes()
+    governor = MemoryGovernor(int(size / 0.85))
+
+    assert governor.enforce(collection) == size
+    assert governor.downsampled_series == 0
+    assert all(series.resolution == 1 for series in collection.series.values())
+    with pytest.raises(ValueError):
+        MemoryGovernor(size, low_water=0.9, high_water=0.8)
+
+
+def test_quietest_series_are_downsampled_first(collection):
+    end = datetime.fromtimestamp(START + 99)
+    total = collection.total_count_since(end, 100)
+    governor = MemoryGovernor(collection.approximate_bytes())
+
+    assert governor.enforce(collection) <= 0.8 * governor.budget_in_bytes
+    assert 0 < governor.downsampled_series < 100
+    assert governor.shortened_series == governor.evicted_series == 0
+    assert collection.series["section0.200"].resolution == 10
+    assert collection.series["section99.200"].resolution == 1
+    # whole buckets still add up
+    assert collection.total_count_since(end, 100) == total
+    # and the estimate wasn't far off
+    assert collection.approximate_bytes() == pytest.approx(
+        governor.approximate_bytes, rel=0.05
+    )
+
+
+def test_series_are_only_evicted_once_nothing_else_is_left(collection):
+    self_metrics = SelfMetrics(CountersCollection())
+    governor = MemoryGovernor(
+        collection.approximate_bytes() // 2,
+        self_metrics=self_metrics,
+        ticks_between_clock_checks=1,
+        interval=0,
+    )
+    governor.tick(collection)
+
+    assert governor.downsampled_series == governor.shortened_series == 100
+    assert 0 < governor.evicted_series < 100
+    assert "section0.200" not in collection.series
+    assert "section99.200" in collection.series
+    assert all(
+        name in collection.series
+        for names in collection.label_index.values()
+        for name in names
+    )
+    assert ("section", "section0") not in collection.label_index
+    # evicting aims for low water from a guess at how much labels will
+    # be freed, so it can land a little over, but not over high water
+    assert collection.approximate_bytes() <= 0.9 * governor.budget_in_bytes
+    assert collection.approximate_bytes() == pytest.approx(
+        governor.approximate_bytes, rel=0.05
+    )
+    assert self_metrics.counters["governor.evicted_series"] == governor.evicted_series
+    assert self_metrics.gauges["governor.bytes"] == governor.approximate_bytes
@@ -0,0 +1,110 @@
+import math
+from datetime import datetime
+
+import pytest
+
+from structured_log_alerting.alertmanager import AlertManager
+from structured_log_alerting.heavyhitters import (
+    RESCALE_AFTER_TIME_CONSTANTS,
+    DecayedCountMinSketch,
+    HeavyHitterDetector,
+)
+from structured_log_alerting.metricscollection import CountersCollection
+from structured_log_alerting.selfmetrics import SelfMetrics
+
+START = 1549573860
+
+
+def line(remotehost, seconds):
+    return {"remotehost": remotehost, "date": datetime.fromtimestamp(seconds)}
+
+
+def test_sketch_estimates_are_never_too_low():
+    sketch = DecayedCountMinSketch.for_error(0.01, 0.01, time_constant=60)
+    true_counts = {f"10.0.{i // 256}.{i % 256}": 1 + i % 7 for i in range(2000)}
+    for key, count in true_counts.items():
+        sketch.add(key, START, count)
+
+    assert (sketch.width, sketch.depth) == (272, 5)
+    too_high = 0
+    for key, count in true_counts.items():
+        estimate = sketch.estimate(key)
+        assert estimate >= count
+        if estimate > count + 0.01 * sketch.total:
+            too_high += 1
+    assert too_high <= 0.01 * len(true_counts)
+
+
+def test_sketch_counts_decay():
+    sketch = DecayedCountMinSketch(64, 4, time_constant=60)
+    sketch.add("10.0.0.1", START, 10)
+    sketch.add("10.0.0.2", START + 60, 10)
+
+    assert sketch.estimate("10.0.0.1") * sketch.decay(START + 60) == pytest.approx(
+        10 / math.e
+    )
+    assert sketch.estimate("10.0.0.2") * sketch.decay(START + 60) == pytest.approx(10)
+
+    # far enough along that the landmark moves up, which mustn't change
+    # what anything's worth
+    later = START + 60 * (RESCALE_AFTER_TIME_CONSTANTS + 1)
+    sketch.add("10.0.0.3", later)
+    assert sketch.landmark == later
+    assert sketch.estimate("10.0.0.2") * sketch.decay(later) == pytest.approx(
+        10 * math.exp(-RESCALE_AFTER_TIME_CONSTANTS)
+    )
+    assert sketch.estimate("10.0.0.3") * sketch.decay(later) == pytest.approx(1)
+
+
+def test_candidates_are_the_heaviest_keys():
+    detector = HeavyHitterDetector(5, max_candidates=2)
+    for count, remotehost in [(3, "10.0.0.1"), (5, "10.0.0.2"), (1, "10.0.0.3")]:
+        detector.add(line(remotehost, START), count)
+    assert set(detector.candidates) == {"10.0.0.1", "10.0.0.2"}
+
+    detector.add(line("10.0.0.3", START), 4)
+    assert set(detector.candidates) == {"10.0.0.2", "10.0.0.3"}
+    # what was counted while it was a candidate isn't lost
+    assert detector.sketch.estimate("10.0.0.1") >= 3
+    detector.add(line("10.0.0.2", START), 2)
+    assert detector.candidates["10.0.0.2"] == 7
+    with pytest.raises(ValueError):
+        HeavyHitterDetector(0)
+
+
+def test_heavy_hitters_alert_over_the_threshold_and_resolve_under_it():
+    self_metrics = SelfMetrics(CountersCollection())
+    detector = HeavyHitterDetector(
+        10, window_in_seconds=20, max_candidates=20, self_metrics=self_metrics
+    )
+    alertmanager = AlertManager(CountersCollection(), heavy_hitter_detector=detector)
+
+    alerts = []
+    for seconds in range(START, START + 300):
+        # 200 clients sending a request a second each...
+        for i in range(200):
+            detector.add(line(f"10.0.0.{i}", seconds))
+        # ...and one sending 30 a second for a couple of minutes
+        if START + 60 <= seconds < START + 180:
+            detector.add(line("10.0.1.1", seconds), 30)
+        alerts.extend(
+            alertmanager.evaluate_heavy_hitters(datetime.fromtimestamp(seconds))
+        )
+
+    assert [(alert.name, alert.state) for alert in alerts] == [
+        ("rate.10.0.1.1", "firing"),
+        ("rate.10.0.1.1", "resolved"),
+    ]
+    firing, resolved = alerts
+    # it takes about ln(3 / 2) windows to reach 10 of 30 a second, and
+    # ln(3) to drop back under it
+    assert 60 + 5 <= (firing.timestamp.timestamp() - START) <= 60 + 12
+    assert 180 + 18 <= (resolved.timestamp.timestamp() - START) <= 180 + 26
+    assert firing.value >= 10
+    assert "10.0.1.1" in firing.message
+    # everyone else is a long way under, even with the error bound
+    end = datetime.fromtimestamp(START + 299)
+    assert detector.rate("10.0.0.7", end) == pytest.approx(1, abs=0.1)
+    assert detector.error_bound(end) < 0.1
+    assert self_metrics.gauges["heavyhitters.candidates"] == 20
+    assert self_metrics.gauges["heavyhitters.firing"] == 0
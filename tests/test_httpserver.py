@@ -0,0 +1,187 @@
+import json
+from datetime import datetime
+from urllib.error import HTTPError
+from urllib.parse import quote
+from urllib.request import urlopen
+import pytest
+
+from structured_log_alerting.columnarcollection import ColumnarCountersCollection
+from structured_log_alerting.httpserver import MetricsServer
+from structured_log_alerting.metricscollection import CountersCollection
+from structured_log_alerting.selfmetrics import SelfMetrics
+
+
+@pytest.fixture(params=[CountersCollection, ColumnarCountersCollection])
+def counters_collection(
+    request,
+    api_200_metric_name,
+    api_200_parsed_log,
+    api_200_newer_parsed_log,
+    report_404_metric_name,
+    report_404_parsed_log,
+):
+    counters_collection = request.param()
+    counters_collection.add_or_update_series(api_200_metric_name, api_200_parsed_log)
+    counters_collection.add_or_update_series(
+        api_200_metric_name, api_200_newer_parsed_log, 2
+    )
+    counters_collection.add_or_update_series(
+        report_404_metric_name, report_404_parsed_log
+    )
+
+    return counters_collection
+
+
+@pytest.fixture
+def most_recent_time(api_200_newer_parsed_log):
+    return api_200_newer_parsed_log["date"]
+
+
+@pytest.fixture
+def metrics_server(counters_collection):
+    metrics_server = MetricsServer(counters_collection).start()
+    yield metrics_server
+    metrics_server.stop()
+
+
+def get(metrics_server, path):
+    with urlopen(metrics_server.url + path, timeout=5) as response:
+        return response.headers["Content-Type"], response.read().decode()
+
+
+def get_json(metrics_server, path):
+    return json.loads(get(metrics_server, path)[1])
+
+
+def test_metrics_server_is_unavailable_until_published(metrics_server):
+    with pytest.raises(HTTPError) as error:
+        get(metrics_server, "/metrics")
+
+    assert error.value.code == 503
+
+
+def test_metrics_server_exports_prometheus_counters(metrics_server, most_recent_time):
+    metrics_server.publish(most_recent_time)
+    content_type, body = get(metrics_server, "/metrics")
+
+    assert content_type.startswith("text/plain; version=0.0.4")
+    assert "# TYPE log_requests_total counter" in body
+    assert 'log_requests_total{series="api.200",section="api",status="200"} 3' in body
+    assert (
+        'log_requests_total{series="report.404",section="report",status="404"} 1'
+        in body
+    )
+    assert "log_series 2" in body
+
+
+def test_metrics_server_serves_from_the_snapshot(
+    metrics_server, counters_collection, most_recent_time, api_200_newer_parsed_log
+):
+    metrics_server.publish(most_recent_time)
+    counters_collection.add_or_update_series("api.200", api_200_newer_parsed_log, 100)
+
+    assert get_json(metrics_server, "/query?window=10")["value"] == 4
+
+    metrics_server.publish(most_recent_time)
+
+    assert get_json(metrics_server, "/query?window=10")["value"] == 104
+
+
+def test_metrics_server_answers_windowed_counts(metrics_server, most_recent_time):
+    metrics_server.publish(most_recent_time)
+
+    assert get_json(metrics_server, "/query?namespace=404&window=10") == {
+        "time": "2019-02-07T16:18:59",
+        "type": "count",
+        "namespace": "404",
+        "window": 10,
+        "value": 1,
+    }
+    assert (
+        get_json(metrics_server, "/query?window=5&time=2019-02-07T16:18:58")["value"]
+        == 2
+    )
+
+    # the same moment with a UTC offset
+    aware = datetime(2019, 2, 7, 16, 18, 58).astimezone().isoformat()
+    assert get_json(metrics_server, "/query?window=5&time=" + quote(aware)) == {
+        "time": "2019-02-07T16:18:58",
+        "type": "count",
+        "namespace": "",
+        "window": 5,
+        "value": 2,
+    }
+
+
+def test_metrics_server_answers_queries(metrics_server, most_recent_time):
+    metrics_server.publish(most_recent_time)
+
+    grouped = get_json(
+        metrics_server, "/query?q=" + quote("sum by (section) ({}[10s])")
+    )
+    assert grouped["type"] == "vector"
+    assert grouped["result"] == [
+        {"labels": {"section": "api"}, "value": 3.0},
+        {"labels": {"section": "report"}, "value": 1.0},
+    ]
+
+    range_vector = get_json(metrics_server, "/query?q=" + quote("api.200[10s]"))
+    assert range_vector["result"] == [
+        {
+            "series": "api.200",
+            "values": [["2019-02-07T16:18:58", 1], ["2019-02-07T16:18:59", 2]],
+        }
+    ]
+
+
+@pytest.mark.parametrize(
+    "path, status",
+    [
+        ("/query?q=" + quote("median({}[10s])"), 400),
+        ("/query?window=soon", 400),
+        ("/query?time=yesterday", 400),
+        ("/nope", 404),
+    ],
+)
+def test_metrics_server_rejects_bad_requests(
+    metrics_server, most_recent_time, path, status
+):
+    metrics_server.publish(most_recent_time)
+
+    with pytest.raises(HTTPError) as error:
+        get(metrics_server, path)
+
+    assert error.value.code == status
+    assert "error" in json.loads(error.value.read())
+
+
+def test_metrics_server_exports_self_metrics(counters_collection, most_recent_time):
+    self_metrics = SelfMetrics(CountersCollection())
+    self_metrics.increment("parser.parse_log_line.errors", 3)
+    metrics_server = MetricsServer(counters_collection, self_metrics=self_metrics)
+    metrics_server.start()
+    try:
+        metrics_server.publish(most_recent_time)
+        body = get(metrics_server, "/metrics")[1]
+    finally:
+        metrics_server.stop()
+
+    assert "structured_log_alerting_parser_parse_log_line_errors_total 3" in body
+
+
+def test_metrics_server_tick_publishes_periodically(
+    counters_collection, most_recent_time
+):
+    metrics_server = MetricsServer(counters_collection, refresh_interval=3600)
+    try:
+        metrics_server.tick(most_recent_time)
+        first_snapshot = metrics_server.snapshot
+        for _ in range(5000):
+            metrics_server.tick(datetime(2019, 2, 7, 16, 19, 0))
+    finally:
+        metrics_server.stop()
+
+    # the first tick publishes straight away, and then not again until
+    # refresh_interval has passed.
+    assert first_snapshot is not None
+    assert metrics_server.snapshot is first_snapshot
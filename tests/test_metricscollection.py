@@ -89,3 +89,53 @@ def test_counters_collection_total_since_time_respects_exclusive_lower_bound(
     count = counters_collection.total_count_since(datetime(2019, 2, 7, 16, 18, 59), 1)
 
     assert count == 1
+
+
+def test_counters_collection_shares_label_pairs_between_series(
+    report_200_metric_name,
+    report_200_parsed_log,
+    report_404_metric_name,
+    report_404_parsed_log,
+):
+    counters_collection = CountersCollection()
+    counters_collection.add_or_update_series(
+        report_200_metric_name, report_200_parsed_log
+    )
+    counters_collection.add_or_update_series(
+        report_404_metric_name, report_404_parsed_log
+    )
+    report_200_pairs = counters_collection.series[report_200_metric_name].label_pairs
+    report_404_pairs = counters_collection.series[report_404_metric_name].label_pairs
+
+    # both series are in the "report" section, so they should share
+    # the exact same ("section", "report") pair.
+    assert report_200_pairs[1] == ("section", "report")
+    assert report_200_pairs[1] is report_404_pairs[1]
+
+
+def test_counters_collection_totals_grouped_by_label(
+    api_200_metric_name,
+    api_200_parsed_log,
+    report_200_metric_name,
+    report_200_parsed_log,
+    report_404_metric_name,
+    report_404_parsed_log,
+):
+    counters_collection = CountersCollection()
+    counters_collection.add_or_update_series(api_200_metric_name, api_200_parsed_log)
+    counters_collection.add_or_update_series(
+        report_200_metric_name, report_200_parsed_log
+    )
+    counters_collection.add_or_update_series(
+        report_404_metric_name, report_404_parsed_log
+    )
+    end = datetime(2019, 2, 7, 16, 18, 59)
+
+    assert counters_collection.total_counts_by_label(end, 10) == {
+        "api": 1,
+        "report": 2,
+    }
+    assert counters_collection.total_counts_by_label(end, 10, "status") == {
+        "200": 2,
+        "404": 1,
+    }
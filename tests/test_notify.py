@@ -0,0 +1,238 @@
+import json
+import threading
+import time
+from datetime import datetime, timedelta
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+from structured_log_alerting.alertmanager import Alert
+from structured_log_alerting.metricscollection import CountersCollection
+from structured_log_alerting.notify import Notifier, WebhookClient
+from structured_log_alerting.output import TextSink
+from structured_log_alerting.selfmetrics import SelfMetrics
+
+
+START = datetime(2019, 2, 7, 16, 0, 0)
+
+
+class StubWebhook(ThreadingHTTPServer):
+    """
+    Records every payload POSTed to it, and which client port it came
+    from (to tell whether connections were reused). Answers with
+    whatever's next in statuses, then 200s.
+    """
+
+    daemon_threads = True
+
+    def __init__(self, statuses=(), delay=0.0):
+        self.payloads = []
+        self.client_ports = []
+        self.statuses = list(statuses)
+        self.delay = delay
+        self.lock = threading.Lock()
+        super().__init__(("127.0.0.1", 0), StubHandler)
+        self.thread = threading.Thread(
+            target=self.serve_forever, args=(0.05,), daemon=True
+        )
+        self.thread.start()
+
+    @property
+    def url(self):
+        return f"http://127.0.0.1:{self.server_address[1]}/hooks/alerts"
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers["Content-Length"]))
+        time.sleep(self.server.delay)
+        with self.server.lock:
+            self.server.client_ports.append(self.client_address[1])
+            status = self.server.statuses.pop(0) if self.server.statuses else 200
+            if status == 200:
+                self.server.payloads.append(json.loads(body))
+
+        self.send_response(status)
+        self.send_header("Content-Length", "0")
+        self.end_headers()
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def webhook():
+    server = StubWebhook()
+    yield server
+    server.stop()
+
+
+def alert(name, state="firing", seconds=0, value=20):
+    return Alert(
+        name=name,
+        state=state,
+        timestamp=START + timedelta(seconds=seconds),
+        value=value,
+        message=f"{name} is {state}",
+    )
+
+
+def test_webhook_client_rejects_bad_urls():
+    for url in ["127.0.0.1:8080", "ftp://example.com/hook", "http://"]:
+        with pytest.raises(ValueError):
+            WebhookClient(url)
+
+
+def test_webhook_client_reuses_connections(webhook):
+    client = WebhookClient(webhook.url)
+    for i in range(5):
+        assert client.post({"i": i})
+    client.close()
+
+    assert [payload["i"] for payload in webhook.payloads] == list(range(5))
+    assert len(set(webhook.client_ports)) == 1
+
+
+def test_webhook_client_retries_with_backoff():
+    server = StubWebhook(statuses=[503, 429])
+    client = WebhookClient(server.url, backoff=0.01)
+    try:
+        assert client.post({"ok": True})
+    finally:
+        client.close()
+        server.stop()
+
+    assert client.requests == 3
+    assert client.retries == 2
+    assert server.payloads == [{"ok": True}]
+
+
+def test_webhook_client_gives_up():
+    server = StubWebhook(statuses=[400, 500, 500, 500, 500])
+    client = WebhookClient(server.url, max_retries=3, backoff=0.01)
+    try:
+        # not worth retrying
+        assert not client.post({})
+        # runs out of retries
+        assert not client.post({})
+    finally:
+        client.close()
+        server.stop()
+
+    assert client.requests == 5
+
+
+def test_webhook_client_retries_when_nobody_is_listening():
+    server = StubWebhook()
+    url = server.url
+    server.stop()
+    client = WebhookClient(url, max_retries=2, backoff=0.01)
+
+    assert not client.post({})
+    assert client.requests == 3
+
+
+def test_notifier_groups_alerts_by_kind(webhook):
+    notifier = Notifier(WebhookClient(webhook.url), group_interval=60)
+    for section in ["api", "report", "search"]:
+        notifier.notify(alert(f"anomaly.{section}"))
+    notifier.notify(alert("high_traffic"))
+    notifier.close()
+
+    assert sorted(
+        (payload["group"], [record["name"] for record in payload["alerts"]])
+        for payload in webhook.payloads
+    ) == [
+        ("anomaly", ["anomaly.api", "anomaly.report", "anomaly.search"]),
+        ("high_traffic", ["high_traffic"]),
+    ]
+    assert webhook.payloads[0]["alerts"][0]["message"].endswith("is firing")
+    assert notifier.sent_alerts == 4
+    assert notifier.sent_notifications == 2
+
+
+def test_notifier_batches_big_groups(webhook):
+    notifier = Notifier(WebhookClient(webhook.url), group_interval=60, batch_size=10)
+    for section in range(25):
+        notifier.notify(alert(f"anomaly.section{section}"))
+    notifier.close()
+
+    assert sorted(len(payload["alerts"]) for payload in webhook.payloads) == [5, 10, 10]
+
+
+def test_notifier_dedupes_repeats_within_the_repeat_interval(webhook):
+    notifier = Notifier(
+        WebhookClient(webhook.url), group_by="name", repeat_interval=300
+    )
+    notifier.notify(alert("high_traffic", "firing", 0))
+    notifier.notify(alert("high_traffic", "firing", 10))
+    notifier.notify(alert("high_traffic", "resolved", 20))
+    notifier.notify(alert("high_traffic", "resolved", 30))
+    notifier.notify(alert("high_traffic", "firing", 40))
+    notifier.notify(alert("high_traffic", "firing", 400))
+    notifier.close()
+
+    states = [
+        (record["state"], record["time"])
+        for payload in webhook.payloads
+        for record in payload["alerts"]
+    ]
+    assert [state for state, _ in sorted(states, key=lambda state: state[1])] == [
+        "firing",
+        "resolved",
+        "firing",
+        "firing",
+    ]
+    assert notifier.deduplicated_alerts == 2
+
+
+def test_slow_webhooks_never_block_notify():
+    server = StubWebhook(delay=0.2)
+    notifier = Notifier(
+        WebhookClient(server.url),
+        group_by="name",
+        group_interval=0.01,
+        max_pending=2,
+        senders=1,
+    )
+    started = time.monotonic()
+    try:
+        for i in range(20):
+            notifier.notify(alert(f"anomaly.section{i}"))
+            time.sleep(0.02)
+        elapsed = time.monotonic() - started
+        notifier.close()
+    finally:
+        server.stop()
+
+    assert elapsed < 1
+    assert notifier.outbox.dropped > 0
+    assert notifier.sent_alerts + notifier.outbox.dropped == 20
+
+
+def test_sinks_hand_alerts_to_their_notifier(webhook):
+    self_metrics = SelfMetrics(CountersCollection())
+    notifier = Notifier(WebhookClient(webhook.url), self_metrics=self_metrics)
+    written = []
+
+    class Stream:
+        write = written.append
+
+        def flush(self):
+            pass
+
+    sink = TextSink(Stream(), notifier=notifier)
+    sink.write_alert(alert("high_traffic"))
+    sink.close()
+
+    assert written == ["high_traffic is firing\n"]
+    assert [payload["alerts"][0]["name"] for payload in webhook.payloads] == [
+        "high_traffic"
+    ]
+    assert self_metrics.counters["notifier.sent_alerts"] == 1
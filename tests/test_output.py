@@ -0,0 +1,103 @@
+from datetime import datetime
+import io
+import json
+import time
+import pytest
+
+from structured_log_alerting.alertmanager import Alert
+from structured_log_alerting.output import (
+    BatchedFileSink,
+    JSONLinesSink,
+    RateLimitedLogger,
+    TextSink,
+)
+
+
+@pytest.fixture
+def alert():
+    return Alert(
+        name="high_traffic",
+        state="firing",
+        timestamp=datetime(2019, 2, 7, 16, 18, 58),
+        value=12.345,
+        message="2019-02-07 16:18:58: High traffic generated an alert - hits = 12.35 per second",
+    )
+
+
+@pytest.fixture
+def summary():
+    return [
+        "Current time interval: 2019-02-07 16:18:58",
+        "There have been 1 counts of a 404 in the last 10 seconds.",
+    ]
+
+
+def test_text_sink_writes_lines_like_print(alert, summary):
+    sink = TextSink(io.StringIO())
+    sink.write_alert(alert)
+    sink.write_summary(alert.timestamp, summary)
+
+    assert sink.stream.getvalue() == "\n".join([alert.message] + summary) + "\n"
+
+
+def test_jsonlines_sink_writes_one_object_per_record(alert, summary):
+    sink = JSONLinesSink(io.StringIO())
+    sink.write_alert(alert)
+    sink.write_summary(alert.timestamp, summary)
+    alert_record, summary_record = [
+        json.loads(line) for line in sink.stream.getvalue().splitlines()
+    ]
+
+    assert alert_record["type"] == "alert"
+    assert alert_record["state"] == "firing"
+    assert alert_record["value"] == 12.35
+    assert summary_record["type"] == "summary"
+    assert summary_record["lines"] == summary
+
+
+def test_sink_holds_lines_until_buffer_is_full(alert):
+    sink = TextSink(io.StringIO(), buffer_size=3)
+    sink.write_alert(alert)
+    sink.write_alert(alert)
+
+    assert sink.stream.getvalue() == ""
+
+    sink.write_alert(alert)
+
+    assert sink.stream.getvalue().count("\n") == 3
+
+
+def test_batched_file_sink_writes_on_close(tmp_path, alert):
+    path = tmp_path / "alerts.jsonl"
+    sink = BatchedFileSink(str(path), batch_size=100)
+    sink.write_alert(alert)
+
+    assert path.read_text() == ""
+
+    sink.close()
+
+    assert json.loads(path.read_text())["alert"] == "high_traffic"
+
+
+def test_sink_flushes_a_quiet_buffer_on_a_timer(alert):
+    sink = TextSink(io.StringIO(), buffer_size=100, flush_interval=0.05)
+    sink.write_alert(alert)
+    deadline = time.monotonic() + 5
+    while not sink.stream.getvalue() and time.monotonic() < deadline:
+        time.sleep(0.01)
+    sink.close()
+
+    assert sink.stream.getvalue() == f"{alert.message}\n"
+
+
+def test_rate_limited_logger_suppresses_past_burst():
+    stream = io.StringIO()
+    log = RateLimitedLogger(stream, burst=2, interval=60)
+    for i in range(10):
+        log(f"Malformed log line {i}")
+    log.flush()
+    lines = stream.getvalue().splitlines()
+
+    assert lines[:2] == ["Malformed log line 0", "Malformed log line 1"]
+    assert "8 more" in lines[2]
+    assert log.total_suppressed == 8
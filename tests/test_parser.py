@@ -1,6 +1,11 @@
+import time
+
 import pytest
 
+from structured_log_alerting.metricscollection import CountersCollection
 from structured_log_alerting.parser import Parser
+from structured_log_alerting.paths import PathNormalizer
+from structured_log_alerting.selfmetrics import SelfMetrics
 
 
 @pytest.fixture
@@ -105,3 +110,101 @@ def test_invalid_timestamp_handles_valueerror(capsys, correctly_formatted_log_li
 
     assert out == f"Invalid timestamp, failed to parse: {invalid_timestamp}\n"
     assert timestamp is None
+
+
+def test_timestamps_after_2106_are_counted(correctly_formatted_log_line):
+    correctly_formatted_log_line["date"] = "9999999999"
+    parser = Parser(list(correctly_formatted_log_line))
+    metric_name, parsed_log_line = parser.parse_log_line(correctly_formatted_log_line)
+    counters_collection = CountersCollection()
+    counters_collection.add_or_update_series(metric_name, parsed_log_line, 2**40)
+
+    assert counters_collection.total_count_since(parsed_log_line["date"], 1) == 2**40
+
+
+def test_timestamp_before_1970_in_local_time_is_invalid(
+    capsys, monkeypatch, correctly_formatted_log_line
+):
+    # epoch 0 is still 1969 west of UTC
+    monkeypatch.setenv("TZ", "America/New_York")
+    time.tzset()
+    try:
+        correctly_formatted_log_line["date"] = "0"
+        parser = Parser(list(correctly_formatted_log_line))
+        with pytest.raises(ValueError):
+            parser.parse_log_line(correctly_formatted_log_line)
+    finally:
+        monkeypatch.undo()
+        time.tzset()
+    out, err = capsys.readouterr()
+
+    assert "Invalid timestamp, failed to parse: 0\n" in out
+
+
+def test_parser_keeps_normalized_subpaths(correctly_formatted_log_line):
+    parser = Parser(
+        list(correctly_formatted_log_line), path_normalizer=PathNormalizer()
+    )
+    correctly_formatted_log_line["request"] = "GET /api/user/12345 HTTP/1.0"
+    metric_name, parsed_log_line = parser.parse_log_line(correctly_formatted_log_line)
+
+    assert metric_name == "api.user.ID.200"
+    assert parsed_log_line["route"] == "/api/user/{id}"
+    assert parsed_log_line["section"] == "api"
+    assert parsed_log_line["endpoint"] == "/api/user/12345"
+
+
+def test_parser_caches_parsed_requests(correctly_formatted_log_line):
+    parser = Parser(list(correctly_formatted_log_line), request_cache_size=2)
+    first = parser.lookup_request(correctly_formatted_log_line)
+    second = parser.lookup_request(dict(correctly_formatted_log_line))
+
+    assert second is first
+    assert first.metric_prefix == "api"
+    assert (parser.request_cache_hits, parser.request_cache_misses) == (1, 1)
+
+    for request in ["GET /report HTTP/1.0", "GET /static HTTP/1.0"]:
+        correctly_formatted_log_line["request"] = request
+        parser.parse_log_line(correctly_formatted_log_line)
+
+    # the least recently used request was evicted
+    assert list(parser.request_cache) == [
+        "GET /report HTTP/1.0",
+        "GET /static HTTP/1.0",
+    ]
+
+
+def test_parser_interns_requests(correctly_formatted_log_line):
+    parser = Parser(list(correctly_formatted_log_line), request_cache_size=0)
+    a = parser.parse_log_line(dict(correctly_formatted_log_line))[1]
+    b = parser.parse_log_line(dict(correctly_formatted_log_line))[1]
+
+    # nothing's cached, but the strings are still shared
+    assert not parser.request_cache
+    assert a["endpoint"] is b["endpoint"]
+    assert a["section"] is b["section"]
+
+
+def test_parser_counts_request_cache_hits(correctly_formatted_log_line):
+    self_metrics = SelfMetrics(CountersCollection())
+    parser = Parser(
+        list(correctly_formatted_log_line),
+        self_metrics=self_metrics,
+        path_normalizer=PathNormalizer(),
+    )
+    for user in [1, 2, 1, 1]:
+        correctly_formatted_log_line["request"] = f"GET /api/user/{user} HTTP/1.0"
+        metric_name, _ = parser.parse_log_line(correctly_formatted_log_line)
+        assert metric_name == "api.user.ID.200"
+
+    assert self_metrics.counters["parser.request_cache.hits"] == 2
+    assert self_metrics.counters["parser.request_cache.misses"] == 2
+
+
+def test_parser_does_not_cache_malformed_requests(malformed_log_line_b):
+    parser = Parser(list(malformed_log_line_b), lambda message: None)
+    for _ in range(2):
+        with pytest.raises(ValueError):
+            parser.parse_log_line(malformed_log_line_b)
+
+    assert not parser.request_cache
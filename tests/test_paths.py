@@ -0,0 +1,73 @@
+import pytest
+
+from structured_log_alerting.paths import PathNormalizer, Route, metric_segment
+
+
+@pytest.fixture
+def normalizer():
+    return PathNormalizer(
+        ["/api/user/{name}", "/api/user/me", "/report/{year}/{month}"]
+    )
+
+
+def test_ids_uuids_and_hashes_become_placeholders():
+    normalizer = PathNormalizer()
+
+    assert normalizer.normalize("/api/user/12345") == Route(
+        "/api/user/{id}", "api.user.ID"
+    )
+    assert normalizer.normalize("/item/6f1c2a9e-3b2d-4c1e-9a7b-1234567890ab") == Route(
+        "/item/{uuid}", "item.UUID"
+    )
+    assert normalizer.normalize("/blob/d41d8cd98f00b204e9800998ecf8427e") == Route(
+        "/blob/{hash}", "blob.HASH"
+    )
+    # short hex-looking words are left alone
+    assert normalizer.normalize("/cafe/beef") == Route("/cafe/beef", "cafe.beef")
+
+
+def test_templates_match_the_longest_prefix(normalizer):
+    assert normalizer.normalize("/api/user/bob").template == "/api/user/{name}"
+    # literal segments win over placeholders
+    assert normalizer.normalize("/api/user/me").template == "/api/user/me"
+    assert normalizer.normalize("/report/2019/02").metric_path == "report.YEAR.MONTH"
+    # anything past the template is still rewritten
+    normalizer.add_template("/files/{name}")
+    assert normalizer.normalize("/files/bob/7").template == "/files/{name}/{id}"
+
+
+def test_unmatched_paths_are_cut_short(normalizer):
+    assert normalizer.normalize("/static/a/b/c/d.js").template == "/static/a/b"
+    # but a template is always kept whole
+    normalizer.add_template("/a/b/c/{d}/e")
+    assert normalizer.normalize("/a/b/c/x/e/f").template == "/a/b/c/{d}/e"
+
+
+def test_query_strings_and_unsafe_characters(normalizer):
+    assert normalizer.normalize("/static/app.js?v=3") == Route(
+        "/static/app.js", "static.app_js"
+    )
+    assert metric_segment("{id}") == "ID"
+    assert metric_segment("my-page") == "my_page"
+
+
+def test_lookups_are_memoized_in_a_bounded_lru():
+    normalizer = PathNormalizer(max_entries=2)
+    first = normalizer.normalize("/api/user/1")
+
+    assert normalizer.normalize("/api/user/1") is first
+    normalizer.normalize("/api/user/2")
+    normalizer.normalize("/api/user/1")
+    normalizer.normalize("/api/user/3")
+
+    assert list(normalizer.memo) == ["/api/user/1", "/api/user/3"]
+    assert (normalizer.hits, normalizer.misses) == (2, 3)
+    # however many users there are, they share one metric name
+    assert normalizer.normalize("/api/user/4").metric_path is first.metric_path
+
+
+def test_bad_templates_are_rejected(normalizer):
+    with pytest.raises(ValueError):
+        normalizer.add_template("api/user")
+    with pytest.raises(ValueError):
+        normalizer.add_template("/api/user/{id}")
@@ -0,0 +1,186 @@
+import threading
+
+import pytest
+
+from structured_log_alerting.metricscollection import CountersCollection
+from structured_log_alerting.parser import Parser
+from structured_log_alerting.pipeline import (
+    END_OF_QUEUE,
+    BoundedQueue,
+    IngestPipeline,
+)
+from structured_log_alerting.selfmetrics import SelfMetrics
+from structured_log_alerting.synthetic import FIELDNAMES, SyntheticLogGenerator
+
+
+def log_lines(count, status="200"):
+    return [
+        {
+            "remotehost": "10.0.0.1",
+            "rfc931": "-",
+            "authuser": "apache",
+            "date": str(1549573860 + i // 10),
+            "request": "GET /api/user HTTP/1.0",
+            "status": status,
+            "bytes": "1234",
+        }
+        for i in range(count)
+    ]
+
+
+def drain(queue):
+    queue.close()
+    batches = []
+    while (batch := queue.get()) is not END_OF_QUEUE:
+        batches.append(batch)
+    return batches
+
+
+def test_bounded_queue_rejects_bad_settings():
+    with pytest.raises(ValueError):
+        BoundedQueue("lines", 10, "drop-newest")
+    with pytest.raises(ValueError):
+        BoundedQueue("lines", 0)
+
+
+def test_block_waits_for_room():
+    queue = BoundedQueue("lines", 10)
+    queue.put(list(range(8)))
+
+    assert not queue.put(list(range(8)), timeout=0.01)
+
+    threading.Timer(0.05, queue.get).start()
+    assert queue.put(list(range(8)), timeout=5)
+    assert queue.depth == 8
+    assert queue.max_depth == 8
+    assert queue.dropped == 0
+
+
+def test_an_oversized_batch_still_fits_in_an_empty_queue():
+    queue = BoundedQueue("lines", 10, "drop-oldest")
+    queue.put(list(range(25)))
+
+    assert drain(queue) == [(list(range(25)), 1)]
+
+
+def test_drop_oldest_makes_room_for_new_batches():
+    queue = BoundedQueue("lines", 10, "drop-oldest")
+    for start in range(0, 20, 5):
+        queue.put(list(range(start, start + 5)), weight=2)
+
+    assert drain(queue) == [([10, 11, 12, 13, 14], 2), ([15, 16, 17, 18, 19], 2)]
+    assert queue.dropped == 10 * 2
+
+
+def test_sample_keeps_one_in_n_and_reweights():
+    queue = BoundedQueue("lines", 4, "sample", sample_rate=4)
+    queue.put([0, 1, 2, 3])
+    # doesn't fit, so it's sampled (and then the oldest batch is dropped)
+    queue.put(list(range(4, 10)))
+    queue.put(list(range(10, 14)))
+
+    # every 4th item across batches, standing for 4 items each
+    assert drain(queue) == [([4, 8], 4), ([12], 4)]
+    assert queue.sampled_out == 7
+    assert queue.dropped == 4
+
+
+def test_get_waits_for_a_batch():
+    queue = BoundedQueue("lines", 10)
+    threading.Timer(0.05, queue.put, args=([1, 2],)).start()
+
+    assert queue.get() == ([1, 2], 1)
+
+
+def test_pipeline_ingests_everything_when_blocking():
+    lines = log_lines(5000) + [{"request": "nonsense"}] + log_lines(10, status="404")
+    parser = Parser(FIELDNAMES, lambda message: None)
+    counters_collection = CountersCollection()
+
+    with IngestPipeline(lines, parser, queue_size=100, batch_size=7) as pipeline:
+        for metric_name, parsed_log_line, count in pipeline:
+            counters_collection.add_or_update_series(
+                metric_name, parsed_log_line, count
+            )
+
+    assert counters_collection.series["api.200"].total == 5000
+    assert counters_collection.series["api.404"].total == 10
+    assert pipeline.malformed_lines == 1
+    assert [queue.dropped + queue.sampled_out for queue in pipeline.queues] == [0, 0]
+    assert all(queue.max_depth <= 100 for queue in pipeline.queues)
+
+
+def test_pipeline_sampling_keeps_counts_roughly_right():
+    lines = log_lines(20000)
+    parser = Parser(FIELDNAMES, lambda message: None)
+
+    pipeline = IngestPipeline(
+        lines, parser, queue_size=1000, policy="sample", sample_rate=10, batch_size=100
+    )
+    pipeline.start()
+    # hold off aggregating until the reader has run out, so the queues
+    # overflow and have to sample
+    pipeline.threads[0].join()
+
+    total = 0
+    try:
+        for _, _, count in pipeline:
+            total += count
+    finally:
+        pipeline.close()
+
+    shed = sum(queue.dropped for queue in pipeline.queues)
+    assert pipeline.lines.sampled_out > 0
+    assert abs(total + shed - len(lines)) <= len(lines) * 0.05
+
+
+def test_pipeline_raises_reader_errors():
+    def broken_reader():
+        yield from log_lines(10)
+        raise OSError("disk on fire")
+
+    parser = Parser(FIELDNAMES, lambda message: None)
+    with IngestPipeline(broken_reader(), parser) as pipeline:
+        with pytest.raises(OSError):
+            list(pipeline)
+
+
+def test_pipeline_can_be_closed_early():
+    generator = SyntheticLogGenerator(requests_per_second=100)
+    parser = Parser(FIELDNAMES, lambda message: None)
+    pipeline = IngestPipeline(
+        generator.lines(3600), parser, queue_size=10, batch_size=5
+    )
+    next(iter(pipeline))
+    pipeline.close()
+
+    assert not pipeline.threads[1].is_alive()
+
+
+def test_pipeline_reports_queue_depths_and_shedding():
+    self_metrics = SelfMetrics(CountersCollection())
+    parser = Parser(FIELDNAMES, lambda message: None)
+    pipeline = IngestPipeline(
+        log_lines(1000),
+        parser,
+        queue_size=100,
+        policy="drop-oldest",
+        batch_size=50,
+        self_metrics=self_metrics,
+    )
+    pipeline.start()
+    pipeline.threads[0].join()
+    count = sum(1 for _ in pipeline)
+    pipeline.close()
+
+    dropped = sum(queue.dropped for queue in pipeline.queues)
+    assert count + dropped == 1000
+    assert self_metrics.gauges["pipeline.lines.depth"] == 0
+    assert (
+        self_metrics.counters.get("pipeline.lines.dropped", 0)
+        + self_metrics.counters.get("pipeline.parsed_lines.dropped", 0)
+        == dropped
+    )
+    assert "  pipeline.parsed_lines.depth: 0 (now)" in self_metrics.format_stats(
+        CountersCollection()
+    )
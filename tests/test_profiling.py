@@ -0,0 +1,57 @@
+import io
+import pstats
+import pytest
+
+from structured_log_alerting.profiling import StageProfiler
+
+
+class Doubler:
+    def double(self, value):
+        return value * 2
+
+
+def test_time_iterator_counts_lines_and_time():
+    profiler = StageProfiler()
+    items = list(profiler.time_iterator("csv_decode", range(5)))
+
+    assert items == [0, 1, 2, 3, 4]
+    assert profiler.lines == 5
+    assert profiler.stage_nanoseconds["csv_decode"] > 0
+
+
+def test_instrument_method_only_shadows_one_instance():
+    profiler = StageProfiler()
+    doubler = Doubler()
+    profiler.instrument_method(doubler, "double", "parse")
+
+    assert doubler.double(2) == 4
+    assert profiler.stage_nanoseconds["parse"] > 0
+    assert "double" not in vars(Doubler())
+
+
+def test_breakdown_attributes_the_rest_to_other():
+    profiler = StageProfiler()
+    profiler.stage_nanoseconds = {"parse": 300, "evaluate": 100}
+    profiler.total_nanoseconds = 1000
+    profiler.lines = 10
+    breakdown = {stage: row for stage, *row in profiler.breakdown()}
+
+    assert breakdown["other"] == [600, 60.0, 60.0]
+    assert breakdown["parse"] == [300, 30.0, 30.0]
+    assert sum(percent for _, _, percent in breakdown.values()) == pytest.approx(100)
+
+
+def test_profile_writes_pstats_and_breakdown(tmp_path):
+    pstats_path = tmp_path / "main.pstats"
+    profiler = StageProfiler()
+    doubler = Doubler()
+    profiler.instrument_method(doubler, "double", "parse")
+    with profiler.profile(str(pstats_path)):
+        for value in profiler.time_iterator("csv_decode", range(100)):
+            doubler.double(value)
+    stream = io.StringIO()
+    profiler.write_breakdown(stream)
+
+    assert pstats.Stats(str(pstats_path)).total_calls > 0
+    assert "Profiled 100 lines" in stream.getvalue()
+    assert "parse" in stream.getvalue()
@@ -0,0 +1,177 @@
+from datetime import datetime
+import pytest
+
+from structured_log_alerting.columnarcollection import ColumnarCountersCollection
+from structured_log_alerting.metricscollection import CountersCollection
+from structured_log_alerting.parser import Parser
+from structured_log_alerting.query import Matcher, QueryEngine, parse_query
+from structured_log_alerting.synthetic import FIELDNAMES, SyntheticLogGenerator
+
+
+@pytest.fixture(params=[CountersCollection, ColumnarCountersCollection])
+def counters_collection(
+    request,
+    api_200_metric_name,
+    api_200_parsed_log,
+    api_200_newer_parsed_log,
+    report_200_metric_name,
+    report_200_parsed_log,
+    report_404_metric_name,
+    report_404_parsed_log,
+):
+    counters_collection = request.param()
+    counters_collection.add_or_update_series(api_200_metric_name, api_200_parsed_log)
+    counters_collection.add_or_update_series(
+        api_200_metric_name, api_200_newer_parsed_log
+    )
+    counters_collection.add_or_update_series(
+        report_200_metric_name, report_200_parsed_log
+    )
+    counters_collection.add_or_update_series(
+        report_404_metric_name, report_404_parsed_log
+    )
+
+    return counters_collection
+
+
+@pytest.fixture
+def most_recent_time(api_200_newer_parsed_log):
+    return api_200_newer_parsed_log["date"]
+
+
+def test_query_parses_aggregations_with_matchers_and_grouping():
+    query = parse_query(
+        'sum by (section, status) ({section!="api", status=~"5.."}[120s])'
+    )
+
+    assert query.function == "sum"
+    assert query.by == ("section", "status")
+    assert query.window_in_seconds == 120
+    assert query.matchers == (
+        Matcher("section", "!=", "api"),
+        Matcher("status", "=~", "5.."),
+    )
+
+
+def test_query_parses_bare_names_as_range_vectors():
+    query = parse_query("api.200[10s]")
+
+    assert query.function is None
+    assert query.matchers == (Matcher("__name__", "=", "api.200"),)
+
+
+@pytest.mark.parametrize(
+    "text",
+    [
+        'sum({status="200"})',
+        'median({status="200"}[10s])',
+        '{status=~"("}[10s]',
+        '{status="200"}[0s]',
+        '{status: "200"}[10s]',
+    ],
+)
+def test_query_rejects_invalid_queries(text):
+    with pytest.raises(ValueError):
+        parse_query(text)
+
+
+def test_query_engine_sums_by_label(counters_collection, most_recent_time):
+    engine = QueryEngine(counters_collection)
+
+    assert engine.query("sum by (section) ({}[10s])", most_recent_time) == {
+        ("api",): 2.0,
+        ("report",): 2.0,
+    }
+    assert engine.query('sum({status!="200"}[10s])', most_recent_time) == {(): 1.0}
+
+
+def test_query_engine_aggregation_functions(counters_collection, most_recent_time):
+    engine = QueryEngine(counters_collection)
+
+    assert engine.query('max({section="report"}[10s])', most_recent_time) == {(): 1.0}
+    assert engine.query("avg by (section) ({}[10s])", most_recent_time) == {
+        ("api",): 2.0,
+        ("report",): 1.0,
+    }
+    assert engine.query('count({status=~"2.."}[10s])', most_recent_time) == {(): 2.0}
+    assert engine.query('rate({section=~"api|report"}[4s])', most_recent_time) == {
+        (): 0.75
+    }
+
+
+def test_query_engine_returns_range_vectors(counters_collection, most_recent_time):
+    engine = QueryEngine(counters_collection)
+    vectors = engine.query('{section="api"}[10s]', most_recent_time)
+
+    assert vectors == {
+        "api.200": [
+            (datetime(2019, 2, 7, 16, 18, 58), 1),
+            (datetime(2019, 2, 7, 16, 18, 59), 1),
+        ]
+    }
+
+
+def test_query_engine_tops_up_plans_with_new_series(
+    counters_collection, most_recent_time, api_200_parsed_log
+):
+    engine = QueryEngine(counters_collection)
+    query = parse_query('sum({status="500"}[10s])')
+
+    assert engine.evaluate(query, most_recent_time) == {}
+
+    counters_collection.add_or_update_series(
+        "api.500", dict(api_200_parsed_log, status="500")
+    )
+
+    assert engine.evaluate(query, most_recent_time) == {(): 1.0}
+    assert len(engine.plans) == 1
+
+
+def test_query_engine_starts_over_after_series_are_evicted(
+    most_recent_time, api_200_parsed_log
+):
+    counters_collection = CountersCollection()
+    for status in ["200", "404"]:
+        counters_collection.add_or_update_series(
+            f"api.{status}", dict(api_200_parsed_log, status=status)
+        )
+    engine = QueryEngine(counters_collection)
+    query = parse_query('sum by (status) ({section="api"}[10s])')
+
+    assert engine.evaluate(query, most_recent_time) == {("200",): 1.0, ("404",): 1.0}
+
+    counters_collection.evict_series(["api.200"])
+    counters_collection.add_or_update_series(
+        "api.500", dict(api_200_parsed_log, status="500")
+    )
+
+    # the same number of series as before, but not the same series
+    assert engine.evaluate(query, most_recent_time) == {("404",): 1.0, ("500",): 1.0}
+
+
+def test_query_engine_agrees_with_total_count_since():
+    parser = Parser(FIELDNAMES, lambda message: None)
+    generator = SyntheticLogGenerator(requests_per_second=10, section_count=4)
+    collections = [
+        CountersCollection(max_series_length=1000),
+        ColumnarCountersCollection(),
+    ]
+    for line in generator.lines(200):
+        metric_name, parsed_log_line = parser.parse_log_line(line)
+        for counters_collection in collections:
+            counters_collection.add_or_update_series(metric_name, parsed_log_line)
+
+    end = datetime.fromtimestamp(generator.start_timestamp + 199)
+    for counters_collection in collections:
+        engine = QueryEngine(counters_collection)
+        for seconds in [1, 9, 10, 37, 120]:
+            by_section = engine.query(f"sum by (section) ({{}}[{seconds}s])", end)
+            assert by_section == {
+                (section,): count
+                for section, count in counters_collection.total_counts_by_label(
+                    end, seconds
+                ).items()
+            }
+            assert sum(by_section.values()) == counters_collection.total_count_since(
+                end, seconds
+            )
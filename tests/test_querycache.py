@@ -0,0 +1,154 @@
+from datetime import datetime, timedelta
+import pytest
+
+from structured_log_alerting.alertmanager import AlertManager
+from structured_log_alerting.columnarcollection import ColumnarCountersCollection
+from structured_log_alerting.metricscollection import CountersCollection
+from structured_log_alerting.query import QueryEngine
+from structured_log_alerting.querycache import QueryCache
+from structured_log_alerting.sortedarraydict import to_seconds
+
+
+START = datetime(2019, 2, 7, 16, 18, 0)
+
+
+def add(counters_collection, parsed_log, seconds, count=1):
+    counters_collection.add_or_update_series(
+        f"{parsed_log['section']}.{parsed_log['status']}",
+        dict(parsed_log, date=START + timedelta(seconds=seconds)),
+        count,
+    )
+
+
+@pytest.fixture(params=[CountersCollection, ColumnarCountersCollection])
+def counters_collection(request, api_200_parsed_log, report_404_parsed_log):
+    counters_collection = request.param(max_series_length=1000)
+    for seconds in range(1, 200):
+        add(counters_collection, api_200_parsed_log, seconds)
+        if seconds % 3 == 0:
+            add(counters_collection, report_404_parsed_log, seconds)
+    return counters_collection
+
+
+def test_query_cache_hits_on_repeated_queries(counters_collection):
+    cache = QueryCache(counters_collection)
+    end = START + timedelta(seconds=195)
+
+    first = cache.total_count_since(end, 10)
+    second = cache.total_count_since(end, 10)
+
+    assert first == second == counters_collection.total_count_since(end, 10)
+    assert cache.misses == 1
+    assert cache.hits == 1
+
+
+def test_query_cache_builds_long_windows_from_blocks(counters_collection):
+    cache = QueryCache(counters_collection)
+
+    for seconds in [120, 130, 140]:
+        end = START + timedelta(seconds=seconds)
+        assert cache.total_count_since(end, 120) == (
+            counters_collection.total_count_since(end, 120)
+        )
+
+    # 12 blocks for the first window, then one new block for each of
+    # the next two. the older, closed blocks are never recomputed.
+    assert cache.misses == 14
+
+
+def test_query_cache_only_invalidates_windows_new_data_touches(
+    counters_collection, api_200_parsed_log
+):
+    cache = QueryCache(counters_collection)
+    old_end = START + timedelta(seconds=150)
+    new_end = START + timedelta(seconds=190)
+    cache.total_count_since(old_end, 10)
+    cache.total_count_since(new_end, 10)
+
+    add(counters_collection, api_200_parsed_log, 185, 5)
+
+    assert cache.total_count_since(old_end, 10) == (
+        counters_collection.total_count_since(old_end, 10)
+    )
+    assert cache.total_count_since(new_end, 10) == (
+        counters_collection.total_count_since(new_end, 10)
+    )
+    assert cache.invalidations == 1
+    assert cache.hits == 1
+
+
+def test_query_cache_invalidates_blocks_hit_by_late_data(
+    counters_collection, api_200_parsed_log
+):
+    cache = QueryCache(counters_collection)
+    end = START + timedelta(seconds=190)
+    cache.total_count_since(end, 120)
+    misses = cache.misses
+
+    add(counters_collection, api_200_parsed_log, 101, 7)
+
+    assert cache.total_count_since(end, 120) == (
+        counters_collection.total_count_since(end, 120)
+    )
+    # just the block that the late data landed in
+    assert cache.misses == misses + 1
+
+
+@pytest.mark.parametrize(
+    "counters_collection",
+    [
+        CountersCollection(max_series_length=30),
+        ColumnarCountersCollection(retention_in_seconds=30),
+    ],
+)
+def test_query_cache_invalidates_windows_old_data_falls_out_of(
+    counters_collection, api_200_parsed_log
+):
+    for seconds in range(1, 31):
+        add(counters_collection, api_200_parsed_log, seconds)
+    cache = QueryCache(counters_collection)
+    end = START + timedelta(seconds=25)
+    assert cache.total_count_since(end, 30) == 25
+
+    # no longer room for the first second
+    add(counters_collection, api_200_parsed_log, 31)
+
+    assert cache.total_count_since(end, 30) == 24
+    assert counters_collection.total_count_since(end, 30) == 24
+
+
+def test_query_cache_evicts_least_recently_used(counters_collection):
+    cache = QueryCache(counters_collection, max_entries=3)
+    ends = [START + timedelta(seconds=seconds) for seconds in [151, 152, 153, 154]]
+    for end in ends[:3]:
+        cache.total_count_since(end, 5)
+    cache.total_count_since(ends[0], 5)
+    cache.total_count_since(ends[3], 5)
+
+    # 152 was the least recently used, since 151 was looked up again
+    assert len(cache) == 3
+    assert {key[2] for key in cache.entries} == {
+        to_seconds(end) for end in [ends[0], ends[2], ends[3]]
+    }
+
+
+def test_query_cache_works_with_alertmanager_and_query_engine(
+    counters_collection, api_200_parsed_log
+):
+    cache = QueryCache(counters_collection)
+    alertmanager = AlertManager(counters_collection, ["404", "500"], query_cache=cache)
+    uncached_alertmanager = AlertManager(counters_collection, ["404", "500"])
+    engine = QueryEngine(counters_collection, cache)
+    end = START + timedelta(seconds=199)
+
+    assert alertmanager.provide_summary_for_interval(
+        end
+    ) == uncached_alertmanager.provide_summary_for_interval(end)
+    assert engine.query("sum by (section) ({}[10s])", end) == {
+        ("api",): 10.0,
+        ("report",): 3.0,
+    }
+
+    add(counters_collection, api_200_parsed_log, 199, 2)
+
+    assert engine.query("sum by (section) ({}[10s])", end)[("api",)] == 12.0
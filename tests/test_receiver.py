@@ -0,0 +1,143 @@
+import socket
+import time
+from itertools import islice
+
+import pytest
+
+from structured_log_alerting.metricscollection import CountersCollection
+from structured_log_alerting.parser import Parser
+from structured_log_alerting.receiver import LogReceiver, parse_address
+from structured_log_alerting.selfmetrics import SelfMetrics
+
+
+START = 1549573860
+
+
+def log_line(timestamp, section="api", status=200):
+    return f'"10.0.0.1","-","apache",{START + timestamp},"GET /{section}/user HTTP/1.0",{status},1234\n'
+
+
+def wait_for(condition, timeout=5.0):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        if time.monotonic() > deadline:
+            raise AssertionError("timed out")
+        time.sleep(0.01)
+
+
+def test_parse_address():
+    assert parse_address("udp://127.0.0.1:5140") == ("udp", "127.0.0.1", 5140)
+    assert parse_address("tcp://localhost:0") == ("tcp", "localhost", 0)
+    assert parse_address("unix:///tmp/logs.sock") == ("unix", "/tmp/logs.sock", None)
+
+    for address in [
+        "127.0.0.1:5140",
+        "http://127.0.0.1:80",
+        "tcp://127.0.0.1",
+        "unix://",
+    ]:
+        with pytest.raises(ValueError):
+            parse_address(address)
+
+
+def test_tcp_lines_are_parsed_into_a_collection():
+    counters_collection = CountersCollection()
+    with LogReceiver(["tcp://127.0.0.1:0"]) as receiver:
+        parser = Parser(receiver.fieldnames, lambda message: None)
+        with socket.create_connection(receiver.bound_addresses[0]) as connection:
+            for timestamp in range(1, 101):
+                connection.sendall(log_line(timestamp).encode())
+            # a final line without a newline still counts
+            connection.sendall(log_line(101, status=404).rstrip().encode())
+
+        for line in islice(receiver, 101):
+            counters_collection.add_or_update_series(*parser.parse_log_line(line))
+
+    assert counters_collection.series["api.200"].total == 100
+    assert counters_collection.series["api.404"].total == 1
+    assert receiver.line_num == 101
+    assert receiver.received_lines == 101
+
+
+def test_udp_datagrams_are_batched():
+    with LogReceiver(
+        ["udp://127.0.0.1:0"], batch_size=10, flush_interval=0.05
+    ) as receiver:
+        with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as sender:
+            for timestamp in range(1, 26):
+                # with a syslog-style priority in front
+                sender.sendto(
+                    f"<134>{log_line(timestamp)}".encode(), receiver.bound_addresses[0]
+                )
+
+        lines = list(islice(receiver, 25))
+
+    assert [int(line["date"]) - START for line in lines] == list(range(1, 26))
+    assert lines[0]["remotehost"] == "10.0.0.1"
+    # two full batches, then whatever was left when the flush timer went off
+    assert receiver.dropped_lines == 0
+
+
+def test_unix_socket(tmp_path):
+    path = str(tmp_path / "logs.sock")
+    with LogReceiver([f"unix://{path}"]) as receiver:
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as connection:
+            connection.connect(path)
+            connection.sendall("".join(log_line(t) for t in range(1, 6)).encode())
+
+        lines = list(islice(receiver, 5))
+
+    assert [int(line["date"]) - START for line in lines] == [1, 2, 3, 4, 5]
+
+
+def test_tcp_senders_are_pushed_back_on_instead_of_dropped():
+    sent = 20000
+    receiver = LogReceiver(["tcp://127.0.0.1:0"], max_pending_batches=1)
+    receiver.read_size = 1024
+    with receiver:
+        with socket.create_connection(receiver.bound_addresses[0]) as connection:
+            # nobody's ingesting yet, so the queue fills straight away
+            connection.sendall("".join(log_line(1) for _ in range(sent)).encode())
+            wait_for(lambda: receiver.backpressure_waits > 0)
+            assert receiver.batches.full()
+
+        assert sum(1 for _ in islice(receiver, sent)) == sent
+
+    assert receiver.dropped_lines == 0
+
+
+def test_udp_drops_are_counted_when_ingest_falls_behind():
+    sent = 50
+    self_metrics = SelfMetrics(CountersCollection())
+    with LogReceiver(
+        ["udp://127.0.0.1:0"],
+        batch_size=1,
+        max_pending_batches=5,
+        self_metrics=self_metrics,
+    ) as receiver:
+        with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as sender:
+            for timestamp in range(sent):
+                sender.sendto(log_line(timestamp).encode(), receiver.bound_addresses[0])
+
+        wait_for(lambda: receiver.received_lines + receiver.dropped_lines == sent)
+        lines = list(islice(receiver, receiver.received_lines))
+
+    assert receiver.received_lines == len(lines) == 5
+    assert receiver.dropped_lines == sent - 5
+    assert self_metrics.counters["receiver.dropped_lines"] == sent - 5
+
+
+def test_iteration_ends_once_closed():
+    receiver = LogReceiver(["tcp://127.0.0.1:0"]).start()
+    with socket.create_connection(receiver.bound_addresses[0]) as connection:
+        connection.sendall(log_line(1).encode())
+    wait_for(lambda: receiver.received_lines == 1)
+    receiver.close()
+
+    assert len(list(receiver)) == 1
+
+
+def test_listening_on_a_taken_port_raises():
+    with LogReceiver(["tcp://127.0.0.1:0"]) as receiver:
+        with pytest.raises(OSError):
+            LogReceiver([f"tcp://127.0.0.1:{receiver.bound_addresses[0][1]}"]).start()
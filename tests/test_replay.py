@@ -0,0 +1,94 @@
+from datetime import datetime
+import io
+import json
+import pytest
+
+from structured_log_alerting.alertmanager import AlertManager
+from structured_log_alerting.metricscollection import CountersCollection
+from structured_log_alerting.output import JSONLinesSink
+from structured_log_alerting.parser import Parser
+from structured_log_alerting.replay import Replayer
+
+
+@pytest.fixture
+def log_lines():
+    # 20 seconds of 5 rps followed by 20 quiet seconds with a
+    # single request each, starting on a 10s boundary.
+    start = int(datetime(2019, 2, 7, 16, 18, 0).timestamp())
+    lines = []
+    for offset in range(40):
+        for i in range(5 if offset < 20 else 1):
+            lines.append(
+                {
+                    "remotehost": "10.0.0.1",
+                    "rfc931": "-",
+                    "authuser": "apache",
+                    "date": str(start + offset),
+                    "request": "GET /api/user HTTP/1.0",
+                    "status": "200",
+                    "bytes": "1234",
+                }
+            )
+    return lines
+
+
+@pytest.fixture
+def replayer(log_lines):
+    counters_collection = CountersCollection()
+    alertmanager = AlertManager(
+        counters_collection, rolling_alert_window=10, elevated_request_threshold=3
+    )
+    return Replayer(
+        Parser(list(log_lines[0]), lambda message: None),
+        counters_collection,
+        alertmanager,
+        JSONLinesSink(io.StringIO()),
+        evaluation_interval=10,
+        batch_size=7,
+    )
+
+
+def test_replay_aligns_first_boundary(replayer):
+    boundary = replayer.first_boundary_for(datetime(2019, 2, 7, 16, 18, 3))
+
+    assert boundary == datetime(2019, 2, 7, 16, 18, 10)
+
+
+def test_replay_writes_alert_transitions_as_json_lines(replayer, log_lines):
+    replayer.run(log_lines)
+    records = [
+        json.loads(line) for line in replayer.output.stream.getvalue().splitlines()
+    ]
+
+    assert [record["state"] for record in records] == ["firing", "resolved"]
+    assert records[0]["alert"] == "high_traffic"
+    assert records[0]["time"] == "2019-02-07T16:18:10"
+
+
+def test_replay_reports_line_counts(replayer, log_lines):
+    malformed_line = dict(log_lines[0], request="garbage")
+    stats = replayer.run(log_lines + [malformed_line])
+
+    assert stats.lines == len(log_lines) + 1
+    assert stats.malformed_lines == 1
+    assert stats.alerts == 2
+    assert stats.lines_per_second > 0
+
+
+def test_replay_skips_empty_boundaries_in_gaps(replayer, log_lines):
+    boundaries = []
+    evaluate = replayer.evaluate
+
+    def recording_evaluate(boundary):
+        boundaries.append(boundary)
+        evaluate(boundary)
+
+    replayer.evaluate = recording_evaluate
+    far_future = int(datetime(2119, 2, 7, 16, 18, 5).timestamp())
+    stats = replayer.run(log_lines + [dict(log_lines[-1], date=str(far_future))])
+
+    # every boundary up to the gap, then just the ones around the far line
+    assert boundaries == [
+        datetime(2019, 2, 7, 16, 18, second) for second in range(0, 50, 10)
+    ] + [datetime(2119, 2, 7, 16, 18, 0), datetime(2119, 2, 7, 16, 18, 10)]
+    assert stats.alerts == 2
@@ -0,0 +1,73 @@
+from datetime import datetime
+import io
+import pytest
+
+from structured_log_alerting.metricscollection import CountersCollection
+from structured_log_alerting.parser import Parser
+from structured_log_alerting.selfmetrics import LatencyHistogram, SelfMetrics
+
+
+@pytest.fixture
+def self_metrics():
+    return SelfMetrics(CountersCollection(), stream=io.StringIO())
+
+
+@pytest.fixture
+def log_line():
+    return {
+        "remotehost": "10.0.0.3",
+        "rfc931": "-",
+        "authuser": "apache",
+        "date": "1549574330",
+        "request": "POST /api/user HTTP/1.0",
+        "status": "200",
+        "bytes": "1234",
+    }
+
+
+def test_histogram_percentiles_are_bucket_upper_bounds():
+    histogram = LatencyHistogram()
+    for nanoseconds in [100] * 99 + [5000]:
+        histogram.observe(nanoseconds)
+
+    assert histogram.count == 100
+    assert histogram.percentile(50) == 128
+    assert histogram.percentile(100) == 8192
+    assert histogram.mean() == 149
+
+
+def test_instrumented_parser_records_latency_and_failures(self_metrics, log_line):
+    parser = Parser(list(log_line), lambda message: None, self_metrics)
+    parser.parse_log_line(log_line)
+    with pytest.raises(ValueError):
+        parser.parse_log_line(dict(log_line, request=None))
+
+    assert self_metrics.histograms["parser.parse_log_line"].count == 2
+    assert self_metrics.counters["parser.parse_log_line.errors"] == 1
+
+
+def test_flush_writes_counter_deltas_into_collection(self_metrics):
+    first_flush = datetime(2019, 2, 7, 16, 18, 58)
+    second_flush = datetime(2019, 2, 7, 16, 18, 59)
+    self_metrics.increment("lines", 5)
+    self_metrics.flush(first_flush)
+    self_metrics.increment("lines", 2)
+    self_metrics.flush(second_flush)
+    collection = self_metrics.counters_collection
+
+    assert "selfmetrics" in collection.sections
+    assert collection.total_count_since(second_flush, 10, "selfmetrics.lines") == 7
+    assert collection.total_count_since(second_flush, 1, "selfmetrics.lines") == 2
+
+
+def test_dump_writes_stats_for_instrumented_collection(self_metrics, log_line):
+    instrumented_collection = CountersCollection(self_metrics=self_metrics)
+    parser = Parser(list(log_line), self_metrics=self_metrics)
+    metric_name, parsed_log_line = parser.parse_log_line(log_line)
+    instrumented_collection.add_or_update_series(metric_name, parsed_log_line)
+    self_metrics.dump(parsed_log_line["date"], instrumented_collection)
+    dump = self_metrics.stream.getvalue()
+
+    assert "1 lines" in dump
+    assert "1 series" in dump
+    assert "counterscollection.add_or_update_series: 1 calls" in dump
@@ -0,0 +1,190 @@
+import socket
+import time
+from datetime import datetime
+from multiprocessing.shared_memory import SharedMemory
+
+import pytest
+
+from structured_log_alerting.alertmanager import AlertManager
+from structured_log_alerting.columnarcollection import ColumnarCountersCollection
+from structured_log_alerting.parser import Parser
+from structured_log_alerting.sharding import (
+    ShardedCollection,
+    ShardedIngest,
+    SharedColumnarCollection,
+)
+from structured_log_alerting.synthetic import FIELDNAMES, SyntheticLogGenerator
+
+
+@pytest.fixture
+def shared_collections():
+    # a shard's block, with a writer and a reader over it, as if they
+    # were in different processes
+    writers = []
+    readers = []
+
+    def shared_collection(capacity=64):
+        writer = SharedColumnarCollection.create(capacity, retention_in_seconds=200)
+        reader = SharedColumnarCollection(
+            SharedMemory(writer.memory.name), capacity, retention_in_seconds=200
+        )
+        writers.append(writer)
+        readers.append(reader)
+        return writer, reader
+
+    yield shared_collection
+
+    for reader in readers:
+        reader.close()
+    for writer in writers:
+        writer.close()
+        writer.memory.unlink()
+
+
+@pytest.fixture
+def synthetic_lines():
+    parser = Parser(FIELDNAMES, lambda message: None)
+    generator = SyntheticLogGenerator(requests_per_second=10, section_count=4)
+    parsed_lines = [parser.parse_log_line(line) for line in generator.lines(300)]
+
+    return parsed_lines, datetime.fromtimestamp(generator.start_timestamp + 299)
+
+
+def assert_same_totals(collection, expected, end):
+    for seconds, namespace in [(10, ""), (120, ""), (120, "api"), (37, "500")]:
+        assert collection.total_count_since(
+            end, seconds, namespace
+        ) == expected.total_count_since(end, seconds, namespace)
+    assert collection.total_counts_by_label(end, 120) == expected.total_counts_by_label(
+        end, 120
+    )
+
+
+def test_readers_see_what_the_writer_wrote_in_place(
+    shared_collections, synthetic_lines
+):
+    writer, reader = shared_collections()
+    columnar_collection = ColumnarCountersCollection(retention_in_seconds=200)
+    parsed_lines, end = synthetic_lines
+    for metric_name, parsed_log_line in parsed_lines:
+        writer.add_or_update_series(metric_name, parsed_log_line)
+        columnar_collection.add_or_update_series(metric_name, parsed_log_line)
+
+    assert reader.series == {}
+    new_series = reader.refresh()
+
+    assert [series.name for series in new_series] == list(columnar_collection.series)
+    assert reader.sections == columnar_collection.sections
+    assert reader.newest_second == columnar_collection.newest_second
+    assert reader.label_index == columnar_collection.label_index
+    assert_same_totals(reader, columnar_collection, end)
+    assert reader.refresh() == []
+
+
+def test_full_shards_drop_new_series(
+    shared_collections,
+    api_200_metric_name,
+    api_200_parsed_log,
+    report_200_metric_name,
+    report_200_parsed_log,
+):
+    writer, reader = shared_collections(capacity=1)
+    writer.add_or_update_series(api_200_metric_name, api_200_parsed_log)
+    writer.add_or_update_series(report_200_metric_name, report_200_parsed_log, 3)
+    writer.add_or_update_series(api_200_metric_name, api_200_parsed_log)
+    reader.refresh()
+
+    assert list(reader.series) == ["api.200"]
+    assert reader.series["api.200"].total == 2
+    assert reader.dropped_points == 3
+
+
+def test_sharded_collections_sum_every_shard(shared_collections, synthetic_lines):
+    shards = [shared_collections() for _ in range(3)]
+    columnar_collection = ColumnarCountersCollection(retention_in_seconds=200)
+    parsed_lines, end = synthetic_lines
+    for i, (metric_name, parsed_log_line) in enumerate(parsed_lines):
+        writer, _ = shards[i % 3]
+        writer.add_or_update_series(metric_name, parsed_log_line)
+        columnar_collection.add_or_update_series(metric_name, parsed_log_line)
+
+    sharded_collection = ShardedCollection([reader for _, reader in shards])
+    assert sharded_collection.refresh() == end
+    assert sorted(sharded_collection.series) == sorted(columnar_collection.series)
+    assert len(sharded_collection.series["api.200"].parts) == 3
+    assert_same_totals(sharded_collection, columnar_collection, end)
+
+    series = list(sharded_collection.series.values())
+    assert sharded_collection.totals_for_series(
+        series, end, 60
+    ) == columnar_collection.totals_for_series(
+        [columnar_collection.series[each.name] for each in series], end, 60
+    )
+    assert AlertManager(
+        sharded_collection, ["404", "500"]
+    ).provide_summary_for_interval(end) == AlertManager(
+        columnar_collection, ["404", "500"]
+    ).provide_summary_for_interval(
+        end
+    )
+
+
+def test_snapshots_outlive_the_shared_block(shared_collections, synthetic_lines):
+    writer, reader = shared_collections()
+    parsed_lines, end = synthetic_lines
+    for metric_name, parsed_log_line in parsed_lines:
+        writer.add_or_update_series(metric_name, parsed_log_line)
+
+    sharded_collection = ShardedCollection([reader])
+    sharded_collection.refresh()
+    expected = sharded_collection.total_counts_by_label(end, 120)
+    sharded_collection.detach()
+    # the reader's been swapped for a copy, so the block can go
+    reader.close()
+
+    assert sharded_collection.refresh() == end
+    assert sharded_collection.total_counts_by_label(end, 120) == expected
+
+
+def test_shards_need_a_shareable_address():
+    for address in ["unix:///tmp/logs.sock", "tcp://127.0.0.1:0"]:
+        with pytest.raises(ValueError):
+            ShardedIngest([address], 2)
+    with pytest.raises(ValueError):
+        ShardedIngest(["udp://127.0.0.1:5140"], 0)
+
+
+def test_shards_ingest_in_their_own_processes():
+    with socket.socket() as probe:
+        probe.bind(("127.0.0.1", 0))
+        port = probe.getsockname()[1]
+    lines = [
+        f'"10.0.0.{i % 7}","-","apache",{1549573860 + i // 50},'
+        f'"GET /{["api", "report"][i % 2]}/user HTTP/1.0",200,1234\n'
+        for i in range(2000)
+    ]
+
+    with ShardedIngest(
+        [f"tcp://127.0.0.1:{port}"], 2, capacity=16, retention_in_seconds=60
+    ) as ingest:
+        for i in range(4):
+            with socket.create_connection(("127.0.0.1", port)) as connection:
+                connection.sendall("".join(lines[i::4]).encode())
+
+        deadline = time.monotonic() + 10
+        while ingest.collection.total_count_since(
+            datetime.fromtimestamp(1549573899), 60
+        ) < len(lines):
+            assert time.monotonic() < deadline
+            time.sleep(0.05)
+            ingest.collection.refresh()
+
+    assert ingest.collection.total_counts_by_label(
+        datetime.fromtimestamp(1549573899), 60
+    ) == {"api": 1000, "report": 1000}
+    assert {
+        name: series.total for name, series in ingest.collection.series.items()
+    } == {
+        "api.200": 1000,
+        "report.200": 1000,
+    }
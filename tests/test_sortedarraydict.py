@@ -0,0 +1,85 @@
+from datetime import datetime
+import pytest
+
+from structured_log_alerting.sortedarraydict import (
+    SortedArrayDict,
+    from_seconds,
+    to_seconds,
+)
+
+
+@pytest.fixture
+def sample_timestamps():
+    return [
+        datetime(2019, 2, 7, 16, 11, 3),
+        datetime(2019, 2, 7, 16, 11, 3),
+        datetime(2019, 2, 7, 16, 11, 4),
+        datetime(2019, 2, 7, 16, 11, 5),
+        datetime(2019, 2, 7, 16, 11, 4),
+        datetime(2019, 2, 7, 16, 11, 2),
+        datetime(2019, 2, 7, 16, 11, 6),
+    ]
+
+
+def test_seconds_round_trip():
+    timestamp = datetime(2019, 2, 7, 16, 11, 3)
+
+    assert from_seconds(to_seconds(timestamp)) == timestamp
+
+
+def test_keys_stay_sorted_with_out_of_order_inserts(sample_timestamps):
+    data_points = SortedArrayDict(10)
+    for timestamp in sample_timestamps:
+        data_points.increment(to_seconds(timestamp))
+
+    assert list(data_points) == sorted(set(sample_timestamps))
+    assert data_points[datetime(2019, 2, 7, 16, 11, 3)] == 2
+    assert data_points[datetime(2019, 2, 7, 16, 11, 4)] == 2
+
+
+def test_setitem_and_contains_use_datetime_keys(sample_timestamps):
+    data_points = SortedArrayDict(10)
+    data_points[sample_timestamps[0]] = 5
+
+    assert sample_timestamps[0] in data_points
+    assert sample_timestamps[2] not in data_points
+    assert data_points[sample_timestamps[0]] == 5
+    with pytest.raises(KeyError):
+        data_points[sample_timestamps[2]]
+
+
+def test_drops_oldest_keys_past_max_len(sample_timestamps):
+    data_points = SortedArrayDict(3)
+    for timestamp in sample_timestamps:
+        data_points.increment(to_seconds(timestamp))
+
+    assert len(data_points) == 3
+    assert data_points.popitem(False)[0] == datetime(2019, 2, 7, 16, 11, 4)
+    assert data_points.popitem()[0] == datetime(2019, 2, 7, 16, 11, 6)
+
+
+def test_sum_between_excludes_lower_bound(sample_timestamps):
+    data_points = SortedArrayDict(10)
+    for timestamp in sample_timestamps:
+        data_points.increment(to_seconds(timestamp))
+    until = to_seconds(datetime(2019, 2, 7, 16, 11, 5))
+
+    assert data_points.sum_between(until - 2, until) == 3
+    assert data_points.sum_between(until - 10, until) == 6
+
+
+def test_downsample_and_shrink_free_keys():
+    data_points = SortedArrayDict(10)
+    for seconds in [1549573858, 1549573859, 1549573860, 1549573865, 1549573871]:
+        data_points.increment(seconds, 2)
+
+    assert data_points.downsample(10) == 2
+    assert list(zip(data_points.seconds, data_points.counts)) == [
+        (1549573850, 4),
+        (1549573860, 4),
+        (1549573870, 2),
+    ]
+    assert data_points.shrink(2) == 1
+    assert list(data_points.seconds) == [1549573860, 1549573870]
+    data_points.increment(1549573880)
+    assert list(data_points.seconds) == [1549573870, 1549573880]
@@ -0,0 +1,193 @@
+import io
+from datetime import datetime
+
+import pytest
+
+from structured_log_alerting.metricscollection import CountersCollection
+from structured_log_alerting.parser import Parser
+from structured_log_alerting.sources import (
+    MergedLogReader,
+    expand_locations,
+    hosts_for,
+    open_logs,
+)
+from structured_log_alerting.synthetic import FIELDNAMES, SyntheticLogGenerator
+from structured_log_alerting.windows import TumblingWindows
+
+
+START = 1549573860
+
+HEADER = '"remotehost","rfc931","authuser","date","request","status","bytes"\n'
+
+
+def write_log(path, timestamps, section="api"):
+    with open(path, "w") as f:
+        f.write(HEADER)
+        for timestamp in timestamps:
+            f.write(
+                f'"10.0.0.1","-","apache",{START + timestamp},"GET /{section}/user HTTP/1.0",200,1234\n'
+            )
+    return str(path)
+
+
+@pytest.fixture
+def log_directory(tmp_path):
+    write_log(tmp_path / "web1.csv", [1, 4, 7, 10])
+    write_log(tmp_path / "web2.csv", [2, 5, 8], section="report")
+    write_log(tmp_path / "web3.example.com.csv", [3, 6, 9])
+    (tmp_path / "archived").mkdir()
+
+    return tmp_path
+
+
+def test_expand_locations_finds_files_directories_and_globs(log_directory):
+    web1 = str(log_directory / "web1.csv")
+    web2 = str(log_directory / "web2.csv")
+    web3 = str(log_directory / "web3.example.com.csv")
+
+    assert expand_locations([str(log_directory)]) == [web1, web2, web3]
+    assert expand_locations([str(log_directory / "web[12].csv")]) == [web1, web2]
+    assert expand_locations([web2, str(log_directory / "*.csv")]) == [web2, web1, web3]
+
+
+def test_expand_locations_rejects_empty_directories_and_globs(log_directory):
+    with pytest.raises(ValueError):
+        expand_locations([str(log_directory / "archived")])
+    with pytest.raises(ValueError):
+        expand_locations([str(log_directory / "*.log")])
+
+
+def test_hosts_for_names_hosts_after_files():
+    assert hosts_for(["a/web1.csv", "b/web1.csv", "web.example.com.csv"]) == [
+        "web1",
+        "web1_2",
+        "web_example_com",
+    ]
+
+
+def test_merged_log_reader_merges_by_timestamp(log_directory):
+    reader = MergedLogReader(expand_locations([str(log_directory)]))
+    try:
+        lines = list(reader)
+    finally:
+        reader.close()
+
+    assert reader.fieldnames == FIELDNAMES
+    assert [int(line["date"]) - START for line in lines] == list(range(1, 11))
+    assert [line["host"] for line in lines[:3]] == ["web1", "web2", "web3_example_com"]
+    assert reader.line_num == 10
+
+
+@pytest.mark.parametrize("buffered_lines", [1, 5, 100000])
+def test_merged_log_reader_bounds_buffered_lines(tmp_path, buffered_lines):
+    paths = []
+    for host in range(4):
+        generator = SyntheticLogGenerator(requests_per_second=5, seed=host)
+        path = tmp_path / f"web{host}.csv"
+        with open(path, "w") as f:
+            generator.write_csv(f, 60)
+        paths.append(str(path))
+
+    reader = MergedLogReader(paths, buffered_lines=buffered_lines)
+    try:
+        timestamps = [int(line["date"]) for line in reader]
+    finally:
+        reader.close()
+
+    assert len(timestamps) == 4 * 5 * 60
+    assert reader.batch_size * reader.batches_per_source * len(paths) <= max(
+        buffered_lines, len(paths)
+    )
+
+
+@pytest.mark.parametrize("decompress_in_thread", [False, True])
+def test_merged_log_reader_bounds_buffered_bytes(tmp_path, decompress_in_thread):
+    paths = [write_log(tmp_path / f"web{host}.csv", [host]) for host in range(8)]
+    reader = MergedLogReader(
+        paths,
+        buffered_bytes=1 << 20,
+        buffering=1 << 20,
+        decompress_in_thread=decompress_in_thread,
+    )
+    try:
+        assert len(list(reader)) == 8
+    finally:
+        reader.close()
+
+    buffers = 5 if decompress_in_thread else 1
+    assert reader.buffering * buffers * len(paths) <= 1 << 20
+    # however many files, each one gets at least a default sized buffer
+    assert (
+        MergedLogReader(paths * 1000, label_hosts=False).buffering
+        == io.DEFAULT_BUFFER_SIZE
+    )
+
+
+def test_merged_log_reader_raises_read_errors(log_directory):
+    reader = MergedLogReader(
+        [str(log_directory / "web1.csv"), str(log_directory / "missing.csv")]
+    )
+    try:
+        with pytest.raises(FileNotFoundError):
+            list(reader)
+    finally:
+        reader.close()
+
+
+def test_merged_log_reader_can_be_closed_early(tmp_path):
+    generator = SyntheticLogGenerator(requests_per_second=50)
+    paths = []
+    for host in range(2):
+        path = tmp_path / f"web{host}.csv"
+        with open(path, "w") as f:
+            generator.write_csv(f, 600)
+        paths.append(str(path))
+
+    reader = MergedLogReader(paths, buffered_lines=100, batch_size=10)
+    next(iter(reader))
+    reader.close()
+
+    assert not any(thread.is_alive() for thread in reader.threads)
+
+
+def test_merged_lines_are_kept_in_series_per_host(log_directory):
+    counters_collection = CountersCollection()
+    with open_logs([str(log_directory)]) as reader:
+        parser = Parser(reader.fieldnames, lambda message: None)
+        for line in reader:
+            counters_collection.add_or_update_series(*parser.parse_log_line(line))
+
+    assert list(counters_collection.series) == [
+        "web1.api.200",
+        "web2.report.200",
+        "web3_example_com.api.200",
+    ]
+    assert counters_collection.series["web2.report.200"].labels["host"] == "web2"
+    assert counters_collection.label_index[("host", "web1")] == ["web1.api.200"]
+
+
+def test_hosts_are_left_out_of_namespaces(tmp_path):
+    write_log(tmp_path / "server500.csv", [1, 2])
+    write_log(tmp_path / "web1.csv", [3])
+    counters_collection = CountersCollection()
+    windows = TumblingWindows(["500"])
+    with open_logs([str(tmp_path)]) as reader:
+        parser = Parser(reader.fieldnames, lambda message: None)
+        for line in reader:
+            metric_name, parsed_log_line = parser.parse_log_line(line)
+            counters_collection.add_or_update_series(metric_name, parsed_log_line)
+            windows.add(metric_name, parsed_log_line)
+
+    end = datetime.fromtimestamp(START + 3)
+    assert counters_collection.total_count_since(end, 10, "500") == 0
+    assert counters_collection.total_count_since(end, 10, "200") == 3
+    assert counters_collection.total_count_since(end, 10, "web1") == 0
+    assert windows.counter_counts == {}
+
+
+def test_open_logs_reads_a_single_file_as_is(log_directory):
+    with open_logs([str(log_directory / "web1.csv")]) as reader:
+        lines = list(reader)
+
+    assert [int(line["date"]) - START for line in lines] == [1, 4, 7, 10]
+    assert "host" not in lines[0]
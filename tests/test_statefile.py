@@ -0,0 +1,149 @@
+import os
+from datetime import timedelta
+
+import pytest
+
+from structured_log_alerting.columnarcollection import ColumnarCountersCollection
+from structured_log_alerting.metricscollection import CountersCollection
+from structured_log_alerting.statefile import StateWriter, load_state, write_state
+
+
+@pytest.fixture(params=[CountersCollection, ColumnarCountersCollection])
+def counters_collection(
+    request,
+    api_200_metric_name,
+    api_200_parsed_log,
+    api_200_newer_parsed_log,
+    report_200_metric_name,
+    report_200_parsed_log,
+    report_404_metric_name,
+    report_404_parsed_log,
+):
+    counters_collection = request.param()
+    counters_collection.add_or_update_series(api_200_metric_name, api_200_parsed_log)
+    counters_collection.add_or_update_series(
+        api_200_metric_name, api_200_newer_parsed_log, 2
+    )
+    counters_collection.add_or_update_series(
+        report_200_metric_name, report_200_parsed_log
+    )
+    counters_collection.add_or_update_series(
+        report_404_metric_name, report_404_parsed_log, 5
+    )
+
+    return counters_collection
+
+
+@pytest.fixture
+def most_recent_time(api_200_newer_parsed_log):
+    return api_200_newer_parsed_log["date"]
+
+
+def test_state_round_trips(counters_collection, most_recent_time, tmp_path):
+    path = str(tmp_path / "state")
+    size = write_state(counters_collection, path)
+    loaded = load_state(path)
+
+    assert os.path.getsize(path) == size
+    assert type(loaded) is type(counters_collection)
+    assert loaded.sections == counters_collection.sections
+    assert loaded.label_index == counters_collection.label_index
+    assert {name: series.total for name, series in loaded.series.items()} == {
+        "api.200": 3,
+        "report.200": 1,
+        "report.404": 5,
+    }
+    assert (
+        loaded.series["api.200"].labels == counters_collection.series["api.200"].labels
+    )
+    assert loaded.total_counts_by_label(
+        most_recent_time, 10
+    ) == counters_collection.total_counts_by_label(most_recent_time, 10)
+    assert loaded.total_count_since(most_recent_time, 10, "report") == 6
+
+
+def test_labels_are_interned_again(counters_collection, tmp_path):
+    path = str(tmp_path / "state")
+    write_state(counters_collection, path)
+    loaded = load_state(path)
+
+    api, report = loaded.series["api.200"], loaded.series["report.200"]
+    assert dict(api.label_pairs)["status"] is dict(report.label_pairs)["status"]
+    assert loaded.intern_labels(api.labels) is api.label_pairs
+
+
+def test_a_warm_started_collection_keeps_ingesting(
+    counters_collection,
+    most_recent_time,
+    api_200_metric_name,
+    api_200_newer_parsed_log,
+    tmp_path,
+):
+    path = str(tmp_path / "state")
+    write_state(counters_collection, path)
+    loaded = load_state(path)
+
+    later = dict(api_200_newer_parsed_log, date=most_recent_time + timedelta(seconds=1))
+    loaded.add_or_update_series(api_200_metric_name, later)
+    new_section = dict(later, section="search", endpoint="/search")
+    loaded.add_or_update_series("search.200", new_section)
+
+    assert loaded.series["api.200"].total == 4
+    assert loaded.total_counts_by_label(later["date"], 10) == {
+        "api": 4,
+        "report": 6,
+        "search": 1,
+    }
+    # and none of that made it back into the file
+    assert load_state(path).series["api.200"].total == 3
+
+
+def test_writes_replace_the_file_whole(counters_collection, tmp_path):
+    path = str(tmp_path / "state")
+    write_state(CountersCollection(), path)
+    # the old file stays mapped while it's replaced
+    loaded = load_state(path)
+    write_state(counters_collection, path)
+
+    assert len(loaded.series) == 0
+    assert len(load_state(path).series) == 3
+    assert os.listdir(tmp_path) == ["state"]
+
+
+def test_columnar_matrices_are_used_in_place(
+    api_200_metric_name, api_200_parsed_log, tmp_path
+):
+    counters_collection = ColumnarCountersCollection()
+    counters_collection.add_or_update_series(api_200_metric_name, api_200_parsed_log)
+    path = str(tmp_path / "state")
+    write_state(counters_collection, path)
+    loaded = load_state(path)
+
+    assert isinstance(loaded.counts, memoryview)
+    assert loaded.newest_second == counters_collection.newest_second
+    assert loaded.snapshot().totals == counters_collection.totals
+
+
+def test_bad_state_files_are_rejected(counters_collection, tmp_path):
+    path = str(tmp_path / "state")
+    with open(path, "wb") as file:
+        file.write(b"not a state file at all, really not at all")
+    with pytest.raises(ValueError):
+        load_state(path)
+
+    write_state(counters_collection, path)
+    with open(path, "r+b") as file:
+        file.truncate(os.path.getsize(path) - 4)
+    with pytest.raises(ValueError):
+        load_state(path)
+
+
+def test_state_writer_writes_periodically(counters_collection, tmp_path):
+    path = str(tmp_path / "state")
+    state_writer = StateWriter(path, interval=0, ticks_between_clock_checks=10)
+    for _ in range(9):
+        state_writer.tick(counters_collection)
+    assert not os.path.exists(path)
+
+    state_writer.tick(counters_collection)
+    assert state_writer.bytes_written == os.path.getsize(path)
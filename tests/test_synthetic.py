@@ -0,0 +1,46 @@
+import io
+import csv
+import pytest
+
+from structured_log_alerting.parser import Parser
+from structured_log_alerting.synthetic import FIELDNAMES, SyntheticLogGenerator
+
+
+def test_generator_is_deterministic():
+    first_log = list(SyntheticLogGenerator(seed=1).lines(10))
+    second_log = list(SyntheticLogGenerator(seed=1).lines(10))
+
+    assert first_log == second_log
+
+
+def test_generator_respects_rps_and_cardinality():
+    generator = SyntheticLogGenerator(
+        requests_per_second=7, section_count=8, host_count=3, out_of_order_ratio=0
+    )
+    lines = list(generator.lines(10))
+
+    assert len(lines) == 70
+    assert len({line["remotehost"] for line in lines}) <= 3
+    assert {line["request"].split("/")[1].split(" ")[0] for line in lines} <= set(
+        generator.sections
+    )
+    assert [line["date"] for line in lines] == sorted(line["date"] for line in lines)
+
+
+def test_generator_pushes_some_lines_out_of_order():
+    lines = list(SyntheticLogGenerator(out_of_order_ratio=0.5).lines(10))
+    timestamps = [int(line["date"]) for line in lines]
+
+    assert timestamps != sorted(timestamps)
+
+
+def test_generator_writes_parseable_csv():
+    output = io.StringIO()
+    line_count = SyntheticLogGenerator().write_csv(output, 5)
+    output.seek(0)
+    reader = csv.DictReader(output)
+    parser = Parser(reader.fieldnames)
+    parsed_lines = [parser.parse_log_line(line) for line in reader]
+
+    assert reader.fieldnames == FIELDNAMES
+    assert len(parsed_lines) == line_count
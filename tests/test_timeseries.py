@@ -80,3 +80,13 @@ def test_counter_returns_count_since_time(
     count = counter.total_count_since(current_time, 10)
 
     assert count == len(sample_timestamps)
+
+
+def test_counter_stores_labels_as_shareable_pairs(sample_name, sample_labels):
+    label_pairs = tuple(sample_labels.items())
+    first_counter = CounterSeries(sample_name, label_pairs)
+    second_counter = CounterSeries(sample_name, label_pairs)
+
+    assert first_counter.label_pairs is second_counter.label_pairs
+    assert first_counter.labels == sample_labels
+    assert not hasattr(first_counter, "__dict__")
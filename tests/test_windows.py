@@ -0,0 +1,90 @@
+from datetime import timedelta
+
+import pytest
+
+from structured_log_alerting.alertmanager import AlertManager
+from structured_log_alerting.metricscollection import CountersCollection
+from structured_log_alerting.parser import Parser
+from structured_log_alerting.selfmetrics import SelfMetrics
+from structured_log_alerting.synthetic import FIELDNAMES, SyntheticLogGenerator
+from structured_log_alerting.windows import TumblingWindows, rollup
+
+
+def at(parsed_log_line, seconds_later=0, section=None):
+    # the fixtures are two seconds before a window starts, so count from
+    # the start of that window
+    moved = dict(
+        parsed_log_line,
+        date=parsed_log_line["date"] + timedelta(seconds=2 + seconds_later),
+    )
+    if section is not None:
+        moved["section"] = section
+    return moved
+
+
+def test_windows_close_on_the_first_line_of_a_later_window(
+    api_200_metric_name, api_200_parsed_log, report_404_metric_name
+):
+    windows = TumblingWindows(["404", "500"])
+    assert windows.add(api_200_metric_name, at(api_200_parsed_log)) is None
+    assert windows.add(api_200_metric_name, at(api_200_parsed_log, 3), 2) is None
+    assert (
+        windows.add(report_404_metric_name, at(api_200_parsed_log, 9, "report"), 4)
+        is None
+    )
+    window = windows.add(api_200_metric_name, at(api_200_parsed_log, 25))
+
+    assert window.end - window.start == timedelta(seconds=9)
+    assert window.start == at(api_200_parsed_log)["date"]
+    assert window.total == 7
+    assert window.section_counts == {"api": 3, "report": 4}
+    assert window.counter_counts == {"404": 4}
+    assert (window.top_section, window.top_count) == ("report", 4)
+    assert list(windows.history) == [window]
+    # the window that had nothing in it is skipped, not written out
+    assert windows.add(api_200_metric_name, at(api_200_parsed_log, 30)).total == 1
+
+
+def test_late_lines_are_not_counted(api_200_metric_name, api_200_parsed_log):
+    self_metrics = SelfMetrics(CountersCollection())
+    windows = TumblingWindows(self_metrics=self_metrics)
+    windows.add(api_200_metric_name, at(api_200_parsed_log, 10))
+    assert windows.add(api_200_metric_name, at(api_200_parsed_log, 9), 3) is None
+
+    assert windows.late_points == 3
+    assert windows.total == 1
+    assert self_metrics.counters["summaries.late_points"] == 3
+    with pytest.raises(ValueError):
+        TumblingWindows(window_in_seconds=0)
+
+
+def test_window_summaries_match_querying_the_collection():
+    parser = Parser(FIELDNAMES, lambda message: None)
+    generator = SyntheticLogGenerator(requests_per_second=10, section_count=4)
+    counters_collection = CountersCollection(max_series_length=1000)
+    alertmanager = AlertManager(counters_collection, ["404", "500"])
+    windows = TumblingWindows(["404", "500"])
+
+    summaries = 0
+    for line in generator.lines(120):
+        metric_name, parsed_log_line = parser.parse_log_line(line)
+        window = windows.add(metric_name, parsed_log_line)
+        if window is not None:
+            # the window is every second up to and including its end,
+            # which is also what ending a query at window.end covers
+            assert alertmanager.summarize_window(
+                window
+            ) == alertmanager.provide_summary_for_interval(window.end)
+            summaries += 1
+        counters_collection.add_or_update_series(metric_name, parsed_log_line)
+
+    assert summaries >= 10
+
+    hour = rollup(windows.history)
+    assert hour.start == windows.history[0].start
+    assert hour.end == windows.history[-1].end
+    assert hour.total == sum(window.total for window in windows.history)
+    assert hour.top_count == max(hour.section_counts.values())
+    assert hour.section_counts[hour.top_section] == hour.top_count
+    with pytest.raises(ValueError):
+        rollup([])